@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Coze 调用准入控制
+所有 Coze 生成（流式接口、后台任务）先在这里排队拿到名额再发请求，生成结束后归还：
+
+- 总并发上限 COZE_MAX_CONCURRENCY（每个 worker 进程）
+- 按 bot 的配额 COZE_BOT_QUOTAS，如 "coach=6,lounge=4"（未设置的 bot 只受总上限约束），
+  避免教练对话占满名额、情感客厅的 AI 一直排不上
+- 公平排队：同一 bot 下按调用方（教练按用户、客厅按房间）分流，流之间用差额轮询（DRR）分配名额，
+  一个用户连续发送也只占自己那一份
+- 排队有上限（COZE_QUEUE_MAX，满时立即拒绝）、等待有时限（COZE_QUEUE_TIMEOUT 秒，超时拒绝）；
+  拒绝时抛出 AdmissionRejected，接口返回 429 或在 SSE 中发送 busy 事件
+- 排队时间、拒绝次数交给 observers（metrics.py 用来汇总指标）
+
+用法：
+    ticket = admission.enqueue('coach', f"user:{user_id}")   # 排队已满时抛出 AdmissionRejected
+    try:
+        ticket.wait()                                       # 等待超时抛出 AdmissionRejected
+        ...调用 Coze...
+    finally:
+        ticket.release()
+
+    with admission.admit('lounge', f"room:{room_id}"):
+        ...调用 Coze...
+"""
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from log import get_logger
+
+log = get_logger('admission')
+
+COZE_MAX_CONCURRENCY = int(os.getenv('COZE_MAX_CONCURRENCY', '8'))
+COZE_BOT_QUOTAS = {
+    bot.strip(): int(value)
+    for bot, _, value in (item.partition('=') for item in os.getenv('COZE_BOT_QUOTAS', '').split(','))
+    if value.strip()
+}
+COZE_QUEUE_MAX = int(os.getenv('COZE_QUEUE_MAX', '64'))
+COZE_QUEUE_TIMEOUT = float(os.getenv('COZE_QUEUE_TIMEOUT', '10'))
+# 每轮给每个流增加的额度；每次调用消耗 1
+DRR_QUANTUM = 1.0
+
+
+class AdmissionRejected(Exception):
+    """未获准调用 Coze（reason：queue_full / timeout）"""
+
+    def __init__(self, bot, reason, retry_after):
+        super().__init__(f"Coze 调用排队被拒绝: {bot} {reason}")
+        self.bot = bot
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# observer(bot, event, **fields)
+#   event='queued'：进入排队
+#   event='admitted'：fields = wait_seconds、queued（是否排过队）
+#   event='rejected'：fields = reason（queue_full / timeout）、wait_seconds
+#   event='cancelled'：排队中被调用方放弃（如客户端断开），fields = wait_seconds
+#   event='released'：归还名额，fields = hold_seconds
+observers = []
+
+
+def _notify(bot, event, **fields):
+    for observer in observers:
+        try:
+            observer(bot, event, **fields)
+        except Exception as e:
+            log.error("准入观察者异常: %s", e)
+
+
+class _Flow:
+    __slots__ = ('key', 'bot', 'waiters', 'deficit')
+
+    def __init__(self, key, bot):
+        self.key = key
+        self.bot = bot
+        self.waiters = deque()
+        self.deficit = 0.0
+
+
+class Ticket:
+    """一次 Coze 调用的名额：enqueue 之后 wait，结束后 release（可重复调用）"""
+
+    __slots__ = ('controller', 'bot', 'flow', 'event', 'state', 'enqueued', 'granted_at')
+
+    def __init__(self, controller, bot, flow):
+        self.controller = controller
+        self.bot = bot
+        self.flow = flow
+        self.event = threading.Event()
+        self.state = 'waiting'   # waiting -> granted -> released / waiting -> rejected / cancelled
+        self.enqueued = time.monotonic()
+        self.granted_at = None
+
+    def wait(self, timeout=None):
+        self.controller._wait(self, self.controller.queue_timeout if timeout is None else timeout)
+        return self
+
+    def release(self):
+        self.controller._release(self)
+
+
+class AdmissionController:
+    def __init__(self, capacity=COZE_MAX_CONCURRENCY, quotas=None, max_queue=COZE_QUEUE_MAX,
+                 queue_timeout=COZE_QUEUE_TIMEOUT):
+        self.capacity = capacity
+        self.quotas = dict(COZE_BOT_QUOTAS if quotas is None else quotas)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._flows = {}          # (bot, key) -> _Flow（只保留有人排队的流）
+        self._active = deque()    # 轮询顺序
+        self._running = 0
+        self._running_by_bot = {}
+        self._waiting = 0
+        self.admitted = 0
+        self.rejected = {'queue_full': 0, 'timeout': 0}
+
+    def _has_room(self, bot):
+        quota = self.quotas.get(bot)
+        return self._running < self.capacity and (quota is None or self._running_by_bot.get(bot, 0) < quota)
+
+    def _retry_after(self):
+        return max(1, math.ceil(self.queue_timeout / 2))
+
+    def _grant(self, ticket):
+        ticket.state = 'granted'
+        ticket.granted_at = time.monotonic()
+        self._running += 1
+        self._running_by_bot[ticket.bot] = self._running_by_bot.get(ticket.bot, 0) + 1
+        self.admitted += 1
+        ticket.event.set()
+
+    def _dispatch(self):
+        """差额轮询：每轮给有人排队的流加 DRR_QUANTUM 额度，额度够就放行队首；bot 配额满的流本轮跳过"""
+        while self._active and self._running < self.capacity:
+            progressed = False
+            for _ in range(len(self._active)):
+                flow = self._active.popleft()
+                if self._has_room(flow.bot):
+                    flow.deficit += DRR_QUANTUM
+                    while flow.waiters and flow.deficit >= 1 and self._has_room(flow.bot):
+                        self._waiting -= 1
+                        self._grant(flow.waiters.popleft())
+                        flow.deficit -= 1
+                        progressed = True
+                if flow.waiters:
+                    self._active.append(flow)
+                else:
+                    del self._flows[(flow.bot, flow.key)]
+                if self._running >= self.capacity:
+                    break
+            if not progressed:
+                break
+
+    def enqueue(self, bot, key):
+        """排队；没有人排队且有空闲名额时直接放行"""
+        with self._lock:
+            if not self._waiting and self._has_room(bot):
+                ticket = Ticket(self, bot, None)
+                self._grant(ticket)
+                admitted = True
+            elif self._waiting >= self.max_queue:
+                self.rejected['queue_full'] += 1
+                rejected = AdmissionRejected(bot, 'queue_full', self._retry_after())
+                admitted = None
+            else:
+                flow = self._flows.get((bot, key))
+                if flow is None:
+                    flow = self._flows[(bot, key)] = _Flow(key, bot)
+                    self._active.append(flow)
+                ticket = Ticket(self, bot, flow)
+                flow.waiters.append(ticket)
+                self._waiting += 1
+                self._dispatch()
+                admitted = False
+        if admitted is None:
+            _notify(bot, 'rejected', reason='queue_full', wait_seconds=0.0)
+            raise rejected
+        if admitted:
+            _notify(bot, 'admitted', wait_seconds=0.0, queued=False)
+        else:
+            _notify(bot, 'queued')
+        return ticket
+
+    def _remove_waiter(self, ticket):
+        flow = ticket.flow
+        flow.waiters.remove(ticket)
+        self._waiting -= 1
+        if not flow.waiters:
+            self._flows.pop((flow.bot, flow.key), None)
+            self._active.remove(flow)
+
+    def _wait(self, ticket, timeout):
+        ticket.event.wait(timeout)
+        with self._lock:
+            if ticket.state == 'waiting':
+                self._remove_waiter(ticket)
+                ticket.state = 'rejected'
+                self.rejected['timeout'] += 1
+                timed_out = True
+            else:
+                timed_out = False
+        waited = (ticket.granted_at or time.monotonic()) - ticket.enqueued
+        if timed_out:
+            _notify(ticket.bot, 'rejected', reason='timeout', wait_seconds=waited)
+            raise AdmissionRejected(ticket.bot, 'timeout', self._retry_after())
+        if ticket.flow is not None:
+            # 直接放行的在 enqueue 时已通知
+            _notify(ticket.bot, 'admitted', wait_seconds=waited, queued=True)
+
+    def _release(self, ticket):
+        with self._lock:
+            state = ticket.state
+            if state == 'granted':
+                ticket.state = 'released'
+                self._running -= 1
+                self._running_by_bot[ticket.bot] -= 1
+                self._dispatch()
+            elif state == 'waiting':
+                self._remove_waiter(ticket)
+                ticket.state = 'cancelled'
+        if state == 'granted':
+            _notify(ticket.bot, 'released', hold_seconds=time.monotonic() - ticket.granted_at)
+        elif state == 'waiting':
+            _notify(ticket.bot, 'cancelled', wait_seconds=time.monotonic() - ticket.enqueued)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'capacity': self.capacity,
+                'quotas': self.quotas,
+                'max_queue': self.max_queue,
+                'queue_timeout': self.queue_timeout,
+                'running': self._running,
+                'running_by_bot': dict(self._running_by_bot),
+                'waiting': self._waiting,
+                'flows': len(self._flows),
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+            }
+
+
+controller = AdmissionController()
+
+
+def enqueue(bot, key):
+    return controller.enqueue(bot, key)
+
+
+@contextmanager
+def admit(bot, key):
+    """排队、等待名额，退出时归还"""
+    ticket = controller.enqueue(bot, key)
+    try:
+        ticket.wait()
+        yield ticket
+    finally:
+        ticket.release()
+
+
+def stats():
+    return dict(controller.stats(), pid=os.getpid())
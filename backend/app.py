@@ -1,7 +1,27 @@
 # -*- coding: utf-8 -*-
 from flask import Flask, request, jsonify, render_template, session, Response, stream_with_context
 from flask_cors import CORS
-from storage_supabase import User, Relationship, CoachChat, LoungeChat
+import storage
+import sqlite_checkpoint
+import storage_dualwrite
+from storage import User, Relationship, CoachChat, LoungeChat, batch
+from storage_cache import install_cache, cache_stats
+import coach_context
+import coze_context
+from circuit_breaker import CircuitOpenError, RollingWindowBreaker
+import request_timing
+from request_timing import timed, timed_post, timed_lines
+import metrics
+import jobs
+import admission
+import idempotency
+import history_transfer
+from coze_reply import clean_reply
+from tokens import write_token_counts
+import sse
+import serializer
+import log as applog
+from log import get_logger
 from datetime import datetime, timedelta
 from functools import wraps
 import secrets
@@ -16,7 +36,34 @@ from dotenv import load_dotenv
 # 加载环境变量
 load_dotenv()
 
+log = get_logger('app')
+coze_log = get_logger('coze')
+coze_stream_log = get_logger('coze.stream')  # 原始 SSE 行，默认不输出（LOG_LEVELS=coze.stream=DEBUG 打开）
+coach_log = get_logger('coach')
+lounge_log = get_logger('lounge')
+
+
+def install_storage(backend):
+    """给存储模块装上应用使用的各层包装（按顺序，重复调用无效）；测试换用其他后端时也调用它，保持同样的接线"""
+    # 双写 / 影子读（DUALWRITE_SECONDARY 为空时关闭）：装在缓存之前，只复制、比较真正落到后端的调用
+    storage_dualwrite.install(backend)
+    # 用户、关系等热点读取走读穿缓存（STORAGE_CACHE_ENABLED=0 关闭；内存后端声明了 CACHEABLE = False，不装）
+    install_cache(backend)
+    # 教练最近对话写穿到内存环形缓冲（构造上下文不查询存储，COACH_CONTEXT_ENABLED=0 关闭）
+    coach_context.install(backend)
+    # 存储调用计时（Server-Timing / 慢请求记录）
+    request_timing.instrument_storage(backend)
+
+
+install_storage(storage.backend)
+# SQLite 本地工作副本定期写回持久化目录（SQLITE_LOCAL_PATH 为空时什么都不做）
+sqlite_checkpoint.start(storage.backend)
+
 app = Flask(__name__)
+serializer.init_app(app)
+request_timing.init_app(app)
+metrics.init_app(app)
+idempotency.init_app(app)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', secrets.token_hex(32))
 app.config['JSON_AS_ASCII'] = False  # 支持中文 JSON 响应
 
@@ -41,6 +88,40 @@ CORS(app, supports_credentials=True, origins=[
 ])
 
 
+@app.errorhandler(CircuitOpenError)
+def handle_circuit_open(e):
+    """数据服务 / Coze 熔断中：快速返回 503，不占用 worker 等待超时"""
+    message = 'AI 服务暂时不可用，请稍后重试' if e.name == 'coze' else '数据服务暂时不可用，请稍后重试'
+    response = jsonify({'success': False, 'message': message})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, int(e.retry_after or 0)))
+    return response
+
+
+@app.errorhandler(admission.AdmissionRejected)
+def handle_admission_rejected(e):
+    """Coze 调用排队已满 / 等待超时：返回 429，由客户端稍后重试"""
+    response = jsonify({'success': False, 'message': 'AI 正忙，请稍后重试'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+@app.errorhandler(jobs.JobQueueFull)
+def handle_job_queue_full(e):
+    """AI 任务排队已满：快速返回 503，由客户端稍后重试"""
+    response = jsonify({'success': False, 'message': 'AI 正忙，请稍后重试'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+@app.errorhandler(idempotency.IdempotencyError)
+def handle_idempotency_error(e):
+    """Idempotency-Key 无效（400）、相同请求处理中（409）或与原请求不一致（422）"""
+    return jsonify({'success': False, 'message': e.message}), e.status
+
+
 # ==================== JWT 认证工具 ====================
 def create_token(user_id):
     """创建 JWT Token"""
@@ -52,6 +133,7 @@ def create_token(user_id):
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 
+@timed('auth')
 def get_current_user():
     """获取当前用户（支持 JWT 和 Session 两种方式）"""
     # 优先检查 JWT Token
@@ -87,10 +169,49 @@ def token_required(f):
     return decorated
 
 # Coze API 配置
-COZE_API_URL = "https://api.coze.cn/v3/chat"
+# 可指向本地模拟服务（coze_mock_server.py）做离线压测
+COZE_API_URL = os.getenv("COZE_API_URL", "https://api.coze.cn/v3/chat")
 COZE_API_KEY = os.getenv("COZE_API_KEY", "")
 COZE_BOT_ID_COACH = os.getenv("COZE_BOT_ID_COACH", "")
 COZE_BOT_ID_LOUNGE = os.getenv("COZE_BOT_ID_LOUNGE", "")
+# 连接超时 / 读取超时（两次收到数据之间的最长间隔），连不上时尽快失败
+COZE_TIMEOUT = (float(os.getenv('COZE_CONNECT_TIMEOUT', '5')), float(os.getenv('COZE_READ_TIMEOUT', '60')))
+
+# Coze 熔断：最近窗口内失败率（首字时间超过 COZE_BREAKER_SLOW_TTFT 也算失败）过高时打开，
+# 期间 AI 接口立即返回错误，不再让每个请求等到超时；冷却后放行一个探测请求
+coze_breaker = RollingWindowBreaker(
+    'coze',
+    window=float(os.getenv('COZE_BREAKER_WINDOW', '60')),
+    min_calls=int(os.getenv('COZE_BREAKER_MIN_CALLS', '5')),
+    failure_rate=float(os.getenv('COZE_BREAKER_FAILURE_RATE', '0.5')),
+    slow_call_seconds=float(os.getenv('COZE_BREAKER_SLOW_TTFT', '20')),
+    recovery_timeout=float(os.getenv('COZE_BREAKER_RECOVERY', '30')),
+)
+
+
+def _observe_coze(name, bot, event, **fields):
+    """根据上游调用结果更新 Coze 熔断器"""
+    if name != 'coze':
+        return
+    if event == 'response':
+        status = fields['status']
+        if status is None or status >= 500 or status == 429:
+            coze_breaker.record(False)
+        elif status >= 400:
+            # 4xx 之后不会再读流：上游本身可用，按成功计
+            coze_breaker.record(True)
+    elif event == 'stream':
+        outcome, ttft = fields['outcome'], fields['ttft']
+        if outcome == 'done':
+            coze_breaker.record(True, ttft)
+        elif outcome in ('error', 'incomplete'):
+            coze_breaker.record(False)
+        elif ttft is not None:
+            # 客户端断开与上游无关，只按首字时间判断是否慢调用
+            coze_breaker.record(True, ttft)
+
+
+request_timing.upstream_observers.append(_observe_coze)
 
 # 开场白配置
 COACH_GREETINGS = [
@@ -105,21 +226,59 @@ LOUNGE_GREETINGS = [
     "这里是属于你们的小天地。有我在，你们可以放心地说出心里话。需要帮忙时，@我一下就好～💫"
 ]
 
+# 情感客厅启动接口分页配置
+LOUNGE_BOOTSTRAP_PAGE_SIZE = int(os.getenv('LOUNGE_BOOTSTRAP_PAGE_SIZE', 100))
+LOUNGE_BOOTSTRAP_MAX_PAGE_SIZE = 500
+# 完整聊天记录接口每次从存储读取的条数（流式输出，峰值内存只与这个值有关）
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 200))
+
 def create_coach_greeting(user_id):
     """为新用户创建个人教练开场白"""
     import random
     greeting = random.choice(COACH_GREETINGS)
     greeting_msg = CoachChat(user_id=user_id, role='assistant', content=greeting)
     greeting_msg.save()
-    print(f"[Coach] 已为用户 {user_id} 创建开场白", flush=True)
+    coach_log.info("已为用户 %s 创建开场白", user_id)
 
-def create_lounge_greeting(room_id):
-    """为新房间创建情感客厅开场白"""
+def create_lounge_greeting(room_id, unit=None):
+    """为新房间创建情感客厅开场白（传入 unit 时加入该批量写入，否则立即保存）"""
     import random
     greeting = random.choice(LOUNGE_GREETINGS)
     greeting_msg = LoungeChat(room_id=room_id, user_id=None, role='assistant', content=greeting)
-    greeting_msg.save()
-    print(f"[Lounge] 已为房间 {room_id} 创建开场白", flush=True)
+    if unit is not None:
+        unit.save(greeting_msg)
+    else:
+        greeting_msg.save()
+    lounge_log.info("已为房间 %s 创建开场白", room_id)
+
+# ==================== Coze 调用 ====================
+def coze_post(payload, headers):
+    """发起 Coze 流式请求；熔断打开时抛出 CircuitOpenError，不发请求"""
+    coze_breaker.check()
+    return timed_post('coze', COZE_API_URL, bot=payload['bot_id'], headers=headers, json=payload,
+                      timeout=COZE_TIMEOUT, stream=True)
+
+
+def coze_unavailable():
+    """Coze 熔断打开时返回 CircuitOpenError（不占用探测名额），否则返回 None"""
+    if coze_breaker.state == coze_breaker.OPEN:
+        return CircuitOpenError('coze', retry_after=coze_breaker.retry_after())
+    return None
+
+
+def coze_error_event(e):
+    """熔断期间的 SSE 错误事件"""
+    retry_after = max(1, int(e.retry_after or 0))
+    return sse.event({'type': 'error', 'content': 'AI 服务暂时不可用，请稍后重试', 'retry_after': retry_after})
+
+
+def coze_unavailable_stream(e):
+    """熔断期间的流式接口：立即返回一条错误事件"""
+    return Response(coze_error_event(e), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'Retry-After': str(max(1, int(e.retry_after or 0)))
+    })
+
 
 # ==================== 性能优化工具 ====================
 def save_message_async(message_obj):
@@ -129,14 +288,74 @@ def save_message_async(message_obj):
             start = time.time()
             message_obj.save()
             duration = time.time() - start
-            print(f"[DB Perf] 异步保存耗时: {duration:.3f}s", flush=True)
+            log.debug("异步保存耗时: %.3fs", duration)
         except Exception as e:
-            print(f"[Async Save Error] {e}", flush=True)
-    
+            log.error("异步保存失败: %s", e)
+        finally:
+            metrics.write_done()
+
+    metrics.write_queued()
     thread = threading.Thread(target=_save)
     thread.daemon = True
     thread.start()
 
+
+def get_room_user_map(relationship):
+    """房间两位用户的 ID -> 昵称映射（一次查询，只取展示所需的列）"""
+    slots = [relationship.user1_id, relationship.user2_id]
+    users = User.query('id', 'phone', 'nickname').in_('id', slots).order('id').all()
+    # 优先使用昵称，没有昵称则用手机号后4位；都没有时按在关系中的位置编号（与后端返回顺序无关）
+    return {
+        u.id: u.nickname or (u.phone[-4:] if u.phone else f"用户{slots.index(u.id) + 1}")
+        for u in users
+    }
+
+
+def get_unsent_lounge_messages(room_id, limit=10):
+    """获取最近 limit 条未传给AI的用户消息，按时间顺序返回"""
+    latest = LoungeChat.query().eq('room_id', room_id).eq('role', 'user').eq('sent_to_ai', False) \
+        .order('created_at', desc=True).limit(limit).all()
+    return list(reversed(latest))
+
+
+def iter_history_pages(model, column, value, page_size=None):
+    """
+    按 created_at 顺序分页读取 column=value 的全部记录，每次产出一页 to_dict()
+    每页一次查询；页的最后一个时间戳可能跨页，单独查一次把这个时间戳的记录读完，下一页从它之后开始
+    """
+    page_size = page_size or HISTORY_PAGE_SIZE
+    after = None
+    while True:
+        query = model.query().eq(column, value).order('created_at').order('id').limit(page_size)
+        if after is not None:
+            query = query.gt('created_at', after)
+        rows = query.all()
+        if len(rows) < page_size:
+            yield [row.to_dict() for row in rows]
+            return
+        after = rows[-1].created_at
+        boundary = model.query().eq(column, value).eq('created_at', after).order('id').all()
+        yield [row.to_dict() for row in rows if row.created_at != after] + [row.to_dict() for row in boundary]
+
+
+def history_response(pages):
+    """聊天记录流式输出：默认与 jsonify 相同的 {"success": true, "messages": [...]}，?format=ndjson 时每行一条"""
+    if request.args.get('format') == 'ndjson':
+        return Response(stream_with_context(serializer.ndjson(pages)), mimetype=serializer.NDJSON_MIMETYPE)
+    return Response(stream_with_context(serializer.json_array(pages, {'success': True})), mimetype='application/json')
+
+
+def get_stream_profile(data):
+    """流式档位：请求体 stream_profile 或查询参数 profile（full / summary / content，默认 full）；无效时返回 None"""
+    profile = (data or {}).get('stream_profile') or request.args.get('profile') or sse.DEFAULT_PROFILE
+    return profile if profile in sse.PROFILES else None
+
+
+def admission_busy_event(e):
+    """SSE 已开始后排队超时：发送 busy 事件代替 429"""
+    return sse.event({'type': 'busy', 'content': 'AI 正忙，请稍后重试', 'retry_after': e.retry_after})
+
+
 # Supabase 延迟检测已移除（改用 SQLite）
 
 def call_coze_api(user_phone, message, bot_id, conversation_history=None):
@@ -151,7 +370,11 @@ def call_coze_api(user_phone, message, bot_id, conversation_history=None):
     if not COZE_API_KEY or not bot_id:
         return "AI 服务未配置，请在 .env 文件中设置 COZE_API_KEY 和 BOT_ID。"
 
+    # 准入控制：按 bot 配额、按调用方（Coze user_id）公平排队；被拒绝时抛出 AdmissionRejected
+    bot_name = metrics.bot_label(bot_id)
+    ticket = admission.enqueue(bot_name, f"{bot_name}:{user_phone}")
     try:
+        ticket.wait()
         import json
         headers = {
             'Authorization': f'Bearer {COZE_API_KEY}',
@@ -186,16 +409,14 @@ def call_coze_api(user_phone, message, bot_id, conversation_history=None):
             "additional_messages": messages
         }
 
-        print(f"\n{'='*60}", flush=True)
-        print(f"[Coze API] 发送请求", flush=True)
-        print(f"[Coze API] Payload: {json.dumps(payload, ensure_ascii=False)}", flush=True)
+        coze_log.debug("发送请求", extra={'payload': payload})
 
-        response = requests.post(COZE_API_URL, headers=headers, json=payload, timeout=60, stream=True)
+        response = coze_post(payload, headers)
         response.raise_for_status()
 
         # 检查响应内容类型
         content_type = response.headers.get('Content-Type', '')
-        print(f"[Coze API] 响应 Content-Type: {content_type}", flush=True)
+        coze_log.debug("响应 Content-Type: %s", content_type)
 
         # 处理流式响应
         # 只使用 conversation.message.completed 事件中的完整内容，忽略中间的片段
@@ -203,12 +424,12 @@ def call_coze_api(user_phone, message, bot_id, conversation_history=None):
         has_stream_data = False
         current_event = None  # 跟踪 SSE event 类型
         
-        for line in response.iter_lines():
+        for line in timed_lines('coze', response, bot=payload['bot_id']):
             if line:
                 has_stream_data = True
                 try:
                     line_text = line.decode('utf-8')
-                    print(f"[Coze Stream] {line_text}", flush=True)
+                    coze_stream_log.debug("%s", line_text)
 
                     # 处理 SSE 格式 - event: 行
                     if line_text.startswith('event:'):
@@ -225,7 +446,7 @@ def call_coze_api(user_phone, message, bot_id, conversation_history=None):
                             continue
 
                         try:
-                            data = json.loads(json_str)
+                            data = serializer.loads(json_str)
                         except json.JSONDecodeError:
                             continue
                         
@@ -244,7 +465,7 @@ def call_coze_api(user_phone, message, bot_id, conversation_history=None):
                             msg_type_field = data.get('type')  # answer, follow_up, verbose 等
                             content = data.get('content', '')
                             
-                            print(f"[Coze API] 完成事件: role={role}, type={msg_type_field}, content_len={len(content) if content else 0}", flush=True)
+                            coze_log.debug("完成事件: role=%s, type=%s, content_len=%d", role, msg_type_field, len(content) if content else 0)
                             
                             # 跳过 verbose 类型（内部日志）
                             if msg_type_field == 'verbose':
@@ -254,24 +475,24 @@ def call_coze_api(user_phone, message, bot_id, conversation_history=None):
                                 # 优先使用 answer 类型的回复，follow_up 作为备选
                                 if msg_type_field == 'answer':
                                     completed_content = content
-                                    print(f"[Coze API] 收到 answer 回复，内容长度: {len(content)}", flush=True)
+                                    coze_log.debug("收到 answer 回复，内容长度: %d", len(content))
                                 elif msg_type_field == 'follow_up' and not completed_content:
                                     # 如果还没有 answer，暂存 follow_up
                                     completed_content = content
-                                    print(f"[Coze API] 收到 follow_up 回复，内容长度: {len(content)}", flush=True)
+                                    coze_log.debug("收到 follow_up 回复，内容长度: %d", len(content))
 
                 except UnicodeDecodeError as e:
-                    print(f"[Coze API] 解码错误: {e}", flush=True)
+                    coze_log.warning("解码错误: %s", e)
                     continue
                 except Exception as e:
-                    print(f"[Coze API] 处理流式数据异常: {type(e).__name__}: {e}", flush=True)
+                    coze_log.warning("处理流式数据异常: %s: %s", type(e).__name__, e)
                     continue
         
         # 如果没有收到流式数据，尝试解析为普通 JSON
         if not has_stream_data:
             try:
                 result = response.json()
-                print(f"[Coze API] 非流式响应: {result}", flush=True)
+                coze_log.debug("非流式响应: %s", result)
                 if isinstance(result, dict) and result.get("code") == 0:
                     data = result.get("data", {})
                     if isinstance(data, dict):
@@ -284,66 +505,32 @@ def call_coze_api(user_phone, message, bot_id, conversation_history=None):
                                         completed_content = content
                                         break
             except Exception as e:
-                print(f"[Coze API] 解析非流式响应失败: {e}", flush=True)
+                coze_log.warning("解析非流式响应失败: %s", e)
 
-        # 清理文本：移除可能混入的JSON字符串和重复内容
-        final_content = completed_content
-        if final_content:
-            import re
-            # 移除所有JSON格式的字符串（包括嵌套的）
-            # 匹配 { 开头 } 结尾的JSON对象
-            while True:
-                # 移除简单的JSON对象
-                new_content = re.sub(r'\{[^{}]*"msg_type"[^{}]*\}', '', final_content)
-                # 移除嵌套的JSON对象（处理转义的情况）
-                new_content = re.sub(r'\{[^{}]*"data"[^{}]*"[^{}]*"[^{}]*\}', '', new_content)
-                if new_content == final_content:
-                    break
-                final_content = new_content
-            
-            # 移除多余的空白字符，但保留换行符
-            final_content = re.sub(r'[ ]+', ' ', final_content).strip()
-            
-            # 移除行首和行尾的空格
-            final_content = '\n'.join(line.strip() for line in final_content.split('\n'))
-            
-            # 智能去重：检测并移除重复的句子或段落
-            # 如果内容重复（前一半等于后一半），只保留一半
-            half_len = len(final_content) // 2
-            if half_len > 20:  # 至少20个字符才判断重复
-                if final_content[:half_len] == final_content[half_len:]:
-                    final_content = final_content[:half_len]
-                # 检查是否有明显的重复模式（如连续两次相同）
-                elif len(final_content) > 40:
-                    # 尝试找到重复的句子
-                    sentences = re.split(r'[。！？\n]', final_content)
-                    if len(sentences) > 2:
-                        # 检查是否有连续重复的句子
-                        cleaned_sentences = []
-                        for i, sent in enumerate(sentences):
-                            if i == 0 or sent != sentences[i-1]:
-                                cleaned_sentences.append(sent)
-                        if len(cleaned_sentences) < len(sentences):
-                            final_content = '。'.join(cleaned_sentences)
-        
-        print(f"[Coze API] 完成事件内容长度: {len(completed_content) if completed_content else 0}", flush=True)
-        print(f"[Coze API] 清理后内容长度: {len(final_content) if final_content else 0}", flush=True)
-        print(f"[Coze API] 最终回复: {final_content[:200] if final_content else 'None'}...", flush=True)
-        print(f"{'='*60}\n", flush=True)
+        # 清理文本：移除可能混入的JSON字符串和重复内容（线性时间，见 coze_reply.py）
+        final_content = clean_reply(completed_content)
+
+        coze_log.info("回复完成", extra={'completed_len': len(completed_content) if completed_content else 0,
+                                     'final_len': len(final_content) if final_content else 0})
+        coze_log.debug("最终回复: %s...", final_content[:200] if final_content else None)
 
         if final_content:
             return final_content
         else:
             return "AI 未返回有效回复，请稍后重试"
 
+    except (admission.AdmissionRejected, CircuitOpenError):
+        raise
     except requests.exceptions.Timeout:
         return "AI 响应超时，请稍后再试"
     except requests.exceptions.RequestException as e:
-        print(f"[Coze API] 请求错误: {str(e)}", flush=True)
+        coze_log.error("请求错误: %s", e)
         return f"AI 调用失败: {str(e)}"
     except Exception as e:
-        print(f"[Coze API] 处理异常: {str(e)}", flush=True)
+        coze_log.exception("处理异常: %s", e)
         return f"AI 处理异常: {str(e)}"
+    finally:
+        ticket.release()
 
 # ==================== 用户认证 API ====================
 @app.route('/api/register', methods=['POST'])
@@ -534,12 +721,13 @@ def bind_partner():
         user2_id=max(user.id, partner.id),
         room_id=room_id
     )
-    relationship.save()
-    user.save()
-    partner.save()
-    
-    # 为新房间创建情感客厅开场白
-    create_lounge_greeting(room_id)
+    # 关系、双方用户和开场白一次提交（单次往返、原子）
+    with batch() as unit:
+        unit.save(relationship)
+        unit.save(user)
+        unit.save(partner)
+        # 为新房间创建情感客厅开场白
+        create_lounge_greeting(room_id, unit=unit)
 
     return jsonify({
         'success': True,
@@ -576,8 +764,9 @@ def unbind_partner():
     #     relationship.is_active = False
     #     relationship.save()
 
-    user.save()
-    partner.save()
+    with batch() as unit:
+        unit.save(user)
+        unit.save(partner)
 
     return jsonify({
         'success': True,
@@ -618,8 +807,9 @@ def cancel_unbind():
     #     relationship.is_active = True
     #     relationship.save()
 
-    user.save()
-    partner.save()
+    with batch() as unit:
+        unit.save(user)
+        unit.save(partner)
 
     return jsonify({
         'success': True,
@@ -628,9 +818,49 @@ def cancel_unbind():
 
 
 # ==================== 个人教练聊天室 API ====================
+def job_accepted(job):
+    """提交后台任务后的响应：202 + job_id，结果通过 /api/jobs/<job_id> 获取"""
+    poll_url = f"/api/jobs/{job['id']}"
+    response = jsonify({
+        'success': True,
+        'job_id': job['id'],
+        'status': job['status'],
+        'poll_url': poll_url,
+        'wait_url': f"{poll_url}/wait"
+    })
+    response.status_code = 202
+    response.headers['Location'] = poll_url
+    return response
+
+
+def find_coach_reply(params):
+    """教练任务被接管重跑前检查：用户消息之后已有 AI 回复，说明上次执行已保存，直接返回它"""
+    if not params.get('user_message_id'):
+        return None
+    reply = CoachChat.query('id', 'content').eq('user_id', params['user_id']).eq('role', 'assistant') \
+        .gt('id', params['user_message_id']).order('created_at').limit(1).first()
+    if not reply:
+        return None
+    return {'message': reply.content, 'message_id': reply.id}
+
+
+@jobs.handler('coach_chat', lane='coach', resume=find_coach_reply)
+def run_coach_chat(params):
+    """个人教练后台任务：调用 Coze 并保存 AI 回复"""
+    ai_reply = call_coze_api(
+        user_phone=params['user_phone'],
+        message=params['message'],
+        bot_id=COZE_BOT_ID_COACH,
+        conversation_history=params['history']
+    )
+    ai_msg = CoachChat(user_id=params['user_id'], role='assistant', content=ai_reply)
+    ai_msg.save()
+    return {'message': ai_reply, 'message_id': ai_msg.id}
+
+
 @app.route('/api/coach/chat', methods=['POST'])
 def coach_chat():
-    """个人教练聊天"""
+    """个人教练聊天（后台任务版本：立即返回 job_id，回复通过 /api/jobs/<job_id> 获取）"""
     current_user = get_current_user()
     if not current_user:
         return jsonify({'success': False, 'message': '未登录'}), 401
@@ -641,6 +871,11 @@ def coach_chat():
     if not message:
         return jsonify({'success': False, 'message': '消息不能为空'}), 400
 
+    # Coze 熔断中：直接返回 503，不保存消息、不提交任务
+    unavailable = coze_unavailable()
+    if unavailable:
+        raise unavailable
+
     # 获取用户信息
     user = current_user
     user_id = user.id
@@ -650,28 +885,19 @@ def coach_chat():
     user_msg = CoachChat(user_id=user_id, role='user', content=message)
     user_msg.save()
 
-    # 获取历史对话（最近5条，避免消息过长）
-    all_history = CoachChat.filter(user_id=user_id)
-    all_history.sort(key=lambda x: x.created_at, reverse=True)
-    history = all_history[:5]
-    conversation_history = [{"role": msg.role, "content": msg.content} for msg in reversed(history)]
+    # 获取历史对话（最近5条，含刚保存的这条；活跃用户直接取内存环形缓冲），排除当前消息后按 token 预算取舍
+    conversation_history = coach_context.recent(user_id, 5)
+    context = coze_context.fit_history(conversation_history[:-1])
 
-    # 调用 Coze API
-    ai_reply = call_coze_api(
-        user_phone=user_phone,
-        message=message,
-        bot_id=COZE_BOT_ID_COACH,
-        conversation_history=conversation_history[:-1] if conversation_history else None  # 排除当前消息
-    )
-
-    # 保存 AI 回复
-    ai_msg = CoachChat(user_id=user_id, role='assistant', content=ai_reply)
-    ai_msg.save()
-
-    return jsonify({
-        'success': True,
-        'message': ai_reply
-    })
+    # 调用 Coze API、保存 AI 回复交给后台任务
+    job = jobs.submit('coach_chat', {
+        'user_id': user_id,
+        'user_phone': user_phone,
+        'user_message_id': user_msg.id,
+        'message': message,
+        'history': context.messages or None
+    }, user_id=user_id)
+    return job_accepted(job)
 
 
 @app.route('/api/coach/history', methods=['GET'])
@@ -681,14 +907,26 @@ def get_coach_history():
     if not current_user:
         return jsonify({'success': False, 'message': '未登录'}), 401
 
-    user_id = current_user.id
-    history = CoachChat.filter(user_id=user_id)
-    history.sort(key=lambda x: x.created_at)
+    # 边读边写，不在内存里拼出完整记录
+    return history_response(iter_history_pages(CoachChat, 'user_id', current_user.id))
 
-    return jsonify({
-        'success': True,
-        'messages': [msg.to_dict() for msg in history]
-    })
+
+def export_response(table, value, filename):
+    """聊天记录导出（NDJSON，带检查点行）；?after_id= 从上次收到的检查点之后继续"""
+    after_id = request.args.get('after_id', 0, type=int)
+    lines = history_transfer.export_history(storage.backend, table, value, after_id)
+    return Response(stream_with_context(lines), mimetype=serializer.NDJSON_MIMETYPE,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@app.route('/api/coach/history/export', methods=['GET'])
+def export_coach_history():
+    """导出个人教练聊天记录"""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({'success': False, 'message': '未登录'}), 401
+
+    return export_response('coach_chats', current_user.id, f"coach_{current_user.id}.ndjson")
 
 
 @app.route('/api/debug/config', methods=['GET'])
@@ -702,21 +940,57 @@ def debug_config():
             'COZE_BOT_ID_COACH': COZE_BOT_ID_COACH or '未配置',
             'COZE_BOT_ID_LOUNGE': COZE_BOT_ID_LOUNGE or '未配置',
             'COZE_API_URL': COZE_API_URL,
-            'DB_PATH': DB_PATH,
-            'FLASK_ENV': os.getenv('FLASK_ENV', 'development')
-        }
+            'STORAGE_BACKEND': storage.STORAGE_BACKEND,
+            'DB_PATH': storage.describe()['db_path'],
+            'FLASK_ENV': os.getenv('FLASK_ENV', 'development'),
+            'JSON_SERIALIZER': serializer.stats()
+        },
+        'coze_breaker': coze_breaker.stats(),
+        'logging': applog.stats()
+    })
+
+
+@app.route('/api/debug/storage', methods=['GET'])
+def debug_storage():
+    """调试接口：数据库传输层状态（连接池、重试、熔断）、缓存和教练上下文缓冲命中情况、双写 / 影子读对比、
+    SQLite 检查点写回状态"""
+    return jsonify({
+        'success': True,
+        'storage': storage.describe(),
+        'transport': storage.transport_stats(),
+        'cache': cache_stats(),
+        'coach_context': coach_context.stats(),
+        'dualwrite': storage_dualwrite.stats(),
+        'checkpoint': sqlite_checkpoint.stats()
+    })
+
+
+@app.route('/api/debug/jobs', methods=['GET'])
+def debug_jobs():
+    """调试接口：后台任务通道（并发、排队）、各状态任务数、Coze 准入控制状态和幂等记录"""
+    return jsonify({'success': True, 'jobs': jobs.stats(), 'admission': admission.stats(),
+                    'idempotency': idempotency.stats()})
+
+
+@app.route('/api/debug/timings', methods=['GET'])
+def debug_timings():
+    """调试接口：本 worker 最近的慢请求 / 抽样请求耗时分解（?limit=&min_ms=&path=）"""
+    limit = request.args.get('limit', 50, type=int)
+    min_ms = request.args.get('min_ms', 0, type=float)
+    return jsonify({
+        'success': True,
+        'timing': request_timing.stats(),
+        'requests': request_timing.buffer.query(limit=limit, min_ms=min_ms, path=request.args.get('path'))
     })
 
 
 @app.route('/api/coach/chat/stream', methods=['POST'])
 def coach_chat_stream():
-    """个人教练流式聊天 - 实时推送思考过程和正文"""
-    print(f"\n{'='*60}", flush=True)
-    print(f"[Coach Stream] 收到流式聊天请求", flush=True)
+    """个人教练流式聊天 - 实时推送思考过程和正文（stream_profile：full / summary / content）"""
 
     current_user = get_current_user()
     if not current_user:
-        print(f"[Coach Stream] 用户未登录", flush=True)
+        coach_log.debug("流式聊天：用户未登录")
         return jsonify({'success': False, 'message': '未登录'}), 401
 
     user = current_user
@@ -725,42 +999,53 @@ def coach_chat_stream():
 
     data = request.json
     message = data.get('message')
-    print(f"[Coach Stream] 用户ID: {user_id}", flush=True)
-    print(f"[Coach Stream] 消息内容: {message[:50]}..." if len(message) > 50 else f"[Coach Stream] 消息内容: {message}", flush=True)
 
     if not message:
-        print(f"[Coach Stream] 消息为空", flush=True)
         return jsonify({'success': False, 'message': '消息不能为空'}), 400
 
-    # 用户信息已获取
-    print(f"[Coach Stream] 用户手机号: {user_phone}", flush=True)
-    print(f"[Coach Stream] 用户手机号: {user_phone}", flush=True)
+    profile = get_stream_profile(data)
+    if profile is None:
+        return jsonify({'success': False, 'message': 'stream_profile 无效'}), 400
+
+    # 带 Idempotency-Key 的重试：不保存消息、不调用 Coze，回放（跟读）原请求的流
+    claim = idempotency.claim(user_id, stream=True)
+    if claim is not None and claim.duplicate:
+        return claim.replay()
 
-    # 异步保存用户消息（不阻塞）
-    print(f"[Coach Stream] 开始保存用户消息到数据库...", flush=True)
+    # Coze 熔断中：立即返回错误事件（不保存消息、不排队）
+    unavailable = coze_unavailable()
+    if unavailable:
+        return coze_unavailable_stream(unavailable)
+
+    # 准入控制：排队已满时直接返回 429（不保存消息），排队等待放到流里
+    ticket = admission.enqueue('coach', f"coach:{user_phone}")
+
+    # 异步保存用户消息（不阻塞）；先放入环形缓冲，保存完成前构造的上下文也包含这条
     user_msg = CoachChat(user_id=user_id, role='user', content=message)
+    coach_context.pending(user_msg)
     save_message_async(user_msg)
-    print(f"[Coach Stream] 用户消息已提交异步保存", flush=True)
 
-    # 获取历史对话（最近5条）
-    print(f"[Coach Stream] 开始读取历史对话...", flush=True)
-    all_history = CoachChat.filter(user_id=user_id)
-    print(f"[Coach Stream] 数据库返回历史记录数: {len(all_history)}", flush=True)
-    all_history.sort(key=lambda x: x.created_at, reverse=True)
-    history = all_history[:5]
-    conversation_history = [{"role": msg.role, "content": msg.content} for msg in reversed(history)]
-    print(f"[Coach Stream] 构建对话历史完成，共 {len(conversation_history)} 条", flush=True)
+    # 获取历史对话（最近5条，含当前消息；活跃用户直接取内存环形缓冲）
+    conversation_history = coach_context.recent(user_id, 5)
+    context = coze_context.fit_history(conversation_history[:-1])  # 排除当前消息，按 token 预算取舍
+    coach_log.info("收到流式聊天请求", extra={'user_id': user_id, 'message_len': len(message),
+                                          'history': len(context.messages), 'history_tokens': context.tokens})
 
     def generate():
         """流式生成器"""
-        print(f"[Coach Stream] 进入流式生成器", flush=True)
-        
+        coalescer = sse.Coalescer(profile)
+
         if not COZE_API_KEY or not COZE_BOT_ID_COACH:
-            print(f"[Coach Stream] ❌ AI服务未配置: COZE_API_KEY={bool(COZE_API_KEY)}, BOT_ID={bool(COZE_BOT_ID_COACH)}", flush=True)
-            yield f"data: {json.dumps({'type': 'error', 'content': 'AI 服务未配置'}, ensure_ascii=False)}\n\n"
+            coach_log.error("AI服务未配置: COZE_API_KEY=%s, BOT_ID=%s",
+                            bool(COZE_API_KEY), bool(COZE_BOT_ID_COACH))
+            yield sse.event({'type': 'error', 'content': 'AI 服务未配置'})
+            return
+
+        try:
+            ticket.wait()
+        except admission.AdmissionRejected as e:
+            yield admission_busy_event(e)
             return
-        
-        print(f"[Coach Stream] ✓ API配置检查通过", flush=True)
 
         try:
             headers = {
@@ -770,15 +1055,14 @@ def coach_chat_stream():
 
             # 构建消息列表
             messages = []
-            if conversation_history:
-                for msg in conversation_history[:-1]:  # 排除当前消息
-                    msg_type = "question" if msg["role"] == "user" else "answer"
-                    messages.append({
-                        "role": msg["role"],
-                        "content": msg["content"],
-                        "content_type": "text",
-                        "type": msg_type
-                    })
+            for msg in context.messages:
+                msg_type = "question" if msg["role"] == "user" else "answer"
+                messages.append({
+                    "role": msg["role"],
+                    "content": msg["content"],
+                    "content_type": "text",
+                    "type": msg_type
+                })
 
             messages.append({
                 "role": "user",
@@ -795,16 +1079,11 @@ def coach_chat_stream():
                 "additional_messages": messages
             }
 
-            print(f"[Coach Stream] 准备调用 Coze API", flush=True)
-            print(f"[Coach Stream] API URL: {COZE_API_URL}", flush=True)
-            print(f"[Coach Stream] Bot ID: {COZE_BOT_ID_COACH}", flush=True)
-            print(f"[Coach Stream] User ID: {user_phone}", flush=True)
-            print(f"[Coach Stream] 消息数量: {len(messages)}", flush=True)
+            coach_log.debug("调用 Coze API，消息数量: %d", len(messages))
             
             api_start_time = time.time()
-            response = requests.post(COZE_API_URL, headers=headers, json=payload, timeout=60, stream=True)
-            print(f"[Coach Stream] API响应状态码: {response.status_code}", flush=True)
-            print(f"[Coach Stream] API响应耗时: {time.time() - api_start_time:.3f}s", flush=True)
+            response = coze_post(payload, headers)
+            coach_log.debug("API响应状态码: %s，耗时: %.3fs", response.status_code, time.time() - api_start_time)
             response.raise_for_status()
 
             current_event = None
@@ -813,7 +1092,6 @@ def coach_chat_stream():
             line_count = 0
             
             # 预先创建AI消息记录（边流式边保存策略）
-            print(f"[Coach Stream] 创建AI消息记录...", flush=True)
             ai_msg = CoachChat(
                 user_id=user_id, 
                 role='assistant', 
@@ -822,39 +1100,43 @@ def coach_chat_stream():
             )
             db_save_start = time.time()
             ai_msg.save()  # 先保存一次，获取ID
-            print(f"[Coach Stream] AI消息记录已保存，ID: {ai_msg.id if hasattr(ai_msg, 'id') else 'N/A'}，耗时: {time.time() - db_save_start:.3f}s", flush=True)
+            coach_log.debug("AI消息记录已创建，ID: %s，耗时: %.3fs", ai_msg.id, time.time() - db_save_start)
             last_save_time = time.time()
             save_interval = 2.0  # 每2秒保存一次
             
-            print(f"[Coach Stream] 开始读取流式响应...", flush=True)
 
-            for line in response.iter_lines():
+            for line in timed_lines('coze', response, bot=payload['bot_id']):
+                # 每读到一行上游数据（包括空行、心跳和其他事件）都检查一次：缓冲的增量到时间就发出，
+                # 上游停顿（如模型思考）时不会一直攒到下一个增量
+                frames = coalescer.tick()
+                if frames:
+                    yield frames
                 if line:
                     line_count += 1
                     try:
                         line_text = line.decode('utf-8')
                         
                         if line_count <= 5 or line_count % 10 == 0:  # 只打印前5行和每10行
-                            print(f"[Coach Stream] 第{line_count}行: {line_text[:100]}...", flush=True)
+                            coze_stream_log.debug("第%d行: %s", line_count, line_text[:100])
 
                         # 处理 event: 行
                         if line_text.startswith('event:'):
                             current_event = line_text[6:].strip()
-                            print(f"[Coach Stream] 事件类型: {current_event}", flush=True)
+                            coze_stream_log.debug("事件类型: %s", current_event)
                             continue
 
                         # 处理 data: 行
                         if line_text.startswith('data:'):
                             json_str = line_text[5:].strip()
                             if json_str == '[DONE]' or json_str == '"[DONE]"':
-                                print(f"[Coach Stream] 收到完成信号 [DONE]", flush=True)
+                                coze_stream_log.debug("收到完成信号 [DONE]")
                                 break
 
                             if not json_str:
                                 continue
 
                             try:
-                                data = json.loads(json_str)
+                                data = serializer.loads(json_str)
                             except json.JSONDecodeError:
                                 continue
 
@@ -874,21 +1156,25 @@ def coach_chat_stream():
                                 reasoning = data.get('reasoning_content', '')
                                 if reasoning:
                                     reasoning_content += reasoning
-                                    print(f"[Coach Stream] 收到思考内容，长度: {len(reasoning)}", flush=True)
-                                    yield f"data: {json.dumps({'type': 'reasoning', 'content': reasoning}, ensure_ascii=False)}\n\n"
+                                    coze_stream_log.debug("收到思考内容，长度: %d", len(reasoning))
+                                    frames = coalescer.add('reasoning', reasoning)
+                                    if frames:
+                                        yield frames
 
                                 # 正文内容 (content)
                                 content = data.get('content', '')
                                 if content:
                                     final_content += content
                                     if len(final_content) % 50 < len(content):  # 每50字符打印一次
-                                        print(f"[Coach Stream] 累计正文长度: {len(final_content)}", flush=True)
-                                    yield f"data: {json.dumps({'type': 'content', 'content': content}, ensure_ascii=False)}\n\n"
+                                        coze_stream_log.debug("累计正文长度: %d", len(final_content))
+                                    frames = coalescer.add('content', content)
+                                    if frames:
+                                        yield frames
                                     
                                     # 定期保存（边流式边保存，防止数据丢失）
                                     current_time = time.time()
                                     if current_time - last_save_time >= save_interval:
-                                        print(f"[Coach Stream] 定期保存中间结果...", flush=True)
+                                        coach_log.debug("定期保存中间结果")
                                         ai_msg.content = final_content
                                         ai_msg.reasoning_content = reasoning_content if reasoning_content else None
                                         save_message_async(ai_msg)
@@ -898,13 +1184,13 @@ def coach_chat_stream():
                             elif current_event == 'conversation.message.completed' and role == 'assistant':
                                 if msg_type_field == 'answer':
                                     # 思考完成信号
-                                    yield f"data: {json.dumps({'type': 'reasoning_done'}, ensure_ascii=False)}\n\n"
+                                    yield coalescer.event({'type': 'reasoning_done'})
                                 elif msg_type_field == 'follow_up':
                                     # 跳过 follow_up
                                     pass
 
                     except Exception as e:
-                        print(f"[Stream Error] {e}", flush=True)
+                        coach_log.warning("处理流式数据异常: %s", e)
                         continue
 
             # 最终保存完整内容
@@ -912,20 +1198,24 @@ def coach_chat_stream():
                 ai_msg.content = final_content
                 ai_msg.reasoning_content = reasoning_content if reasoning_content else None
                 ai_msg.save()  # 同步保存最终版本
-                print(f"[Coach Stream] 最终保存内容长度: {len(final_content)}", flush=True)
+                coach_log.info("回复完成，正文长度: %d", len(final_content))
             else:
                 # 如果没有内容，删除之前创建的空记录
-                print(f"[Coach Stream] 未收到AI回复，删除空记录", flush=True)
+                coach_log.warning("未收到AI回复")
 
             # 发送完成信号
-            yield f"data: {json.dumps({'type': 'done', 'final_content': final_content, 'reasoning_content': reasoning_content}, ensure_ascii=False)}\n\n"
+            yield coalescer.event({'type': 'done', 'final_content': final_content,
+                                   'reasoning_content': sse.visible_reasoning(profile, reasoning_content)})
+            coze_stream_log.debug("SSE 合并: %s", coalescer.stats())
 
+        except CircuitOpenError as e:
+            yield coze_error_event(e)
         except Exception as e:
-            print(f"[Stream API Error] {e}", flush=True)
-            yield f"data: {json.dumps({'type': 'error', 'content': str(e)}, ensure_ascii=False)}\n\n"
+            coach_log.error("流式调用失败: %s", e)
+            yield coalescer.event({'type': 'error', 'content': str(e)})
 
-    return Response(
-        stream_with_context(generate()),
+    response = Response(
+        idempotency.record(claim, stream_with_context(generate())),
         mimetype='text/event-stream',
         headers={
             'Cache-Control': 'no-cache',
@@ -933,6 +1223,9 @@ def coach_chat_stream():
             'X-Accel-Buffering': 'no'
         }
     )
+    # 流结束或客户端断开时归还名额（生成器未开始时同样生效）
+    response.call_on_close(ticket.release)
+    return response
 
 
 # ==================== 情感客厅聊天室 API ====================
@@ -948,12 +1241,8 @@ def get_lounge_room():
         return jsonify({'success': False, 'message': '您还没有绑定伴侣'}), 400
 
     # 查找用户相关的活跃关系（user1_id 或 user2_id 等于当前用户）
-    all_relationships = Relationship.all()
-    relationships = [
-        r for r in all_relationships 
-        if (r.user1_id == user.id or r.user2_id == user.id) and r.is_active
-    ]
-    relationship = relationships[0] if relationships else None
+    relationship = Relationship.query('room_id').or_eq(user1_id=user.id, user2_id=user.id) \
+        .eq('is_active', True).order('id').first()
 
     if not relationship:
         return jsonify({'success': False, 'message': '未找到有效的关系'}), 404
@@ -964,32 +1253,116 @@ def get_lounge_room():
     })
 
 
+def lounge_page(room_id, limit, before=None):
+    """
+    情感客厅按时间倒序的一页消息：返回（正序的消息列表，是否还有更早的消息）
+    before 为已显示的最早一条消息时只取它之前的消息，按 (created_at, id) 比较，同一时间戳的消息不会漏掉
+    """
+    if before is None:
+        rows = LoungeChat.query().eq('room_id', room_id) \
+            .order('created_at', desc=True).order('id', desc=True).limit(limit + 1).all()
+    else:
+        rows = LoungeChat.query().eq('room_id', room_id).eq('created_at', before.created_at).lt('id', before.id) \
+            .order('id', desc=True).limit(limit + 1).all()
+        if len(rows) <= limit:
+            rows += LoungeChat.query().eq('room_id', room_id).lt('created_at', before.created_at) \
+                .order('created_at', desc=True).order('id', desc=True).limit(limit + 1 - len(rows)).all()
+    return list(reversed(rows[:limit])), len(rows) > limit
+
+
+@app.route('/api/lounge/bootstrap', methods=['GET'])
+def lounge_bootstrap():
+    """
+    情感客厅启动聚合接口
+
+    一次请求返回：当前用户、伴侣展示信息、房间、最近一页消息和轮询游标，
+    替代进入页面时 /api/user/info、/api/user/<id>、/api/lounge/room、
+    /api/lounge/history 的串行请求（只认证一次、只扫描一次关系表）。
+    各部分是分别读取的，不在同一个事务里；只保证轮询游标和消息页一致。
+    更早的消息按 has_more 用 /api/lounge/history?before_id=<最早一条的 id> 分页加载。
+    """
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({'success': False, 'message': '未登录'}), 401
+
+    user = current_user
+    if not user.partner_id:
+        return jsonify({'success': False, 'message': '您还没有绑定伴侣'}), 400
+
+    limit = request.args.get('limit', LOUNGE_BOOTSTRAP_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, LOUNGE_BOOTSTRAP_MAX_PAGE_SIZE))
+
+    relationship = Relationship.query().or_eq(user1_id=user.id, user2_id=user.id) \
+        .eq('is_active', True).order('id').first()
+
+    if not relationship:
+        return jsonify({'success': False, 'message': '未找到有效的关系'}), 404
+
+    partner_id = relationship.user2_id if relationship.user1_id == user.id else relationship.user1_id
+    partner = User.get(partner_id)
+
+    # 最近一页消息（多取一条判断是否还有更早的消息）；
+    # 轮询游标由同一批数据计算，保证首轮轮询不会漏掉或重复消息
+    page, has_more = lounge_page(relationship.room_id, limit)
+    since_id = max((msg.id for msg in page if msg.id), default=0)
+
+    return jsonify({
+        'success': True,
+        'user': user.to_dict(),
+        'partner': {
+            'id': partner.id,
+            'phone': partner.phone,
+            'nickname': partner.nickname if partner.nickname else (partner.phone[-4:] if len(partner.phone) >= 4 else partner.phone)
+        } if partner else None,
+        'room_id': relationship.room_id,
+        'messages': [msg.to_dict() for msg in page],
+        'has_more': has_more,
+        'since_id': since_id
+    })
+
+
 @app.route('/api/lounge/history', methods=['GET'])
 def get_lounge_history():
-    """获取情感客厅聊天记录"""
+    """获取情感客厅聊天记录；?before_id=<消息 id>&limit=<条数> 时只返回这条消息之前的一页（加载更早的消息）"""
     current_user = get_current_user()
     if not current_user:
         return jsonify({'success': False, 'message': '未登录'}), 401
 
     user = current_user
     # 查找用户相关的关系
-    all_relationships = Relationship.all()
-    relationships = [
-        r for r in all_relationships 
-        if r.user1_id == user.id or r.user2_id == user.id
-    ]
-    relationship = relationships[0] if relationships else None
+    relationship = Relationship.query('room_id').or_eq(user1_id=user.id, user2_id=user.id).order('id').first()
 
     if not relationship:
         return jsonify({'success': False, 'message': '未找到房间'}), 404
 
-    history = LoungeChat.filter(room_id=relationship.room_id)
-    history.sort(key=lambda x: x.created_at)
+    before_id = request.args.get('before_id', type=int)
+    if before_id is not None:
+        before = LoungeChat.get(before_id)
+        if not before or before.room_id != relationship.room_id:
+            return jsonify({'success': False, 'message': '消息不存在'}), 404
+        limit = request.args.get('limit', LOUNGE_BOOTSTRAP_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, LOUNGE_BOOTSTRAP_MAX_PAGE_SIZE))
+        page, has_more = lounge_page(relationship.room_id, limit, before)
+        return jsonify({'success': True, 'messages': [msg.to_dict() for msg in page], 'has_more': has_more})
 
-    return jsonify({
-        'success': True,
-        'messages': [msg.to_dict() for msg in history]
-    })
+    # 边读边写，不在内存里拼出完整记录
+    return history_response(iter_history_pages(LoungeChat, 'room_id', relationship.room_id))
+
+
+@app.route('/api/lounge/history/export', methods=['GET'])
+def export_lounge_history():
+    """导出情感客厅聊天记录"""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({'success': False, 'message': '未登录'}), 401
+
+    user = current_user
+    relationship = Relationship.query('room_id').or_eq(user1_id=user.id, user2_id=user.id).order('id').first()
+
+    if not relationship:
+        return jsonify({'success': False, 'message': '未找到房间'}), 404
+
+    return export_response('lounge_chats', relationship.room_id, f"lounge_{relationship.room_id}.ndjson")
 
 
 @app.route('/api/lounge/messages/new', methods=['GET'])
@@ -1002,20 +1375,14 @@ def get_new_lounge_messages():
     since_id = request.args.get('since_id', 0, type=int)
 
     user = current_user
-    all_relationships = Relationship.all()
-    relationships = [
-        r for r in all_relationships 
-        if r.user1_id == user.id or r.user2_id == user.id
-    ]
-    relationship = relationships[0] if relationships else None
+    relationship = Relationship.query('room_id').or_eq(user1_id=user.id, user2_id=user.id).order('id').first()
 
     if not relationship:
         return jsonify({'success': False, 'message': '未找到房间'}), 404
 
-    # 获取所有消息，筛选出 ID 大于 since_id 的
-    all_messages = LoungeChat.filter(room_id=relationship.room_id)
-    new_messages = [msg for msg in all_messages if msg.id > since_id]
-    new_messages.sort(key=lambda x: x.created_at)
+    # 只查询 ID 大于 since_id 的消息（在数据库端过滤）
+    new_messages = LoungeChat.query().eq('room_id', relationship.room_id).gt('id', since_id) \
+        .order('created_at').all()
 
     return jsonify({
         'success': True,
@@ -1038,6 +1405,11 @@ def send_lounge_message():
     if not content:
         return jsonify({'success': False, 'message': '消息不能为空'}), 400
 
+    # 带 Idempotency-Key 的重试：返回第一次保存的结果，不再重复保存
+    claim = idempotency.claim(user_id)
+    if claim is not None and claim.duplicate:
+        return claim.replay()
+
     # 保存消息
     msg = LoungeChat(room_id=room_id, user_id=user_id, role='user', content=content)
     msg.save()
@@ -1048,10 +1420,91 @@ def send_lounge_message():
     })
 
 
+def lounge_reply_result(ai_msg):
+    """客厅 AI 回复任务的返回内容"""
+    return {
+        'message': {
+            'id': ai_msg.id,
+            'room_id': ai_msg.room_id,
+            'user_id': ai_msg.user_id,
+            'role': ai_msg.role,
+            'content': ai_msg.content,
+            'reasoning_content': ai_msg.reasoning_content,
+            'created_at': ai_msg.created_at.isoformat() if hasattr(ai_msg.created_at, 'isoformat') else str(ai_msg.created_at)
+        }
+    }
+
+
+def find_lounge_reply(params):
+    """
+    客厅任务被接管重跑前检查：提交任务之后房间里已有 AI 回复，说明上次执行已保存（未传消息也已一起标记），
+    直接返回它，不再调用 Coze，也不会因为没有未传消息而多存一条"暂时没有新的对话内容"
+    """
+    if params.get('after_id') is None:
+        return None
+    reply = LoungeChat.query().eq('room_id', params['room_id']).eq('role', 'assistant') \
+        .gt('id', params['after_id']).order('created_at').limit(1).first()
+    return lounge_reply_result(reply) if reply else None
+
+
+@jobs.handler('lounge_call_ai', lane='lounge', resume=find_lounge_reply)
+def run_lounge_call_ai(params):
+    """情感客厅后台任务：把未传给 AI 的消息交给 Coze，标记已传并保存 AI 回复"""
+    room_id = params['room_id']
+    relationship = Relationship.query('user1_id', 'user2_id', 'room_id').eq('room_id', room_id).first()
+    if not relationship:
+        raise LookupError('未找到房间关系')
+
+    user_map = get_room_user_map(relationship)
+
+    # 获取最近10条未传给AI的用户消息（在数据库端过滤和分页），按时间顺序
+    messages_to_send = get_unsent_lounge_messages(room_id)
+
+    missing_tokens = {}
+    if not messages_to_send:
+        ai_reply = "暂时没有新的对话内容可供分析哦～"
+        reasoning_content = None
+    else:
+        # 构建消息内容：昵称：消息内容（按 token 预算取舍，超出时省略较早的消息）
+        context = coze_context.fit_lounge(messages_to_send, user_map)
+        conversation_text = context.text
+        missing_tokens = context.missing
+
+        # 调用 Coze API 并提取思考过程
+        lounge_log.debug("开始调用 Coze API，消息数量: %d", len(messages_to_send))
+        lounge_log.debug("传入内容:\n%s", conversation_text)
+
+        # 调用流式API并提取思考过程和正文
+        ai_reply, reasoning_content = call_coze_api_with_reasoning(
+            user_phone=room_id,
+            message=conversation_text,
+            bot_id=COZE_BOT_ID_LOUNGE
+        )
+
+        lounge_log.info("Coze API 返回，回复长度: %d, 思考长度: %d", len(ai_reply), len(reasoning_content) if reasoning_content else 0)
+
+    # 标记消息已传给AI + 保存AI回复消息（新建，不是更新），一次提交
+    ai_msg = LoungeChat(
+        room_id=room_id,
+        user_id=None,
+        role='assistant',
+        content=ai_reply,
+        reasoning_content=reasoning_content
+    )
+    with batch() as unit:
+        unit.update(LoungeChat, [msg.id for msg in messages_to_send], sent_to_ai=True)
+        write_token_counts(unit, LoungeChat, missing_tokens)
+        unit.save(ai_msg)
+    lounge_log.debug("已标记 %d 条消息为已传给AI", len(messages_to_send))
+    lounge_log.debug("已保存AI回复消息，ID: %s", ai_msg.id)
+
+    return lounge_reply_result(ai_msg)
+
+
 @app.route('/api/lounge/call_ai', methods=['POST'])
 def call_lounge_ai():
     """
-    召唤 AI 助手（短轮询版本 - 非流式）
+    召唤 AI 助手（短轮询版本 - 非流式，后台任务：立即返回 job_id，回复通过 /api/jobs/<job_id> 获取）
 
     ⚠️ 已弃用：前端已改用流式版本 /api/lounge/call_ai/stream
     保留此接口仅为兼容性考虑，新功能请在流式版本中实现
@@ -1060,113 +1513,64 @@ def call_lounge_ai():
     if not current_user:
         return jsonify({'success': False, 'message': '未登录'}), 401
 
-    try:
-        data = request.json
-        room_id = data.get('room_id')
-
-        # 获取房间的两个用户
-        all_relationships = Relationship.all()
-        relationships = [
-            r for r in all_relationships 
-            if r.room_id == room_id
-        ]
-        relationship = relationships[0] if relationships else None
-        
-        if not relationship:
-            return jsonify({'success': False, 'message': '未找到房间关系'}), 404
-        
-        user1 = User.get(relationship.user1_id)
-        user2 = User.get(relationship.user2_id)
-        
-        # 创建用户ID到昵称的映射（优先使用昵称，没有昵称则用手机号后4位）
-        user_map = {
-            user1.id: user1.nickname or (user1.phone[-4:] if user1.phone else "用户1"),
-            user2.id: user2.nickname or (user2.phone[-4:] if user2.phone else "用户2")
-        }
+    data = request.json or {}
+    room_id = data.get('room_id')
 
-        # 获取所有未传给AI的用户消息（按时间顺序）
-        all_history = LoungeChat.filter(room_id=room_id)
-        # 只取用户消息且未传给AI的
-        unsent_messages = [
-            msg for msg in all_history 
-            if msg.role == "user" and not msg.sent_to_ai
-        ]
-        unsent_messages.sort(key=lambda x: x.created_at)
-        
-        # 限制最近10条
-        messages_to_send = unsent_messages[-10:] if len(unsent_messages) > 10 else unsent_messages
+    relationship = Relationship.query('room_id').eq('room_id', room_id).first() if room_id else None
+    if not relationship:
+        return jsonify({'success': False, 'message': '未找到房间关系'}), 404
 
-        if not messages_to_send:
-            ai_reply = "暂时没有新的对话内容可供分析哦～"
-            reasoning_content = None
-        else:
-            # 构建消息内容：昵称：消息内容
-            formatted_messages = []
-            for msg in messages_to_send:
-                nickname = user_map.get(msg.user_id, "未知用户")
-                formatted_messages.append(f"{nickname}：{msg.content}")
-            
-            conversation_text = "\n".join(formatted_messages)
-            
-            # 调用 Coze API 并提取思考过程
-            print(f"[Lounge AI] 开始调用 Coze API，消息数量: {len(messages_to_send)}", flush=True)
-            print(f"[Lounge AI] 传入内容:\n{conversation_text}", flush=True)
-            
-            # 调用流式API并提取思考过程和正文
-            ai_reply, reasoning_content = call_coze_api_with_reasoning(
-                user_phone=room_id,
-                message=conversation_text,
-                bot_id=COZE_BOT_ID_LOUNGE
-            )
-            
-            print(f"[Lounge AI] Coze API 返回，回复长度: {len(ai_reply)}, 思考长度: {len(reasoning_content) if reasoning_content else 0}", flush=True)
-            
-            # 标记这些消息已传给AI
-            for msg in messages_to_send:
-                msg.sent_to_ai = True
-                msg.save()
-            print(f"[Lounge AI] 已标记 {len(messages_to_send)} 条消息为已传给AI", flush=True)
-
-        # 保存AI回复消息（新建，不是更新）
-        ai_msg = LoungeChat(
-            room_id=room_id, 
-            user_id=None, 
-            role='assistant', 
-            content=ai_reply,
-            reasoning_content=reasoning_content
-        )
-        ai_msg.save()
-        print(f"[Lounge AI] 已保存AI回复消息，ID: {ai_msg.id}", flush=True)
-
-        # 手动构建返回数据
-        response_data = {
-            'success': True,
-            'message': {
-                'id': ai_msg.id,
-                'room_id': ai_msg.room_id,
-                'user_id': ai_msg.user_id,
-                'role': ai_msg.role,
-                'content': ai_msg.content,
-                'reasoning_content': ai_msg.reasoning_content,
-                'created_at': ai_msg.created_at.isoformat() if hasattr(ai_msg.created_at, 'isoformat') else str(ai_msg.created_at)
-            }
-        }
-        
-        return jsonify(response_data)
-    
-    except Exception as e:
-        print(f"[Lounge AI Error] {type(e).__name__}: {str(e)}", flush=True)
-        import traceback
-        traceback.print_exc()
-        return jsonify({
-            'success': False,
-            'message': f'AI 调用失败: {str(e)}'
-        }), 500
+    unavailable = coze_unavailable()
+    if unavailable:
+        raise unavailable
+
+    # 记下提交时房间里最新的消息，任务被接管重跑时据此判断上次是否已保存回复
+    latest = LoungeChat.query('id').eq('room_id', room_id).order('created_at', desc=True).limit(1).first()
+    job = jobs.submit('lounge_call_ai', {'room_id': room_id, 'after_id': latest.id if latest else 0},
+                      user_id=current_user.id)
+    return job_accepted(job)
+
+
+# ==================== 后台任务 API ====================
+def _owned_job(job_id, current_user):
+    job = jobs.get_job(job_id)
+    if job is None or job['user_id'] != current_user.id:
+        return None
+    return job
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """查询后台任务状态（status 为 done 时 result 即原接口的返回内容）"""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({'success': False, 'message': '未登录'}), 401
+
+    job = _owned_job(job_id, current_user)
+    if job is None:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    return jsonify({'success': True, 'job': jobs.public_view(job)})
+
+
+@app.route('/api/jobs/<job_id>/wait', methods=['GET'])
+def wait_job_result(job_id):
+    """
+    等待后台任务结束（?timeout= 秒，上限 JOBS_MAX_WAIT_SECONDS），超时返回当前状态
+    等待期间占用一个 worker，客户端可优先用 /api/jobs/<job_id> 轮询
+    """
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({'success': False, 'message': '未登录'}), 401
+
+    if _owned_job(job_id, current_user) is None:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    job = jobs.wait_job(job_id, request.args.get('timeout', jobs.JOBS_MAX_WAIT_SECONDS, type=float))
+    return jsonify({'success': True, 'job': jobs.public_view(job)})
 
 
 @app.route('/api/lounge/call_ai/stream', methods=['POST'])
 def call_lounge_ai_stream():
-    """召唤 AI 助手（流式版本）"""
+    """召唤 AI 助手（流式版本，stream_profile 同教练流式聊天）"""
     current_user = get_current_user()
     if not current_user:
         return jsonify({'success': False, 'message': '未登录'}), 401
@@ -1174,54 +1578,54 @@ def call_lounge_ai_stream():
     data = request.json
     room_id = data.get('room_id')
 
+    profile = get_stream_profile(data)
+    if profile is None:
+        return jsonify({'success': False, 'message': 'stream_profile 无效'}), 400
+
+    # 带 Idempotency-Key 的重试：接上原请求的生成，不再调用 Coze
+    claim = idempotency.claim(current_user.id, stream=True)
+    if claim is not None and claim.duplicate:
+        return claim.replay()
+
+    unavailable = coze_unavailable()
+    if unavailable:
+        return coze_unavailable_stream(unavailable)
+
+    # 准入控制：排队已满时直接返回 429，排队等待放到流里
+    ticket = admission.enqueue('lounge', f"lounge:{room_id}")
+
     def generate():
         """流式生成器"""
+        coalescer = sse.Coalescer(profile)
+        try:
+            ticket.wait()
+        except admission.AdmissionRejected as e:
+            yield admission_busy_event(e)
+            return
+
         try:
             # 获取房间的两个用户
-            all_relationships = Relationship.all()
-            relationships = [
-                r for r in all_relationships 
-                if r.room_id == room_id
-            ]
-            relationship = relationships[0] if relationships else None
+            relationship = Relationship.query('user1_id', 'user2_id', 'room_id').eq('room_id', room_id).first()
             
             if not relationship:
-                yield f"data: {json.dumps({'type': 'error', 'content': '未找到房间关系'}, ensure_ascii=False)}\n\n"
+                yield sse.event({'type': 'error', 'content': '未找到房间关系'})
                 return
             
-            user1 = User.get(relationship.user1_id)
-            user2 = User.get(relationship.user2_id)
-            
-            # 创建用户ID到昵称的映射（优先使用昵称，没有昵称则用手机号后4位）
-            user_map = {
-                user1.id: user1.nickname or (user1.phone[-4:] if user1.phone else "用户1"),
-                user2.id: user2.nickname or (user2.phone[-4:] if user2.phone else "用户2")
-            }
+            user_map = get_room_user_map(relationship)
 
-            # 获取所有未传给AI的用户消息
-            all_history = LoungeChat.filter(room_id=room_id)
-            unsent_messages = [
-                msg for msg in all_history 
-                if msg.role == "user" and not msg.sent_to_ai
-            ]
-            unsent_messages.sort(key=lambda x: x.created_at)
-            
-            messages_to_send = unsent_messages[-10:] if len(unsent_messages) > 10 else unsent_messages
+            # 获取最近10条未传给AI的用户消息
+            messages_to_send = get_unsent_lounge_messages(room_id)
 
             if not messages_to_send:
-                yield f"data: {json.dumps({'type': 'content', 'content': '暂时没有新的对话内容可供分析哦～'}, ensure_ascii=False)}\n\n"
-                yield f"data: {json.dumps({'type': 'done', 'final_content': '暂时没有新的对话内容可供分析哦～', 'reasoning_content': None}, ensure_ascii=False)}\n\n"
+                yield sse.event({'type': 'content', 'content': '暂时没有新的对话内容可供分析哦～'})
+                yield sse.event({'type': 'done', 'final_content': '暂时没有新的对话内容可供分析哦～', 'reasoning_content': None})
                 return
 
-            # 构建消息内容
-            formatted_messages = []
-            for msg in messages_to_send:
-                nickname = user_map.get(msg.user_id, "未知用户")
-                formatted_messages.append(f"{nickname}：{msg.content}")
-            
-            conversation_text = "\n".join(formatted_messages)
-            
-            print(f"[Lounge AI Stream] 开始调用 Coze API", flush=True)
+            # 构建消息内容（按 token 预算取舍，超出时省略较早的消息）
+            context = coze_context.fit_lounge(messages_to_send, user_map)
+            conversation_text = context.text
+
+            lounge_log.debug("流式调用 Coze API")
 
             # 调用 Coze API（流式）
             headers = {
@@ -1242,14 +1646,19 @@ def call_lounge_ai_stream():
                 }]
             }
 
-            response = requests.post(COZE_API_URL, headers=headers, json=payload, timeout=60, stream=True)
+            response = coze_post(payload, headers)
             response.raise_for_status()
 
             current_event = None
             final_content = ""
             reasoning_content = ""
             
-            for line in response.iter_lines():
+            for line in timed_lines('coze', response, bot=payload['bot_id']):
+                # 每读到一行上游数据（包括空行、心跳和其他事件）都检查一次：缓冲的增量到时间就发出，
+                # 上游停顿（如模型思考）时不会一直攒到下一个增量
+                frames = coalescer.tick()
+                if frames:
+                    yield frames
                 if line:
                     try:
                         line_text = line.decode('utf-8')
@@ -1267,7 +1676,7 @@ def call_lounge_ai_stream():
                                 continue
 
                             try:
-                                coze_data = json.loads(json_str)
+                                coze_data = serializer.loads(json_str)
                             except json.JSONDecodeError:
                                 continue
                             
@@ -1288,13 +1697,17 @@ def call_lounge_ai_stream():
                                     reasoning = coze_data.get('reasoning_content', '')
                                     if reasoning:
                                         reasoning_content += reasoning
-                                        yield f"data: {json.dumps({'type': 'reasoning', 'content': reasoning}, ensure_ascii=False)}\n\n"
+                                        frames = coalescer.add('reasoning', reasoning)
+                                        if frames:
+                                            yield frames
                                     
                                     # 正文内容
                                     content = coze_data.get('content', '')
                                     if content:
                                         final_content += content
-                                        yield f"data: {json.dumps({'type': 'content', 'content': content}, ensure_ascii=False)}\n\n"
+                                        frames = coalescer.add('content', content)
+                                        if frames:
+                                            yield frames
 
                             # 处理完成事件
                             elif current_event == 'conversation.message.completed':
@@ -1303,38 +1716,40 @@ def call_lounge_ai_stream():
                                 
                                 if role == 'assistant' and msg_type_field == 'answer':
                                     # 思考完成信号
-                                    yield f"data: {json.dumps({'type': 'reasoning_done'}, ensure_ascii=False)}\n\n"
+                                    yield coalescer.event({'type': 'reasoning_done'})
 
                     except Exception as e:
-                        print(f"[Lounge Stream Error] {e}", flush=True)
+                        lounge_log.warning("处理流式数据异常: %s", e)
                         continue
 
-            # 标记消息已传给AI
-            for msg in messages_to_send:
-                msg.sent_to_ai = True
-                msg.save()
-
-            # 保存AI回复
+            # 标记消息已传给AI + 保存AI回复，一次提交
+            with batch() as unit:
+                unit.update(LoungeChat, [msg.id for msg in messages_to_send], sent_to_ai=True)
+                write_token_counts(unit, LoungeChat, context.missing)
+                if final_content:
+                    ai_msg = unit.save(LoungeChat(
+                        room_id=room_id,
+                        user_id=None,
+                        role='assistant',
+                        content=final_content,
+                        reasoning_content=reasoning_content if reasoning_content else None
+                    ))
             if final_content:
-                ai_msg = LoungeChat(
-                    room_id=room_id,
-                    user_id=None,
-                    role='assistant',
-                    content=final_content,
-                    reasoning_content=reasoning_content if reasoning_content else None
-                )
-                ai_msg.save()
-                print(f"[Lounge AI Stream] 已保存AI回复，ID: {ai_msg.id}", flush=True)
+                lounge_log.info("已保存AI回复，ID: %s", ai_msg.id)
 
             # 发送完成信号
-            yield f"data: {json.dumps({'type': 'done', 'final_content': final_content, 'reasoning_content': reasoning_content}, ensure_ascii=False)}\n\n"
+            yield coalescer.event({'type': 'done', 'final_content': final_content,
+                                   'reasoning_content': sse.visible_reasoning(profile, reasoning_content)})
+            coze_stream_log.debug("SSE 合并: %s", coalescer.stats())
 
+        except CircuitOpenError as e:
+            yield coze_error_event(e)
         except Exception as e:
-            print(f"[Lounge Stream API Error] {e}", flush=True)
-            yield f"data: {json.dumps({'type': 'error', 'content': str(e)}, ensure_ascii=False)}\n\n"
+            lounge_log.error("流式调用失败: %s", e)
+            yield coalescer.event({'type': 'error', 'content': str(e)})
 
-    return Response(
-        stream_with_context(generate()),
+    response = Response(
+        idempotency.record(claim, stream_with_context(generate())),
         mimetype='text/event-stream',
         headers={
             'Cache-Control': 'no-cache',
@@ -1342,6 +1757,8 @@ def call_lounge_ai_stream():
             'X-Accel-Buffering': 'no'
         }
     )
+    response.call_on_close(ticket.release)
+    return response
 
 
 def call_coze_api_with_reasoning(user_phone, message, bot_id):
@@ -1352,7 +1769,10 @@ def call_coze_api_with_reasoning(user_phone, message, bot_id):
     if not COZE_API_KEY or not bot_id:
         return "AI 服务未配置", None
 
+    bot_name = metrics.bot_label(bot_id)
+    ticket = admission.enqueue(bot_name, f"{bot_name}:{user_phone}")
     try:
+        ticket.wait()
         import json
         headers = {
             'Authorization': f'Bearer {COZE_API_KEY}',
@@ -1372,15 +1792,15 @@ def call_coze_api_with_reasoning(user_phone, message, bot_id):
             }]
         }
 
-        print(f"[Coze API] 发送请求（带思考过程提取）", flush=True)
-        response = requests.post(COZE_API_URL, headers=headers, json=payload, timeout=60, stream=True)
+        coze_log.debug("发送请求（带思考过程提取）")
+        response = coze_post(payload, headers)
         response.raise_for_status()
 
         completed_content = None
         reasoning_content = None
         current_event = None
         
-        for line in response.iter_lines():
+        for line in timed_lines('coze', response, bot=payload['bot_id']):
             if line:
                 try:
                     line_text = line.decode('utf-8')
@@ -1398,7 +1818,7 @@ def call_coze_api_with_reasoning(user_phone, message, bot_id):
                             continue
 
                         try:
-                            data = json.loads(json_str)
+                            data = serializer.loads(json_str)
                         except json.JSONDecodeError:
                             continue
                         
@@ -1425,10 +1845,10 @@ def call_coze_api_with_reasoning(user_phone, message, bot_id):
                                     completed_content = content
                                     if reasoning:
                                         reasoning_content = reasoning
-                                    print(f"[Coze API] 收到 answer 回复，正文长度: {len(content)}, 思考长度: {len(reasoning) if reasoning else 0}", flush=True)
+                                    coze_log.debug("收到 answer 回复，正文长度: %d, 思考长度: %d", len(content), len(reasoning) if reasoning else 0)
 
                 except Exception as e:
-                    print(f"[Coze API] 处理流式数据异常: {type(e).__name__}: {e}", flush=True)
+                    coze_log.warning("处理流式数据异常: %s: %s", type(e).__name__, e)
                     continue
 
         if completed_content:
@@ -1436,9 +1856,13 @@ def call_coze_api_with_reasoning(user_phone, message, bot_id):
         else:
             return "AI 未返回有效回复", None
 
+    except (admission.AdmissionRejected, CircuitOpenError):
+        raise
     except Exception as e:
-        print(f"[Coze API] 请求错误: {str(e)}", flush=True)
+        coze_log.error("请求错误: %s", e)
         return f"AI 调用失败: {str(e)}", None
+    finally:
+        ticket.release()
 
 
 # ==================== 前端路由 ====================
@@ -1471,13 +1895,15 @@ def lounge():
     return render_template('lounge_polling.html')
 
 
+# 接管已退出 worker 遗留的后台任务（任务处理函数都已定义后再执行）
+jobs.recover()
+
+
 if __name__ == '__main__':
     import os
 
-    print("\n" + "="*60, flush=True)
-    print("[启动] 使用 Supabase PostgreSQL 数据库", flush=True)
-    print("[启动] 情感客厅使用短轮询方案（无需 WebSocket）", flush=True)
-    print("="*60 + "\n", flush=True)
+    log.info("启动：存储后端 %s", storage.STORAGE_BACKEND)
+    log.info("启动：情感客厅使用短轮询方案（无需 WebSocket）")
 
     debug_mode = os.environ.get('FLASK_ENV') != 'production'
     port = int(os.environ.get('PORT', 7860))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Coze 回复清理基准脚本
+
+对比 coze_reply.clean_reply 与原实现（反复 re.sub 直到不再变化）在大回复（50 KB 以上）上的耗时，
+检查新实现的单字符耗时不随长度增长（线性）。原实现在深层嵌套的 JSON 片段上是平方复杂度，
+只在较小的长度上运行（--legacy-max-kb）。
+
+用法：
+    python bench_coze_reply.py [--sizes 2,4,12,25,50,100,200] [--legacy-max-kb 50] [--check]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+from coze_reply import clean_reply
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'coze')
+# --check：最大长度的单字符耗时不超过最小长度的这么多倍
+LINEAR_TOLERANCE = 3.0
+
+
+def legacy_clean_reply(text):
+    """原 call_coze_api 中的清理逻辑（对照基准，不要修改）"""
+    final_content = text
+    if final_content:
+        while True:
+            new_content = re.sub(r'\{[^{}]*"msg_type"[^{}]*\}', '', final_content)
+            new_content = re.sub(r'\{[^{}]*"data"[^{}]*"[^{}]*"[^{}]*\}', '', new_content)
+            if new_content == final_content:
+                break
+            final_content = new_content
+        final_content = re.sub(r'[ ]+', ' ', final_content).strip()
+        final_content = '\n'.join(line.strip() for line in final_content.split('\n'))
+        half_len = len(final_content) // 2
+        if half_len > 20:
+            if final_content[:half_len] == final_content[half_len:]:
+                final_content = final_content[:half_len]
+            elif len(final_content) > 40:
+                sentences = re.split(r'[。！？\n]', final_content)
+                if len(sentences) > 2:
+                    cleaned_sentences = []
+                    for i, sent in enumerate(sentences):
+                        if i == 0 or sent != sentences[i-1]:
+                            cleaned_sentences.append(sent)
+                    if len(cleaned_sentences) < len(sentences):
+                        final_content = '。'.join(cleaned_sentences)
+    return final_content
+
+
+def recorded_replies():
+    """录制的 Coze 流（fixtures/coze/*.sse）中 completed 事件的正文和思考过程"""
+    replies = []
+    for name in sorted(os.listdir(FIXTURE_DIR)):
+        if not name.endswith('.sse'):
+            continue
+        event = None
+        with open(os.path.join(FIXTURE_DIR, name), encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line.startswith('event:'):
+                    event = line[6:].strip()
+                elif line.startswith('data:') and event == 'conversation.message.completed':
+                    try:
+                        data = json.loads(line[5:])
+                    except json.JSONDecodeError:
+                        continue
+                    for key in ('content', 'reasoning_content'):
+                        if isinstance(data, dict) and isinstance(data.get(key), str) and data[key]:
+                            replies.append(data[key])
+    return replies
+
+
+def make_inputs(size):
+    """各种形态的回复，长度约为 size 个字符"""
+    recorded = '\n\n'.join(recorded_replies()) or '我听到了你的感受。'
+    noisy_unit = ('好的，我明白。 {"msg_type":"generate_answer_finish","data":"","from_module":null}  \n'
+                  '{"data":"{\\"x\\":1}","id":"1"} 我们继续。\n')
+    depth = size // 12
+    return {
+        'recorded': (recorded * (size // len(recorded) + 1))[:size],
+        'noisy': noisy_unit * (size // len(noisy_unit) + 1),
+        'duplicated': (recorded * (size // 2 // len(recorded) + 1))[:size // 2] * 2,
+        'nested': '{' * depth + '"msg_type"' + '}' * depth + '正文' * (size // 2 - depth),
+    }
+
+
+def timed(fn, text, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(text)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Coze 回复清理基准')
+    parser.add_argument('--sizes', default='2,4,12,25,50,100,200', help='回复长度（KB，按字符计），逗号分隔')
+    parser.add_argument('--legacy-max-kb', type=float, default=50, help='原实现只在不超过该长度时运行')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--check', action='store_true', help='单字符耗时增长超过容差时以状态码 1 退出')
+    args = parser.parse_args()
+    sizes = [int(float(kb) * 1024) for kb in args.sizes.split(',')]
+
+    print(f"{'形态':<12}{'长度':>10}{'新实现 ms':>12}{'ns/字符':>10}{'原实现 ms':>12}  一致")
+    failed = False
+    for kind in ('recorded', 'noisy', 'duplicated', 'nested'):
+        per_char = []
+        for size in sizes:
+            text = make_inputs(size)[kind]
+            seconds = timed(clean_reply, text, args.repeat)
+            per_char.append(seconds / len(text))
+            legacy = '-'
+            same = '-'
+            # 嵌套片段在原实现上是平方复杂度，只跑较小的长度
+            legacy_limit = args.legacy_max_kb * 1024 / (10 if kind == 'nested' else 1)
+            if size <= legacy_limit:
+                legacy = f"{timed(legacy_clean_reply, text, 1) * 1000:.2f}"
+                same = '✅' if legacy_clean_reply(text) == clean_reply(text) else '❌'
+                failed = failed or same == '❌'
+            print(f"{kind:<12}{len(text):>10}{seconds * 1000:>12.2f}{seconds / len(text) * 1e9:>10.0f}{legacy:>12}  {same}")
+        growth = per_char[-1] / per_char[0]
+        if growth > LINEAR_TOLERANCE:
+            print(f"  ⚠️ {kind}: 单字符耗时增长 {growth:.1f} 倍")
+            failed = True
+    if args.check and failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+列投影 / 服务端过滤基准脚本
+
+对比热点接口"全表/全列拉取 + Python 过滤"与 Query 构造器下推查询的
+返回数据量（按 PostgREST 的 JSON 编码估算网络传输字节数）和耗时。
+
+用法：
+    python bench_projection.py [--rooms 20] [--messages 2000] [--reasoning 1500]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def setup_storage():
+    """使用临时数据库，避免污染开发数据"""
+    db_dir = tempfile.mkdtemp(prefix='bench_projection_')
+    os.environ['SQLITE_DB_PATH'] = os.path.join(db_dir, 'bench.db')
+    import storage_sqlite
+    return storage_sqlite
+
+
+def payload_bytes(storage, sql, values=()):
+    """执行 SQL 并返回 JSON 编码后的字节数和行数"""
+    conn = storage.get_db_connection()
+    try:
+        rows = [dict(row) for row in conn.execute(sql, values).fetchall()]
+    finally:
+        conn.close()
+    return len(json.dumps(rows, ensure_ascii=False).encode('utf-8')), len(rows)
+
+
+def query_bytes(storage, query):
+    sql, values = query.to_sql()
+    return payload_bytes(storage, sql, values)
+
+
+def timed(fn, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def seed(storage, rooms, messages_per_room, reasoning_len):
+    """写入测试数据：每个房间一对用户，含较长的思考过程"""
+    conn = storage.get_db_connection()
+    now = '2026-01-01T00:00:00'
+    reasoning = '思' * reasoning_len
+    room_ids = []
+    for r in range(rooms):
+        u1 = conn.execute("INSERT INTO users (phone, password, nickname, created_at) VALUES (?, ?, ?, ?)",
+                          (f"bench{r}a", 'x', f'A{r}', now)).lastrowid
+        u2 = conn.execute("INSERT INTO users (phone, password, nickname, created_at) VALUES (?, ?, ?, ?)",
+                          (f"bench{r}b", 'x', f'B{r}', now)).lastrowid
+        room_id = f"room_{u1}_{u2}"
+        room_ids.append((room_id, u1, u2))
+        conn.execute("INSERT INTO relationships (user1_id, user2_id, room_id, is_active, created_at) VALUES (?, ?, ?, 1, ?)",
+                     (u1, u2, room_id, now))
+        rows = []
+        for i in range(messages_per_room):
+            is_ai = i % 5 == 4
+            rows.append((room_id, None if is_ai else random.choice((u1, u2)), 'assistant' if is_ai else 'user',
+                         f'消息内容 {i} ' * 4, reasoning if is_ai else None, 1, f"2026-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}.{i:06d}"))
+        conn.executemany("INSERT INTO lounge_chats (room_id, user_id, role, content, reasoning_content, sent_to_ai, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        coach_rows = [(u1, 'assistant' if i % 2 else 'user', f'教练对话 {i} ' * 8, reasoning if i % 2 else None,
+                       f"2026-01-01T00:00:00.{i:06d}") for i in range(messages_per_room // 4)]
+        conn.executemany("INSERT INTO coach_chats (user_id, role, content, reasoning_content, created_at) VALUES (?, ?, ?, ?, ?)", coach_rows)
+    conn.commit()
+    conn.close()
+    return room_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description='列投影 / 服务端过滤基准')
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=2000, help='每个房间的消息数')
+    parser.add_argument('--reasoning', type=int, default=1500, help='AI 消息思考过程长度（字符）')
+    args = parser.parse_args()
+
+    storage = setup_storage()
+    room_ids = seed(storage, args.rooms, args.messages, args.reasoning)
+    room_id, user_id, _ = room_ids[len(room_ids) // 2]
+    User, Relationship, CoachChat, LoungeChat = storage.User, storage.Relationship, storage.CoachChat, storage.LoungeChat
+
+    last_id = LoungeChat.query('id').eq('room_id', room_id).order('id', desc=True).first().id
+    since_id = last_id - 2
+
+    scenarios = [
+        (
+            '轮询新消息 /api/lounge/messages/new',
+            lambda: payload_bytes(storage, "SELECT * FROM lounge_chats WHERE room_id=? ORDER BY created_at ASC", (room_id,)),
+            lambda: query_bytes(storage, LoungeChat.query().eq('room_id', room_id).gt('id', since_id).order('created_at')),
+        ),
+        (
+            '查找房间（关系表）',
+            lambda: payload_bytes(storage, "SELECT * FROM relationships"),
+            lambda: query_bytes(storage, Relationship.query('room_id').or_eq(user1_id=user_id, user2_id=user_id).order('id').limit(1)),
+        ),
+        (
+            '教练上下文（最近5条）',
+            lambda: payload_bytes(storage, "SELECT * FROM coach_chats WHERE user_id=? ORDER BY created_at ASC", (user_id,)),
+            lambda: query_bytes(storage, CoachChat.query('role', 'content', 'created_at').eq('user_id', user_id).order('created_at', desc=True).limit(5)),
+        ),
+        (
+            '客厅 AI 未发送消息',
+            lambda: payload_bytes(storage, "SELECT * FROM lounge_chats WHERE room_id=? ORDER BY created_at ASC", (room_id,)),
+            lambda: query_bytes(storage, LoungeChat.query().eq('room_id', room_id).eq('role', 'user').eq('sent_to_ai', False).order('created_at', desc=True).limit(10)),
+        ),
+        (
+            '客厅昵称映射',
+            lambda: payload_bytes(storage, "SELECT * FROM users WHERE id IN (?, ?)", (room_ids[0][1], room_ids[0][2])),
+            lambda: query_bytes(storage, User.query('id', 'phone', 'nickname').in_('id', [room_ids[0][1], room_ids[0][2]])),
+        ),
+    ]
+
+    print("=" * 96)
+    print(f"列投影 / 服务端过滤基准：{args.rooms} 个房间 × {args.messages} 条消息，思考过程 {args.reasoning} 字")
+    print("=" * 96)
+    print(f"{'场景':<28}{'之前(行/字节)':>20}{'之后(行/字节)':>18}{'减少':>10}{'之前耗时':>10}{'之后耗时':>10}")
+    total_before = total_after = 0
+    for name, before, after in scenarios:
+        before_bytes, before_rows = before()
+        after_bytes, after_rows = after()
+        total_before += before_bytes
+        total_after += after_bytes
+        reduction = 1 - after_bytes / before_bytes if before_bytes else 0
+        print(f"{name:<24}{before_rows:>10}/{before_bytes:<10}{after_rows:>8}/{after_bytes:<10}{reduction:>9.1%}"
+              f"{timed(before) * 1000:>9.2f}ms{timed(after) * 1000:>8.2f}ms")
+    print("-" * 96)
+    print(f"合计传输：{total_before} → {total_after} 字节（减少 {1 - total_after / total_before:.1%}）")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
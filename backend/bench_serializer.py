@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+JSON 序列化基准脚本
+
+比较标准库 json 与 orjson（已安装时）：
+    1. 历史记录响应：一次性序列化（jsonify 的做法）与流式 JSON 数组，按记录数统计耗时和峰值内存（tracemalloc）
+    2. SSE 帧编码：每帧耗时（合并后的 content 增量、done 事件）
+流式输出的峰值内存只与页大小有关，一次性序列化随记录数线性增长。
+
+用法：
+    python bench_serializer.py [--sizes 100,1000,10000] [--page-size 200] [--repeat 5]
+"""
+import argparse
+import statistics
+import time
+import tracemalloc
+
+import serializer
+import sse
+
+
+def make_rows(n):
+    return [{
+        'id': i,
+        'user_id': 1 + i % 2,
+        'role': 'user' if i % 3 else 'assistant',
+        'content': '最近总是和伴侣因为小事吵架，我不知道该怎么沟通才好。' * (1 + i % 4),
+        'reasoning_content': None if i % 3 else '用户在描述沟通困难，先共情再给出具体建议。' * 3,
+        'created_at': f"2024-05-01T12:{i // 60 % 60:02d}:{i % 60:02d}",
+    } for i in range(n)]
+
+
+def pages_of(rows, page_size):
+    for start in range(0, len(rows), page_size):
+        # 模拟边读边转换：每页重新构造 dict，用完即丢
+        yield [dict(row) for row in rows[start:start + page_size]]
+
+
+def measure(fn, repeat):
+    times = []
+    peak = 0
+    for i in range(repeat):
+        tracemalloc.start()
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return statistics.median(times), peak / 1024
+
+
+def bench_history(sizes, page_size, repeat, backends):
+    print(f"历史记录（页大小 {page_size}，耗时取中位数，峰值内存含 tracemalloc 开销）")
+    print(f"{'记录数':<8}{'实现':<8}{'方式':<8}{'耗时 ms':>10}{'峰值 KB':>12}")
+    for n in sizes:
+        rows = make_rows(n)
+
+        for backend in backends:
+            def whole():
+                serializer.dumpb({'success': True, 'messages': [dict(row) for row in rows]}, backend=backend)
+
+            def streamed():
+                serializer.BACKEND, saved = backend, serializer.BACKEND
+                try:
+                    for _ in serializer.json_array(pages_of(rows, page_size), {'success': True}):
+                        pass
+                finally:
+                    serializer.BACKEND = saved
+
+            for label, fn in (('一次性', whole), ('流式', streamed)):
+                ms, peak = measure(fn, repeat)
+                print(f"{n:<8}{backend:<8}{label:<8}{ms:>10.2f}{peak:>12.0f}")
+
+
+def bench_sse(repeat, backends):
+    frames = [{'type': 'content', 'content': '我听到了你们两个人的感受'}] * 2000
+    done = {'type': 'done', 'final_content': '我听到了你们两个人的感受。' * 40, 'reasoning_content': '先共情。' * 50}
+    print()
+    print("SSE 帧编码（每帧微秒）")
+    print(f"{'实现':<8}{'content 帧':>12}{'done 帧':>12}")
+    saved = serializer.BACKEND
+    try:
+        for backend in backends:
+            serializer.BACKEND = backend
+            results = []
+            for payloads in (frames, [done] * 500):
+                samples = []
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    for payload in payloads:
+                        sse.event(payload)
+                    samples.append((time.perf_counter() - started) * 1e6 / len(payloads))
+                results.append(statistics.median(samples))
+            print(f"{backend:<8}{results[0]:>12.2f}{results[1]:>12.2f}")
+    finally:
+        serializer.BACKEND = saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description='JSON 序列化基准')
+    parser.add_argument('--sizes', default='100,1000,10000', help='历史记录条数，逗号分隔')
+    parser.add_argument('--page-size', type=int, default=200, help='流式输出每页条数（HISTORY_PAGE_SIZE）')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    backends = ['json'] + (['orjson'] if serializer.orjson is not None else [])
+    if serializer.orjson is None:
+        print("未安装 orjson，只测试标准库")
+    bench_history([int(v) for v in args.sizes.split(',')], args.page_size, args.repeat, backends)
+    bench_sse(args.repeat, backends)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SSE 增量合并基准脚本
+
+启动 Coze 模拟服务（回放 fixtures/coze 录制的流），在进程内用 Flask 测试客户端调用
+/api/coach/chat/stream（--profile 选择流式档位），按不同的 SSE_COALESCE_MS 统计每个回答的帧数、字节数、写出次数、
+首字时间（第一个 content 帧）和服务端 CPU 时间（本线程的 CPU 时间，模拟服务在另一个进程里）。
+
+用法：
+    python bench_sse.py [--intervals 0,20,50,100] [--profile full] [--streams 10] [--token-rate 40] [--port 18095]
+"""
+import argparse
+import json
+import os
+import secrets
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_mock(args):
+    cmd = [sys.executable, os.path.join(BACKEND_DIR, 'coze_mock_server.py'), '--port', str(args.port),
+           '--latency', str(args.latency), '--jitter', '0', '--token-rate', str(args.token_rate)]
+    log = open(os.path.join(tempfile.gettempdir(), 'bench_sse_mock.log'), 'w')
+    process = subprocess.Popen(cmd, cwd=BACKEND_DIR, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{args.port}/stats", timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f"模拟服务启动失败，日志见 {log.name}")
+
+
+def setup_app(port):
+    """进程内应用（内存存储），环境变量必须在导入 app 之前设置"""
+    os.environ.update(STORAGE_BACKEND='memory', COZE_API_URL=f"http://127.0.0.1:{port}/v3/chat",
+                      COZE_API_KEY='mock', COZE_BOT_ID_COACH='mock_coach', COZE_BOT_ID_LOUNGE='mock_lounge',
+                      LOG_LEVEL='WARNING', METRICS_ENABLED='0')
+    sys.path.insert(0, BACKEND_DIR)
+    import app as app_module
+    client = app_module.app.test_client()
+    phone = '197' + str(secrets.randbelow(10 ** 8)).zfill(8)
+    client.post('/api/register', json={'phone': phone, 'password': 'pw'}).close()
+    client.post('/api/login', json={'phone': phone, 'password': 'pw'}).close()
+    return client
+
+
+def run_stream(client, profile):
+    started = time.perf_counter()
+    cpu_started = time.thread_time()
+    response = client.post('/api/coach/chat/stream', json={'message': '最近总是和伴侣吵架怎么办', 'stream_profile': profile},
+                           buffered=False)
+    writes = frames = size = 0
+    ttft = None
+    answer = ''
+    for chunk in response.response:
+        chunk = chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+        writes += 1
+        size += len(chunk)
+        for line in chunk.decode('utf-8').split('\n'):
+            if not line.startswith('data: '):
+                continue
+            frames += 1
+            data = json.loads(line[6:])
+            if data['type'] == 'content':
+                if ttft is None:
+                    ttft = time.perf_counter() - started
+                answer += data['content']
+            elif data['type'] == 'done':
+                assert answer == data['final_content'], '合并后的正文与 final_content 不一致'
+    response.close()
+    return {
+        'frames': frames, 'bytes': size, 'writes': writes,
+        'ttft_ms': (ttft or 0) * 1000,
+        'cpu_ms': (time.thread_time() - cpu_started) * 1000,
+        'wall_ms': (time.perf_counter() - started) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SSE 增量合并基准')
+    parser.add_argument('--intervals', default='0,20,50,100', help='SSE_COALESCE_MS 取值，逗号分隔')
+    parser.add_argument('--profile', default='full', choices=('full', 'summary', 'content'), help='流式档位')
+    parser.add_argument('--max-bytes', type=int, default=1024, help='SSE_COALESCE_BYTES')
+    parser.add_argument('--streams', type=int, default=10, help='每个取值运行的流数')
+    parser.add_argument('--port', type=int, default=18095)
+    parser.add_argument('--latency', type=float, default=100, help='模拟服务首字节延迟（毫秒）')
+    parser.add_argument('--token-rate', type=float, default=40, help='模拟服务每秒 delta 事件数')
+    args = parser.parse_args()
+
+    mock = start_mock(args)
+    try:
+        client = setup_app(args.port)
+        import sse
+        sse.SSE_COALESCE_BYTES = args.max_bytes
+        run_stream(client, args.profile)   # 预热
+        print(f"{'合并间隔':<10}{'帧数':>8}{'字节':>9}{'写出次数':>10}{'首字 ms':>10}{'CPU ms':>9}{'总耗时 ms':>11}")
+        for interval in (float(v) for v in args.intervals.split(',')):
+            sse.SSE_COALESCE_MS = interval
+            results = [run_stream(client, args.profile) for _ in range(args.streams)]
+            avg = {key: statistics.mean(r[key] for r in results) for key in results[0]}
+            print(f"{interval:<10.0f}{avg['frames']:>8.1f}{avg['bytes']:>9.0f}{avg['writes']:>10.1f}"
+                  f"{avg['ttft_ms']:>10.1f}{avg['cpu_ms']:>9.2f}{avg['wall_ms']:>11.0f}")
+    finally:
+        mock.terminate()
+
+
+if __name__ == "__main__":
+    main()
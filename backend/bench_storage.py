@@ -0,0 +1,575 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+存储层微基准
+在接近生产的数据规模下逐个测量模型方法（get / filter / query / save / all / batch）的
+吞吐（ops/s）和延迟分位数，输出机器可读的 JSON 报告，并可与基线对比、标记退化超过阈值的操作。
+
+后端：
+    sqlite         storage_sqlite（默认）
+    memory         storage_memory（零 I/O 基线）
+    supabase_stub  storage_supabase + 本地桩传输（不联网，只测客户端构造请求、解析响应的开销）
+
+规模预设（--scale）：
+    smoke       2k 用户 / 1k 房间 / 5 万客厅消息
+    medium      2 万用户 / 1 万房间 / 100 万客厅消息
+    production  10 万用户 / 5 万房间 / 1000 万客厅消息，1000 位用户各 2000 条教练对话
+    （memory 后端建议不超过 medium，数据全部常驻内存）
+
+用法：
+    python bench_storage.py --backend sqlite --scale medium --db /tmp/bench.db --json report.json
+    python bench_storage.py --backend sqlite --scale medium --db /tmp/bench.db --baseline report.json
+    python bench_storage.py --backend sqlite --check-plans --json report.json   # 同时检查热点表查询计划
+
+--db 中的数据只在生成时写入：每次运行在它的临时副本上执行（写操作不会累积到下一次运行），
+行数与生成时记录的不一致时重新生成。
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+PRESETS = {
+    'smoke': dict(users=2000, rooms=1000, lounge_messages=50_000, coach_long_users=20, coach_long_len=500, coach_short_len=4),
+    'medium': dict(users=20_000, rooms=10_000, lounge_messages=1_000_000, coach_long_users=200, coach_long_len=2000, coach_short_len=4),
+    'production': dict(users=100_000, rooms=50_000, lounge_messages=10_000_000, coach_long_users=1000, coach_long_len=2000, coach_short_len=4),
+}
+
+BASE_TIME = datetime(2026, 1, 1)
+# 全表扫描类操作在大规模下很慢，默认只在不超过该行数时执行（--full-scans 强制执行）
+FULL_SCAN_MAX_ROWS = 200_000
+SEED_CHUNK = 50_000
+
+
+def percentile(values, p):
+    """最近秩百分位数"""
+    ordered = sorted(values)
+    rank = math.ceil(p / 100 * len(ordered))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+# ==================== 测试数据 ====================
+
+def phone_of(i):
+    return f"138{i:08d}"
+
+
+def binding_code_of(i):
+    return f"{i:06X}"
+
+
+def room_of(r):
+    return f"room_{2 * r + 1}_{2 * r + 2}"
+
+
+def generate_rows(scale, reasoning_len, rng):
+    """按表生成测试数据（行字典，时间为 datetime）"""
+    reasoning = '思' * reasoning_len
+
+    def users():
+        for i in range(1, scale['users'] + 1):
+            partner = i + 1 if i % 2 else i - 1
+            paired = (i + 1) // 2 <= scale['rooms']
+            yield dict(phone=phone_of(i), password='bench', nickname=f"用户{i}", binding_code=binding_code_of(i),
+                       partner_id=partner if paired else None, unbind_at=None, coach_greeting_shown=True,
+                       created_at=BASE_TIME + timedelta(seconds=i))
+
+    def relationships():
+        for r in range(scale['rooms']):
+            yield dict(user1_id=2 * r + 1, user2_id=2 * r + 2, room_id=room_of(r), is_active=True,
+                       greeting_shown=True, created_at=BASE_TIME + timedelta(seconds=r))
+
+    def lounge_chats():
+        for i in range(scale['lounge_messages']):
+            r = rng.randrange(scale['rooms'])
+            is_ai = i % 5 == 4
+            yield dict(room_id=room_of(r), user_id=None if is_ai else rng.choice((2 * r + 1, 2 * r + 2)),
+                       role='assistant' if is_ai else 'user', content=f"客厅消息 {i} " * 3,
+                       reasoning_content=reasoning if is_ai else None, sent_to_ai=rng.random() < 0.98,
+                       created_at=BASE_TIME + timedelta(milliseconds=i))
+
+    def coach_chats():
+        n = 0
+        for user_id in range(1, scale['users'] + 1):
+            length = scale['coach_long_len'] if user_id <= scale['coach_long_users'] else scale['coach_short_len']
+            for k in range(length):
+                is_ai = k % 2 == 1
+                n += 1
+                yield dict(user_id=user_id, role='assistant' if is_ai else 'user', content=f"教练对话 {k} " * 6,
+                           reasoning_content=reasoning if is_ai else None,
+                           created_at=BASE_TIME + timedelta(milliseconds=n))
+
+    return [('users', users), ('relationships', relationships), ('lounge_chats', lounge_chats), ('coach_chats', coach_chats)]
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# ==================== 后端 ====================
+
+class SqliteBackend:
+    name = 'sqlite'
+
+    def __init__(self, db_path):
+        # 导入时的 init_db 作用在本次运行的副本上：它会给缺少开场白的用户补消息，不能改动生成好的数据
+        self.work_dir = tempfile.mkdtemp(prefix='bench_storage_run_')
+        self.work_path = os.path.join(self.work_dir, 'bench.db')
+        os.environ['SQLITE_DB_PATH'] = self.work_path
+        import storage_sqlite
+        self.module = storage_sqlite
+        self.db_path = db_path
+
+    def seeded_signature(self):
+        """已生成数据的签名；行数与生成时记录的不一致（数据被改动过）时返回 None，需要重新生成"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            try:
+                row = conn.execute("SELECT signature, row_counts FROM bench_meta").fetchone()
+            except sqlite3.OperationalError:
+                return None
+        finally:
+            conn.close()
+        if not row:
+            return None
+        if json.loads(row[1]) != self.row_counts():
+            print("[Bench] 已有数据的行数与生成时不一致，重新生成", flush=True)
+            return None
+        return row[0]
+
+    def seed(self, tables, signature):
+        # 建表（及迁移），随后清空重新生成
+        self.module.DB_PATH = self.db_path
+        try:
+            self.module.init_db()
+        finally:
+            self.module.DB_PATH = self.work_path
+        conn = sqlite3.connect(self.db_path)
+        try:
+            for table, rows in tables:
+                conn.execute(f"DELETE FROM {table}")
+                conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+                for chunk in chunked(rows(), SEED_CHUNK):
+                    columns = list(chunk[0])
+                    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+                    conn.executemany(sql, [[self.module._to_db_value(row[c]) for c in columns] for row in chunk])
+                print(f"  {table}: {conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]} 行", flush=True)
+            conn.commit()
+            conn.execute("DROP TABLE IF EXISTS bench_meta")
+            conn.execute("CREATE TABLE bench_meta (signature TEXT, row_counts TEXT)")
+            conn.execute("INSERT INTO bench_meta VALUES (?, ?)", (signature, json.dumps(self.row_counts())))
+            conn.commit()
+            conn.execute("ANALYZE")
+        finally:
+            conn.close()
+
+    def row_counts(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+                    for t in ('users', 'relationships', 'lounge_chats', 'coach_chats')}
+        finally:
+            conn.close()
+
+    def start_run(self):
+        """把生成好的数据库复制给本次运行使用，写操作只落在副本上"""
+        src = sqlite3.connect(self.db_path)
+        dst = sqlite3.connect(self.work_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+
+    def end_run(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def size_bytes(self):
+        return sum(os.path.getsize(p) for p in (self.db_path, self.db_path + '-wal') if os.path.exists(p))
+
+
+class MemoryBackend:
+    name = 'memory'
+
+    def __init__(self, db_path=None):
+        import storage_memory
+        self.module = storage_memory
+
+    def seeded_signature(self):
+        return None
+
+    def seed(self, tables, signature):
+        self.module.reset()
+        for table, rows in tables:
+            target = self.module._tables[table]
+            for row in rows():
+                target.insert(row)
+            print(f"  {table}: {len(target.rows)} 行", flush=True)
+
+    def row_counts(self):
+        return {name: len(table.rows) for name, table in self.module._tables.items()}
+
+    def start_run(self):
+        pass
+
+    def end_run(self):
+        pass
+
+    def size_bytes(self):
+        return None
+
+
+class SupabaseStubBackend:
+    """storage_supabase 接本地桩传输：返回固定行数的罐装数据，不访问网络"""
+    name = 'supabase_stub'
+
+    def __init__(self, db_path=None, stub_rows=20):
+        os.environ['SUPABASE_URL'] = 'http://supabase.stub'
+        os.environ['SUPABASE_KEY'] = 'eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.stub'
+        import httpx
+        import storage_supabase
+        self.module = storage_supabase
+        self.stub_rows = stub_rows
+        self._next_id = 10 ** 6
+        create_session = storage_supabase._create_http_session
+        transport = httpx.MockTransport(self._handle)
+
+        def _create_stub_session(base_url, headers):
+            session = create_session(base_url, headers)
+            session._transport = transport
+            return session
+
+        storage_supabase._create_http_session = _create_stub_session
+
+    def _row(self, table, i):
+        now = (BASE_TIME + timedelta(seconds=i)).isoformat()
+        if table == 'users':
+            return dict(id=i, phone=phone_of(i), password='bench', nickname=f"用户{i}", binding_code=binding_code_of(i),
+                        partner_id=i + 1, unbind_at=None, coach_greeting_shown=True, created_at=now)
+        if table == 'relationships':
+            return dict(id=i, user1_id=1, user2_id=2, room_id=room_of(0), is_active=True, greeting_shown=True, created_at=now)
+        if table == 'coach_chats':
+            return dict(id=i, user_id=1, role='user', content=f"教练对话 {i} " * 6, reasoning_content=None, created_at=now)
+        return dict(id=i, room_id=room_of(0), user_id=1, role='user', content=f"客厅消息 {i} " * 3,
+                    reasoning_content=None, sent_to_ai=True, created_at=now)
+
+    def _handle(self, request):
+        import httpx
+        path = request.url.path
+        if path.endswith('/rpc/apply_batch'):
+            ops = json.loads(request.content)['ops']
+            return httpx.Response(200, json=[self._inserted(op['table']) if op['action'] == 'insert' else op['ids'] for op in ops])
+        table = path.rsplit('/', 1)[-1]
+        if request.method in ('POST', 'PATCH'):
+            return httpx.Response(201 if request.method == 'POST' else 200, json=[self._inserted(table)])
+        limit = request.url.params.get('limit')
+        n = min(int(limit), self.stub_rows) if limit else self.stub_rows
+        return httpx.Response(200, json=[self._row(table, i + 1) for i in range(n)])
+
+    def _inserted(self, table):
+        self._next_id += 1
+        return self._row(table, self._next_id)
+
+    def seeded_signature(self):
+        return None
+
+    def seed(self, tables, signature):
+        print(f"  桩传输：每次查询返回最多 {self.stub_rows} 行", flush=True)
+
+    def row_counts(self):
+        return None
+
+    def start_run(self):
+        pass
+
+    def end_run(self):
+        pass
+
+    def size_bytes(self):
+        return None
+
+
+BACKENDS = {'sqlite': SqliteBackend, 'memory': MemoryBackend, 'supabase_stub': SupabaseStubBackend}
+
+
+# ==================== 基准操作 ====================
+
+def build_operations(s, scale, rng):
+    """返回 [(名称, 每次调用的函数, 迭代倍率, 是否全表扫描)]"""
+    User, Relationship, CoachChat, LoungeChat = s.User, s.Relationship, s.CoachChat, s.LoungeChat
+    users, rooms = scale['users'], scale['rooms']
+    rand_user = lambda: rng.randint(1, users)
+    rand_paired_user = lambda: rng.randint(1, 2 * rooms)
+    rand_room = lambda: rng.randrange(rooms)
+    rand_long_coach_user = lambda: rng.randint(1, max(1, scale['coach_long_users']))
+    lounge_total = scale['lounge_messages']
+    coach_total = scale['coach_long_users'] * scale['coach_long_len'] + (users - scale['coach_long_users']) * scale['coach_short_len']
+
+    def update_user():
+        user = User.get(rand_user())
+        if user:
+            user.nickname = f"昵称{rng.randrange(10 ** 6)}"
+            user.save()
+
+    def update_relationship():
+        rel = Relationship.get(rng.randint(1, rooms))
+        if rel:
+            rel.is_active = True
+            rel.save()
+
+    def update_coach():
+        chat = CoachChat.get(rng.randint(1, coach_total))
+        if chat:
+            chat.content += '。'
+            chat.save()
+
+    def update_lounge():
+        chat = LoungeChat.get(rng.randint(1, lounge_total))
+        if chat:
+            chat.sent_to_ai = True
+            chat.save()
+
+    def batch_commit():
+        r = rand_room()
+        with s.batch() as unit:
+            unit.save(LoungeChat(room_id=room_of(r), user_id=None, role='assistant', content='基准批量写入'))
+            unit.update(LoungeChat, [rng.randint(1, lounge_total) for _ in range(5)], sent_to_ai=True)
+            user = User(phone=f"139{rng.randrange(10 ** 8):08d}", password='bench')
+            unit.save(user)
+
+    return [
+        ('User.get', lambda: User.get(rand_user()), 1, False),
+        ('User.filter(phone)', lambda: User.filter(phone=phone_of(rand_user())), 1, False),
+        ('User.filter(binding_code)', lambda: User.filter(binding_code=binding_code_of(rand_user())), 1, False),
+        ('User.query(in_ 投影)', lambda: User.query('id', 'phone', 'nickname').in_('id', [rand_user(), rand_user()]).all(), 1, False),
+        ('User.save(insert)', lambda: User(phone=f"137{rng.randrange(10 ** 8):08d}", password='bench').save(), 1, False),
+        ('User.save(update)', update_user, 1, False),
+        ('User.all', lambda: User.all(), 0.05, users > FULL_SCAN_MAX_ROWS),
+
+        ('Relationship.get', lambda: Relationship.get(rng.randint(1, rooms)), 1, False),
+        ('Relationship.filter(user1_id)', lambda: Relationship.filter(user1_id=rand_paired_user()), 1, False),
+        ('Relationship.query(or_eq)', lambda: (lambda u: Relationship.query('room_id').or_eq(user1_id=u, user2_id=u).order('id').first())(rand_paired_user()), 1, False),
+        ('Relationship.save(insert)', lambda: Relationship(user1_id=rand_user(), user2_id=rand_user(), room_id='room_bench', is_active=False).save(), 1, False),
+        ('Relationship.save(update)', update_relationship, 1, False),
+        ('Relationship.all', lambda: Relationship.all(), 0.05, rooms > FULL_SCAN_MAX_ROWS),
+
+        ('CoachChat.get', lambda: CoachChat.get(rng.randint(1, coach_total)), 1, False),
+        ('CoachChat.filter(长历史)', lambda: CoachChat.filter(user_id=rand_long_coach_user()), 0.1, False),
+        ('CoachChat.query(最近5条)', lambda: CoachChat.query('role', 'content', 'created_at').eq('user_id', rand_long_coach_user()).order('created_at', desc=True).limit(5).all(), 1, False),
+        ('CoachChat.save(insert)', lambda: CoachChat(user_id=rand_user(), role='user', content='基准写入').save(), 1, False),
+        ('CoachChat.save(update)', update_coach, 1, False),
+        ('CoachChat.all', lambda: CoachChat.all(), 0.02, coach_total > FULL_SCAN_MAX_ROWS),
+
+        ('LoungeChat.get', lambda: LoungeChat.get(rng.randint(1, lounge_total)), 1, False),
+        ('LoungeChat.filter(room_id)', lambda: LoungeChat.filter(room_id=room_of(rand_room())), 0.2, False),
+        ('LoungeChat.query(轮询新消息)', lambda: LoungeChat.query().eq('room_id', room_of(rand_room())).gt('id', lounge_total - 50).order('created_at').all(), 1, False),
+        ('LoungeChat.query(未发送)', lambda: LoungeChat.query().eq('room_id', room_of(rand_room())).eq('role', 'user').eq('sent_to_ai', False).order('created_at', desc=True).limit(10).all(), 1, False),
+        ('LoungeChat.query(最新一页)', lambda: LoungeChat.query().eq('room_id', room_of(rand_room())).order('created_at', desc=True).limit(101).all(), 1, False),
+        ('LoungeChat.save(insert)', lambda: LoungeChat(room_id=room_of(rand_room()), user_id=1, role='user', content='基准写入').save(), 1, False),
+        ('LoungeChat.save(update)', update_lounge, 1, False),
+        ('LoungeChat.all', lambda: LoungeChat.all(), 0.02, lounge_total > FULL_SCAN_MAX_ROWS),
+
+        ('batch(3 项写入)', batch_commit, 1, False),
+    ]
+
+
+def measure(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    return {
+        'iterations': iterations,
+        'ops_per_sec': round(iterations / elapsed, 2) if elapsed else None,
+        'mean_us': round(sum(latencies) / iterations * 1e6, 1),
+        'p50_us': round(percentile(latencies, 50) * 1e6, 1),
+        'p95_us': round(percentile(latencies, 95) * 1e6, 1),
+        'p99_us': round(percentile(latencies, 99) * 1e6, 1),
+    }
+
+
+# ==================== 基线对比 ====================
+
+def compare(report, baseline, threshold):
+    """吞吐下降或 p95 上升超过阈值的操作记为退化"""
+    regressions = []
+    for name, current in report['operations'].items():
+        base = baseline.get('operations', {}).get(name)
+        if not base or current.get('skipped') or base.get('skipped'):
+            continue
+        throughput_change = current['ops_per_sec'] / base['ops_per_sec'] - 1
+        p95_change = current['p95_us'] / base['p95_us'] - 1 if base['p95_us'] else 0
+        current['vs_baseline'] = {'ops_per_sec': round(throughput_change, 4), 'p95': round(p95_change, 4)}
+        if throughput_change < -threshold or p95_change > threshold:
+            regressions.append((name, throughput_change, p95_change))
+    return regressions
+
+
+def print_report(report):
+    print("=" * 104)
+    print(f"{'操作':<34}{'ops/s':>12}{'p50':>11}{'p95':>11}{'p99':>11}{'对比基线':>20}")
+    print("-" * 104)
+    for name, r in report['operations'].items():
+        if r.get('skipped'):
+            print(f"{name:<34}{'跳过（' + r['skipped'] + '）':>40}")
+            continue
+        vs = r.get('vs_baseline')
+        vs_text = f"{vs['ops_per_sec']:+.1%} / p95 {vs['p95']:+.1%}" if vs else ''
+        print(f"{name:<34}{r['ops_per_sec']:>12.1f}{r['p50_us']:>9.0f}µs{r['p95_us']:>9.0f}µs{r['p99_us']:>9.0f}µs{vs_text:>24}")
+    print("=" * 104)
+    if report['db_size_bytes'] is not None:
+        print(f"数据库大小: {report['db_size_bytes'] / 1024 / 1024:.1f} MB")
+    if report['row_counts']:
+        print(f"行数: {report['row_counts']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='存储层微基准')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='sqlite')
+    parser.add_argument('--scale', choices=sorted(PRESETS), default='smoke')
+    parser.add_argument('--db', help='SQLite 数据库路径（规模相同则复用已生成的数据）')
+    parser.add_argument('--iterations', type=int, default=300, help='单条操作的迭代次数')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--reasoning', type=int, default=200, help='AI 消息思考过程长度（字符）')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--full-scans', action='store_true', help='大规模下也执行 all() 全表扫描')
+    parser.add_argument('--cache', action='store_true', help='在后端外层装上 storage_cache 读穿缓存')
+    parser.add_argument('--json', metavar='PATH', help='报告输出路径')
+    parser.add_argument('--baseline', metavar='PATH', help='与基线报告对比')
+    parser.add_argument('--threshold', type=float, default=0.10, help='退化阈值（默认 10%%）')
+    parser.add_argument('--check-plans', action='store_true',
+                        help='记录 EXPLAIN QUERY PLAN，热点表出现全表扫描则失败（仅 sqlite，计时会略偏高）')
+    args = parser.parse_args()
+
+    scale = PRESETS[args.scale]
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix='bench_storage_'), 'bench.db')
+    backend = BACKENDS[args.backend](db_path)
+    s = backend.module
+
+    signature = json.dumps(dict(scale, reasoning=args.reasoning, seed=args.seed), sort_keys=True)
+    print(f"[Bench] 后端 {backend.name}，规模 {args.scale}: {scale}", flush=True)
+    seed_seconds = 0.0
+    if backend.seeded_signature() != signature:
+        print("[Bench] 生成测试数据...", flush=True)
+        start = time.perf_counter()
+        backend.seed(generate_rows(scale, args.reasoning, random.Random(args.seed)), signature)
+        seed_seconds = time.perf_counter() - start
+        print(f"[Bench] 数据生成完成，耗时 {seed_seconds:.1f}s", flush=True)
+    else:
+        print(f"[Bench] 复用已有数据: {db_path}", flush=True)
+
+    catalogue = None
+    if args.check_plans:
+        if backend.name != 'sqlite':
+            parser.error('--check-plans 仅支持 sqlite 后端')
+        catalogue = s.enable_query_plan_capture()
+
+    if args.cache:
+        from storage_cache import StorageCache, VersionStore, install_cache
+        install_cache(s, cache=StorageCache(versions=VersionStore()), enabled=True)
+
+    # 降低日志噪音：基准期间丢弃模型方法内的打印
+    rng = random.Random(args.seed)
+    operations = {}
+    row_counts = backend.row_counts()
+    devnull = open(os.devnull, 'w')
+    backend.start_run()
+    try:
+        for name, fn, factor, is_full_scan in build_operations(s, scale, rng):
+            if is_full_scan and not args.full_scans:
+                operations[name] = {'skipped': '全表扫描，--full-scans 开启'}
+                continue
+            iterations = max(3, int(args.iterations * factor))
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                operations[name] = measure(fn, iterations, max(1, int(args.warmup * factor)))
+            finally:
+                sys.stdout = stdout
+            print(f"  {name}: {operations[name]['ops_per_sec']} ops/s", flush=True)
+    finally:
+        backend.end_run()
+
+    report = {
+        'meta': {
+            'backend': backend.name,
+            'scale': args.scale,
+            'scale_params': scale,
+            'iterations': args.iterations,
+            'cache': args.cache,
+            'seed': args.seed,
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+        },
+        'seed_seconds': round(seed_seconds, 2),
+        'db_size_bytes': backend.size_bytes(),
+        'row_counts': row_counts,
+        'operations': operations,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('scale') != args.scale or baseline.get('meta', {}).get('backend') != backend.name:
+            print("⚠️  基线的后端或规模与本次不同，对比结果仅供参考")
+        regressions = compare(report, baseline, args.threshold)
+        report['regressions'] = [name for name, _, _ in regressions]
+
+    plan_violations = []
+    if catalogue is not None:
+        report['query_plans'] = catalogue.report()
+        plan_violations = report['query_plans']['violations']
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"报告已写入 {args.json}")
+    if regressions:
+        print(f"\n❌ {len(regressions)} 项操作退化超过 {args.threshold:.0%}:")
+        for name, throughput, p95 in regressions:
+            print(f"  {name}: 吞吐 {throughput:+.1%}，p95 {p95:+.1%}")
+    if plan_violations:
+        print(f"\n❌ {len(plan_violations)} 条语句在热点表上全表扫描:")
+        for entry in plan_violations:
+            print(f"  {entry['sql']}\n    {entry['plan']}")
+    elif catalogue is not None:
+        print(f"\n✅ 查询计划检查通过（{len(report['query_plans']['statements'])} 种语句）")
+    return 1 if regressions or plan_violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+熔断器
+下游（Supabase 等）持续失败时快速失败，避免每个请求都等到超时、占满 gunicorn worker
+
+状态流转：
+    closed    正常放行；连续失败达到阈值 → open
+    open      直接拒绝（抛出 CircuitOpenError）；冷却 recovery_timeout 秒后 → half_open
+    half_open 只放行少量探测请求；探测成功 → closed，失败 → open
+              （探测超过 recovery_timeout 仍没有结果时允许新的探测）
+
+CircuitBreaker 按连续失败次数打开；RollingWindowBreaker 按最近一段时间的失败率打开，
+并可把过慢的调用（如 AI 首字时间过长）也记为失败。
+"""
+import time
+from collections import deque
+from threading import Lock
+
+from log import get_logger
+
+log = get_logger('breaker')
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开时抛出，调用方应快速返回错误而不是等待下游"""
+
+    def __init__(self, name, retry_after=None):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"{name} 熔断中，暂时不可用")
+
+
+class CircuitBreaker:
+    """连续失败计数熔断器（线程安全）"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30.0, half_open_max_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._lock = Lock()
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._half_open_calls = 0
+        self._half_open_since = 0.0
+        self._stats = {'opened': 0, 'rejected': 0, 'successes': 0, 'failures': 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            self._maybe_half_open()
+            return self._state
+
+    def _maybe_half_open(self):
+        now = time.monotonic()
+        if self._state == self.OPEN and now - self._opened_at >= self.recovery_timeout:
+            self._state = self.HALF_OPEN
+            self._half_open_calls = 0
+            self._half_open_since = now
+        elif self._state == self.HALF_OPEN and now - self._half_open_since >= self.recovery_timeout:
+            # 探测请求迟迟没有结果（调用方没有上报），重新放行探测，避免一直卡在 half_open
+            self._half_open_calls = 0
+            self._half_open_since = now
+
+    def _open(self):
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._stats['opened'] += 1
+        log.warning("%s 熔断打开，%.0fs 后探测", self.name, self.recovery_timeout)
+
+    def allow(self):
+        """是否放行本次调用"""
+        with self._lock:
+            self._maybe_half_open()
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and self._half_open_calls < self.half_open_max_calls:
+                self._half_open_calls += 1
+                return True
+            self._stats['rejected'] += 1
+            return False
+
+    def check(self):
+        """放行则返回，否则抛出 CircuitOpenError"""
+        if not self.allow():
+            raise CircuitOpenError(self.name, retry_after=self.retry_after())
+
+    def retry_after(self):
+        """距离下一次探测的秒数"""
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0
+            return max(0.0, self.recovery_timeout - (time.monotonic() - self._opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self._stats['successes'] += 1
+            self._consecutive_failures = 0
+            if self._state == self.HALF_OPEN:
+                self._state = self.CLOSED
+                log.info("%s 探测成功，熔断关闭", self.name)
+
+    def record_failure(self):
+        with self._lock:
+            self._stats['failures'] += 1
+            self._consecutive_failures += 1
+            if self._state == self.HALF_OPEN:
+                self._open()
+            elif self._state == self.CLOSED and self._consecutive_failures >= self.failure_threshold:
+                self._open()
+
+    def stats(self):
+        """当前状态和计数"""
+        state = self.state
+        with self._lock:
+            return dict(self._stats, state=state, consecutive_failures=self._consecutive_failures)
+
+
+class RollingWindowBreaker(CircuitBreaker):
+    """
+    滑动窗口失败率熔断器：最近 window 秒内调用数达到 min_calls、且失败率达到 failure_rate 时打开。
+    record(ok, seconds) 中 seconds 超过 slow_call_seconds 的成功调用按失败（慢调用）计。
+    """
+
+    def __init__(self, name, window=30.0, min_calls=10, failure_rate=0.5, slow_call_seconds=None,
+                 recovery_timeout=30.0, half_open_max_calls=1):
+        super().__init__(name, failure_threshold=min_calls, recovery_timeout=recovery_timeout,
+                         half_open_max_calls=half_open_max_calls)
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self._calls = deque()   # (时间, 是否失败)
+        self._stats['slow'] = 0
+
+    def _prune(self, now):
+        while self._calls and now - self._calls[0][0] > self.window:
+            self._calls.popleft()
+
+    def _open(self):
+        # 窗口从头统计，避免关闭后被旧的失败立即再次打开
+        self._calls.clear()
+        super()._open()
+
+    def record(self, ok, seconds=None):
+        """上报一次调用结果；seconds 为判断慢调用的耗时（如首字时间）"""
+        if ok and self.slow_call_seconds and seconds is not None and seconds >= self.slow_call_seconds:
+            with self._lock:
+                self._stats['slow'] += 1
+            ok = False
+        if ok:
+            self.record_success()
+        else:
+            self.record_failure()
+
+    def record_success(self):
+        with self._lock:
+            self._stats['successes'] += 1
+            self._consecutive_failures = 0
+            if self._state == self.HALF_OPEN:
+                self._state = self.CLOSED
+                log.info("%s 探测成功，熔断关闭", self.name)
+                return
+            now = time.monotonic()
+            self._calls.append((now, False))
+            self._prune(now)
+
+    def record_failure(self):
+        with self._lock:
+            self._stats['failures'] += 1
+            self._consecutive_failures += 1
+            if self._state == self.HALF_OPEN:
+                self._open()
+                return
+            if self._state != self.CLOSED:
+                return
+            now = time.monotonic()
+            self._calls.append((now, True))
+            self._prune(now)
+            failed = sum(1 for _, is_failure in self._calls if is_failure)
+            if len(self._calls) >= self.min_calls and failed / len(self._calls) >= self.failure_rate:
+                self._open()
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            self._prune(time.monotonic())
+            calls = len(self._calls)
+            failed = sum(1 for _, is_failure in self._calls if is_failure)
+        stats.update(window_calls=calls, window_failure_rate=round(failed / calls, 3) if calls else 0.0)
+        return stats
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+个人教练最近对话的内存环形缓冲
+构造 Coze 上下文（最近 5 条）时不再每轮查询存储：
+
+- 每个用户一个定长环形缓冲（COACH_CONTEXT_TURNS 条），用户之间按 LRU 淘汰（COACH_CONTEXT_MAX_USERS）
+- 写穿：CoachChat.save() 成功后写入缓冲；异步保存的消息在发起保存前先用 pending() 放入缓冲，
+  保证紧接着构造的上下文包含刚发送的消息
+- 懒加载：用户第一次读取（或版本不一致）时从存储加载最近的记录
+- 多 worker 一致：每个用户一个版本号（与 storage_cache 共用本机 SQLite 版本文件），每次 save() 递增；
+  读取时比对，其他进程写入过就重新加载。本进程写入时版本号恰好只比缓冲新 1 才直接跟进，
+  否则说明期间有其他写入，下次读取重新加载
+- 只跟踪 save() 的写入；绕过 save() 的批量导入（history_transfer.py）写入后调用 invalidate()，
+  递增这些用户的版本号
+- 每条记录带 token 数（token_count 列，见 tokens.py），供 coze_context 按预算取舍；
+  加载到的旧记录没有 token_count 时补上估算值并在后台写回
+
+用法：
+    coach_context.install(storage.backend)          # 在 install_cache 之后、instrument_storage 之前
+    coach_context.pending(user_msg)                 # 异步保存前
+    history = coach_context.recent(user_id, 5)      # [{'id', 'role', 'content', 'tokens'}, ...]，按时间顺序
+"""
+import os
+import threading
+from collections import OrderedDict, deque
+
+from log import get_logger
+from storage_cache import STORAGE_CACHE_VERSION_PATH, VersionStore
+from tokens import estimate_tokens, missing_token_counts, write_token_counts
+
+log = get_logger('coach_context')
+
+COACH_CONTEXT_ENABLED = os.getenv('COACH_CONTEXT_ENABLED', '1') == '1'
+COACH_CONTEXT_TURNS = int(os.getenv('COACH_CONTEXT_TURNS', '10'))
+COACH_CONTEXT_MAX_USERS = int(os.getenv('COACH_CONTEXT_MAX_USERS', '2048'))
+
+
+class _Turn:
+    __slots__ = ('id', 'role', 'content', 'tokens', 'source', 'local')
+
+    def __init__(self, msg, local):
+        self.id = msg.id
+        self.role = msg.role
+        self.content = msg.content
+        self.tokens = _tokens(msg)
+        self.source = msg if msg.id is None else None   # 尚未保存：按对象匹配之后的 save()
+        self.local = local                              # 本进程写入，重新加载时若不在结果里则保留
+
+
+class _Ring:
+    __slots__ = ('turns', 'version')
+
+    def __init__(self, size):
+        self.turns = deque(maxlen=size)
+        self.version = None     # None：尚未从存储加载
+
+
+def _tokens(msg):
+    token_count = getattr(msg, 'token_count', None)
+    return estimate_tokens(msg.content) if token_count is None else token_count
+
+
+def _turn_id(turn):
+    return turn.source.id if turn.source is not None else turn.id
+
+
+def _as_history(turns):
+    return [{'id': t.id, 'role': t.role, 'content': t.content, 'tokens': t.tokens} for t in turns]
+
+
+class RecentTurns:
+    def __init__(self, size=COACH_CONTEXT_TURNS, max_users=COACH_CONTEXT_MAX_USERS, versions=None):
+        self.size = size
+        self.max_users = max_users
+        self.versions = versions if versions is not None else VersionStore()
+        self.model = None
+        self.batch = None       # 存储模块的 batch()，用于写回旧记录的 token 数；None 时不写回
+        self._rings = OrderedDict()     # user_id -> _Ring
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'loads': 0, 'evictions': 0}
+
+    @staticmethod
+    def _key(user_id):
+        return f"coach_chats:{user_id}"
+
+    def _ring(self, user_id):
+        ring = self._rings.get(user_id)
+        if ring is None:
+            ring = self._rings[user_id] = _Ring(self.size)
+            while len(self._rings) > self.max_users:
+                self._rings.popitem(last=False)
+                self._stats['evictions'] += 1
+        self._rings.move_to_end(user_id)
+        return ring
+
+    @staticmethod
+    def _apply(ring, msg):
+        for turn in ring.turns:
+            if turn.source is msg or (msg.id is not None and turn.id == msg.id):
+                turn.id = msg.id
+                turn.role = msg.role
+                turn.content = msg.content
+                turn.tokens = _tokens(msg)
+                if msg.id is not None:
+                    turn.source = None
+                return
+        ring.turns.append(_Turn(msg, local=True))
+
+    def pending(self, msg):
+        """异步保存前先放入缓冲（本进程可见，不递增版本号）"""
+        with self._lock:
+            self._apply(self._ring(msg.user_id), msg)
+
+    def saved(self, msg):
+        """save() 成功后写穿"""
+        version = self.versions.bump(self._key(msg.user_id))
+        with self._lock:
+            ring = self._rings.get(msg.user_id)
+            if ring is None:
+                return      # 未加载过，下次读取时从存储加载
+            self._apply(ring, msg)
+            if ring.version is not None and ring.version == version - 1:
+                ring.version = version
+
+    def invalidate(self, user_id):
+        """存储被直接改写（批量导入）：递增版本号，所有进程下次读取时重新加载"""
+        self.versions.bump(self._key(user_id))
+
+    def discard(self, msg):
+        """保存失败：移除 pending() 放入的记录"""
+        with self._lock:
+            ring = self._rings.get(msg.user_id)
+            if ring is not None:
+                ring.turns = deque((t for t in ring.turns if t.source is not msg), maxlen=self.size)
+
+    def load(self, user_id, limit=None):
+        """从存储读取最近 limit 条（默认缓冲长度），按时间顺序"""
+        rows = self.model.query('id', 'role', 'content', 'token_count', 'created_at').eq('user_id', user_id) \
+            .order('created_at', desc=True).limit(limit or self.size).all()
+        missing = missing_token_counts(rows)
+        if missing and self.batch is not None:
+            threading.Thread(target=self._write_token_counts, args=(missing,), daemon=True).start()
+        return list(reversed(rows))
+
+    def _write_token_counts(self, missing):
+        try:
+            with self.batch() as unit:
+                write_token_counts(unit, self.model, missing)
+        except Exception as e:
+            log.warning("写回教练记录 token 数失败: %s", e)
+
+    def recent(self, user_id, limit):
+        """最近 limit 条记录（按时间顺序）；缓冲是最新版本时不访问存储"""
+        version = self.versions.get(self._key(user_id))
+        with self._lock:
+            ring = self._rings.get(user_id)
+            if ring is not None and ring.version == version:
+                self._rings.move_to_end(user_id)
+                self._stats['hits'] += 1
+                return self._view(ring, limit)
+
+        # 先取版本号再读存储：读取期间的写入会让缓冲在下一次读取时重新加载
+        rows = self.load(user_id)
+        with self._lock:
+            ring = self._ring(user_id)
+            loaded = {row.id for row in rows}
+            # 本进程写入但不在结果里的（尚未保存完成、或在加载之后保存）放在最后；
+            # 异步保存可能已经拿到 id 但还没写穿，按消息对象当前的 id 判断
+            kept = [t for t in ring.turns if t.local and _turn_id(t) not in loaded]
+            ring.turns = deque((_Turn(row, local=False) for row in rows), maxlen=self.size)
+            for turn in kept:
+                turn.local = turn.id is None
+                ring.turns.append(turn)
+            ring.version = version
+            self._stats['loads'] += 1
+            return self._view(ring, limit)
+
+    @staticmethod
+    def _view(ring, limit):
+        return _as_history(list(ring.turns)[-limit:] if limit else [])
+
+    def clear(self):
+        with self._lock:
+            self._rings.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, users=len(self._rings), max_users=self.max_users, turns=self.size)
+        total = stats['hits'] + stats['loads']
+        stats['hit_rate'] = round(stats['hits'] / total, 4) if total else 0.0
+        return stats
+
+
+recent_turns = RecentTurns(versions=VersionStore(STORAGE_CACHE_VERSION_PATH))
+_installed = set()
+
+
+def install(storage, turns=None):
+    """给存储模块的 CoachChat.save 加写穿（重复调用无效）"""
+    turns = turns or recent_turns
+    turns.model = storage.CoachChat
+    turns.batch = getattr(storage, 'batch', None)
+    if not COACH_CONTEXT_ENABLED or storage.__name__ in _installed:
+        return
+    model = storage.CoachChat
+    save = model.save
+
+    def save_through(self):
+        try:
+            result = save(self)
+        except Exception:
+            turns.discard(self)
+            raise
+        turns.saved(self)
+        return result
+
+    model.save = save_through
+    _installed.add(storage.__name__)
+    log.info("已启用教练上下文缓冲: %s", storage.__name__)
+
+
+def pending(msg):
+    if COACH_CONTEXT_ENABLED:
+        recent_turns.pending(msg)
+
+
+def invalidate(user_ids):
+    for user_id in user_ids:
+        recent_turns.invalidate(user_id)
+
+
+def recent(user_id, limit):
+    """最近 limit 条记录（按时间顺序）；关闭缓冲（COACH_CONTEXT_ENABLED=0）时每次查询存储"""
+    if not COACH_CONTEXT_ENABLED:
+        return _as_history(recent_turns.load(user_id, limit)) if limit else []
+    return recent_turns.recent(user_id, limit)
+
+
+def stats():
+    return dict(recent_turns.stats(), enabled=COACH_CONTEXT_ENABLED, pid=os.getpid())
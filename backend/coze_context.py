@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+按 token 预算构造 Coze 上下文（教练对话、情感客厅的流式和后台任务接口共用）
+
+教练固定带前 4 条历史、客厅最多带 10 条未传消息，不看长度；几条长消息就能让请求体很大，
+拖慢上游预填充和首字时间。这里按 token 预算取舍：
+
+- 从最新的消息往前放，放得下就整条保留
+- 第一条放不下的：剩余预算不少于 COZE_CONTEXT_MIN_TRUNCATED_TOKENS 时保留开头并标注截断，否则整条省略
+- 更早的全部省略（客厅消息在开头注明省略了几条）
+- 当前这条用户消息不计入预算，始终完整发送
+
+token 数来自存储的 token_count 列（保存时估算，见 tokens.py），旧记录第一次用到时补上并写回。
+
+用法：
+    context = coze_context.fit_history(history)              # 教练：[{'role', 'content', 'tokens'}, ...]
+    context = coze_context.fit_lounge(messages, user_map)    # 客厅：LoungeChat 列表 -> context.text
+    write_token_counts(unit, LoungeChat, context.missing)    # 客厅：旧记录的估算值随同一批写入
+"""
+import os
+
+from log import get_logger
+from tokens import estimate_tokens, missing_token_counts, truncate_to_tokens
+
+log = get_logger('coze.context')
+
+COZE_CONTEXT_TOKEN_BUDGET = int(os.getenv('COZE_CONTEXT_TOKEN_BUDGET', '1500'))
+COZE_CONTEXT_MIN_TRUNCATED_TOKENS = int(os.getenv('COZE_CONTEXT_MIN_TRUNCATED_TOKENS', '64'))
+# 每条消息的格式开销（角色、分隔）
+MESSAGE_OVERHEAD_TOKENS = 4
+TRUNCATED_MARK = '…（内容过长，已截断）'
+
+
+class Context:
+    """取舍结果：messages（教练）或 text（客厅）、用掉的 token 数、省略条数、是否截断、待写回的估算值"""
+
+    def __init__(self, messages=None, text=None, tokens=0, elided=0, truncated=False, missing=None):
+        self.messages = messages
+        self.text = text
+        self.tokens = tokens
+        self.elided = elided
+        self.truncated = truncated
+        self.missing = missing or {}
+
+    def stats(self):
+        return {'tokens': self.tokens, 'elided': self.elided, 'truncated': self.truncated}
+
+
+def _fit(items, budget):
+    """
+    items: [(text, tokens)]，按时间顺序；从最新的往前放
+    返回 (保留的 [(下标, text)]（按时间顺序）, 用掉的 token 数, 省略条数, 是否截断)
+    """
+    kept = []
+    used = 0
+    truncated = False
+    index = len(items) - 1
+    while index >= 0:
+        text, tokens = items[index]
+        cost = tokens + MESSAGE_OVERHEAD_TOKENS
+        if used + cost <= budget:
+            kept.append((index, text))
+            used += cost
+            index -= 1
+            continue
+        remaining = budget - used - MESSAGE_OVERHEAD_TOKENS - estimate_tokens(TRUNCATED_MARK)
+        if remaining >= COZE_CONTEXT_MIN_TRUNCATED_TOKENS:
+            kept.append((index, truncate_to_tokens(text, remaining) + TRUNCATED_MARK))
+            used = budget
+            truncated = True
+            index -= 1
+        break
+    kept.reverse()
+    return kept, used, index + 1, truncated
+
+
+def fit_history(history, budget=None):
+    """教练历史（不含当前消息）：返回 Context.messages = [{'role', 'content'}, ...]"""
+    budget = COZE_CONTEXT_TOKEN_BUDGET if budget is None else budget
+    items = [(msg['content'] or '', msg.get('tokens')) for msg in history]
+    items = [(text, estimate_tokens(text) if tokens is None else tokens) for text, tokens in items]
+    kept, used, elided, truncated = _fit(items, budget)
+    messages = [{'role': history[index]['role'], 'content': text} for index, text in kept]
+    context = Context(messages=messages, tokens=used, elided=elided, truncated=truncated)
+    if elided or truncated:
+        log.info("教练上下文超出预算", extra=dict(context.stats(), budget=budget, history=len(history)))
+    return context
+
+
+def fit_lounge(messages, user_map, budget=None):
+    """客厅未传消息：返回 Context.text（每行“昵称：内容”），旧记录的估算值在 Context.missing"""
+    budget = COZE_CONTEXT_TOKEN_BUDGET if budget is None else budget
+    missing = missing_token_counts(messages)
+    items = []
+    for msg in messages:
+        nickname = user_map.get(msg.user_id, "未知用户")
+        items.append((f"{nickname}：{msg.content}", msg.token_count + estimate_tokens(nickname) + 1))
+    kept, used, elided, truncated = _fit(items, budget)
+    lines = [text for _, text in kept]
+    if elided:
+        lines.insert(0, f"（更早的 {elided} 条消息已省略）")
+    context = Context(text="\n".join(lines), tokens=used, elided=elided, truncated=truncated, missing=missing)
+    if elided or truncated:
+        log.info("客厅上下文超出预算", extra=dict(context.stats(), budget=budget, messages=len(messages)))
+    return context
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Coze API 本地模拟服务
+回放 fixtures/coze/ 下录制的 SSE 流（conversation.message.delta / completed / [DONE]），
+可配置首字节延迟、吐字速率和失败率，用于离线压测 AI 链路。
+
+用法：
+    python coze_mock_server.py --port 18080 --latency 800 --token-rate 30 --failure-rate 0.05
+    # 应用侧指向模拟服务
+    COZE_API_URL=http://127.0.0.1:18080/v3/chat COZE_API_KEY=mock COZE_BOT_ID_COACH=mock COZE_BOT_ID_LOUNGE=mock python app.py
+
+    # 录制真实流（代理到 Coze 并把原始 SSE 保存到 fixtures 目录）
+    python coze_mock_server.py --record fixtures/coze
+"""
+import argparse
+import glob
+import os
+import random
+import time
+from threading import Lock
+
+import requests
+from flask import Flask, Response, jsonify, request, stream_with_context
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'coze')
+UPSTREAM_URL = os.getenv('COZE_UPSTREAM_URL', 'https://api.coze.cn/v3/chat')
+
+app = Flask(__name__)
+
+config = {
+    'latency_ms': 800.0,      # 首字节延迟
+    'jitter_ms': 200.0,       # 首字节延迟抖动
+    'token_rate': 30.0,       # 每秒吐出的 delta 事件数（0 表示不限速）
+    'failure_rate': 0.0,      # 失败概率
+    'failure_mode': 'mixed',  # http：直接返回 5xx；disconnect：流中途断开；mixed：各一半
+    'record_dir': None,
+}
+fixtures = []
+stats_lock = Lock()
+stats = {'requests': 0, 'completed': 0, 'http_errors': 0, 'disconnects': 0, 'active': 0}
+
+
+def _count(key, n=1):
+    with stats_lock:
+        stats[key] += n
+
+
+def parse_sse(text):
+    """把 SSE 文本拆成 (event, data) 列表"""
+    events = []
+    event = None
+    for line in text.splitlines():
+        if line.startswith('event:'):
+            event = line[6:].strip()
+        elif line.startswith('data:'):
+            events.append((event, line[5:]))
+            event = None
+    return events
+
+
+def load_fixtures(directory):
+    loaded = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.sse'))):
+        with open(path, encoding='utf-8') as f:
+            events = parse_sse(f.read())
+        if events:
+            loaded.append((os.path.basename(path), events))
+    return loaded
+
+
+def _failure():
+    """按失败率决定本次请求是否失败，返回失败方式或 None"""
+    if random.random() >= config['failure_rate']:
+        return None
+    if config['failure_mode'] == 'mixed':
+        return random.choice(('http', 'disconnect'))
+    return config['failure_mode']
+
+
+def replay(events, disconnect):
+    """按配置的速率回放事件；disconnect 时在 delta 中途停止（不发送 completed / [DONE]）"""
+    deltas = sum(1 for event, _ in events if event == 'conversation.message.delta')
+    cut_at = random.randint(1, max(1, deltas)) if disconnect else None
+    interval = 1.0 / config['token_rate'] if config['token_rate'] > 0 else 0
+    sent_deltas = 0
+    _count('active')
+    try:
+        for event, data in events:
+            if event == 'conversation.message.delta':
+                if cut_at is not None and sent_deltas >= cut_at:
+                    _count('disconnects')
+                    return
+                if interval:
+                    time.sleep(interval)
+                sent_deltas += 1
+            yield f"event:{event}\ndata:{data}\n\n"
+        _count('completed')
+    finally:
+        _count('active', -1)
+
+
+def proxy_and_record(payload):
+    """代理到真实 Coze 并把原始流写入录制目录"""
+    headers = {'Authorization': request.headers.get('Authorization', ''), 'Content-Type': 'application/json'}
+    upstream = requests.post(UPSTREAM_URL, headers=headers, json=payload, timeout=60, stream=True)
+    path = os.path.join(config['record_dir'], f"recorded_{int(time.time() * 1000)}.sse")
+
+    def generate():
+        with open(path, 'w', encoding='utf-8') as f:
+            for line in upstream.iter_lines():
+                text = line.decode('utf-8') if line else ''
+                f.write(text + '\n')
+                yield text + '\n'
+        print(f"[Coze Mock] 已录制: {path}", flush=True)
+
+    return Response(stream_with_context(generate()), status=upstream.status_code,
+                    content_type=upstream.headers.get('Content-Type', 'text/event-stream'))
+
+
+@app.route('/v3/chat', methods=['POST'])
+def chat():
+    _count('requests')
+    payload = request.get_json(silent=True) or {}
+    if config['record_dir']:
+        return proxy_and_record(payload)
+    if not request.headers.get('Authorization', '').startswith('Bearer '):
+        return jsonify({'code': 4100, 'msg': 'authentication is invalid'}), 401
+
+    failure = _failure()
+    latency = max(0.0, config['latency_ms'] + random.uniform(-config['jitter_ms'], config['jitter_ms'])) / 1000
+    time.sleep(latency)
+    if failure == 'http':
+        _count('http_errors')
+        return jsonify({'code': 5000, 'msg': 'mock upstream failure'}), random.choice((500, 502, 503))
+
+    name, events = random.choice(fixtures)
+    response = Response(stream_with_context(replay(events, failure == 'disconnect')), content_type='text/event-stream')
+    response.headers['X-Mock-Fixture'] = name
+    return response
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    with stats_lock:
+        return jsonify(dict(stats, config={k: v for k, v in config.items() if k != 'record_dir'}))
+
+
+@app.route('/config', methods=['POST'])
+def update_config():
+    """运行时调整参数（压测中途模拟上游变慢/故障）"""
+    data = request.get_json(silent=True) or {}
+    for key in ('latency_ms', 'jitter_ms', 'token_rate', 'failure_rate'):
+        if key in data:
+            config[key] = float(data[key])
+    if data.get('failure_mode') in ('http', 'disconnect', 'mixed'):
+        config['failure_mode'] = data['failure_mode']
+    return get_stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Coze API 本地模拟服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--fixtures', default=FIXTURE_DIR, help='录制的 SSE 文件目录（*.sse）')
+    parser.add_argument('--latency', type=float, default=config['latency_ms'], help='首字节延迟（毫秒）')
+    parser.add_argument('--jitter', type=float, default=config['jitter_ms'], help='首字节延迟抖动（毫秒）')
+    parser.add_argument('--token-rate', type=float, default=config['token_rate'], help='每秒 delta 事件数，0 为不限速')
+    parser.add_argument('--failure-rate', type=float, default=config['failure_rate'], help='失败概率 0~1')
+    parser.add_argument('--failure-mode', choices=('http', 'disconnect', 'mixed'), default=config['failure_mode'])
+    parser.add_argument('--record', metavar='DIR', help='录制模式：代理到真实 Coze 并保存原始流')
+    args = parser.parse_args()
+
+    config.update(latency_ms=args.latency, jitter_ms=args.jitter, token_rate=args.token_rate,
+                  failure_rate=args.failure_rate, failure_mode=args.failure_mode, record_dir=args.record)
+    if args.record:
+        os.makedirs(args.record, exist_ok=True)
+        print(f"[Coze Mock] 录制模式：{UPSTREAM_URL} → {args.record}", flush=True)
+    else:
+        fixtures.extend(load_fixtures(args.fixtures))
+        if not fixtures:
+            raise SystemExit(f"[Coze Mock] {args.fixtures} 下没有 *.sse 录制文件")
+        print(f"[Coze Mock] 已加载 {len(fixtures)} 个录制流: {', '.join(name for name, _ in fixtures)}", flush=True)
+    print(f"[Coze Mock] 监听 http://{args.host}:{args.port}/v3/chat", flush=True)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Coze 非流式回复的文本清理（call_coze_api 使用）
+
+    1. 移除混入正文的 JSON 片段：不含花括号的 {...} 中出现 "msg_type"，
+       或出现 "data" 且其后还有至少两个双引号时整体删除；删除后外层变得不含花括号的，按同样规则继续判断
+    2. 连续空格合并为一个，去掉首尾空白和每行首尾空白
+    3. 去重：前一半与后一半完全相同时只保留一半；否则去掉连续重复的句子（按 。！？和换行切分，用 。连接）
+
+正则全部预编译。JSON 片段先用一次正则替换删除最内层的片段（常见的不嵌套情况到此结束），
+有删除且仍有花括号时再用栈扫描一遍得到最终结果；原实现反复 re.sub 直到不再变化，嵌套深时为平方复杂度。
+整体耗时与文本长度成线性关系。输出与原实现一致（见 test_coze_reply.py、bench_coze_reply.py）。
+"""
+import re
+
+_BRACES = re.compile(r'[{}]')
+_INNERMOST = re.compile(r'\{[^{}]*\}')
+_SPACES = re.compile(r' {2,}')
+_SENTENCE_END = re.compile(r'[。！？\n]')
+
+# 至少多少个字符（一半的长度）才做重复判断
+MIN_DUPLICATE_HALF = 20
+
+
+def _is_noise(fragment):
+    """不含花括号的 JSON 片段（不含两侧花括号）是否需要删除"""
+    if '"msg_type"' in fragment:
+        return True
+    at = fragment.find('"data"')
+    return at >= 0 and fragment.count('"', at + 6) >= 2
+
+
+def _drop_noise(match):
+    fragment = match.group()
+    return '' if _is_noise(fragment[1:-1]) else fragment
+
+
+def _strip_nested(text):
+    """栈扫描：片段闭合时判断是否删除，删除后外层按同样规则继续判断"""
+    out = []       # 输出片段
+    stack = []     # 未闭合的 {：(在 out 中的下标, 其后是否还没有保留下来的花括号)
+    last = 0
+    for match in _BRACES.finditer(text):
+        pos = match.start()
+        if pos > last:
+            out.append(text[last:pos])
+        last = pos + 1
+        if text[pos] == '{':
+            stack.append((len(out), True))
+            out.append('{')
+            continue
+        if not stack:
+            out.append('}')
+            continue
+        start, clean = stack.pop()
+        if clean and _is_noise(''.join(out[start + 1:])):
+            del out[start:]
+            continue
+        out.append('}')
+        if stack:
+            # 保留下来的 {...} 让外层不再是“不含花括号”的片段，外层不会被删除
+            stack[-1] = (stack[-1][0], False)
+    if last < len(text):
+        out.append(text[last:])
+    return ''.join(out)
+
+
+def strip_json_fragments(text):
+    """删除混入的 JSON 片段（由内向外）"""
+    if '{' not in text:
+        return text
+    stripped = _INNERMOST.sub(_drop_noise, text)
+    if len(stripped) == len(text) or '{' not in stripped:
+        return stripped
+    # 删除后外层可能变成新的不含花括号的片段
+    return _strip_nested(stripped)
+
+
+def normalize_whitespace(text):
+    if '  ' in text:
+        text = _SPACES.sub(' ', text)
+    return '\n'.join(map(str.strip, text.strip().split('\n')))
+
+
+def dedupe(text):
+    half_len = len(text) // 2
+    if half_len <= MIN_DUPLICATE_HALF:
+        return text
+    # 奇数长度时两半长度不同，不可能相等
+    if len(text) % 2 == 0 and text[:half_len] == text[half_len:]:
+        return text[:half_len]
+    if len(text) > 40:
+        sentences = _SENTENCE_END.split(text)
+        if len(sentences) > 2:
+            cleaned = [sentences[0]]
+            cleaned.extend(sent for prev, sent in zip(sentences, sentences[1:]) if sent != prev)
+            if len(cleaned) < len(sentences):
+                return '。'.join(cleaned)
+    return text
+
+
+def clean_reply(text):
+    """完整的清理流程；空内容原样返回"""
+    if not text:
+        return text
+    return dedupe(normalize_whitespace(strip_json_fragments(text)))
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn 配置（命令行参数优先，这里只放钩子）
+多 worker 下 Prometheus 指标写入共享目录，由任一 worker 汇总输出（见 metrics.py）
+"""
+import os
+import shutil
+import tempfile
+
+
+def on_starting(server):
+    # 每次启动清空，避免上次运行的指标文件被累加
+    path = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'between_us_metrics'))
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
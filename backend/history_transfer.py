@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+聊天记录流式导出 / 导入（NDJSON）
+替代手工的 Supabase <-> SQLite 数据迁移（见 doc/archive/sqlite-migration-*），内存占用只与页大小 / 批大小有关：
+
+- 导出：按 id 键集分页（每页一次查询，HISTORY_TRANSFER_CHUNK 条），边读边写；
+  读取失败按退避重试 HISTORY_TRANSFER_RETRIES 次，仍失败则中止（不写 _end 行，可续传）
+- 文件格式（每行一个 JSON 对象）：
+    {"_export": {"version": 1, "backend": "sqlite", "tables": [...], "filters": {...}}}
+    {"_table": "coach_chats"}
+    {"id": 1, "user_id": 3, ...}                                             # 记录，列与模型 COLUMNS 一致
+    {"_checkpoint": {"table": "coach_chats", "after_id": 1000, "rows": 1000}}  # 每页之后
+    {"_end": {"rows": 1234, "seconds": 1.2, "rows_per_second": 1028}}
+- 导入：逐行读取，攒够 HISTORY_TRANSFER_BATCH 条用目标后端的 Batch.import_rows 一次提交
+  （按原 id 写入，已存在的 id 跳过，重复导入不产生重复数据）；每次提交后原子地写检查点文件，
+  中断后用同一个检查点文件重跑，从最后一次提交之后继续
+- 导出中断：--resume 截掉输出文件最后一个检查点之后的部分，从该检查点继续
+- migrate：源后端直接接到目标后端，不落盘；检查点记录最后提交的表和 id
+- 进度和吞吐（行/秒）输出到 stderr
+- 导入绕过了 save()：提交后递增教练上下文缓冲和存储缓存的版本号（同一台机器上的 worker 随之重新加载）
+- 导入到 Supabase 时 apply_batch 会推进 id 序列；数据库没有部署 apply_batch（退化为逐条写入）时序列不会推进，
+  导入完成后需对每张导入的表手动执行 setval（日志里会给出 SQL，见 SEQUENCE_NOTE），否则之后新建的行会 id 冲突
+
+用法：
+    python history_transfer.py export --backend supabase -o history.ndjson [--resume]
+    python history_transfer.py export --backend sqlite --tables coach_chats --user-id 3 -o coach_3.ndjson
+    python history_transfer.py import --backend sqlite -i history.ndjson --checkpoint history.ckpt
+    python history_transfer.py migrate --from supabase --to sqlite --checkpoint migrate.ckpt
+
+接口：/api/coach/history/export、/api/lounge/history/export 用 export_history() 输出当前用户的记录（?after_id= 续传）
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+import serializer
+from log import get_logger
+
+load_dotenv()
+
+log = get_logger('transfer')
+
+HISTORY_TRANSFER_CHUNK = int(os.getenv('HISTORY_TRANSFER_CHUNK', '1000'))
+HISTORY_TRANSFER_BATCH = int(os.getenv('HISTORY_TRANSFER_BATCH', '500'))
+HISTORY_TRANSFER_RETRIES = int(os.getenv('HISTORY_TRANSFER_RETRIES', '3'))
+HISTORY_TRANSFER_RETRY_BACKOFF = float(os.getenv('HISTORY_TRANSFER_RETRY_BACKOFF', '0.5'))
+
+FORMAT_VERSION = 1
+# 按外键依赖排序：导入时先写被引用的表
+TABLES = ('users', 'relationships', 'coach_chats', 'lounge_chats')
+HISTORY_TABLES = ('coach_chats', 'lounge_chats')
+# 按用户 / 房间导出时的过滤列
+SCOPES = {'coach_chats': 'user_id', 'lounge_chats': 'room_id'}
+_MODELS = {'users': 'User', 'relationships': 'Relationship', 'coach_chats': 'CoachChat', 'lounge_chats': 'LoungeChat'}
+_TIME_COLUMNS = ('created_at', 'unbind_at')
+
+
+def model_for(storage, table):
+    return getattr(storage, _MODELS[table])
+
+
+class Progress:
+    """行数和吞吐（行/秒）；out 不为空时每 interval 秒输出一次"""
+
+    def __init__(self, label, out=None, interval=5.0, rows=0):
+        self.label = label
+        self.out = out
+        self.interval = interval
+        self.base = rows        # 续传前已完成的行数（不计入本次吞吐）
+        self.rows = 0
+        self.started = self._last = time.perf_counter()
+
+    def add(self, n):
+        self.rows += n
+        now = time.perf_counter()
+        if self.out is not None and now - self._last >= self.interval:
+            self._last = now
+            self.report()
+
+    def summary(self):
+        seconds = time.perf_counter() - self.started
+        return {
+            'rows': self.base + self.rows,
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(self.rows / seconds) if seconds > 0 else 0
+        }
+
+    def report(self, final=False):
+        if self.out is None:
+            return
+        s = self.summary()
+        print(f"[{self.label}] {s['rows']} 行  {s['seconds']:.1f}s  {s['rows_per_second']} 行/秒"
+              f"{'（完成）' if final else ''}", file=self.out, flush=True)
+
+
+# ==================== 导出 ====================
+
+def _record(obj, columns):
+    record = {}
+    for column in columns:
+        value = getattr(obj, column, None)
+        record[column] = value.isoformat() if isinstance(value, datetime) else value
+    return record
+
+
+def iter_pages(model, filters=None, after_id=0, chunk=None):
+    """按 id 升序分页读取（每页一次查询），每次产出一页模型对象"""
+    chunk = chunk or HISTORY_TRANSFER_CHUNK
+
+    def query(*columns):
+        q = model.query(*columns).gt('id', after_id)
+        for column, value in (filters or {}).items():
+            q = q.eq(column, value)
+        return q.order('id')
+
+    while True:
+        rows = _read_page(model, query().limit(chunk), after_id)
+        if rows:
+            yield rows
+            after_id = rows[-1].id
+        if len(rows) < chunk:
+            return
+
+
+def _read_page(model, query, after_id):
+    """
+    读取一页；查询失败时抛出而不是当作空页（否则导出 / 迁移会在失败处悄悄结束并写出 _end 行）
+    失败后按指数退避重试 HISTORY_TRANSFER_RETRIES 次，仍失败则抛出，导出中止（不写 _end 行），可从最后一个检查点续传
+    """
+    for attempt in range(HISTORY_TRANSFER_RETRIES + 1):
+        try:
+            return query.all(raise_errors=True)
+        except Exception as e:
+            if attempt >= HISTORY_TRANSFER_RETRIES:
+                log.error("读取 %s 失败，导出中止", model.TABLE, extra={'after_id': after_id, 'error': str(e)})
+                raise
+            delay = HISTORY_TRANSFER_RETRY_BACKOFF * (2 ** attempt)
+            log.warning("读取 %s 失败，%.1fs 后第 %d 次重试", model.TABLE, delay, attempt + 1,
+                        extra={'after_id': after_id, 'error': str(e)})
+            time.sleep(delay)
+
+
+def export_chunks(storage, tables, filters=None, start=None, chunk=None, progress=None):
+    """
+    按页产出导出文件的各行（每次一个 dict 列表：一页记录加一个检查点）
+    filters：{表: {列: 值}}；start：检查点 {'table', 'after_id', 'rows'}，从它之后继续（之前的表视为已导出）
+    """
+    filters = filters or {}
+    tables = list(tables)
+    if start:
+        tables = tables[tables.index(start['table']):]
+    rows = start['rows'] if start else 0
+    for table in tables:
+        model = model_for(storage, table)
+        after_id = start['after_id'] if start and table == start['table'] else 0
+        yield [{'_table': table}]
+        for page in iter_pages(model, filters.get(table), after_id, chunk):
+            rows += len(page)
+            if progress is not None:
+                progress.add(len(page))
+            yield [_record(obj, model.COLUMNS) for obj in page] + \
+                [{'_checkpoint': {'table': table, 'after_id': page[-1].id, 'rows': rows}}]
+
+
+def export_lines(storage, tables, filters=None, start=None, chunk=None, progress=None, header=True):
+    """导出为 NDJSON 字节（每页一块）；header=False 时不输出首行（续写已有文件）"""
+    progress = progress or Progress('导出')
+    if header:
+        yield serializer.dumpb({'_export': {
+            'version': FORMAT_VERSION,
+            'backend': getattr(storage, '__name__', None),
+            'tables': list(tables),
+            'filters': filters or {},
+            'created_at': datetime.now().isoformat()
+        }}) + b'\n'
+    for records in export_chunks(storage, tables, filters, start, chunk, progress):
+        yield b''.join(serializer.dumpb(record) + b'\n' for record in records)
+    summary = progress.summary()
+    log.info("导出完成: %s 行, %s 行/秒", summary['rows'], summary['rows_per_second'])
+    yield serializer.dumpb({'_end': summary}) + b'\n'
+
+
+def export_history(storage, table, value, after_id=0, chunk=None):
+    """单个用户 / 房间的聊天记录（接口用）；after_id 为客户端收到的最后一个检查点，从它之后继续"""
+    start = {'table': table, 'after_id': after_id, 'rows': 0} if after_id else None
+    return export_lines(storage, [table], {table: {SCOPES[table]: value}}, start, chunk)
+
+
+def scan_export(path):
+    """
+    读取（可能不完整的）导出文件，返回 (首行, 最后一个检查点, 检查点之后的偏移量, 是否已结束)
+    只解析以 {"_ 开头的控制行，逐行读取，内存与文件大小无关
+    """
+    header, checkpoint, offset, finished = None, None, 0, False
+    position = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            position += len(line)
+            if not line.endswith(b'\n'):
+                break       # 写到一半的行
+            if not line.startswith(b'{"_'):
+                continue
+            record = serializer.loads(line)
+            if '_export' in record:
+                header, offset = record['_export'], position
+            elif '_checkpoint' in record:
+                checkpoint, offset = record['_checkpoint'], position
+            elif '_end' in record:
+                finished, offset = True, position
+    return header, checkpoint, offset, finished
+
+
+# ==================== 导入 ====================
+
+def to_object(model, record):
+    """导出记录 -> 目标后端的模型对象（时间列转回 datetime，缺失的列用模型默认值）"""
+    data = dict(record)
+    for column in _TIME_COLUMNS:
+        value = data.get(column)
+        if isinstance(value, str):
+            try:
+                data[column] = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            except ValueError:
+                pass        # 交给模型自己的解析
+    build = getattr(model, 'from_row', None) or model.from_dict
+    return build(data)
+
+
+def read_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return serializer.loads(f.read())
+
+
+def write_checkpoint(path, state):
+    """原子写入：先写临时文件再替换，中断时不会留下半个检查点"""
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(serializer.dumpb(state))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Importer:
+    """
+    逐条接收导出记录，攒批写入目标后端（每批一个 Batch，一次提交）
+    每次提交后写检查点 {'table', 'after_id', 'rows', 'offset'}；offset 为输入文件中已提交部分的字节数（读文件时才有）
+    """
+
+    def __init__(self, storage, batch_size=None, checkpoint=None, progress=None, resume=None):
+        self.storage = storage
+        self.batch_size = batch_size or HISTORY_TRANSFER_BATCH
+        self.checkpoint = checkpoint
+        self.progress = progress or Progress('导入')
+        self.state = dict(resume or {'table': None, 'after_id': 0, 'rows': 0})
+        self.progress.base = self.state['rows']
+        self.table = self.state['table']
+        self.model = model_for(storage, self.table) if self.table else None
+        self.pending = []
+        self.offset = self.state.get('offset')
+        self.finished = False
+
+    def feed(self, record, offset=None):
+        """接收一行（offset：这一行之后的文件偏移量）"""
+        if '_table' in record:
+            self.flush()
+            self.table = record['_table']
+            self.model = model_for(self.storage, self.table)
+        elif '_end' in record:
+            self.flush()
+            self.finished = True
+        elif '_export' not in record and '_checkpoint' not in record:
+            if self.model is None:
+                raise ValueError("导入数据缺少 _table 行")
+            self.pending.append(record)
+        self.offset = offset
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        records, self.pending = self.pending, []
+        with self.storage.batch() as unit:
+            unit.import_rows(self.model, [to_object(self.model, record) for record in records])
+        self._invalidate(records)
+        self.progress.add(len(records))
+        self.state = {'table': self.table, 'after_id': records[-1]['id'],
+                      'rows': self.state['rows'] + len(records), 'offset': self.offset}
+        if self.checkpoint:
+            write_checkpoint(self.checkpoint, self.state)
+
+    def _invalidate(self, records):
+        """导入绕过了 save()：递增相关缓存的版本号"""
+        if self.table == 'coach_chats':
+            import coach_context
+            coach_context.invalidate({record['user_id'] for record in records})
+        elif self.table in ('users', 'relationships'):
+            from storage_cache import get_cache
+            get_cache().invalidate(self.table)
+
+    def read(self, f):
+        """从二进制文件逐行导入；从检查点续传时先跳到已提交的位置"""
+        position = self.state.get('offset') or 0
+        if position:
+            f.seek(position)
+        for line in f:
+            position += len(line)
+            if not line.strip():
+                continue
+            self.feed(serializer.loads(line), position)
+        self.flush()
+
+
+def import_file(storage, path, batch_size=None, checkpoint=None, progress=None):
+    """导入一个导出文件，返回 Importer（state 为最后一次提交的位置）"""
+    resume = read_checkpoint(checkpoint)
+    if resume and resume.get('offset') is None:
+        raise ValueError(f"检查点 {checkpoint} 不是由文件导入产生的")
+    importer = Importer(storage, batch_size, checkpoint, progress, resume)
+    with open(path, 'rb') as f:
+        importer.read(f)
+    return importer
+
+
+def migrate(source, target, tables=TABLES, filters=None, chunk=None, batch_size=None, checkpoint=None,
+            progress=None):
+    """源后端直接导入目标后端；checkpoint 存在时从最后一次提交之后继续"""
+    resume = read_checkpoint(checkpoint)
+    importer = Importer(target, batch_size, checkpoint, progress, resume)
+    start = resume if resume and resume.get('table') else None
+    for records in export_chunks(source, tables, filters, start, chunk):
+        for record in records:
+            importer.feed(record)
+    importer.flush()
+    importer.finished = True
+    return importer
+
+
+# ==================== 命令行 ====================
+
+SEQUENCE_NOTE = """目标为 supabase 时：数据库已部署 supabase_migrations.sql 中的 apply_batch 则 id 序列自动推进；
+否则导入退化为逐条写入，序列不会推进，导入完成后需在 Supabase SQL Editor 对每张导入的表执行
+    SELECT setval(pg_get_serial_sequence('<表名>', 'id'), (SELECT COALESCE(MAX(id), 1) FROM <表名>));
+（日志中会给出具体语句），否则之后新建的行会与导入的 id 冲突"""
+
+def _load(name):
+    import storage
+    return storage.load_backend(name)
+
+
+def _filters(args):
+    filters = {}
+    if args.user_id is not None:
+        filters['coach_chats'] = {'user_id': args.user_id}
+    if args.room_id is not None:
+        filters['lounge_chats'] = {'room_id': args.room_id}
+    return filters
+
+
+def _tables(args):
+    if args.tables:
+        tables = [t.strip() for t in args.tables.split(',') if t.strip()]
+    elif args.user_id is not None or args.room_id is not None:
+        tables = [t for t in HISTORY_TABLES if t in _filters(args)]
+    else:
+        tables = list(TABLES)
+    unknown = set(tables) - set(TABLES)
+    if unknown:
+        raise SystemExit(f"未知的表: {', '.join(sorted(unknown))}（可选: {', '.join(TABLES)}）")
+    return [t for t in TABLES if t in tables]
+
+
+def cmd_export(args):
+    storage = _load(args.backend)
+    tables, filters, start, header = _tables(args), _filters(args), None, True
+    if args.resume and os.path.exists(args.output):
+        previous, checkpoint, offset, finished = scan_export(args.output)
+        if finished:
+            print(f"{args.output} 已导出完成", file=sys.stderr)
+            return
+        if previous:
+            tables, filters, start, header = previous['tables'], previous['filters'], checkpoint, False
+        with open(args.output, 'r+b') as f:
+            f.truncate(offset)
+        print(f"从检查点继续导出: {start or '开头'}", file=sys.stderr)
+    progress = Progress('导出', out=sys.stderr, rows=start['rows'] if start else 0)
+    with open(args.output, 'ab' if not header else 'wb') as f:
+        for chunk in export_lines(storage, tables, filters, start, args.chunk, progress, header=header):
+            f.write(chunk)
+    progress.report(final=True)
+
+
+def cmd_import(args):
+    storage = _load(args.backend)
+    progress = Progress('导入', out=sys.stderr)
+    importer = import_file(storage, args.input, args.batch, args.checkpoint, progress)
+    progress.report(final=True)
+    if not importer.finished:
+        print("输入文件没有 _end 行（导出可能未完成）", file=sys.stderr)
+
+
+def cmd_migrate(args):
+    if args.source == args.target:
+        raise SystemExit("源后端和目标后端相同")
+    progress = Progress('迁移', out=sys.stderr)
+    migrate(_load(args.source), _load(args.target), _tables(args), _filters(args), args.chunk, args.batch,
+            args.checkpoint, progress)
+    progress.report(final=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='聊天记录流式导出 / 导入（NDJSON）')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    def scope(p):
+        p.add_argument('--tables', help=f"逗号分隔（默认全部: {','.join(TABLES)}；指定用户/房间时只导出聊天记录）")
+        p.add_argument('--user-id', type=int, help='只导出该用户的个人教练记录')
+        p.add_argument('--room-id', help='只导出该房间的情感客厅记录')
+        p.add_argument('--chunk', type=int, default=HISTORY_TRANSFER_CHUNK, help='每页读取条数')
+
+    p = sub.add_parser('export', help='导出为 NDJSON 文件')
+    p.add_argument('--backend', required=True)
+    p.add_argument('-o', '--output', required=True)
+    p.add_argument('--resume', action='store_true', help='从输出文件最后一个检查点继续')
+    scope(p)
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser('import', help='从 NDJSON 文件导入', epilog=SEQUENCE_NOTE,
+                       formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--backend', required=True)
+    p.add_argument('-i', '--input', required=True)
+    p.add_argument('--checkpoint', help='检查点文件（存在时从中断处继续）')
+    p.add_argument('--batch', type=int, default=HISTORY_TRANSFER_BATCH, help='每次提交条数')
+    p.set_defaults(func=cmd_import)
+
+    p = sub.add_parser('migrate', help='从一个后端直接迁移到另一个后端', epilog=SEQUENCE_NOTE,
+                       formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--from', dest='source', required=True)
+    p.add_argument('--to', dest='target', required=True)
+    p.add_argument('--checkpoint', help='检查点文件（存在时从中断处继续）')
+    p.add_argument('--batch', type=int, default=HISTORY_TRANSFER_BATCH, help='每次提交条数')
+    scope(p)
+    p.set_defaults(func=cmd_migrate)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
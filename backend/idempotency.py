@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""
+Idempotency-Key 支持（/api/lounge/send、/api/coach/chat/stream、/api/lounge/call_ai/stream）
+移动端网络不稳定时会重试请求，没有幂等键时每次重试都会多存一条消息、多调用一次 Coze。
+
+- 客户端在请求头带 Idempotency-Key（同一次操作的重试用同一个值），键按 用户 + 接口 区分
+- 记录写入本机共享的 SQLite 文件（IDEMPOTENCY_DB_PATH），gunicorn 的任一 worker 都能查到；
+  超过 IDEMPOTENCY_TTL 秒的记录视为过期，总数超过 IDEMPOTENCY_MAX_KEYS 时删除最早的
+- 普通接口：2xx 响应保存下来，重复请求原样返回（响应头 Idempotent-Replayed: true）；
+  非 2xx 不保存，重试会重新执行；原请求还在处理时返回 409
+- 流式接口：逐帧记录 SSE 输出；重复请求不再调用 Coze，而是从第一帧开始回放，
+  原请求还在生成时跟着读取新帧（接上正在进行的生成）。带幂等键的流客户端断开后继续生成到结束，
+  以 error / busy 事件结束的记录标记为失败，之后的重试重新执行
+- 同一个键用于不同的请求体时返回 422；原请求所在进程已退出时，重试重新执行
+  （所属进程按 pid + 启动时间 + 开机 id 识别，见 process_identity.py，容器重启后 pid 被复用时也能判断）
+
+用法：
+    idempotency.init_app(app)
+
+    claim = idempotency.claim(user_id, stream=True)     # 没有请求头时返回 None
+    if claim is not None and claim.duplicate:
+        return claim.replay()
+    ...
+    # 包在 stream_with_context 外面：流还没开始就断开时，Response.close() 也会调用记录器的 close()
+    Response(idempotency.record(claim, stream_with_context(generate())), ...)
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from flask import Response, g, request
+
+import process_identity
+import sse
+from log import get_logger
+
+log = get_logger('idempotency')
+
+IDEMPOTENCY_ENABLED = os.getenv('IDEMPOTENCY_ENABLED', '1') == '1'
+IDEMPOTENCY_DB_PATH = os.getenv('IDEMPOTENCY_DB_PATH', os.path.join(tempfile.gettempdir(), 'between_us_idempotency.db'))
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', '600'))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv('IDEMPOTENCY_MAX_KEYS', '10000'))
+# 重复的流式请求跟读原请求的最长时间
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', '120'))
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+# 跟读其他 worker 的流时，查询新帧的间隔
+POLL_INTERVAL_SECONDS = 0.1
+PURGE_INTERVAL_SECONDS = 60
+# 以这些事件结束的流视为失败，重试时重新执行
+FAILED_EVENTS = ('error', 'busy')
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'X-Accel-Buffering': 'no'
+}
+
+
+class IdempotencyError(Exception):
+    """幂等键无效（400）、原请求处理中（409）或与原请求不一致（422）"""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _last_event_type(frame):
+    """一帧里可能合并了多个事件，取最后一个的 type"""
+    try:
+        payload = frame.rstrip('\n').rsplit('\n\n', 1)[-1]
+        return json.loads(payload[len('data: '):]).get('type')
+    except (ValueError, AttributeError):
+        return None
+
+
+class IdempotencyStore:
+    """幂等记录和流式帧（本机 SQLite 文件，多个 worker 共享）"""
+
+    COLUMNS = ('key', 'fingerprint', 'kind', 'status', 'owner_pid', 'owner', 'response', 'created_at', 'expires_at')
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                owner_pid INTEGER,
+                owner TEXT,
+                response TEXT,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        # 加入进程身份之前建的文件（/tmp 在容器重启后仍保留）
+        if 'owner' not in {row[1] for row in conn.execute('PRAGMA table_info(idempotency_keys)')}:
+            conn.execute('ALTER TABLE idempotency_keys ADD COLUMN owner TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys(created_at)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_frames (
+                key TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (key, seq)
+            )
+        ''')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _row(self, row):
+        return dict(zip(self.COLUMNS, row)) if row is not None else None
+
+    def get(self, key):
+        row = self._conn().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+        return self._row(row)
+
+    def claim(self, key, fingerprint, kind, owner, ttl):
+        """
+        登记一个键，返回 (是否新登记, 记录)
+        已有未过期的记录：请求体不一致时抛 IdempotencyError(422)；已完成或原进程仍在处理时返回原记录；
+        失败或原进程已退出的记录由本次请求接管
+        """
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            record = self.get(key)
+            if record is not None and record['expires_at'] > now:
+                if record['fingerprint'] != fingerprint:
+                    raise IdempotencyError('Idempotency-Key 已用于不同的请求', 422)
+                if record['status'] == 'done' or (record['status'] == 'pending' and
+                                                  process_identity.alive(record['owner'], record['owner_pid'])):
+                    conn.execute('COMMIT')
+                    return False, record
+            record = {'key': key, 'fingerprint': fingerprint, 'kind': kind, 'status': 'pending',
+                      'owner_pid': process_identity.pid_of(owner), 'owner': owner,
+                      'response': None, 'created_at': now, 'expires_at': now + ttl}
+            conn.execute("DELETE FROM idempotency_frames WHERE key = ?", (key,))
+            conn.execute(
+                f"INSERT OR REPLACE INTO idempotency_keys ({', '.join(self.COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                tuple(record[c] for c in self.COLUMNS))
+            conn.execute('COMMIT')
+            return True, record
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def complete(self, key, response):
+        self._conn().execute(
+            "UPDATE idempotency_keys SET status = 'done', response = ? WHERE key = ?",
+            (json.dumps(response, ensure_ascii=False), key))
+
+    def finish(self, key, status):
+        self._conn().execute("UPDATE idempotency_keys SET status = ? WHERE key = ?", (status, key))
+
+    def release(self, key):
+        conn = self._conn()
+        conn.execute("DELETE FROM idempotency_keys WHERE key = ?", (key,))
+        conn.execute("DELETE FROM idempotency_frames WHERE key = ?", (key,))
+
+    def append(self, key, seq, data):
+        self._conn().execute("INSERT INTO idempotency_frames (key, seq, data) VALUES (?, ?, ?)", (key, seq, data))
+
+    def frames(self, key, after=0):
+        return self._conn().execute(
+            "SELECT seq, data FROM idempotency_frames WHERE key = ? AND seq > ? ORDER BY seq", (key, after)).fetchall()
+
+    def purge(self, now, max_keys):
+        """删除过期记录；超过 max_keys 时再删除最早的已结束记录，返回删除条数"""
+        conn = self._conn()
+        removed = conn.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (now,)).rowcount
+        excess = conn.execute("SELECT COUNT(*) FROM idempotency_keys").fetchone()[0] - max_keys
+        if excess > 0:
+            removed += conn.execute(
+                "DELETE FROM idempotency_keys WHERE key IN (SELECT key FROM idempotency_keys "
+                "WHERE status != 'pending' ORDER BY created_at LIMIT ?)", (excess,)).rowcount
+        if removed:
+            conn.execute("DELETE FROM idempotency_frames WHERE key NOT IN (SELECT key FROM idempotency_keys)")
+        return removed
+
+    def counts(self):
+        rows = self._conn().execute("SELECT kind, status, COUNT(*) FROM idempotency_keys GROUP BY kind, status").fetchall()
+        counts = {}
+        for kind, status, count in rows:
+            counts.setdefault(kind, {})[status] = count
+        return counts
+
+
+class Claim:
+    """一次带幂等键的请求"""
+
+    def __init__(self, manager, key, kind, created, record):
+        self.manager = manager
+        self.key = key
+        self.kind = kind            # 'json' / 'stream'
+        self.created = created      # True：本次请求负责执行；False：重复请求
+        self.record = record
+        self.recording = False      # 流式响应已交给 _Recorder，结束状态由它写入
+
+    @property
+    def duplicate(self):
+        return not self.created
+
+    def replay(self):
+        """重复请求的响应：普通接口返回保存的响应，流式接口回放（跟读）原请求的帧"""
+        if self.kind == 'stream':
+            self.manager._count('attached')
+            response = Response(self.manager.follow(self.key), mimetype='text/event-stream', headers=SSE_HEADERS)
+        else:
+            self.manager._count('replayed')
+            saved = json.loads(self.record['response'])
+            response = Response(saved['body'], status=saved['status'], mimetype=saved['mimetype'])
+        response.headers[REPLAYED_HEADER] = 'true'
+        return response
+
+
+class _Recorder:
+    """
+    流式响应记录：逐帧写入存储后交给客户端
+    客户端断开（或流还没开始就被关闭）时继续生成到结束，重试的请求可以接上
+    """
+
+    def __init__(self, manager, claim, frames):
+        self.manager = manager
+        self.claim = claim
+        self._frames = iter(frames)
+        self._seq = 0
+        self._last = None
+        self._closed = False
+        claim.recording = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        try:
+            frame = next(self._frames)
+        except StopIteration:
+            self._finish()
+            raise
+        except Exception:
+            self._finish(failed=True)
+            raise
+        self._append(frame)
+        return frame
+
+    def _append(self, frame):
+        self._seq += 1
+        self._last = frame
+        try:
+            self.manager.store.append(self.claim.key, self._seq, frame)
+        except sqlite3.Error as e:
+            log.warning("记录流式帧失败: %s", e)
+
+    def _finish(self, failed=False):
+        self._closed = True
+        close = getattr(self._frames, 'close', None)
+        if close is not None:
+            close()
+        failed = failed or self._last is None or _last_event_type(self._last) in FAILED_EVENTS
+        try:
+            self.manager.store.finish(self.claim.key, 'failed' if failed else 'done')
+        except sqlite3.Error as e:
+            log.warning("记录流式结束状态失败: %s", e)
+
+    def close(self):
+        if self._closed:
+            return
+        drained = 0
+        try:
+            for frame in self._frames:
+                self._append(frame)
+                drained += 1
+        except Exception as e:
+            log.warning("客户端断开后继续生成失败: %s", e)
+            self._finish(failed=True)
+            return
+        self._finish()
+        log.info("客户端已断开，生成已完成", extra={'frames': self._seq, 'drained': drained})
+
+
+class IdempotencyManager:
+    def __init__(self, store, ttl=IDEMPOTENCY_TTL, max_keys=IDEMPOTENCY_MAX_KEYS, wait_seconds=IDEMPOTENCY_WAIT_SECONDS):
+        self.store = store
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.wait_seconds = wait_seconds
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._stats = {'claimed': 0, 'replayed': 0, 'attached': 0, 'in_progress': 0, 'conflicts': 0, 'released': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def claim(self, scope, key, fingerprint, stream=False):
+        if not key or len(key) > MAX_KEY_LENGTH or not key.isprintable():
+            raise IdempotencyError(f'{HEADER} 无效（1-{MAX_KEY_LENGTH} 个可见字符）', 400)
+        self._maybe_purge()
+        full_key = f"{scope}:{key}"
+        kind = 'stream' if stream else 'json'
+        try:
+            created, record = self.store.claim(full_key, fingerprint, kind, process_identity.current(), self.ttl)
+        except IdempotencyError:
+            self._count('conflicts')
+            raise
+        if created:
+            self._count('claimed')
+        elif kind == 'json' and record['status'] == 'pending':
+            self._count('in_progress')
+            raise IdempotencyError('相同的请求正在处理中，请稍后重试', 409)
+        return Claim(self, full_key, kind, created, record)
+
+    def complete(self, claim, response):
+        """普通接口：2xx 保存响应，其余释放（重试时重新执行）"""
+        if 200 <= response.status_code < 300 and not response.is_streamed:
+            self.store.complete(claim.key, {
+                'status': response.status_code,
+                'mimetype': response.mimetype,
+                'body': response.get_data(as_text=True),
+            })
+        else:
+            self.release(claim)
+
+    def release(self, claim):
+        self.store.release(claim.key)
+        self._count('released')
+
+    def record(self, claim, frames):
+        return _Recorder(self, claim, frames)
+
+    def follow(self, key):
+        """从第一帧开始回放，原请求还在生成时跟着读取新帧"""
+        seq = 0
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            record = self.store.get(key)
+            for seq, data in self.store.frames(key, seq):
+                yield data
+            if record is None or record['status'] == 'failed':
+                if seq == 0:
+                    yield sse.event({'type': 'error', 'content': '原请求已失败，请重新发送'})
+                return
+            if record['status'] == 'done':
+                return
+            if not process_identity.alive(record['owner'], record['owner_pid']) or time.monotonic() >= deadline:
+                yield sse.event({'type': 'error', 'content': '原请求已中断，请重新发送'})
+                return
+            time.sleep(POLL_INTERVAL_SECONDS)
+
+    def _maybe_purge(self):
+        now = time.time()
+        if now - self._last_purge < PURGE_INTERVAL_SECONDS:
+            return
+        self._last_purge = now
+        try:
+            self.store.purge(now, self.max_keys)
+        except sqlite3.Error as e:
+            log.warning("清理幂等记录失败: %s", e)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        return {
+            'pid': os.getpid(),
+            'db_path': self.store.path,
+            'ttl': self.ttl,
+            'max_keys': self.max_keys,
+            'requests': stats,
+            'keys': self.store.counts(),
+        }
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = IdempotencyManager(IdempotencyStore(IDEMPOTENCY_DB_PATH))
+    return _manager
+
+
+def fingerprint():
+    """请求指纹：方法、路径、JSON 请求体（键排序）和查询参数"""
+    body = request.get_json(silent=True)
+    if body is None:
+        body = request.get_data(as_text=True)
+    digest = hashlib.sha256()
+    digest.update(f"{request.method} {request.path}\n".encode('utf-8'))
+    digest.update(json.dumps(body, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    digest.update(json.dumps(sorted(request.args.items(multi=True)), ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def claim(user_id, stream=False):
+    """登记本次请求的幂等键；请求头没有 Idempotency-Key（或 IDEMPOTENCY_ENABLED=0）时返回 None"""
+    key = request.headers.get(HEADER)
+    if not IDEMPOTENCY_ENABLED or key is None:
+        return None
+    result = get_manager().claim(f"{request.path}:{user_id}", key.strip(), fingerprint(), stream=stream)
+    if result.created:
+        g._idempotency_claim = result
+    return result
+
+
+def record(claim, frames):
+    """流式响应：有幂等键时逐帧记录，否则原样返回"""
+    if claim is None or not claim.created:
+        return frames
+    return get_manager().record(claim, frames)
+
+
+def init_app(app):
+    """请求结束时保存普通接口的响应；未交给 _Recorder 的流式请求、出错的请求释放幂等键"""
+
+    @app.after_request
+    def settle_claim(response):
+        pending = g.pop('_idempotency_claim', None)
+        if pending is None or pending.recording:
+            return response
+        try:
+            if pending.kind == 'json':
+                pending.manager.complete(pending, response)
+            else:
+                pending.manager.release(pending)
+        except sqlite3.Error as e:
+            log.warning("保存幂等记录失败: %s", e)
+        return response
+
+    @app.teardown_request
+    def release_claim(exc):
+        pending = g.pop('_idempotency_claim', None)
+        if pending is not None and not pending.recording:
+            try:
+                pending.manager.release(pending)
+            except sqlite3.Error as e:
+                log.warning("释放幂等键失败: %s", e)
+
+
+def stats():
+    return dict(get_manager().stats(), enabled=IDEMPOTENCY_ENABLED)
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+后台任务（非流式 AI 调用）
+/api/coach/chat、/api/lounge/call_ai 不再在请求线程里等 Coze（最长 60 秒），
+而是提交任务、立即返回 job_id，客户端通过 /api/jobs/<id> 轮询或 /api/jobs/<id>/wait 等待结果。
+
+- 每个 bot 一条执行通道（lane），各自一个有界线程池：
+    JOBS_CONCURRENCY 按通道设置并发数，如 "coach=4,lounge=2"（未设置的通道用 JOBS_DEFAULT_CONCURRENCY）
+    JOBS_MAX_QUEUE 每条通道排队 + 执行中的上限，超过时提交失败（JobQueueFull，接口返回 503）
+- 任务状态写入本机共享的 SQLite 文件（JOBS_DB_PATH），gunicorn 的任一 worker 都能查询；
+  worker 重启后，新进程把所属进程已退出、仍处于 queued / running 的任务接过来重新执行
+  （所属进程按 pid + 启动时间 + 开机 id 识别，见 process_identity.py，pid 被复用时也能判断）
+  （最多 JOBS_MAX_ATTEMPTS 次，超过则标记为 failed）
+- 执行过的任务被接管时，进程可能是在写入结果之后、标记完成之前退出的：注册了 resume 的任务类型
+  重新执行前先调用它，返回已有结果时直接标记完成，不再调用 Coze、不重复写入
+- 结束超过 JOBS_RETENTION_SECONDS 的任务在提交新任务时顺带清理
+- 排队时间、执行时间等交给 observers（metrics.py 用来汇总指标）
+
+用法：
+    import jobs
+
+    @jobs.handler('coach_chat', lane='coach', resume=find_coach_reply)
+    def run_coach_chat(params):
+        return {'message': ...}          # 返回值需可 JSON 序列化
+
+    job = jobs.submit('coach_chat', {'user_id': 1, ...}, user_id=1)
+    jobs.get_job(job['id'])
+"""
+import json
+import os
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import process_identity
+from log import get_logger
+
+log = get_logger('jobs')
+
+JOBS_DB_PATH = os.getenv('JOBS_DB_PATH', os.path.join(tempfile.gettempdir(), 'between_us_jobs.db'))
+JOBS_DEFAULT_CONCURRENCY = int(os.getenv('JOBS_DEFAULT_CONCURRENCY', '4'))
+JOBS_CONCURRENCY = {
+    lane.strip(): int(value)
+    for lane, _, value in (item.partition('=') for item in os.getenv('JOBS_CONCURRENCY', '').split(','))
+    if value.strip()
+}
+JOBS_MAX_QUEUE = int(os.getenv('JOBS_MAX_QUEUE', '32'))
+JOBS_MAX_ATTEMPTS = int(os.getenv('JOBS_MAX_ATTEMPTS', '2'))
+JOBS_RETENTION_SECONDS = int(os.getenv('JOBS_RETENTION_SECONDS', '3600'))
+JOBS_MAX_WAIT_SECONDS = float(os.getenv('JOBS_MAX_WAIT_SECONDS', '25'))
+# 等待其他 worker 执行的任务时，查询数据库的间隔
+POLL_INTERVAL_SECONDS = 0.2
+PURGE_INTERVAL_SECONDS = 60
+
+FINAL_STATES = ('done', 'failed')
+
+
+class JobQueueFull(Exception):
+    """通道排队已满"""
+
+    def __init__(self, lane, retry_after=5):
+        super().__init__(f"任务通道 {lane} 已满")
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+# observer(lane, event, **fields)
+#   event='queued'：fields = kind
+#   event='rejected'：fields = kind
+#   event='started'：fields = kind、queue_seconds
+#   event='finished'：fields = kind、status（done / failed）、seconds
+#   event='skipped'：fields = kind（开始前已被其他进程接管，不执行）
+observers = []
+
+
+def _notify(lane, event, **fields):
+    for observer in observers:
+        try:
+            observer(lane, event, **fields)
+        except Exception as e:
+            log.error("任务观察者异常: %s", e)
+
+
+class JobStore:
+    """任务状态（本机 SQLite 文件，多个 worker 共享）"""
+
+    COLUMNS = ('id', 'kind', 'lane', 'user_id', 'status', 'params', 'result', 'error',
+               'owner_pid', 'owner', 'attempts', 'created_at', 'started_at', 'finished_at')
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                lane TEXT NOT NULL,
+                user_id INTEGER,
+                status TEXT NOT NULL,
+                params TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                owner_pid INTEGER,
+                owner TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+        ''')
+        # 加入进程身份之前建的文件（/tmp 在容器重启后仍保留）
+        if 'owner' not in {row[1] for row in conn.execute('PRAGMA table_info(jobs)')}:
+            conn.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _row(self, row):
+        if row is None:
+            return None
+        job = dict(zip(self.COLUMNS, row))
+        job['params'] = json.loads(job['params'])
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+    def insert(self, job):
+        self._conn().execute(
+            f"INSERT INTO jobs ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+            tuple(json.dumps(job[c], ensure_ascii=False) if c in ('params', 'result') and job[c] is not None
+                  else job[c] for c in self.COLUMNS)
+        )
+
+    def get(self, job_id):
+        row = self._conn().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(row)
+
+    def start(self, job_id, owner):
+        """queued -> running；任务已被其他进程接管时返回 False"""
+        cursor = self._conn().execute(
+            "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 "
+            "WHERE id = ? AND status = 'queued' AND owner = ?",
+            (time.time(), job_id, owner))
+        return cursor.rowcount == 1
+
+    def finish(self, job_id, status, result=None, error=None):
+        self._conn().execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+            (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error,
+             time.time(), job_id))
+
+    def orphans(self, owner):
+        """不属于 owner 的未结束任务（所属进程是否还在由调用方判断）"""
+        rows = self._conn().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE status IN ('queued', 'running') AND owner IS NOT ?",
+            (owner,)).fetchall()
+        return [self._row(row) for row in rows]
+
+    def adopt(self, job, owner):
+        """把已退出进程的任务改为本进程排队；与其他 worker 竞争时只有一个成功"""
+        cursor = self._conn().execute(
+            "UPDATE jobs SET status = 'queued', owner_pid = ?, owner = ? "
+            "WHERE id = ? AND owner IS ? AND owner_pid IS ? AND status IN ('queued', 'running')",
+            (process_identity.pid_of(owner), owner, job['id'], job['owner'], job['owner_pid']))
+        return cursor.rowcount == 1
+
+    def purge(self, before):
+        cursor = self._conn().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (before,))
+        return cursor.rowcount
+
+    def counts(self):
+        rows = self._conn().execute("SELECT lane, status, COUNT(*) FROM jobs GROUP BY lane, status").fetchall()
+        counts = {}
+        for lane, status, count in rows:
+            counts.setdefault(lane, {})[status] = count
+        return counts
+
+
+class Lane:
+    """一个 bot 的执行通道：有界线程池 + 排队计数"""
+
+    def __init__(self, name, concurrency, max_queue):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"job-{name}")
+        self.pending = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, force=False):
+        with self._lock:
+            if self.pending >= self.max_queue and not force:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.pending -= 1
+
+
+class JobManager:
+    def __init__(self, store, max_queue=JOBS_MAX_QUEUE):
+        self.store = store
+        self.max_queue = max_queue
+        self._handlers = {}   # kind -> (fn, lane, resume)
+        self._lanes = {}
+        self._events = {}     # 本进程执行中的任务 -> 完成事件
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def _lane(self, name):
+        with self._lock:
+            lane = self._lanes.get(name)
+            if lane is None:
+                concurrency = JOBS_CONCURRENCY.get(name, JOBS_DEFAULT_CONCURRENCY)
+                lane = self._lanes[name] = Lane(name, concurrency, self.max_queue)
+            return lane
+
+    def handler(self, kind, lane, resume=None):
+        """
+        注册任务类型（装饰器）
+        resume(params)：任务被接管重跑前调用，上次执行已经写入结果时返回该结果（否则返回 None）
+        """
+        def decorator(fn):
+            self._handlers[kind] = (fn, lane, resume)
+            return fn
+        return decorator
+
+    def submit(self, kind, params, user_id=None):
+        _, lane_name, _ = self._handlers[kind]
+        lane = self._lane(lane_name)
+        if not lane.reserve():
+            _notify(lane_name, 'rejected', kind=kind)
+            raise JobQueueFull(lane_name)
+        job = {
+            'id': secrets.token_urlsafe(12),
+            'kind': kind,
+            'lane': lane_name,
+            'user_id': user_id,
+            'status': 'queued',
+            'params': params,
+            'result': None,
+            'error': None,
+            'owner_pid': os.getpid(),
+            'owner': process_identity.current(),
+            'attempts': 0,
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+        }
+        try:
+            self.store.insert(job)
+        except Exception:
+            lane.release()
+            raise
+        self._dispatch(job, lane)
+        self._maybe_purge()
+        return job
+
+    def _dispatch(self, job, lane):
+        with self._lock:
+            self._events[job['id']] = threading.Event()
+        _notify(lane.name, 'queued', kind=job['kind'])
+        lane.executor.submit(self._run, job, lane)
+
+    def _run(self, job, lane):
+        job_id, kind = job['id'], job['kind']
+        fn, _, resume = self._handlers[kind]
+        started = time.time()
+        status = 'failed'
+        try:
+            if not self.store.start(job_id, process_identity.current()):
+                _notify(lane.name, 'skipped', kind=kind)
+                return
+            _notify(lane.name, 'started', kind=kind, queue_seconds=max(0.0, started - job['created_at']))
+            try:
+                result = None
+                if job['attempts'] and resume is not None:
+                    result = resume(job['params'])
+                    if result is not None:
+                        log.warning("接管的任务上次已写入结果，不再重复执行: %s %s", kind, job_id)
+                if result is None:
+                    result = fn(job['params'])
+                self.store.finish(job_id, 'done', result=result)
+                status = 'done'
+            except Exception as e:
+                log.exception("任务执行失败: %s %s", kind, job_id)
+                self.store.finish(job_id, 'failed', error=f"{type(e).__name__}: {e}")
+            _notify(lane.name, 'finished', kind=kind, status=status, seconds=time.time() - started)
+        except Exception as e:
+            log.error("任务状态更新失败: %s %s: %s", kind, job_id, e)
+        finally:
+            lane.release()
+            with self._lock:
+                event = self._events.pop(job_id, None)
+            if event is not None:
+                event.set()
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def wait(self, job_id, timeout):
+        """等待任务结束或超时，返回任务当前状态"""
+        timeout = max(0.0, min(timeout, JOBS_MAX_WAIT_SECONDS))
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            event = self._events.get(job_id)
+        if event is not None:
+            # 本进程执行的任务：等完成事件，不查库
+            event.wait(timeout)
+            return self.store.get(job_id)
+        while True:
+            job = self.store.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job['status'] in FINAL_STATES or remaining <= 0:
+                return job
+            time.sleep(min(POLL_INTERVAL_SECONDS, remaining))
+
+    def recover(self):
+        """接管已退出进程遗留的任务（每个 worker 启动时调用一次）"""
+        owner = process_identity.current()
+        recovered = failed = 0
+        for job in self.store.orphans(owner):
+            if process_identity.alive(job['owner'], job['owner_pid']) or job['kind'] not in self._handlers:
+                continue
+            if job['attempts'] >= JOBS_MAX_ATTEMPTS:
+                self.store.finish(job['id'], 'failed', error='worker 退出，重试次数已用完')
+                failed += 1
+                continue
+            if not self.store.adopt(job, owner):
+                continue
+            lane = self._lane(job['lane'])
+            # 接管的任务不受排队上限限制，避免重启后丢任务
+            lane.reserve(force=True)
+            job['owner_pid'], job['owner'] = os.getpid(), owner
+            self._dispatch(job, lane)
+            recovered += 1
+        if recovered or failed:
+            log.warning("接管遗留任务", extra={'recovered': recovered, 'failed': failed})
+        return recovered
+
+    def _maybe_purge(self):
+        now = time.time()
+        if now - self._last_purge < PURGE_INTERVAL_SECONDS:
+            return
+        self._last_purge = now
+        try:
+            self.store.purge(now - JOBS_RETENTION_SECONDS)
+        except sqlite3.Error as e:
+            log.warning("清理过期任务失败: %s", e)
+
+    def stats(self):
+        return {
+            'pid': os.getpid(),
+            'db_path': self.store.path,
+            'max_queue': self.max_queue,
+            'lanes': {
+                name: {'concurrency': lane.concurrency, 'pending': lane.pending, 'rejected': lane.rejected}
+                for name, lane in self._lanes.items()
+            },
+            'jobs': self.store.counts(),
+        }
+
+
+def public_view(job):
+    """返回给客户端的任务信息（不含参数和内部字段）"""
+    def iso(ts):
+        return datetime.fromtimestamp(ts).isoformat(timespec='milliseconds') if ts else None
+
+    view = {
+        'id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'result': job['result'],
+        'error': job['error'],
+        'created_at': iso(job['created_at']),
+        'started_at': iso(job['started_at']),
+        'finished_at': iso(job['finished_at']),
+    }
+    if job['started_at']:
+        view['queue_ms'] = round((job['started_at'] - job['created_at']) * 1000, 1)
+    if job['finished_at'] and job['started_at']:
+        view['run_ms'] = round((job['finished_at'] - job['started_at']) * 1000, 1)
+    return view
+
+
+manager = JobManager(JobStore(JOBS_DB_PATH))
+handler = manager.handler
+submit = manager.submit
+get_job = manager.get
+wait_job = manager.wait
+recover = manager.recover
+stats = manager.stats
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+端到端压测脚本
+模拟 N 对情侣：每人每 1.5 秒轮询客厅新消息，随机发消息、找个人教练、召唤客厅 AI，
+统计各接口 p50/p95/p99 延迟、流式接口首字时间（TTFT）和错误率。
+
+用法：
+    # 全离线：自动启动 Coze 模拟服务和应用（内存存储）
+    python loadtest.py --spawn --couples 20 --duration 60
+
+    # 压测已经运行的服务
+    python loadtest.py --base-url http://127.0.0.1:7860 --couples 20 --duration 60 --json report.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, p):
+    """最近秩百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = math.ceil(p / 100 * len(ordered))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+class Recorder:
+    """按接口汇总延迟、首字时间和错误"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def _entry(self, name):
+        return self._data.setdefault(name, {'latency': [], 'ttft': [], 'errors': 0, 'count': 0, 'error_samples': {}})
+
+    def record(self, name, latency, ok, ttft=None, error=None):
+        with self._lock:
+            entry = self._entry(name)
+            entry['count'] += 1
+            entry['latency'].append(latency)
+            if ttft is not None:
+                entry['ttft'].append(ttft)
+            if not ok:
+                entry['errors'] += 1
+                key = str(error)[:80]
+                entry['error_samples'][key] = entry['error_samples'].get(key, 0) + 1
+
+    def report(self, duration):
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+
+        with self._lock:
+            result = {}
+            for name, entry in sorted(self._data.items()):
+                result[name] = {
+                    'count': entry['count'],
+                    'rps': round(entry['count'] / duration, 2) if duration else None,
+                    'error_rate': round(entry['errors'] / entry['count'], 4) if entry['count'] else 0.0,
+                    'p50_ms': ms(percentile(entry['latency'], 50)),
+                    'p95_ms': ms(percentile(entry['latency'], 95)),
+                    'p99_ms': ms(percentile(entry['latency'], 99)),
+                    'ttft_p50_ms': ms(percentile(entry['ttft'], 50)),
+                    'ttft_p95_ms': ms(percentile(entry['ttft'], 95)),
+                    'ttft_p99_ms': ms(percentile(entry['ttft'], 99)),
+                    'errors': dict(entry['error_samples']),
+                }
+            return result
+
+
+class Client:
+    """一个模拟用户（独立的 Session，复用连接）"""
+
+    def __init__(self, base_url, recorder, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.phone = '177' + str(secrets.randbelow(10 ** 8)).zfill(8)
+        self.user = None
+        self.room_id = None
+        self.last_id = 0
+
+    def call(self, name, method, path, **kwargs):
+        """普通 JSON 接口：记录延迟，返回 (ok, data)"""
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+            data = response.json() if response.content else {}
+            ok = response.status_code < 400 and data.get('success', True)
+            error = None if ok else f"HTTP {response.status_code}: {data.get('message', '')}"
+        except Exception as e:
+            ok, data, error = False, {}, type(e).__name__
+        self.recorder.record(name, time.perf_counter() - start, ok, error=error)
+        return ok, data
+
+    def stream(self, name, path, payload):
+        """SSE 接口：记录首个 reasoning/content 事件的时间（TTFT）和完整耗时"""
+        start = time.perf_counter()
+        ttft = None
+        ok, error = False, None
+        try:
+            with self.session.post(self.base_url + path, json=payload, timeout=self.timeout, stream=True) as response:
+                if response.status_code >= 400:
+                    error = f"HTTP {response.status_code}"
+                else:
+                    for line in response.iter_lines():
+                        if not line or not line.startswith(b'data:'):
+                            continue
+                        event = json.loads(line[5:])
+                        kind = event.get('type')
+                        if kind in ('reasoning', 'content') and ttft is None:
+                            ttft = time.perf_counter() - start
+                        if kind == 'error':
+                            error = f"error: {event.get('content', '')}"
+                            break
+                        if kind == 'done':
+                            ok = True
+                            break
+                    if not ok and error is None:
+                        error = 'stream ended without done'
+        except Exception as e:
+            error = type(e).__name__
+        self.recorder.record(name, time.perf_counter() - start, ok, ttft=ttft, error=error)
+        return ok
+
+    def register_and_login(self):
+        ok, _ = self.call('register', 'POST', '/api/register', json={'phone': self.phone, 'password': 'loadtest'})
+        if not ok:
+            return False
+        ok, data = self.call('login', 'POST', '/api/login', json={'phone': self.phone, 'password': 'loadtest'})
+        if ok:
+            self.user = data['user']
+            self.session.headers['Authorization'] = f"Bearer {data['token']}"
+        return ok
+
+
+def setup_couple(base_url, recorder, timeout):
+    """注册两位用户并绑定，返回 (a, b)；失败返回 None"""
+    a, b = Client(base_url, recorder, timeout), Client(base_url, recorder, timeout)
+    if not (a.register_and_login() and b.register_and_login()):
+        return None
+    ok, data = a.call('binding_code', 'GET', '/api/binding/code')
+    if not ok:
+        return None
+    ok, _ = b.call('bind', 'POST', '/api/binding/bind', json={'binding_code': data['binding_code']})
+    if not ok:
+        return None
+    for client in (a, b):
+        ok, data = client.call('bootstrap', 'GET', '/api/lounge/bootstrap')
+        if not ok:
+            return None
+        client.room_id = data['room_id']
+        client.last_id = data.get('since_id') or 0
+    return a, b
+
+
+def run_user(client, args, stop_at, is_caller):
+    """单个用户的行为循环：固定间隔轮询，按泊松过程触发其他动作"""
+    next_send = time.time() + random.expovariate(1 / args.send_interval)
+    next_coach = time.time() + random.expovariate(1 / args.coach_interval)
+    next_lounge_ai = time.time() + random.expovariate(1 / args.lounge_ai_interval)
+    next_poll = time.time() + random.uniform(0, args.poll_interval)
+    while time.time() < stop_at:
+        now = time.time()
+        if now >= next_poll:
+            ok, data = client.call('messages_new', 'GET', f'/api/lounge/messages/new?since_id={client.last_id}')
+            if ok and data.get('messages'):
+                client.last_id = max(m['id'] for m in data['messages'])
+            next_poll += args.poll_interval
+        if now >= next_send:
+            client.call('lounge_send', 'POST', '/api/lounge/send',
+                        json={'room_id': client.room_id, 'content': f'压测消息 {secrets.token_hex(4)}'})
+            next_send = now + random.expovariate(1 / args.send_interval)
+        if now >= next_coach:
+            client.stream('coach_stream', '/api/coach/chat/stream', {'message': '最近和TA相处有点累，想聊聊'})
+            next_coach = time.time() + random.expovariate(1 / args.coach_interval)
+        if is_caller and now >= next_lounge_ai:
+            client.stream('lounge_ai_stream', '/api/lounge/call_ai/stream', {'room_id': client.room_id})
+            next_lounge_ai = time.time() + random.expovariate(1 / args.lounge_ai_interval)
+        time.sleep(max(0.0, min(next_poll, next_send) - time.time()))
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return True
+        except requests.RequestException:
+            time.sleep(0.2)
+    return False
+
+
+def spawn_services(args):
+    """启动 Coze 模拟服务和应用，返回 (base_url, 进程列表)"""
+    mock_cmd = [sys.executable, os.path.join(BACKEND_DIR, 'coze_mock_server.py'), '--port', str(args.mock_port),
+                '--latency', str(args.mock_latency), '--token-rate', str(args.mock_token_rate),
+                '--failure-rate', str(args.mock_failure_rate)]
+    env = dict(os.environ,
+               STORAGE_BACKEND=args.backend,
+               SQLITE_DB_PATH=os.path.join(tempfile.mkdtemp(prefix='loadtest_'), 'loadtest.db'),
+               COZE_API_URL=f"http://127.0.0.1:{args.mock_port}/v3/chat",
+               COZE_API_KEY='mock', COZE_BOT_ID_COACH='mock_coach', COZE_BOT_ID_LOUNGE='mock_lounge',
+               PORT=str(args.app_port), FLASK_ENV='production')
+    app_cmd = [sys.executable, '-c', "from app import app; import os; app.run(host='127.0.0.1', port=int(os.environ['PORT']), threaded=True)"]
+    log = open(os.path.join(tempfile.gettempdir(), 'loadtest_services.log'), 'w')
+    processes = [
+        subprocess.Popen(mock_cmd, cwd=BACKEND_DIR, stdout=log, stderr=subprocess.STDOUT),
+        subprocess.Popen(app_cmd, cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT),
+    ]
+    base_url = f"http://127.0.0.1:{args.app_port}"
+    if not (wait_for(f"http://127.0.0.1:{args.mock_port}/stats") and wait_for(base_url + '/api/debug/config')):
+        for p in processes:
+            p.terminate()
+        raise SystemExit(f"服务启动失败，日志见 {log.name}")
+    print(f"[Loadtest] 已启动模拟服务和应用（{args.backend} 存储），日志: {log.name}", flush=True)
+    return base_url, processes
+
+
+def print_report(report, duration):
+    print("=" * 118)
+    print(f"{'接口':<18}{'请求数':>8}{'RPS':>8}{'错误率':>8}{'p50':>9}{'p95':>9}{'p99':>9}"
+          f"{'TTFT p50':>11}{'TTFT p95':>11}{'TTFT p99':>11}")
+    print("-" * 118)
+    for name, r in report.items():
+        fmt = lambda v: f"{v:.0f}ms" if v is not None else '-'
+        print(f"{name:<18}{r['count']:>8}{r['rps']:>8}{r['error_rate']:>8.1%}{fmt(r['p50_ms']):>9}{fmt(r['p95_ms']):>9}"
+              f"{fmt(r['p99_ms']):>9}{fmt(r['ttft_p50_ms']):>11}{fmt(r['ttft_p95_ms']):>11}{fmt(r['ttft_p99_ms']):>11}")
+    print("=" * 118)
+    print(f"压测时长 {duration:.1f}s")
+    for name, r in report.items():
+        for error, count in r['errors'].items():
+            print(f"  ⚠️  {name}: {error} × {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='端到端压测（模拟情侣使用客厅和教练）')
+    parser.add_argument('--base-url', default='http://127.0.0.1:7860')
+    parser.add_argument('--couples', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=60, help='压测时长（秒）')
+    parser.add_argument('--poll-interval', type=float, default=1.5)
+    parser.add_argument('--send-interval', type=float, default=10, help='平均发消息间隔（秒）')
+    parser.add_argument('--coach-interval', type=float, default=60, help='平均找教练间隔（秒）')
+    parser.add_argument('--lounge-ai-interval', type=float, default=45, help='每对情侣平均召唤 AI 间隔（秒）')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--json', metavar='PATH', help='把报告写入 JSON 文件')
+    parser.add_argument('--spawn', action='store_true', help='自动启动 Coze 模拟服务和应用')
+    parser.add_argument('--backend', default='memory', help='--spawn 时应用使用的存储后端')
+    parser.add_argument('--app-port', type=int, default=17860)
+    parser.add_argument('--mock-port', type=int, default=18080)
+    parser.add_argument('--mock-latency', type=float, default=800)
+    parser.add_argument('--mock-token-rate', type=float, default=30)
+    parser.add_argument('--mock-failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    processes = []
+    base_url = args.base_url
+    if args.spawn:
+        base_url, processes = spawn_services(args)
+    try:
+        recorder = Recorder()
+        couples = []
+        for _ in range(args.couples):
+            couple = setup_couple(base_url, recorder, args.timeout)
+            if couple:
+                couples.append(couple)
+        print(f"[Loadtest] {len(couples)}/{args.couples} 对情侣就绪，开始压测 {args.duration:.0f}s", flush=True)
+
+        start = time.time()
+        stop_at = start + args.duration
+        threads = []
+        for a, b in couples:
+            for client, is_caller in ((a, True), (b, False)):
+                t = threading.Thread(target=run_user, args=(client, args, stop_at, is_caller), daemon=True)
+                t.start()
+                threads.append(t)
+        for t in threads:
+            t.join()
+        duration = time.time() - start
+
+        report = recorder.report(duration)
+        print_report(report, duration)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump({'config': vars(args), 'duration_s': round(duration, 2), 'endpoints': report},
+                          f, ensure_ascii=False, indent=2)
+            print(f"报告已写入 {args.json}")
+        return 0 if couples else 1
+    finally:
+        for p in processes:
+            p.terminate()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
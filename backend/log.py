@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+结构化日志（替代 print(..., flush=True)）
+    - 分级：LOG_LEVEL（默认 INFO），LOG_LEVELS 按类别覆盖，如 "coze.stream=DEBUG,db=WARNING"
+    - 抽样：LOG_SAMPLE 按类别抽样 INFO 及以下的记录，如 "coze.stream=0.01,coach=0.1"（WARNING 及以上不抽样）
+    - 非阻塞：调用线程只把记录放进有界队列，后台线程负责格式化、脱敏和写出；队列满时丢弃并计数
+    - 脱敏：手机号只保留前 3 后 4 位；password / token / api_key 等字段和 Bearer 令牌替换为 ***
+    - 格式：LOG_FORMAT=json（默认，一行一个 JSON）/ text（本地开发）
+
+用法：
+    from log import get_logger
+    log = get_logger('coze')
+    log.info("请求完成", extra={'bot': 'coach', 'duration_ms': 12.3})
+    log.debug("原始事件: %s", line)   # 参数在确定输出后才格式化
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+from datetime import datetime
+from threading import Lock
+
+ROOT = 'between_us'
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+
+def _parse_pairs(value):
+    """"a=1,b=2" -> {'a': '1', 'b': '2'}"""
+    pairs = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            key, _, val = item.partition('=')
+            pairs[key.strip()] = val.strip()
+    return pairs
+
+
+LOG_LEVELS = {k: v.upper() for k, v in _parse_pairs(os.getenv('LOG_LEVELS')).items()}
+LOG_SAMPLE = {k: float(v) for k, v in _parse_pairs(os.getenv('LOG_SAMPLE')).items()}
+
+# ==================== 脱敏 ====================
+
+SENSITIVE_KEYS = {'password', 'passwd', 'token', 'api_key', 'secret', 'authorization'}
+_PHONE = re.compile(r'(?<!\d)(1[3-9]\d)\d{4}(\d{4})(?!\d)')
+_SECRET_FIELD = re.compile(
+    r'''(["']?(?:password|passwd|token|api_key|secret)["']?\s*[:=]\s*)(["']?)[^"',\s}]+''', re.IGNORECASE)
+_BEARER = re.compile(r'Bearer\s+[\w.\-]+')
+
+
+def redact(text):
+    text = _PHONE.sub(r'\1****\2', text)
+    text = _SECRET_FIELD.sub(r'\1\2***', text)
+    return _BEARER.sub('Bearer ***', text)
+
+
+def _redact_value(key, value):
+    if key.lower() in SENSITIVE_KEYS:
+        return '***'
+    if isinstance(value, str):
+        return redact(value)
+    if isinstance(value, dict):
+        return {k: _redact_value(str(k), v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_redact_value(key, v) for v in value]
+    return value
+
+
+# ==================== 格式化（在后台线程执行） ====================
+# 异常堆栈已在入队时转成 record.exc_text（见 DroppingQueueHandler.prepare）
+
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def _category(record):
+    return record.name[len(ROOT) + 1:] if record.name.startswith(ROOT + '.') else record.name
+
+
+def _fields(record):
+    return {k: _redact_value(k, v) for k, v in record.__dict__.items() if k not in _RESERVED}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'category': _category(record),
+            'msg': redact(record.getMessage()),
+            'pid': record.process,
+        }
+        entry.update(_fields(record))
+        if record.exc_text:
+            entry['exc'] = redact(record.exc_text)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{datetime.fromtimestamp(record.created).strftime('%H:%M:%S.%f')[:-3]} " \
+               f"{record.levelname:<7} [{_category(record)}] {redact(record.getMessage())}"
+        fields = _fields(record)
+        if fields:
+            line += ' ' + ' '.join(f"{k}={v}" for k, v in fields.items())
+        if record.exc_text:
+            line += '\n' + redact(record.exc_text)
+        return line
+
+
+# ==================== 抽样 + 非阻塞队列 ====================
+
+class SamplingFilter(logging.Filter):
+    """按类别（取最长匹配前缀）抽样 INFO 及以下的记录"""
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not LOG_SAMPLE:
+            return True
+        category = _category(record)
+        while True:
+            rate = LOG_SAMPLE.get(category)
+            if rate is not None:
+                return random.random() < rate
+            if '.' not in category:
+                return True
+            category = category.rsplit('.', 1)[0]
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃记录而不是阻塞请求线程"""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 只合并参数，格式化和脱敏留给后台线程
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_lock = Lock()
+_handler = None
+_listener = None
+
+
+def _start_listener():
+    global _handler, _listener
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+    _handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    _handler.addFilter(SamplingFilter())
+    _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=False)
+    _listener.start()
+
+    root = logging.getLogger(ROOT)
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(_handler)
+
+
+def configure():
+    """初始化（导入时自动调用，重复调用无效）"""
+    with _lock:
+        if _listener is not None:
+            return
+        root = logging.getLogger(ROOT)
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False
+        for category, level in LOG_LEVELS.items():
+            logging.getLogger(f"{ROOT}.{category}").setLevel(level)
+        _start_listener()
+        atexit.register(shutdown)
+        # gunicorn --preload 等 fork 场景：子进程里后台线程不存在，需要重新启动
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_start_listener)
+
+
+def shutdown():
+    """把队列里剩余的记录写完"""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def get_logger(category):
+    return logging.getLogger(f"{ROOT}.{category}")
+
+
+def stats():
+    return {
+        'level': LOG_LEVEL,
+        'format': LOG_FORMAT,
+        'levels': LOG_LEVELS,
+        'sample': LOG_SAMPLE,
+        'queued': _handler.queue.qsize() if _handler else 0,
+        'dropped': _handler.dropped if _handler else 0,
+    }
+
+
+configure()
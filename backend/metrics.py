@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus 指标（/metrics）
+    - HTTP：按路由模板统计请求数、耗时
+    - 存储：按后端 / 模型 / 方法统计调用数、耗时、错误
+    - Coze：按 bot（coach / lounge）统计响应状态、TTFT、每秒 token 数、流式时长、结束方式（含客户端取消）
+    - 准入控制：按 bot 统计 Coze 调用排队等待时间、排队中的调用数、被拒绝的次数（排队已满 / 等待超时）
+    - 后台任务：按通道（coach / lounge）统计排队时间、执行时间、结果、排队已满被拒绝的次数
+    - SQLite 检查点（SQLITE_LOCAL_PATH）：写回耗时、结果、当前未写回的滞后
+    - 仪表：进行中的 AI 流、待写入的异步保存、排队中的后台任务、缓存条目数
+
+多 worker：gunicorn 启动时设置 PROMETHEUS_MULTIPROC_DIR（见 gunicorn.conf.py），
+各 worker 把指标写入该目录下的 mmap 文件，任一 worker 响应 /metrics 时汇总全部进程。
+未设置该变量时（python app.py 单进程）使用进程内默认注册表。
+
+依赖 prometheus_client；未安装或 METRICS_ENABLED=0 时所有记录函数为空操作，/metrics 返回 404。
+"""
+import os
+import time
+
+try:
+    from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                                   generate_latest, multiprocess)
+except ImportError:  # pragma: no cover - 依赖缺失时降级
+    Counter = None
+
+from flask import Response, g, request
+
+import admission
+import jobs
+import request_timing
+import sqlite_checkpoint
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') != '0' and Counter is not None
+MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+# 进程级仪表（缓存条目数）最多每隔这么多秒刷新一次，避免每个请求都去算
+GAUGE_REFRESH_SECONDS = 5.0
+
+COZE_BOTS = {
+    os.getenv('COZE_BOT_ID_COACH', ''): 'coach',
+    os.getenv('COZE_BOT_ID_LOUNGE', ''): 'lounge',
+}
+COZE_BOTS.pop('', None)
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+STORAGE_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+AI_BUCKETS = (.25, .5, 1, 2, 3, 5, 8, 13, 20, 30, 45, 60, 90)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120)
+CHECKPOINT_BUCKETS = (.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+if METRICS_ENABLED:
+    HTTP_REQUESTS = Counter('http_requests_total', 'HTTP 请求数', ['method', 'route', 'status'])
+    HTTP_DURATION = Histogram('http_request_duration_seconds', 'HTTP 请求耗时（流式响应到连接关闭）',
+                              ['method', 'route'], buckets=LATENCY_BUCKETS)
+    STORAGE_CALLS = Counter('storage_calls_total', '存储调用数', ['backend', 'model', 'method', 'result'])
+    STORAGE_DURATION = Histogram('storage_call_duration_seconds', '存储调用耗时',
+                                 ['backend', 'model', 'method'], buckets=STORAGE_BUCKETS)
+    COZE_RESPONSES = Counter('coze_responses_total', 'Coze 请求数（按响应状态，error 为连接异常）', ['bot', 'status'])
+    COZE_CONNECT = Histogram('coze_connect_seconds', 'Coze 建连到收到响应头', ['bot'], buckets=AI_BUCKETS)
+    COZE_STREAMS = Counter('coze_streams_total', 'Coze 流结束方式', ['bot', 'outcome'])
+    COZE_CANCELLATIONS = Counter('coze_stream_cancellations_total', '客户端断开导致的流取消', ['bot'])
+    COZE_TTFT = Histogram('coze_time_to_first_token_seconds', '发出请求到第一个增量事件', ['bot'], buckets=AI_BUCKETS)
+    COZE_STREAM_DURATION = Histogram('coze_stream_duration_seconds', '发出请求到流结束', ['bot'], buckets=AI_BUCKETS)
+    COZE_TOKEN_RATE = Histogram('coze_tokens_per_second', '首个增量事件之后每秒的增量事件数', ['bot'],
+                                buckets=RATE_BUCKETS)
+    STREAMS_IN_FLIGHT = Gauge('coze_streams_in_flight', '正在读取的 Coze 流', ['bot'], multiprocess_mode='livesum')
+    WRITE_QUEUE_DEPTH = Gauge('write_queue_depth', '已提交、尚未完成的异步写入', multiprocess_mode='livesum')
+    CACHE_ENTRIES = Gauge('storage_cache_entries', '存储缓存条目数', multiprocess_mode='livesum')
+    ADMISSION_WAIT = Histogram('coze_admission_wait_seconds', 'Coze 调用排队等待名额（result：admitted / timeout）',
+                               ['bot', 'result'], buckets=LATENCY_BUCKETS)
+    ADMISSION_REJECTED = Counter('coze_admission_rejected_total', 'Coze 调用被准入控制拒绝', ['bot', 'reason'])
+    ADMISSION_QUEUED = Gauge('coze_admission_queued', '排队等待名额的 Coze 调用', ['bot'], multiprocess_mode='livesum')
+    JOBS_TOTAL = Counter('jobs_total', '后台任务数（按结果，rejected 为排队已满）', ['lane', 'status'])
+    JOB_QUEUE_SECONDS = Histogram('job_queue_seconds', '后台任务提交到开始执行', ['lane'], buckets=LATENCY_BUCKETS)
+    JOB_RUN_SECONDS = Histogram('job_run_seconds', '后台任务执行耗时', ['lane'], buckets=AI_BUCKETS)
+    JOBS_PENDING = Gauge('jobs_pending', '已提交、尚未结束的后台任务', ['lane'], multiprocess_mode='livesum')
+    CHECKPOINTS_TOTAL = Counter('sqlite_checkpoints_total', 'SQLite 检查点写回次数', ['result'])
+    CHECKPOINT_SECONDS = Histogram('sqlite_checkpoint_duration_seconds', 'SQLite 检查点写回耗时',
+                                   buckets=CHECKPOINT_BUCKETS)
+    # 只有负责写回的 worker 设置，其余为 0：取存活进程中的最大值
+    CHECKPOINT_LAG = Gauge('sqlite_checkpoint_lag_seconds', '最早一个未写回的修改距今', multiprocess_mode='livemax')
+
+_last_gauge_refresh = 0.0
+# 标签子对象缓存：轮询热路径上跳过 labels() 的加锁查找
+_http_children = {}
+
+
+def bot_label(bot_id):
+    return COZE_BOTS.get(bot_id, 'other')
+
+
+def _route_label():
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def _observe_storage(backend, model, method, seconds, error):
+    STORAGE_CALLS.labels(backend, model, method, 'error' if error else 'ok').inc()
+    STORAGE_DURATION.labels(backend, model, method).observe(seconds)
+
+
+def _observe_upstream(name, bot, event, **fields):
+    if name != 'coze':
+        return
+    label = bot_label(bot)
+    if event == 'open':
+        STREAMS_IN_FLIGHT.labels(label).inc()
+        return
+    if event == 'response':
+        status = fields['status']
+        COZE_RESPONSES.labels(label, str(status) if status else 'error').inc()
+        COZE_CONNECT.labels(label).observe(fields['seconds'])
+        return
+    STREAMS_IN_FLIGHT.labels(label).dec()
+    outcome = fields['outcome']
+    COZE_STREAMS.labels(label, outcome).inc()
+    if outcome == 'cancelled':
+        COZE_CANCELLATIONS.labels(label).inc()
+    COZE_STREAM_DURATION.labels(label).observe(fields['seconds'])
+    ttft = fields['ttft']
+    if ttft is not None:
+        COZE_TTFT.labels(label).observe(ttft)
+        generating = fields['seconds'] - ttft
+        if fields['tokens'] > 1 and generating > 0:
+            COZE_TOKEN_RATE.labels(label).observe((fields['tokens'] - 1) / generating)
+
+
+def _observe_admission(bot, event, **fields):
+    if event == 'queued':
+        ADMISSION_QUEUED.labels(bot).inc()
+    elif event == 'admitted':
+        if fields['queued']:
+            ADMISSION_QUEUED.labels(bot).dec()
+        ADMISSION_WAIT.labels(bot, 'admitted').observe(fields['wait_seconds'])
+    elif event == 'rejected':
+        ADMISSION_REJECTED.labels(bot, fields['reason']).inc()
+        if fields['reason'] == 'timeout':
+            ADMISSION_QUEUED.labels(bot).dec()
+            ADMISSION_WAIT.labels(bot, 'timeout').observe(fields['wait_seconds'])
+    elif event == 'cancelled':
+        ADMISSION_QUEUED.labels(bot).dec()
+
+
+def _observe_job(lane, event, **fields):
+    if event == 'queued':
+        JOBS_PENDING.labels(lane).inc()
+    elif event == 'rejected':
+        JOBS_TOTAL.labels(lane, 'rejected').inc()
+    elif event == 'started':
+        JOB_QUEUE_SECONDS.labels(lane).observe(fields['queue_seconds'])
+    elif event == 'skipped':
+        JOBS_PENDING.labels(lane).dec()
+    elif event == 'finished':
+        JOBS_PENDING.labels(lane).dec()
+        JOBS_TOTAL.labels(lane, fields['status']).inc()
+        JOB_RUN_SECONDS.labels(lane).observe(fields['seconds'])
+
+
+def _observe_checkpoint(event, **fields):
+    if event == 'lag':
+        CHECKPOINT_LAG.set(fields['seconds'])
+        return
+    CHECKPOINTS_TOTAL.labels('ok' if fields['ok'] else 'error').inc()
+    CHECKPOINT_SECONDS.observe(fields['seconds'])
+
+
+def write_queued():
+    if METRICS_ENABLED:
+        WRITE_QUEUE_DEPTH.inc()
+
+
+def write_done():
+    if METRICS_ENABLED:
+        WRITE_QUEUE_DEPTH.dec()
+
+
+def _refresh_gauges():
+    global _last_gauge_refresh
+    now = time.monotonic()
+    if now - _last_gauge_refresh < GAUGE_REFRESH_SECONDS:
+        return
+    _last_gauge_refresh = now
+    from storage_cache import cache_stats
+    CACHE_ENTRIES.set(sum(stats['size'] for stats in cache_stats().values()))
+
+
+def _registry():
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def init_app(app):
+    """注册请求计数中间件、存储 / 上游观察者和 /metrics"""
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        if not METRICS_ENABLED:
+            return Response('metrics disabled\n', status=404, mimetype='text/plain')
+        _refresh_gauges()
+        return Response(generate_latest(_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+    if not METRICS_ENABLED:
+        return
+    request_timing.storage_observers.append(_observe_storage)
+    request_timing.upstream_observers.append(_observe_upstream)
+    admission.observers.append(_observe_admission)
+    jobs.observers.append(_observe_job)
+    sqlite_checkpoint.observers.append(_observe_checkpoint)
+
+    @app.before_request
+    def start_metrics():
+        g._metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_metrics(response):
+        started = g.get('_metrics_started')
+        if started is None or request.path == '/metrics':
+            return response
+        key = (request.method, _route_label())
+        children = _http_children.get(key)
+        if children is None:
+            children = _http_children[key] = (HTTP_DURATION.labels(*key), {})
+        duration, counters = children
+        status = response.status_code
+        counter = counters.get(status)
+        if counter is None:
+            counter = counters[status] = HTTP_REQUESTS.labels(key[0], key[1], str(status))
+
+        def finish():
+            counter.inc()
+            duration.observe(time.perf_counter() - started)
+            _refresh_gauges()
+
+        response.call_on_close(finish)
+        return response
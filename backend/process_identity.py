@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+进程身份（jobs.py、idempotency.py 共用）
+后台任务和幂等记录写在本机共享的 SQLite 文件里，记录由哪个进程处理；文件在 /tmp，容器重启后还在，
+而 pid 会被复用，只比较 pid 会把已退出进程的记录当成仍在处理（任务不被接管，幂等重试一直 409）。
+
+身份 = "pid:启动时间:开机 id"：启动时间取 /proc/<pid>/stat 的 starttime（开机以来的时钟滴答），
+开机 id 取 /proc/sys/kernel/random/boot_id；pid 存活且三者都一致才视为同一个进程。
+没有 /proc 的系统（本地 macOS 开发）后两项为空，退化为只比较 pid。
+
+用法：
+    owner = process_identity.current()
+    process_identity.alive(record['owner'], record['owner_pid'])
+"""
+import os
+
+_BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+_boot_id = None
+_current = (None, None)     # (pid, 身份)：gunicorn 在导入后 fork，按 pid 缓存
+
+
+def _read_boot_id():
+    global _boot_id
+    if _boot_id is None:
+        try:
+            with open(_BOOT_ID_PATH) as f:
+                _boot_id = f.read().strip()
+        except OSError:
+            _boot_id = ''
+    return _boot_id
+
+
+def _start_time(pid):
+    """进程启动时间（开机以来的时钟滴答）；读不到时返回 None，没有 /proc 时返回空字符串"""
+    if not os.path.isdir('/proc'):
+        return ''
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # 第 2 列（进程名）可能含空格和括号：从最后一个 ')' 之后数，starttime 是第 22 列
+    return stat.rsplit(')', 1)[1].split()[19]
+
+
+def identity(pid):
+    """pid 对应进程当前的身份；进程不存在时返回 None"""
+    start = _start_time(pid)
+    if start is None:
+        return None
+    return f"{pid}:{start}:{_read_boot_id()}"
+
+
+def current():
+    """本进程的身份"""
+    global _current
+    pid = os.getpid()
+    if _current[0] != pid:
+        _current = (pid, identity(pid))
+    return _current[1]
+
+
+def pid_of(owner):
+    return int(owner.split(':', 1)[0]) if owner else None
+
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def alive(owner, pid=None):
+    """
+    记录的所属进程是否仍在运行
+    owner 为空（加入身份之前写入的记录）时只比较 pid
+    """
+    if not owner:
+        return _pid_alive(pid)
+    pid = pid_of(owner)
+    return _pid_alive(pid) and identity(pid) == owner
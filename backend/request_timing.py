@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+请求耗时分解
+按请求收集耗时片段（鉴权、每次存储调用、上游连接 / 首字节 / 流式、JSON 序列化），
+在响应头里输出 Server-Timing，慢请求（及按比例抽样的请求）写入进程内环形缓冲，
+由 /api/debug/timings 查询。
+
+说明：
+    - 片段可以嵌套（鉴权里包含一次 User.get），Server-Timing 按名称汇总
+    - SSE 等流式响应在生成器开始前就已发出响应头，流式阶段的片段只进入环形缓冲
+    - gunicorn 每个 worker 各自一份缓冲
+    - 后台线程（异步保存等）没有请求上下文，不记录
+    - 存储调用和上游调用的结果同时交给 storage_observers / upstream_observers（metrics.py 用来汇总指标）
+"""
+import os
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from threading import Lock
+
+import requests
+from flask import g, has_app_context, request
+
+from log import get_logger
+from serializer import JSONProvider
+
+log = get_logger('timing')
+
+REQUEST_TIMING_ENABLED = os.getenv('REQUEST_TIMING_ENABLED', '1') != '0'
+REQUEST_TIMING_SLOW_MS = float(os.getenv('REQUEST_TIMING_SLOW_MS', '500'))
+REQUEST_TIMING_SAMPLE_RATE = float(os.getenv('REQUEST_TIMING_SAMPLE_RATE', '0'))
+REQUEST_TIMING_BUFFER = int(os.getenv('REQUEST_TIMING_BUFFER', '200'))
+MAX_SPANS_PER_REQUEST = 200
+
+
+class RequestTimer:
+    """单个请求的耗时片段"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+        self.totals = {}
+
+    def add(self, name, started, duration, detail=None):
+        total, count = self.totals.get(name, (0.0, 0))
+        self.totals[name] = (total + duration, count + 1)
+        if len(self.spans) >= MAX_SPANS_PER_REQUEST:
+            self.dropped += 1
+            return
+        self.spans.append({
+            'name': name,
+            'detail': detail,
+            'start_ms': round((started - self.started) * 1000, 2),
+            'dur_ms': round(duration * 1000, 2),
+        })
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self, total_ms):
+        """Server-Timing 头：每类片段一项（dur 为累计，desc 为次数），最后是总耗时"""
+        parts = []
+        for name, (total, count) in self.totals.items():
+            entry = f"{name};dur={total * 1000:.1f}"
+            if count > 1:
+                entry += f';desc="{count}x"'
+            parts.append(entry)
+        parts.append(f"total;dur={total_ms:.1f}")
+        return ", ".join(parts)
+
+
+def current_timer():
+    if not has_app_context():
+        return None
+    return g.get('_request_timer')
+
+
+@contextmanager
+def span(name, detail=None):
+    """记录一段耗时（不在请求内时直接执行）"""
+    timer = current_timer()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, started, time.perf_counter() - started, detail)
+
+
+def timed(name):
+    """函数装饰器版本的 span"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ==================== 上游调用 ====================
+
+# observer(name, bot, event, **fields)
+#   event='response'：fields = status（状态码，异常时为 None）、seconds
+#   event='open'：开始读取流（与 'stream' 成对出现）
+#   event='stream'：fields = outcome（done / cancelled / incomplete / error）、ttft、tokens、seconds
+upstream_observers = []
+
+# SSE 中的增量事件（每个约等于一个 token 片段）和结束标记
+_DELTA_EVENT = b'event:conversation.message.delta'
+_DONE_MARKERS = (b'event:conversation.chat.completed', b'data:[DONE]', b'data:"[DONE]"')
+
+
+def _notify_upstream(name, bot, event, **fields):
+    for observer in upstream_observers:
+        try:
+            observer(name, bot, event, **fields)
+        except Exception as e:
+            log.error("上游观察者异常: %s", e)
+
+
+def timed_post(name, url, bot=None, **kwargs):
+    """requests.post，记录 <name>_connect（建连到收到响应头）"""
+    started = time.perf_counter()
+    status = None
+    try:
+        with span(f"{name}_connect"):
+            response = requests.post(url, **kwargs)
+        status = response.status_code
+        return response
+    finally:
+        if upstream_observers:
+            _notify_upstream(name, bot, 'response', status=status, seconds=time.perf_counter() - started)
+
+
+def timed_lines(name, response, bot=None):
+    """
+    response.iter_lines()，记录 <name>_ttfb（响应头到第一行）和 <name>_stream（第一行到结束）
+    同时统计首个增量事件的时间（TTFT，从发出请求算起）、增量事件数和结束方式
+    """
+    timer = current_timer()
+    started = time.perf_counter()
+    first_at = None
+    ttft = None
+    tokens = 0
+    outcome = 'incomplete'
+    if upstream_observers:
+        _notify_upstream(name, bot, 'open')
+    try:
+        for line in response.iter_lines():
+            now = time.perf_counter()
+            if first_at is None:
+                first_at = now
+                if timer is not None:
+                    timer.add(f"{name}_ttfb", started, first_at - started)
+            if line.startswith(_DELTA_EVENT):
+                tokens += 1
+                if ttft is None:
+                    ttft = response.elapsed.total_seconds() + (now - started)
+            elif line.startswith(_DONE_MARKERS):
+                outcome = 'done'
+            yield line
+    except GeneratorExit:
+        # 调用方提前关闭：客户端断开（或读到 [DONE] 后主动 break）
+        if outcome != 'done':
+            outcome = 'cancelled'
+        raise
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        ended = time.perf_counter()
+        if timer is not None and first_at is not None:
+            timer.add(f"{name}_stream", first_at, ended - first_at)
+        if upstream_observers:
+            _notify_upstream(name, bot, 'stream', outcome=outcome, ttft=ttft, tokens=tokens,
+                             seconds=response.elapsed.total_seconds() + (ended - started))
+
+
+# ==================== 存储调用 ====================
+
+class _TimedQuery:
+    """包装 Query：构造方法照常转发，all() / first() 计时"""
+
+    def __init__(self, backend, model, query):
+        self._backend = backend
+        self._model = model
+        self._query = query
+
+    def __getattr__(self, name):
+        attr = getattr(self._query, name)
+        if not callable(attr):
+            return attr
+
+        def builder(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return self if result is self._query else result
+        return builder
+
+    def all(self, raise_errors=False):
+        with _storage_call(self._backend, self._model.__name__, 'query'):
+            return self._query.all(raise_errors)
+
+    def first(self, raise_errors=False):
+        with _storage_call(self._backend, self._model.__name__, 'query'):
+            return self._query.first(raise_errors)
+
+
+# observer(backend, model, method, seconds, error)，后台线程中的调用也会通知
+storage_observers = []
+
+
+@contextmanager
+def _storage_call(backend, model, method):
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        timer = current_timer()
+        if timer is not None:
+            timer.add('db', started, duration, f"{model}.{method}")
+        _notify_storage(backend, model, method, duration, error)
+
+
+def _notify_storage(backend, model, method, seconds, error):
+    # 在 finally 中调用：观察者出错不能替换存储调用的结果或原来的异常
+    for observer in storage_observers:
+        try:
+            observer(backend, model, method, seconds, error)
+        except Exception as e:
+            log.error("存储观察者异常: %s", e)
+
+
+def _instrument_model(backend, model):
+    get, filter_, all_, query, save = model.get, model.filter, model.all, model.query, model.save
+    name = model.__name__
+
+    def timed_get(id):
+        with _storage_call(backend, name, 'get'):
+            return get(id)
+
+    def timed_filter(**kwargs):
+        with _storage_call(backend, name, 'filter'):
+            return filter_(**kwargs)
+
+    def timed_all():
+        with _storage_call(backend, name, 'all'):
+            return all_()
+
+    def timed_query(*columns):
+        return _TimedQuery(backend, model, query(*columns))
+
+    def timed_save(self):
+        with _storage_call(backend, name, 'save'):
+            return save(self)
+
+    model.get = staticmethod(timed_get)
+    model.filter = staticmethod(timed_filter)
+    model.all = staticmethod(timed_all)
+    model.query = staticmethod(timed_query)
+    model.save = timed_save
+
+
+_instrumented = set()
+
+
+def instrument_storage(storage):
+    """给存储模块的模型方法加计时（在 install_cache 之后调用，缓存命中也会计入）"""
+    if storage.__name__ in _instrumented:
+        return
+    backend = storage.__name__.replace('storage_', '')
+    for model_name in ('User', 'Relationship', 'CoachChat', 'LoungeChat'):
+        _instrument_model(backend, getattr(storage, model_name))
+    commit = storage.Batch.commit
+
+    def timed_commit(self):
+        with _storage_call(backend, 'batch', 'commit'):
+            return commit(self)
+
+    storage.Batch.commit = timed_commit
+    _instrumented.add(storage.__name__)
+
+
+# ==================== JSON 序列化 ====================
+
+class TimedJSONProvider(JSONProvider):
+    """jsonify 的序列化耗时计入 serialize（序列化实现见 serializer.py）"""
+
+    def response(self, *args, **kwargs):
+        with span('serialize'):
+            return super().response(*args, **kwargs)
+
+
+# ==================== 慢请求环形缓冲 ====================
+
+class TimingBuffer:
+    def __init__(self, maxlen=REQUEST_TIMING_BUFFER):
+        self._lock = Lock()
+        self._entries = deque(maxlen=maxlen)
+        self.recorded = 0
+
+    def add(self, entry):
+        with self._lock:
+            self._entries.append(entry)
+            self.recorded += 1
+
+    def query(self, limit=50, min_ms=0.0, path=None):
+        with self._lock:
+            entries = list(self._entries)
+        entries.reverse()
+        if min_ms:
+            entries = [e for e in entries if e['total_ms'] >= min_ms]
+        if path:
+            entries = [e for e in entries if e['path'].startswith(path)]
+        return entries[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+buffer = TimingBuffer()
+
+
+def init_app(app):
+    """注册计时中间件和 JSON 序列化计时"""
+    if not REQUEST_TIMING_ENABLED:
+        return
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_timer():
+        g._request_timer = RequestTimer()
+
+    @app.after_request
+    def add_server_timing(response):
+        timer = g.get('_request_timer')
+        if timer is None:
+            return response
+        response.headers['Server-Timing'] = timer.server_timing(timer.elapsed_ms())
+        method, path, status = request.method, request.path, response.status_code
+        streamed = response.is_streamed
+
+        def finish():
+            total_ms = timer.elapsed_ms()
+            if total_ms < REQUEST_TIMING_SLOW_MS and random.random() >= REQUEST_TIMING_SAMPLE_RATE:
+                return
+            buffer.add({
+                'at': datetime.now().isoformat(timespec='milliseconds'),
+                'method': method,
+                'path': path,
+                'status': status,
+                'streamed': streamed,
+                'slow': total_ms >= REQUEST_TIMING_SLOW_MS,
+                'total_ms': round(total_ms, 2),
+                'totals_ms': {name: round(total * 1000, 2) for name, (total, _) in timer.totals.items()},
+                'spans': list(timer.spans),
+                'dropped_spans': timer.dropped,
+            })
+
+        # 流式响应在生成器结束、连接关闭时才算完成
+        response.call_on_close(finish)
+        return response
+
+
+def stats():
+    return {
+        'pid': os.getpid(),
+        'enabled': REQUEST_TIMING_ENABLED,
+        'slow_ms': REQUEST_TIMING_SLOW_MS,
+        'sample_rate': REQUEST_TIMING_SAMPLE_RATE,
+        'buffer_size': buffer._entries.maxlen,
+        'recorded': buffer.recorded,
+    }
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+JSON 序列化层（jsonify、SSE 帧、流式历史记录共用）
+
+- 安装了 orjson 时使用 orjson（比标准库快数倍），否则用标准库 json；JSON_SERIALIZER=json 强制使用标准库
+- 两种实现输出同样的 JSON 值：datetime / date / Decimal / UUID / dataclass 交给 Flask 的默认转换，
+  按 provider.sort_keys 排序键；区别只在空白和非 ASCII 字符（orjson 直接输出 UTF-8，不转义）
+- 历史记录可以流式输出，不在内存里拼出整个响应：
+    - json_array()：{"success":true,"messages":[...]}，与一次性 jsonify 的结构相同，按页写出
+    - ndjson()：每行一条记录（application/x-ndjson）
+
+用法：
+    serializer.init_app(app)                          # jsonify 走这里（request_timing 的计时 provider 继承它）
+    serializer.dumps({'type': 'done'})                # -> str（紧凑格式，不转义中文）
+    Response(serializer.json_array(pages, {'success': True}), mimetype='application/json')
+"""
+import json
+import os
+
+from flask.json.provider import DefaultJSONProvider
+
+from log import get_logger
+
+log = get_logger('serializer')
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 依赖缺失时降级
+    orjson = None
+
+JSON_SERIALIZER = os.getenv('JSON_SERIALIZER', 'auto')
+if JSON_SERIALIZER == 'orjson' and orjson is None:
+    log.warning("JSON_SERIALIZER=orjson 但未安装 orjson，使用标准库 json")
+BACKEND = 'orjson' if orjson is not None and JSON_SERIALIZER != 'json' else 'json'
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+_default = DefaultJSONProvider.default
+# datetime 交给 default（与标准库实现一致，Flask 输出 HTTP 日期）；非字符串键转成字符串
+_ORJSON_OPTIONS = (orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+                   if orjson is not None else 0)
+
+
+def _dumpb_orjson(obj, sort_keys=False, indent=False):
+    option = _ORJSON_OPTIONS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(obj, default=_default, option=option)
+
+
+def _dumps_json(obj, sort_keys=False, indent=False):
+    if indent:
+        return json.dumps(obj, default=_default, ensure_ascii=False, sort_keys=sort_keys, indent=2)
+    return json.dumps(obj, default=_default, ensure_ascii=False, sort_keys=sort_keys, separators=(',', ':'))
+
+
+def dumpb(obj, sort_keys=False, indent=False, backend=None):
+    """序列化成 UTF-8 字节（紧凑格式）"""
+    if (backend or BACKEND) == 'orjson':
+        return _dumpb_orjson(obj, sort_keys, indent)
+    return _dumps_json(obj, sort_keys, indent).encode('utf-8')
+
+
+def dumps(obj, sort_keys=False, indent=False, backend=None):
+    """序列化成字符串（紧凑格式，不转义非 ASCII 字符）"""
+    if (backend or BACKEND) == 'orjson':
+        return _dumpb_orjson(obj, sort_keys, indent).decode('utf-8')
+    return _dumps_json(obj, sort_keys, indent)
+
+
+def loads(s):
+    return orjson.loads(s) if BACKEND == 'orjson' else json.loads(s)
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask JSON provider：jsonify / app.json.dumps 使用 BACKEND"""
+
+    def dumps(self, obj, **kwargs):
+        # 调用方传了标准库专有参数（cls、separators 等）时走标准库
+        if BACKEND != 'orjson' or set(kwargs) - {'indent', 'sort_keys'}:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj, sort_keys=kwargs.get('sort_keys', self.sort_keys), indent=bool(kwargs.get('indent')))
+
+    def loads(self, s, **kwargs):
+        if BACKEND != 'orjson' or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if BACKEND != 'orjson':
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        body = _dumpb_orjson(obj, sort_keys=self.sort_keys, indent=indent) + b'\n'
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def init_app(app):
+    app.json = JSONProvider(app)
+    log.info("JSON 序列化: %s", BACKEND)
+
+
+# ==================== 流式输出 ====================
+
+def json_array(pages, envelope=None, key='messages'):
+    """
+    按页输出 {**envelope, key: [...]}（UTF-8 字节，pages 每次产出一页可序列化的记录），每页序列化、写出一次；
+    峰值内存只与页大小有关。输出开始后出错时文档不完整，客户端解析失败即视为请求失败
+    """
+    head = dumpb(dict(envelope or {}, **{key: []}))
+    # b'{"success":true,"messages":[]}' -> b'{"success":true,"messages":[' + ... + b']}'
+    yield head[:-2]
+    first = True
+    for page in pages:
+        if not page:
+            continue
+        chunk = dumpb(page)[1:-1]
+        yield chunk if first else b',' + chunk
+        first = False
+    yield head[-2:]
+
+
+def ndjson(pages):
+    """按页输出 NDJSON（UTF-8 字节，每行一条记录）"""
+    for page in pages:
+        if page:
+            yield b''.join(dumpb(row) + b'\n' for row in page)
+
+
+def stats():
+    return {'backend': BACKEND, 'orjson_installed': orjson is not None, 'requested': JSON_SERIALIZER}
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite 本地工作副本 + 定期写回持久化目录
+/mnt/workspace 是网络盘，fsync 延迟高；设置 SQLITE_LOCAL_PATH 后热库放在本地磁盘 / tmpfs，
+后台把快照写回原来的持久化路径（storage_sqlite.PERSISTENT_PATH）：
+
+- 启动：本地副本不存在时（容器重启、tmpfs 清空）从最新的有效检查点恢复（持久化路径，损坏时用上一代 .1）；
+  本地副本存在时直接使用（它不会比检查点旧）。多个 worker 同时启动时由文件锁保证只恢复一次
+- 写回：用 SQLite 在线备份 API 把本地库复制到持久化目录的临时文件（关闭同步，最后只 fsync 一次），
+  再原子替换；上一代保留为 .1（SQLITE_CHECKPOINT_KEEP=1 时不保留）
+- RPO：每 SQLITE_CHECKPOINT_POLL 秒读一次库文件头的修改计数器，有未写回的修改且距上次写回
+  超过 SQLITE_CHECKPOINT_RPO / 2 秒时写回，最长未写回时间（滞后）保持在 RPO 以内；超过时告警
+- 多 worker：各 worker 都启动写回线程，抢到文件锁的一个负责写回，它退出后由其他 worker 接手；
+  负责写回的 worker 退出前（atexit）再写回一次
+- 指标：每次写回的耗时和结果、当前滞后（见 metrics.py）；/api/debug/storage 读状态文件，任一 worker 都能看到
+
+用法：
+    # storage_sqlite 导入时
+    sqlite_checkpoint.restore(PERSISTENT_PATH, LOCAL_PATH)
+    # app.py
+    sqlite_checkpoint.start(storage.backend)        # 非 SQLite 后端或未设置 SQLITE_LOCAL_PATH 时什么都不做
+"""
+import atexit
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from log import get_logger
+
+log = get_logger('db.checkpoint')
+
+SQLITE_CHECKPOINT_RPO = float(os.getenv('SQLITE_CHECKPOINT_RPO', '30'))
+SQLITE_CHECKPOINT_POLL = float(os.getenv('SQLITE_CHECKPOINT_POLL', '1'))
+SQLITE_CHECKPOINT_KEEP = int(os.getenv('SQLITE_CHECKPOINT_KEEP', '2'))
+
+# observer(event, **fields)：checkpoint（seconds、ok、bytes）、lag（seconds）
+observers = []
+
+
+def _notify(event, **fields):
+    for observer in observers:
+        try:
+            observer(event, **fields)
+        except Exception as e:
+            log.warning("检查点观察者出错: %s", e)
+
+
+@contextmanager
+def _flock(path):
+    """文件锁（进程间互斥，阻塞等待）"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)        # 关闭即释放锁
+
+
+def _fsync_dir(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _valid(path):
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            return conn.execute('PRAGMA quick_check').fetchone()[0] == 'ok'
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+
+
+def copy_database(source, target, durable=False):
+    """在线备份 source 到 target 的临时文件后原子替换（source 可以正在被写入）；返回字节数"""
+    tmp = f"{target}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    src = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+    dst = sqlite3.connect(tmp)
+    try:
+        # 临时文件不需要逐页同步，完成后整体 fsync 一次
+        dst.execute('PRAGMA synchronous=OFF')
+        dst.execute('PRAGMA journal_mode=OFF')
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    if durable:
+        fd = os.open(tmp, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    os.replace(tmp, target)
+    if durable:
+        _fsync_dir(target)
+    return os.path.getsize(target)
+
+
+def restore(persistent, local):
+    """本地副本不存在时从最新的有效检查点恢复；返回恢复来源（没有检查点时为 None，由 init_db 建新库）"""
+    os.makedirs(os.path.dirname(os.path.abspath(local)), exist_ok=True)
+    with _flock(f"{local}.restore.lock"):
+        if os.path.exists(local):
+            log.info("使用已有的本地副本: %s", local)
+            return local
+        for candidate in (persistent, f"{persistent}.1"):
+            if not os.path.exists(candidate):
+                continue
+            if not _valid(candidate):
+                log.error("检查点损坏，跳过: %s", candidate)
+                continue
+            started = time.perf_counter()
+            size = copy_database(candidate, local)
+            log.info("已从检查点恢复: %s -> %s（%s 字节，%.2fs）", candidate, local, size,
+                     time.perf_counter() - started)
+            return candidate
+        log.warning("没有可用的检查点，新建本地库: %s", local)
+        return None
+
+
+def _signature(path):
+    """库文件头的修改计数器（每次提交写事务递增）和 WAL 文件状态：不变说明没有新的修改"""
+    try:
+        with open(path, 'rb') as f:
+            counter = f.read(28)[24:28]
+    except FileNotFoundError:
+        return None
+    try:
+        wal = os.stat(f"{path}-wal")
+        return counter, wal.st_size, wal.st_mtime_ns
+    except FileNotFoundError:
+        return counter, None, None
+
+
+class Checkpointer:
+    """把本地副本定期写回持久化路径（抢到文件锁的进程负责）"""
+
+    def __init__(self, local, persistent, rpo=SQLITE_CHECKPOINT_RPO, poll=SQLITE_CHECKPOINT_POLL,
+                 keep=SQLITE_CHECKPOINT_KEEP):
+        self.local = local
+        self.persistent = persistent
+        self.rpo = rpo
+        self.poll = poll
+        self.keep = keep
+        self.status_path = f"{local}.checkpoint.json"
+        self.leader = False
+        self.shipped = None         # 最近一次写回时的库签名
+        self.dirty_since = None     # 第一个未写回的修改被发现的时间
+        self.last_started = 0.0
+        self.lag_warned = False
+        self.final = True           # 退出前再写回一次
+        self._status = {'checkpoints': 0, 'failures': 0, 'last_checkpoint_at': None, 'last_duration_ms': None,
+                        'last_bytes': None, 'last_error': None}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sqlite-checkpoint', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, final=True):
+        self.final = final
+        self._stop.set()
+        if self._thread is not None and self.leader:
+            self._thread.join(timeout=60)
+
+    def _run(self):
+        # 阻塞等锁：负责写回的进程退出后由这里接手
+        with _flock(f"{self.local}.checkpoint.lock"):
+            if self._stop.is_set():
+                return
+            self.leader = True
+            log.info("负责写回检查点: %s -> %s（pid %s，RPO %ss）",
+                     self.local, self.persistent, os.getpid(), self.rpo)
+            atexit.register(self.stop)
+            while not self._stop.is_set():
+                try:
+                    self.tick()
+                except Exception as e:
+                    log.error("检查点线程出错: %s", e)
+                self._stop.wait(self.poll)
+            if self.final:
+                self.tick(force=True)
+            self.leader = False
+
+    def tick(self, force=False):
+        """检查一次：有未写回的修改且到了时间（或 force）就写回"""
+        now = time.time()
+        signature = _signature(self.local)
+        if signature != self.shipped and self.dirty_since is None:
+            self.dirty_since = now
+            self._write_status()
+        if self.dirty_since is not None and (force or now - self.last_started >= self.rpo / 2):
+            self.checkpoint()
+        lag = time.time() - self.dirty_since if self.dirty_since is not None else 0.0
+        _notify('lag', seconds=lag)
+        if lag > self.rpo and not self.lag_warned:
+            self.lag_warned = True
+            log.warning("检查点滞后 %.1fs，超过 RPO %ss", lag, self.rpo)
+
+    def checkpoint(self):
+        started_at = time.time()
+        started = time.perf_counter()
+        self.last_started = started_at
+        signature = _signature(self.local)
+        try:
+            if self.keep > 1 and os.path.exists(self.persistent):
+                # 先写新快照再轮换：任何时刻持久化目录里都至少有一份完整的检查点
+                size = copy_database(self.local, f"{self.persistent}.next", durable=True)
+                os.replace(self.persistent, f"{self.persistent}.1")
+                os.replace(f"{self.persistent}.next", self.persistent)
+                _fsync_dir(self.persistent)
+            else:
+                size = copy_database(self.local, self.persistent, durable=True)
+        except Exception as e:
+            seconds = time.perf_counter() - started
+            self._status.update(failures=self._status['failures'] + 1, last_error=str(e))
+            self._write_status()
+            _notify('checkpoint', seconds=seconds, ok=False, bytes=0)
+            log.error("写回检查点失败: %s", e)
+            return False
+        seconds = time.perf_counter() - started
+        self.shipped = signature
+        # 复制期间又有写入：从这次复制开始算滞后
+        self.dirty_since = started_at if _signature(self.local) != signature else None
+        self.lag_warned = False
+        self._status.update(checkpoints=self._status['checkpoints'] + 1, last_checkpoint_at=started_at,
+                            last_duration_ms=round(seconds * 1000, 1), last_bytes=size, last_error=None)
+        self._write_status()
+        _notify('checkpoint', seconds=seconds, ok=True, bytes=size)
+        log.info("已写回检查点: %s 字节，%.0fms", size, seconds * 1000)
+        return True
+
+    def _write_status(self):
+        status = dict(self._status, leader_pid=os.getpid(), dirty_since=self.dirty_since, rpo=self.rpo,
+                      local=self.local, persistent=self.persistent)
+        tmp = f"{self.status_path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(status, f)
+        os.replace(tmp, self.status_path)
+
+
+_checkpointer = None
+
+
+def start(storage):
+    """SQLite 后端且设置了 SQLITE_LOCAL_PATH 时启动写回线程（每个进程一个）"""
+    global _checkpointer
+    local = getattr(storage, 'LOCAL_PATH', None)
+    if not local or _checkpointer is not None:
+        return None
+    _checkpointer = Checkpointer(local, storage.PERSISTENT_PATH).start()
+    return _checkpointer
+
+
+def stats():
+    """负责写回的进程写的状态（任一进程可读）；滞后按当前时间计算"""
+    if _checkpointer is None:
+        return {'enabled': False}
+    try:
+        with open(_checkpointer.status_path, encoding='utf-8') as f:
+            status = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'enabled': True, 'leader_pid': None}
+    dirty_since = status.get('dirty_since')
+    status['lag_seconds'] = round(time.time() - dirty_since, 3) if dirty_since else 0.0
+    status['enabled'] = True
+    return status
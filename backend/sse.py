@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+SSE 帧编码与增量合并（教练、客厅流式接口使用）
+
+Coze 的 delta 往往只有一两个字，逐个转发时每个字都要一次 json.dumps 和一次写出，经代理时还会变成大量小包。
+Coalescer 把同类型（reasoning / content）的连续增量合并成一帧：
+
+    - 每种类型的第一个增量立即发送（首字快速通道，不影响首字时间）
+    - 距上一帧不足 SSE_COALESCE_MS 毫秒的增量先缓冲，缓冲达到 SSE_COALESCE_BYTES 字节或时间到了再一起发送；
+      增量之间的间隔本来就超过 SSE_COALESCE_MS 时（吐字慢），每个增量仍立即发送
+    - 类型切换、其他事件（reasoning_done / done / error）之前先发出缓冲，保证顺序
+    - SSE_COALESCE_MS=0 时每个增量一帧（与不合并时相同）
+
+流式档位（客户端请求时选择，默认 full）：
+    - full：转发全部思考过程
+    - summary：不转发思考增量，正文开始（或思考结束）时发送一次 reasoning_summary 事件（思考过程开头
+      SSE_REASONING_SUMMARY_CHARS 个字，尽量在句末截断）
+    - content：只转发正文
+不转发的增量不做编码；完整的思考过程照常由调用方累积、保存，done 事件中的 reasoning_content 用
+visible_reasoning() 按档位裁剪。
+
+时间在收到增量时检查，调用方每读到一行上游数据（包括空行、心跳、其他事件）时再调用 tick()：
+模型思考等上游停顿期间，缓冲的内容在下一行上游数据到达时就按时发出，不必等下一个增量。
+没有定时器线程：上游完全没有数据时无法发出，最多延迟到下一行数据、其他事件或流结束。
+前端按 content 累加显示，合并对前端透明。
+
+用法：
+    coalescer = sse.Coalescer(profile)
+    for line in upstream:
+        yield coalescer.tick()                   # 缓冲到时间了就发出（可能是空字符串）
+        ...
+        yield coalescer.add('content', delta)    # 可能是空字符串（已缓冲）
+    yield coalescer.event({'type': 'done', ...})  # 先发出缓冲，再发送该事件
+"""
+import os
+import re
+import time
+
+import serializer
+
+SSE_COALESCE_MS = float(os.getenv('SSE_COALESCE_MS', '50'))
+SSE_COALESCE_BYTES = int(os.getenv('SSE_COALESCE_BYTES', '1024'))
+SSE_REASONING_SUMMARY_CHARS = int(os.getenv('SSE_REASONING_SUMMARY_CHARS', '200'))
+
+PROFILES = ('full', 'summary', 'content')
+DEFAULT_PROFILE = 'full'
+
+_SENTENCE_END = re.compile(r'[。！？!?\n]')
+
+
+def event(payload):
+    """编码一个 SSE data 帧（serializer：有 orjson 时用 orjson）"""
+    return f"data: {serializer.dumps(payload)}\n\n"
+
+
+def summarize_reasoning(text, limit=None):
+    """思考过程开头的摘要：不超过 limit 个字，后半段有句末标点时在句末截断"""
+    limit = SSE_REASONING_SUMMARY_CHARS if limit is None else limit
+    text = text.strip()
+    if len(text) <= limit:
+        return text
+    head = text[:limit]
+    ends = [m.end() for m in _SENTENCE_END.finditer(head, limit // 2)]
+    return head[:ends[-1]].rstrip() if ends else head + '…'
+
+
+def visible_reasoning(profile, reasoning_content):
+    """done 事件中按档位返回的思考过程"""
+    if not reasoning_content or profile == 'content':
+        return None
+    if profile == 'summary':
+        return summarize_reasoning(reasoning_content)
+    return reasoning_content
+
+
+class Coalescer:
+    """一个流的增量合并状态（非线程安全，每个流一个）"""
+
+    def __init__(self, profile=DEFAULT_PROFILE, interval_ms=None, max_bytes=None, clock=time.monotonic):
+        self.profile = profile
+        self.interval = (SSE_COALESCE_MS if interval_ms is None else interval_ms) / 1000
+        self.max_bytes = SSE_COALESCE_BYTES if max_bytes is None else max_bytes
+        self._clock = clock
+        self._kind = None
+        self._parts = []
+        self._size = 0
+        self._last_sent = None
+        self._started = set()   # 已发送过第一个增量的类型
+        self._summary = []      # summary 档位：尚未发送的思考过程开头
+        self._summary_len = 0
+        self.deltas = 0
+        self.skipped = 0
+        self.frames = 0
+        self.bytes = 0
+
+    def _emit(self, payload):
+        frame = event(payload)
+        self.frames += 1
+        self.bytes += len(frame.encode('utf-8'))
+        self._last_sent = self._clock()
+        return frame
+
+    def _flush_summary(self):
+        if not self._summary:
+            return ''
+        summary = summarize_reasoning(''.join(self._summary))
+        self._summary = None    # 每个流只发送一次
+        return self._emit({'type': 'reasoning_summary', 'content': summary}) if summary else ''
+
+    def flush(self):
+        """发出缓冲的增量（以及待发送的思考摘要）；没有缓冲时返回空字符串"""
+        out = self._flush_summary()
+        if not self._parts:
+            return out
+        text = ''.join(self._parts)
+        kind = self._kind
+        self._parts = []
+        self._size = 0
+        self._kind = None
+        return out + self._emit({'type': kind, 'content': text})
+
+    def add(self, kind, text):
+        """加入一个增量（kind：reasoning / content），返回现在需要发送的帧"""
+        self.deltas += 1
+        if kind == 'reasoning' and self.profile != 'full':
+            self.skipped += 1
+            # 摘要只需要开头，多留一些余量给句末截断
+            if self._summary is not None and self.profile == 'summary' \
+                    and self._summary_len < 2 * SSE_REASONING_SUMMARY_CHARS:
+                self._summary.append(text)
+                self._summary_len += len(text)
+            return ''
+        out = self.flush() if self._kind != kind else ''
+        if kind not in self._started:
+            self._started.add(kind)
+            return out + self._emit({'type': kind, 'content': text})
+        self._kind = kind
+        self._parts.append(text)
+        self._size += len(text.encode('utf-8'))
+        if self._size >= self.max_bytes or self._clock() - self._last_sent >= self.interval:
+            out += self.flush()
+        return out
+
+    def tick(self):
+        """距上一帧已超过合并间隔时发出缓冲；调用方每读到一行上游数据时调用"""
+        if self._parts and self._clock() - self._last_sent >= self.interval:
+            return self.flush()
+        return ''
+
+    def event(self, payload):
+        """发出缓冲后再发送一个非增量事件"""
+        return self.flush() + self._emit(payload)
+
+    def stats(self):
+        return {'profile': self.profile, 'deltas': self.deltas, 'skipped': self.skipped,
+                'frames': self.frames, 'bytes': self.bytes}
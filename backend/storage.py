@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+存储后端注册表
+按环境变量 STORAGE_BACKEND 选择实现，各后端模块提供相同的接口
+（User / Relationship / CoachChat / LoungeChat / Query / Batch / batch）：
+
+    supabase  storage_supabase.py（默认，生产环境）
+    sqlite    storage_sqlite.py（本地开发）
+    memory    storage_memory.py（测试、基准的零 I/O 基线）
+
+用法：
+    from storage import User, Relationship, CoachChat, LoungeChat, batch
+"""
+import importlib
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BACKENDS = {
+    'supabase': 'storage_supabase',
+    'sqlite': 'storage_sqlite',
+    'memory': 'storage_memory',
+}
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'supabase').strip().lower()
+
+
+def load_backend(name):
+    """按名称导入后端模块（只导入被选中的后端，避免无关的初始化）"""
+    if name not in BACKENDS:
+        raise ValueError(f"未知的存储后端: {name}（可选: {', '.join(BACKENDS)}）")
+    return importlib.import_module(BACKENDS[name])
+
+
+backend = load_backend(STORAGE_BACKEND)
+
+User = backend.User
+Relationship = backend.Relationship
+CoachChat = backend.CoachChat
+LoungeChat = backend.LoungeChat
+batch = backend.batch
+
+
+def describe():
+    """当前后端信息（调试接口用）"""
+    return {
+        'backend': STORAGE_BACKEND,
+        'module': backend.__name__,
+        'db_path': getattr(backend, 'DB_PATH', None)
+    }
+
+
+def transport_stats():
+    """后端传输层指标（只有远程后端有）"""
+    stats = getattr(backend, 'transport_stats', None)
+    return stats() if stats else {}
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+存储层读穿缓存
+在模型类外面包一层 LRU + TTL 缓存，与具体后端无关（storage_supabase / storage_sqlite 均可），
+减少 get_current_user、伴侣查询、昵称映射等热点读取的网络往返。
+
+- 缓存 Model.get / Model.filter / Model.query(...).all()/first() 的结果
+- 查询结果为空（None / []）也缓存（负缓存），TTL 更短
+- save() 和 batch 提交后递增表版本号；版本号存放在本机共享的 SQLite 文件中，
+  gunicorn 多个 worker 之间互相可见，任一进程写入后其他进程的旧缓存立即失效
+- 按模型统计命中/未命中
+
+用法：
+    import storage
+    from storage_cache import install_cache
+    install_cache(storage.backend)
+"""
+import copy
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from log import get_logger
+
+log = get_logger('cache')
+
+STORAGE_CACHE_ENABLED = os.getenv('STORAGE_CACHE_ENABLED', '1') == '1'
+STORAGE_CACHE_TABLES = [t.strip() for t in os.getenv('STORAGE_CACHE_TABLES', 'users,relationships').split(',') if t.strip()]
+STORAGE_CACHE_MAX_ENTRIES = int(os.getenv('STORAGE_CACHE_MAX_ENTRIES', 2048))
+STORAGE_CACHE_TTL = float(os.getenv('STORAGE_CACHE_TTL', 60))
+STORAGE_CACHE_NEGATIVE_TTL = float(os.getenv('STORAGE_CACHE_NEGATIVE_TTL', 5))
+# 为空时版本号只在进程内有效（单进程部署或测试）
+STORAGE_CACHE_VERSION_PATH = os.getenv(
+    'STORAGE_CACHE_VERSION_PATH',
+    os.path.join(tempfile.gettempdir(), 'between_us_cache_versions.db')
+)
+
+# Query 上会改变结果的构造方法（参与缓存键）
+_BUILDER_METHODS = ('select', 'eq', 'neq', 'gt', 'gte', 'lt', 'lte', 'in_', 'or_eq', 'order', 'limit')
+
+
+class VersionStore:
+    """表版本号：写入时递增，读取缓存时比对"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._local = threading.local()
+        self._memory = {}
+        self._lock = threading.Lock()
+        if path:
+            conn = self._conn()
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache_versions (
+                    tbl TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL
+                )
+            ''')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, table):
+        if not self.path:
+            return self._memory.get(table, 0)
+        row = self._conn().execute("SELECT version FROM cache_versions WHERE tbl = ?", (table,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, table):
+        """递增并返回新的版本号"""
+        if not self.path:
+            with self._lock:
+                version = self._memory[table] = self._memory.get(table, 0) + 1
+            return version
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                "INSERT INTO cache_versions (tbl, version) VALUES (?, 1) "
+                "ON CONFLICT(tbl) DO UPDATE SET version = version + 1",
+                (table,)
+            )
+            version = conn.execute("SELECT version FROM cache_versions WHERE tbl = ?", (table,)).fetchone()[0]
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return version
+
+
+def _copy(value):
+    """返回副本，避免调用方修改对象污染缓存"""
+    if isinstance(value, list):
+        return [copy.copy(item) for item in value]
+    return copy.copy(value)
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class StorageCache:
+    """进程内 LRU + TTL 缓存，条目带表版本号"""
+
+    def __init__(self, max_entries=STORAGE_CACHE_MAX_ENTRIES, ttl=STORAGE_CACHE_TTL,
+                 negative_ttl=STORAGE_CACHE_NEGATIVE_TTL, versions=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.versions = versions if versions is not None else VersionStore()
+        self.tables = set()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _count(self, model, key):
+        stats = self._stats.setdefault(model.__name__, {
+            'hits': 0, 'negative_hits': 0, 'misses': 0, 'stale': 0, 'expired': 0, 'evictions': 0
+        })
+        stats[key] += 1
+
+    def fetch(self, model, key, loader):
+        """命中且未过期、版本一致则返回缓存，否则调用 loader 读取并写入缓存"""
+        table = model.TABLE
+        full_key = (table,) + key
+        # 先取版本号再读数据：读取期间发生的写入会让这条缓存在下一次读取时失效
+        version = self.versions.get(table)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(full_key)
+            if entry is not None:
+                entry_version, expires_at, value = entry
+                if entry_version == version and expires_at > now:
+                    self._entries.move_to_end(full_key)
+                    self._count(model, 'negative_hits' if not value else 'hits')
+                    return _copy(value)
+                del self._entries[full_key]
+                self._count(model, 'stale' if entry_version != version else 'expired')
+            self._count(model, 'misses')
+
+        value = loader()
+        ttl = self.ttl if value else self.negative_ttl
+        with self._lock:
+            self._entries[full_key] = (version, now + ttl, _copy(value))
+            self._entries.move_to_end(full_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._count(model, 'evictions')
+        return _copy(value)
+
+    def invalidate(self, table):
+        """表有写入：递增版本号（所有进程的旧条目随之失效）"""
+        self.versions.bump(table)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            models = {name: dict(stats) for name, stats in self._stats.items()}
+            size = len(self._entries)
+        for stats in models.values():
+            total = stats['hits'] + stats['negative_hits'] + stats['misses']
+            stats['hit_rate'] = round((stats['hits'] + stats['negative_hits']) / total, 4) if total else 0.0
+        return {'size': size, 'max_entries': self.max_entries, 'models': models}
+
+
+class CachedQuery:
+    """包装后端 Query：构造方法照常转发，同时记录调用序列作为缓存键"""
+
+    def __init__(self, cache, model, query, columns):
+        self._cache = cache
+        self._model = model
+        self._query = query
+        self._signature = [('select', _freeze(columns))]
+
+    def __getattr__(self, name):
+        attr = getattr(self._query, name)
+        if name not in _BUILDER_METHODS:
+            return attr
+
+        def builder(*args, **kwargs):
+            attr(*args, **kwargs)
+            self._signature.append((name, _freeze(args), tuple(sorted((k, _freeze(v)) for k, v in kwargs.items()))))
+            return self
+        return builder
+
+    def all(self, raise_errors=False):
+        return self._cache.fetch(self._model, ('query', tuple(self._signature)),
+                                 lambda: self._query.all(raise_errors))
+
+    def first(self, raise_errors=False):
+        results = self.limit(1).all(raise_errors)
+        return results[0] if results else None
+
+
+def _wrap_model(cache, model):
+    originals = {name: model.__dict__[name] for name in ('get', 'filter', 'query', 'save')}
+    get = originals['get'].__func__
+    filter_ = originals['filter'].__func__
+    query = originals['query'].__func__
+    save = originals['save']
+
+    def cached_get(id):
+        return cache.fetch(model, ('get', id), lambda: get(id))
+
+    def cached_filter(**kwargs):
+        key = ('filter', tuple(sorted((k, _freeze(v)) for k, v in kwargs.items())))
+        return cache.fetch(model, key, lambda: filter_(**kwargs))
+
+    def cached_query(*columns):
+        return CachedQuery(cache, model, query(*columns), columns)
+
+    def cached_save(self):
+        try:
+            return save(self)
+        finally:
+            cache.invalidate(model.TABLE)
+
+    model.get = staticmethod(cached_get)
+    model.filter = staticmethod(cached_filter)
+    model.query = staticmethod(cached_query)
+    model.save = cached_save
+    return originals
+
+
+def _wrap_batch(cache, batch_class):
+    commit = batch_class.__dict__['commit']
+
+    def cached_commit(self):
+        tables = set()
+        for op in self._ops:
+            tables.add(op[1].TABLE)
+        try:
+            return commit(self)
+        finally:
+            for table in tables:
+                if table in cache.tables:
+                    cache.invalidate(table)
+
+    batch_class.commit = cached_commit
+    return commit
+
+
+_default_cache = None
+_installed = {}
+
+
+def get_cache():
+    """进程级默认缓存（首次使用时按环境变量创建）"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = StorageCache(versions=VersionStore(STORAGE_CACHE_VERSION_PATH))
+    return _default_cache
+
+
+def install_cache(storage, cache=None, tables=None, enabled=None):
+    """
+    给存储模块的模型类装上缓存（原地替换类方法，重复调用无效）
+    storage: storage.backend，或 storage_supabase / storage_sqlite 等实现了相同模型接口的模块
+    """
+    if enabled is None:
+        enabled = STORAGE_CACHE_ENABLED
+    # 后端可声明 CACHEABLE = False（如内存后端，缓存没有收益）
+    if not enabled or not getattr(storage, 'CACHEABLE', True) or storage.__name__ in _installed:
+        return None
+    cache = cache or get_cache()
+    cache.tables = set(tables if tables is not None else STORAGE_CACHE_TABLES)
+
+    models = [getattr(storage, name) for name in ('User', 'Relationship', 'CoachChat', 'LoungeChat')]
+    originals = {}
+    for model in models:
+        if model.TABLE in cache.tables:
+            originals[model] = _wrap_model(cache, model)
+    batch_commit = _wrap_batch(cache, storage.Batch)
+    _installed[storage.__name__] = (storage, cache, originals, batch_commit)
+    log.info("已启用存储缓存: %s (%s)", storage.__name__, ', '.join(sorted(cache.tables)))
+    return cache
+
+
+def uninstall_cache(storage):
+    """恢复模型类的原始方法"""
+    installed = _installed.pop(storage.__name__, None)
+    if not installed:
+        return
+    _, cache, originals, batch_commit = installed
+    for model, methods in originals.items():
+        for name, method in methods.items():
+            setattr(model, name, method)
+    storage.Batch.commit = batch_commit
+    cache.clear()
+
+
+def cache_stats():
+    """各已安装模块的缓存统计"""
+    return {name: cache.stats() for name, (_, cache, _, _) in _installed.items()}
@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+"""
+双写 / 影子读（后端切换前的线上验证）
+在当前存储后端（主库，STORAGE_BACKEND）外面包一层，同时把写入复制到另一个后端（副库，DUALWRITE_SECONDARY），
+用真实流量比较两边的结果和延迟，再决定是否切换：
+
+- 写：主库写入成功后，把写入后的整行（含主库分配的 id）放进队列；后台线程攒批（DUALWRITE_BATCH 条或
+  DUALWRITE_FLUSH_MS 毫秒）在副库一个 Batch 里提交。新建按原 id 写入（Batch.import_rows），更新先补行再更新，
+  副库缺少的旧数据不影响后续写入；整批失败时逐条重试，隔离出失败的写入。队列满时丢弃并计数，不阻塞请求
+- 读：按 DUALWRITE_SHADOW_READ_RATE 抽样，主库读取返回后把同一查询（get / filter / all / query 构造链）
+  放进同一个队列，排在之前的写入之后执行，避免复制延迟造成的误报；比较两边结果（只比较两边都有的列，
+  未指定排序的结果排序后比较），记录不一致的样本
+- 延迟：两边每种操作（Model.get / Model.query / Batch.commit 等）最近 DUALWRITE_LATENCY_WINDOW 次的
+  p50 / p95 / p99；副库写入是攒批提交的，按批记录
+- 在 install_cache 之前安装：缓存命中不计入主库延迟，也不触发影子读，比较的是真正落到后端的调用
+- 副库与主库各自独立：副库写入失败、读取出错只计数和记录日志，不影响请求
+
+用法：
+    import storage_dualwrite
+    storage_dualwrite.install(storage.backend)      # DUALWRITE_SECONDARY 为空时什么都不做
+    storage_dualwrite.stats()                       # /api/debug/storage
+"""
+import math
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from history_transfer import to_object
+from log import get_logger
+
+log = get_logger('dualwrite')
+
+DUALWRITE_SECONDARY = os.getenv('DUALWRITE_SECONDARY', '').strip().lower()
+DUALWRITE_SHADOW_READ_RATE = float(os.getenv('DUALWRITE_SHADOW_READ_RATE', '0.1'))
+DUALWRITE_BATCH = int(os.getenv('DUALWRITE_BATCH', '200'))
+DUALWRITE_FLUSH_MS = float(os.getenv('DUALWRITE_FLUSH_MS', '50'))
+DUALWRITE_QUEUE_MAX = int(os.getenv('DUALWRITE_QUEUE_MAX', '10000'))
+DUALWRITE_LATENCY_WINDOW = int(os.getenv('DUALWRITE_LATENCY_WINDOW', '1000'))
+
+MODELS = ('User', 'Relationship', 'CoachChat', 'LoungeChat')
+# Query 上会改变结果的构造方法（影子读按同样的顺序在副库上重放）
+_BUILDER_METHODS = ('select', 'eq', 'neq', 'gt', 'gte', 'lt', 'lte', 'in_', 'or_eq', 'order', 'limit')
+
+
+def percentile(values, p):
+    """最近秩百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = math.ceil(p / 100 * len(ordered))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+class LatencyStats:
+    """每个 (库, 操作) 最近 window 次耗时"""
+
+    def __init__(self, window=DUALWRITE_LATENCY_WINDOW):
+        self.window = window
+        self._samples = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, side, op, seconds):
+        key = (side, op)
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            items = [(key, list(samples), self._counts[key]) for key, samples in self._samples.items()]
+        result = {}
+        for (side, op), samples, count in sorted(items):
+            result.setdefault(side, {})[op] = {
+                'count': count,
+                'p50_ms': round(percentile(samples, 50) * 1000, 3),
+                'p95_ms': round(percentile(samples, 95) * 1000, 3),
+                'p99_ms': round(percentile(samples, 99) * 1000, 3),
+                'max_ms': round(max(samples) * 1000, 3)
+            }
+        return result
+
+
+# ==================== 结果比较 ====================
+
+def _plain(value):
+    """可比较的值：带时区的时间统一转成 UTC（Supabase 返回带时区的时间，SQLite 存的是写入时的原值）"""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat()
+    return value
+
+
+def _shape(result, columns):
+    if result is None:
+        return None
+    if isinstance(result, list):
+        return [_shape(obj, columns) for obj in result]
+    return tuple(_plain(getattr(result, column, None)) for column in columns)
+
+
+def _record(obj, model):
+    return {column: getattr(obj, column, None) for column in model.COLUMNS}
+
+
+class _Read:
+    """一次抽样的读取：主库结果（已转成可比较的元组）和在副库上重放所需的信息"""
+    __slots__ = ('model', 'op', 'spec', 'columns', 'ordered', 'primary', 'seconds')
+
+    def __init__(self, model, op, spec, columns, ordered, primary, seconds):
+        self.model = model
+        self.op = op
+        self.spec = spec
+        self.columns = columns
+        self.ordered = ordered
+        self.primary = primary
+        self.seconds = seconds
+
+
+class DualWriter:
+    """副库写入队列、影子读和两边的延迟统计（每个进程一个后台线程，首次使用时启动）"""
+
+    def __init__(self, secondary, shadow_read_rate=DUALWRITE_SHADOW_READ_RATE, batch_size=DUALWRITE_BATCH,
+                 flush_ms=DUALWRITE_FLUSH_MS, queue_max=DUALWRITE_QUEUE_MAX):
+        self.secondary = secondary
+        self.shadow_read_rate = shadow_read_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self.queue = queue.Queue(maxsize=queue_max)
+        self.latency = LatencyStats()
+        self.mismatches = deque(maxlen=20)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'writes_queued': 0, 'writes_applied': 0, 'writes_failed': 0, 'writes_dropped': 0, 'batches': 0,
+            'reads_shadowed': 0, 'reads_matched': 0, 'reads_mismatched': 0, 'reads_failed': 0, 'reads_dropped': 0
+        }
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def _ensure_worker(self):
+        # fork 之后子进程里没有父进程的线程，按 pid 判断
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='dualwrite', daemon=True)
+                self._thread.start()
+
+    def _submit(self, item, kind):
+        self._ensure_worker()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self._count(f"{kind}_dropped")
+            return
+        if kind == 'writes':
+            self._count('writes_queued')
+
+    # ---------- 主库侧（请求线程） ----------
+
+    def timed(self, op, call):
+        started = time.perf_counter()
+        result = call()
+        self.latency.add('primary', op, time.perf_counter() - started)
+        return result
+
+    def wrote(self, model, obj, new):
+        """主库 save() 成功：复制整行"""
+        if obj.id:
+            self._submit(('save', model.__name__, _record(obj, model), new), 'writes')
+
+    def committed(self, ops):
+        """主库 Batch 提交成功：ops 为提交前登记的写入（save 附带提交前是否新建）"""
+        for op in ops:
+            if op[0] == 'save':
+                obj, new = op[1], op[2]
+                self.wrote(type(obj), obj, new)
+            elif op[0] == 'import':
+                _, model, rows = op
+                records = [row if isinstance(row, dict) else dict(zip(model.COLUMNS, row)) for row in rows]
+                self._submit(('import', model.__name__, records), 'writes')
+            else:
+                _, model, ids, fields = op
+                self._submit(('update', model.__name__, list(ids), dict(fields)), 'writes')
+
+    def read(self, model, op, spec, call, columns=None, ordered=True):
+        """主库读取；按比例抽样放进队列，在副库上重放并比较"""
+        started = time.perf_counter()
+        result = call()
+        seconds = time.perf_counter() - started
+        self.latency.add('primary', f"{model.__name__}.{op}", seconds)
+        if self.shadow_read_rate > 0 and random.random() < self.shadow_read_rate:
+            secondary_model = getattr(self.secondary, model.__name__)
+            shared = [c for c in (columns or model.COLUMNS) if c in secondary_model.COLUMNS]
+            self._submit(_Read(model.__name__, op, spec, shared, ordered, _shape(result, shared), seconds), 'reads')
+        return result
+
+    # ---------- 副库侧（后台线程） ----------
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._process(items)
+            except Exception as e:      # 副库问题不能让线程退出
+                log.error("副库处理失败: %s", e)
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    def _process(self, items):
+        """按入队顺序执行：连续的写入合并成一批，影子读在它之前的写入提交之后执行"""
+        writes = []
+        for item in items:
+            if isinstance(item, _Read):
+                self._apply(writes)
+                writes = []
+                self._shadow(item)
+            else:
+                writes.append(item)
+        self._apply(writes)
+
+    def _stage(self, unit, item):
+        action, name = item[0], item[1]
+        model = getattr(self.secondary, name)
+        if action == 'save':
+            _, _, record, new = item
+            unit.import_rows(model, [to_object(model, record)])
+            if not new:
+                fields = {k: v for k, v in record.items() if k != 'id' and k in model.COLUMNS}
+                unit.update(model, [record['id']], **fields)
+        elif action == 'import':
+            unit.import_rows(model, [to_object(model, record) for record in item[2]])
+        else:
+            _, _, ids, fields = item
+            unit.update(model, ids, **{k: v for k, v in fields.items() if k in model.COLUMNS})
+
+    def _commit(self, items):
+        unit = self.secondary.Batch()
+        for item in items:
+            self._stage(unit, item)
+        started = time.perf_counter()
+        unit.commit()
+        self.latency.add('secondary', 'Batch.commit', time.perf_counter() - started)
+
+    def _apply(self, writes):
+        if not writes:
+            return
+        try:
+            self._commit(writes)
+        except Exception as e:
+            if len(writes) == 1:
+                self._count('writes_failed')
+                log.warning("副库写入失败: %s %s: %s", writes[0][0], writes[0][1], e)
+                return
+            # 整批失败：逐条重试，只丢掉真正失败的写入
+            log.warning("副库批量写入失败，逐条重试（%s 条）: %s", len(writes), e)
+            for item in writes:
+                self._apply([item])
+            return
+        self._count('writes_applied', len(writes))
+        self._count('batches')
+
+    def _shadow(self, read):
+        model = getattr(self.secondary, read.model)
+        started = time.perf_counter()
+        try:
+            if read.op == 'get':
+                result = model.get(read.spec)
+            elif read.op == 'filter':
+                result = model.filter(**read.spec)
+            elif read.op == 'all':
+                result = model.all()
+            else:
+                columns, calls, terminal = read.spec
+                query = model.query(*columns)
+                for name, args, kwargs in calls:
+                    query = getattr(query, name)(*args, **kwargs)
+                result = getattr(query, terminal)()
+        except Exception as e:
+            self._count('reads_failed')
+            log.warning("影子读失败: %s.%s: %s", read.model, read.op, e)
+            return
+        self.latency.add('secondary', f"{read.model}.{read.op}", time.perf_counter() - started)
+        self._count('reads_shadowed')
+
+        primary, secondary = read.primary, _shape(result, read.columns)
+        if not read.ordered and isinstance(primary, list):
+            primary, secondary = sorted(primary, key=repr), sorted(secondary, key=repr)
+        if primary == secondary:
+            self._count('reads_matched')
+            return
+        self._count('reads_mismatched')
+        sample = {
+            'op': f"{read.model}.{read.op}",
+            'spec': repr(read.spec)[:200],
+            'primary': repr(primary)[:500],
+            'secondary': repr(secondary)[:500],
+            'primary_ms': round(read.seconds * 1000, 3),
+            'at': datetime.now().isoformat()
+        }
+        self.mismatches.append(sample)
+        log.warning("影子读结果不一致: %s %s", sample['op'], sample['spec'])
+
+    def flush(self, timeout=None):
+        """等队列清空（测试、退出前用）"""
+        if self._thread is None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._stats)
+        return dict(counts, queue=self.queue.qsize(), queue_max=self.queue.maxsize,
+                    shadow_read_rate=self.shadow_read_rate, latency=self.latency.snapshot(),
+                    mismatches=list(self.mismatches))
+
+
+# ==================== 安装 ====================
+
+class DualQuery:
+    """包装主库 Query：构造方法照常转发并记录调用序列，all()/first() 计时并按比例影子读"""
+
+    def __init__(self, writer, model, query, columns):
+        self._writer = writer
+        self._model = model
+        self._query = query
+        self._columns = columns
+        self._calls = []
+
+    def __getattr__(self, name):
+        attr = getattr(self._query, name)
+        if name not in _BUILDER_METHODS:
+            return attr
+
+        def builder(*args, **kwargs):
+            attr(*args, **kwargs)
+            self._calls.append((name, args, kwargs))
+            return self
+        return builder
+
+    def _read(self, terminal, raise_errors):
+        columns = self._columns
+        for name, args, _ in self._calls:
+            if name == 'select':
+                columns = args
+        ordered = any(name == 'order' for name, _, _ in self._calls)
+        spec = (self._columns, list(self._calls), terminal)
+        call = getattr(self._query, terminal)
+        return self._writer.read(self._model, 'query', spec, lambda: call(raise_errors), columns, ordered)
+
+    def all(self, raise_errors=False):
+        return self._read('all', raise_errors)
+
+    def first(self, raise_errors=False):
+        return self._read('first', raise_errors)
+
+
+def _wrap_model(writer, model):
+    originals = {name: model.__dict__[name] for name in ('get', 'filter', 'all', 'query', 'save')}
+    get = originals['get'].__func__
+    filter_ = originals['filter'].__func__
+    all_ = originals['all'].__func__
+    query = originals['query'].__func__
+    save = originals['save']
+    name = model.__name__
+
+    def dual_get(id):
+        return writer.read(model, 'get', id, lambda: get(id))
+
+    def dual_filter(**kwargs):
+        return writer.read(model, 'filter', kwargs, lambda: filter_(**kwargs), ordered=False)
+
+    def dual_all():
+        return writer.read(model, 'all', None, all_, ordered=False)
+
+    def dual_query(*columns):
+        return DualQuery(writer, model, query(*columns), columns)
+
+    def dual_save(self):
+        new = not self.id
+        result = writer.timed(f"{name}.save", lambda: save(self))
+        writer.wrote(model, self, new)
+        return result
+
+    model.get = staticmethod(dual_get)
+    model.filter = staticmethod(dual_filter)
+    model.all = staticmethod(dual_all)
+    model.query = staticmethod(dual_query)
+    model.save = dual_save
+    return originals
+
+
+def _wrap_batch(writer, batch_class):
+    commit = batch_class.__dict__['commit']
+
+    def dual_commit(self):
+        # 提交前记下哪些 save 是新建（提交后 id 已回填）
+        ops = [(op[0], op[1], not op[1].id) if op[0] == 'save' else op for op in self._ops]
+        result = writer.timed('Batch.commit', lambda: commit(self))
+        writer.committed(ops)
+        return result
+
+    batch_class.commit = dual_commit
+    return commit
+
+
+_writer = None
+_installed = {}
+
+
+def install(storage, secondary=None, writer=None):
+    """
+    给主库模块装上双写 / 影子读（原地替换类方法，重复调用无效），返回 DualWriter
+    secondary：副库后端名（默认 DUALWRITE_SECONDARY，为空时不安装）或已导入的后端模块
+    """
+    global _writer
+    secondary = secondary or DUALWRITE_SECONDARY
+    if not secondary or storage.__name__ in _installed:
+        return None
+    if isinstance(secondary, str):
+        from storage import load_backend
+        secondary = load_backend(secondary)
+    if secondary is storage:
+        log.error("DUALWRITE_SECONDARY 与当前存储后端相同，不启用双写")
+        return None
+    writer = writer or DualWriter(secondary)
+    originals = {getattr(storage, name): _wrap_model(writer, getattr(storage, name)) for name in MODELS}
+    batch_commit = _wrap_batch(writer, storage.Batch)
+    _installed[storage.__name__] = (writer, originals, batch_commit)
+    _writer = writer
+    log.info("已启用双写: %s -> %s（影子读比例 %s）",
+             storage.__name__, secondary.__name__, writer.shadow_read_rate)
+    return writer
+
+
+def uninstall(storage):
+    """恢复模型类的原始方法（队列里剩余的写入仍会执行）"""
+    global _writer
+    installed = _installed.pop(storage.__name__, None)
+    if not installed:
+        return
+    writer, originals, batch_commit = installed
+    for model, methods in originals.items():
+        for name, method in methods.items():
+            setattr(model, name, method)
+    storage.Batch.commit = batch_commit
+    if _writer is writer:
+        _writer = None
+
+
+def stats():
+    if _writer is None:
+        return {'enabled': False}
+    return dict(_writer.stats(), enabled=True, secondary=_writer.secondary.__name__)
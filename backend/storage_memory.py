@@ -0,0 +1,721 @@
+# -*- coding: utf-8 -*-
+"""
+内存存储层实现
+保持与 storage_supabase.py / storage_sqlite.py 相同的接口，数据只保存在进程内存中（进程退出即丢失）
+用途：基准测试的零 I/O 基线、测试用的快速后端
+
+按手机号、绑定码、用户、房间建立索引，常用查询不需要全表扫描
+"""
+from datetime import datetime
+import secrets
+from threading import RLock
+from contextlib import contextmanager
+from log import get_logger
+from tokens import estimate_tokens
+
+log = get_logger('db.memory')
+
+# 内存数据没有跨进程一致性，缓存层不需要包装
+CACHEABLE = False
+
+db_lock = RLock()
+
+
+class _Table:
+    """一张表：id -> 行字典，外加按列的索引（值 -> 按插入顺序排列的 id）"""
+
+    def __init__(self, name, indexes=(), unique=()):
+        self.name = name
+        self.rows = {}
+        self.next_id = 1
+        self.unique = set(unique)
+        self.indexes = {column: {} for column in tuple(indexes) + tuple(unique)}
+
+    def _index_add(self, row):
+        for column, index in self.indexes.items():
+            index.setdefault(row.get(column), {})[row['id']] = None
+
+    def _index_remove(self, row):
+        for column, index in self.indexes.items():
+            bucket = index.get(row.get(column))
+            if bucket is not None:
+                bucket.pop(row['id'], None)
+                if not bucket:
+                    del index[row.get(column)]
+
+    def _check_unique(self, row):
+        for column in self.unique:
+            existing = self.indexes[column].get(row.get(column))
+            if existing and any(id != row.get('id') for id in existing):
+                raise ValueError(f"UNIQUE constraint failed: {self.name}.{column}")
+
+    def insert(self, row):
+        """插入一行，返回撤销函数"""
+        row = dict(row, id=self.next_id)
+        self._check_unique(row)
+        self.rows[row['id']] = row
+        self._index_add(row)
+        self.next_id += 1
+
+        def undo():
+            self._index_remove(row)
+            del self.rows[row['id']]
+        return row, undo
+
+    def restore(self, row):
+        """按原 id 插入一行（导入用），id 已存在时跳过；返回撤销函数"""
+        if row['id'] in self.rows:
+            return lambda: None
+        row = dict(row)
+        self._check_unique(row)
+        self.rows[row['id']] = row
+        self._index_add(row)
+        self.next_id = max(self.next_id, row['id'] + 1)
+
+        def undo():
+            self._index_remove(row)
+            del self.rows[row['id']]
+        return undo
+
+    def update(self, id, fields):
+        """更新一行，返回撤销函数（行不存在时什么都不做）"""
+        old = self.rows.get(id)
+        if old is None:
+            return lambda: None
+        new = dict(old, **fields)
+        self._index_remove(old)
+        try:
+            self._check_unique(new)
+        except ValueError:
+            self._index_add(old)
+            raise
+        self.rows[id] = new
+        self._index_add(new)
+
+        def undo():
+            self._index_remove(new)
+            self.rows[id] = old
+            self._index_add(old)
+        return undo
+
+    def clear(self):
+        self.rows.clear()
+        self.next_id = 1
+        for index in self.indexes.values():
+            index.clear()
+
+
+_tables = {
+    'users': _Table('users', indexes=('binding_code',), unique=('phone',)),
+    'relationships': _Table('relationships', indexes=('user1_id', 'user2_id', 'room_id')),
+    'coach_chats': _Table('coach_chats', indexes=('user_id',)),
+    'lounge_chats': _Table('lounge_chats', indexes=('room_id',)),
+}
+
+
+def reset():
+    """清空所有数据（测试 / 基准用）"""
+    with db_lock:
+        for table in _tables.values():
+            table.clear()
+
+
+def _null_first(value):
+    """排序键：与 SQLite 一致，NULL 排在升序最前"""
+    return (value is not None, value)
+
+
+def _compare(op, left, right):
+    # 与 SQL 一致：任一侧为 NULL 时比较结果为假
+    if left is None or right is None:
+        return False
+    if op == 'eq':
+        return left == right
+    if op == 'neq':
+        return left != right
+    if op == 'gt':
+        return left > right
+    if op == 'gte':
+        return left >= right
+    if op == 'lt':
+        return left < right
+    return left <= right
+
+
+class Query:
+    """
+    查询构造器（与 storage_sqlite.Query 接口一致）
+    等值条件命中索引时只扫描对应的桶，否则全表扫描
+
+    用法：
+        LoungeChat.query('id', 'content').eq('room_id', room_id).gt('id', since_id).order('created_at').all()
+    """
+
+    def __init__(self, model, table, columns=()):
+        self.model = model
+        self.table = table
+        self._columns = []
+        self._filters = []
+        self._or_groups = []
+        self._orders = []
+        self._limit = None
+        self._empty = False
+        self.select(*columns)
+
+    def _check_column(self, column):
+        if column not in self.model.COLUMNS:
+            raise ValueError(f"{self.table} 没有字段: {column}")
+        return column
+
+    def select(self, *columns):
+        """只查询指定列（不传则查询全部列）"""
+        self._columns = [self._check_column(c) for c in columns]
+        return self
+
+    def _add(self, op, column, value):
+        self._filters.append((op, self._check_column(column), value))
+        return self
+
+    def eq(self, column, value):
+        if value is None:
+            return self._add('is_null', column, None)
+        return self._add('eq', column, value)
+
+    def neq(self, column, value):
+        return self._add('neq', column, value)
+
+    def gt(self, column, value):
+        return self._add('gt', column, value)
+
+    def gte(self, column, value):
+        return self._add('gte', column, value)
+
+    def lt(self, column, value):
+        return self._add('lt', column, value)
+
+    def lte(self, column, value):
+        return self._add('lte', column, value)
+
+    def in_(self, column, values):
+        values = set(values)
+        if not values:
+            self._empty = True
+            return self
+        return self._add('in', column, values)
+
+    def or_eq(self, **kwargs):
+        """任一字段相等即可，如 or_eq(user1_id=1, user2_id=1)"""
+        if kwargs:
+            self._or_groups.append([(self._check_column(k), v) for k, v in kwargs.items()])
+        return self
+
+    def order(self, column, desc=False):
+        self._orders.append((self._check_column(column), desc))
+        return self
+
+    def limit(self, n):
+        self._limit = int(n)
+        return self
+
+    def _candidates(self, table):
+        """用索引缩小扫描范围：主键直接定位，否则取最小的等值桶；OR 条件的列都有索引时取各桶并集"""
+        best = None
+        for op, column, value in self._filters:
+            if column == 'id' and op in ('eq', 'in'):
+                ids = [value] if op == 'eq' else sorted(value)
+                bucket = [id for id in ids if id in table.rows]
+                if best is None or len(bucket) < len(best):
+                    best = bucket
+            elif op == 'eq' and column in table.indexes:
+                bucket = table.indexes[column].get(value, {})
+                if best is None or len(bucket) < len(best):
+                    best = bucket
+        for group in self._or_groups:
+            if all(column in table.indexes for column, _ in group):
+                union = {}
+                for column, value in group:
+                    union.update(table.indexes[column].get(value, {}))
+                if best is None or len(union) < len(best):
+                    best = sorted(union)
+        return table.rows.keys() if best is None else best
+
+    def _match(self, row):
+        for op, column, value in self._filters:
+            if op == 'is_null':
+                if row.get(column) is not None:
+                    return False
+            elif op == 'in':
+                if row.get(column) not in value:
+                    return False
+            elif not _compare(op, row.get(column), value):
+                return False
+        for group in self._or_groups:
+            if not any(_compare('eq', row.get(column), value) for column, value in group):
+                return False
+        return True
+
+    def all(self, raise_errors=False):
+        """执行查询，返回模型对象列表（未查询的字段为默认值）；查询失败总是抛出，raise_errors 只为与其他后端接口一致"""
+        if self._empty:
+            return []
+        with db_lock:
+            table = _tables[self.table]
+            rows = [table.rows[id] for id in self._candidates(table)]
+            rows = [row for row in rows if self._match(row)]
+        # 多列排序：从最后一个排序键开始做稳定排序
+        for column, desc in reversed(self._orders):
+            rows.sort(key=lambda row: _null_first(row.get(column)), reverse=desc)
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        if self._columns:
+            rows = [{column: row.get(column) for column in self._columns} for row in rows]
+        return [self.model.from_row(row) for row in rows]
+
+    def first(self, raise_errors=False):
+        """执行查询，返回第一条结果或 None"""
+        results = self.limit(1).all(raise_errors)
+        return results[0] if results else None
+
+
+class Batch:
+    """
+    批量写入（工作单元，与 storage_sqlite.Batch 接口一致）
+    提交时在同一把锁内依次执行，任一写入失败则按撤销日志回滚
+
+    用法：
+        with batch() as b:
+            b.save(relationship)
+            b.save(user)
+            b.update(LoungeChat, [1, 2, 3], sent_to_ai=True)
+            b.import_rows(CoachChat, chats)     # 按原 id 写入（导入 / 迁移用）
+    """
+
+    def __init__(self):
+        self._ops = []
+
+    def save(self, obj):
+        """登记一次新建或更新（按 obj.id 判断）"""
+        self._ops.append(('save', obj))
+        return obj
+
+    def update(self, model, ids, **fields):
+        """登记一次批量更新：把 ids 对应行的 fields 设为相同的值"""
+        ids = list(ids)
+        for column in fields:
+            if column not in model.COLUMNS or column == 'id':
+                raise ValueError(f"{model.TABLE} 不能批量更新字段: {column}")
+        if ids and fields:
+            self._ops.append(('update', model, ids, fields))
+
+    def import_rows(self, model, objs):
+        """登记一批按原 id 写入的记录（所有列原样写入）；id 已存在的行跳过，重复导入不会产生重复数据"""
+        rows = [{column: getattr(obj, column) for column in model.COLUMNS} for obj in objs]
+        if rows:
+            self._ops.append(('import', model, rows))
+
+    def commit(self):
+        """在一个事务中执行所有登记的写入"""
+        if not self._ops:
+            return
+        undo_log = []
+        inserted = []
+        with db_lock:
+            try:
+                for op in self._ops:
+                    if op[0] == 'save':
+                        obj = op[1]
+                        if not obj.id:
+                            inserted.append(obj)
+                        undo_log.append(obj._write())
+                    elif op[0] == 'import':
+                        _, model, rows = op
+                        table = _tables[model.TABLE]
+                        for row in rows:
+                            undo_log.append(table.restore(row))
+                    else:
+                        _, model, ids, fields = op
+                        table = _tables[model.TABLE]
+                        for id in ids:
+                            undo_log.append(table.update(id, fields))
+            except Exception as e:
+                for undo in reversed(undo_log):
+                    undo()
+                # 回滚后新建对象的 ID 无效
+                for obj in inserted:
+                    obj.id = None
+                log.error("批量写入失败，已回滚: %s", e)
+                raise
+        self._ops = []
+
+
+@contextmanager
+def batch():
+    """批量写入上下文：退出时一次性提交（代码块内抛出异常则不提交）"""
+    unit = Batch()
+    yield unit
+    unit.commit()
+
+
+def _save(obj, label):
+    with db_lock:
+        try:
+            obj._write()
+            return obj
+        except Exception as e:
+            log.error("保存%s失败: %s", label, e)
+            raise
+
+
+def _get(model, id):
+    with db_lock:
+        row = _tables[model.TABLE].rows.get(id)
+    return model.from_row(row) if row else None
+
+
+def _filter(model, kwargs, order_by=None):
+    query = Query(model, model.TABLE)
+    for key, value in kwargs.items():
+        query.eq(key, value)
+    if order_by:
+        query.order(order_by)
+    return query.all()
+
+
+def _write_row(obj, row):
+    """新建或更新一行（save() 和 Batch 共用），返回撤销函数"""
+    table = _tables[obj.TABLE]
+    if obj.id:
+        return table.update(obj.id, row)
+    stored, undo = table.insert(row)
+    obj.id = stored['id']
+
+    def undo_insert():
+        undo()
+        obj.id = None
+    return undo_insert
+
+
+class User:
+    """用户模型"""
+
+    TABLE = 'users'
+    COLUMNS = ('id', 'phone', 'password', 'nickname', 'binding_code', 'partner_id', 'unbind_at', 'coach_greeting_shown', 'created_at')
+
+    def __init__(self, phone, password, nickname=None, binding_code=None, partner_id=None, unbind_at=None, coach_greeting_shown=False, created_at=None, id=None):
+        self.id = id
+        self.phone = phone
+        self.password = password
+        self.nickname = nickname
+        self.binding_code = binding_code
+        self.partner_id = partner_id
+        self.unbind_at = unbind_at
+        self.coach_greeting_shown = coach_greeting_shown
+        self.created_at = created_at or datetime.now()
+
+    def generate_binding_code(self):
+        """生成6位绑定码"""
+        self.binding_code = secrets.token_hex(3).upper()
+        return self.binding_code
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'phone': self.phone,
+            'nickname': self.nickname,
+            'binding_code': self.binding_code,
+            'partner_id': self.partner_id,
+            'has_partner': self.partner_id is not None,
+            'coach_greeting_shown': self.coach_greeting_shown,
+            'unbind_at': self.unbind_at.isoformat() if isinstance(self.unbind_at, datetime) else self.unbind_at,
+            'created_at': self.created_at.isoformat() if isinstance(self.created_at, datetime) else self.created_at
+        }
+
+    @staticmethod
+    def from_row(row):
+        """从行字典创建用户对象（兼容只查询部分列的结果）"""
+        if not row:
+            return None
+        return User(
+            id=row.get('id'),
+            phone=row.get('phone'),
+            password=row.get('password'),
+            nickname=row.get('nickname'),
+            binding_code=row.get('binding_code'),
+            partner_id=row.get('partner_id'),
+            unbind_at=row.get('unbind_at'),
+            coach_greeting_shown=bool(row.get('coach_greeting_shown')),
+            created_at=row.get('created_at')
+        )
+
+    def _write(self):
+        return _write_row(self, {
+            'phone': self.phone,
+            'password': self.password,
+            'nickname': self.nickname,
+            'binding_code': self.binding_code,
+            'partner_id': self.partner_id,
+            'unbind_at': self.unbind_at,
+            'coach_greeting_shown': bool(self.coach_greeting_shown),
+            'created_at': self.created_at
+        })
+
+    def save(self):
+        """保存用户信息"""
+        return _save(self, '用户')
+
+    @staticmethod
+    def get(id):
+        """根据ID获取用户"""
+        return _get(User, id)
+
+    @staticmethod
+    def filter(**kwargs):
+        """根据条件过滤用户"""
+        return _filter(User, kwargs)
+
+    @staticmethod
+    def query(*columns):
+        """创建查询构造器"""
+        return Query(User, User.TABLE, columns)
+
+    @staticmethod
+    def all():
+        """获取所有用户"""
+        return _filter(User, {})
+
+
+class Relationship:
+    """关系绑定模型"""
+
+    TABLE = 'relationships'
+    COLUMNS = ('id', 'user1_id', 'user2_id', 'room_id', 'is_active', 'greeting_shown', 'created_at')
+
+    def __init__(self, user1_id, user2_id, room_id, is_active=True, greeting_shown=False, created_at=None, id=None):
+        self.id = id
+        self.user1_id = user1_id
+        self.user2_id = user2_id
+        self.room_id = room_id
+        self.is_active = is_active
+        self.greeting_shown = greeting_shown
+        self.created_at = created_at or datetime.now()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user1_id': self.user1_id,
+            'user2_id': self.user2_id,
+            'room_id': self.room_id,
+            'created_at': self.created_at.isoformat() if isinstance(self.created_at, datetime) else self.created_at,
+            'is_active': self.is_active,
+            'greeting_shown': self.greeting_shown
+        }
+
+    @staticmethod
+    def from_row(row):
+        """从行字典创建关系对象（兼容只查询部分列的结果）"""
+        if not row:
+            return None
+        return Relationship(
+            id=row.get('id'),
+            user1_id=row.get('user1_id'),
+            user2_id=row.get('user2_id'),
+            room_id=row.get('room_id'),
+            is_active=bool(row.get('is_active', True)),
+            greeting_shown=bool(row.get('greeting_shown')),
+            created_at=row.get('created_at')
+        )
+
+    def _write(self):
+        return _write_row(self, {
+            'user1_id': self.user1_id,
+            'user2_id': self.user2_id,
+            'room_id': self.room_id,
+            'is_active': bool(self.is_active),
+            'greeting_shown': bool(self.greeting_shown),
+            'created_at': self.created_at
+        })
+
+    def save(self):
+        """保存关系信息"""
+        return _save(self, '关系')
+
+    @staticmethod
+    def get(id):
+        """根据ID获取关系"""
+        return _get(Relationship, id)
+
+    @staticmethod
+    def filter(**kwargs):
+        """根据条件过滤关系"""
+        return _filter(Relationship, kwargs)
+
+    @staticmethod
+    def query(*columns):
+        """创建查询构造器"""
+        return Query(Relationship, Relationship.TABLE, columns)
+
+    @staticmethod
+    def all():
+        """获取所有关系"""
+        return _filter(Relationship, {})
+
+
+class CoachChat:
+    """个人教练聊天记录模型"""
+
+    TABLE = 'coach_chats'
+    COLUMNS = ('id', 'user_id', 'role', 'content', 'reasoning_content', 'token_count', 'created_at')
+
+    def __init__(self, user_id, role, content, reasoning_content=None, created_at=None, id=None, token_count=None):
+        self.id = id
+        self.user_id = user_id
+        self.role = role
+        self.content = content
+        self.reasoning_content = reasoning_content
+        self.token_count = token_count
+        self.created_at = created_at or datetime.now()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'role': self.role,
+            'content': self.content,
+            'reasoning_content': self.reasoning_content,
+            'created_at': self.created_at.isoformat() if isinstance(self.created_at, datetime) else self.created_at
+        }
+
+    @staticmethod
+    def from_row(row):
+        """从行字典创建聊天记录对象"""
+        if not row:
+            return None
+        return CoachChat(
+            id=row.get('id'),
+            user_id=row.get('user_id'),
+            role=row.get('role'),
+            content=row.get('content'),
+            reasoning_content=row.get('reasoning_content'),
+            token_count=row.get('token_count'),
+            created_at=row.get('created_at')
+        )
+
+    def _write(self):
+        self.token_count = estimate_tokens(self.content)
+        return _write_row(self, {
+            'user_id': self.user_id,
+            'role': self.role,
+            'content': self.content,
+            'reasoning_content': self.reasoning_content,
+            'token_count': self.token_count,
+            'created_at': self.created_at
+        })
+
+    def save(self):
+        """保存聊天记录"""
+        return _save(self, '教练聊天记录')
+
+    @staticmethod
+    def get(id):
+        """根据ID获取聊天记录"""
+        return _get(CoachChat, id)
+
+    @staticmethod
+    def filter(**kwargs):
+        """根据条件过滤聊天记录（按创建时间排序）"""
+        return _filter(CoachChat, kwargs, order_by='created_at')
+
+    @staticmethod
+    def query(*columns):
+        """创建查询构造器"""
+        return Query(CoachChat, CoachChat.TABLE, columns)
+
+    @staticmethod
+    def all():
+        """获取所有聊天记录"""
+        return _filter(CoachChat, {}, order_by='created_at')
+
+
+class LoungeChat:
+    """情感客厅聊天记录模型"""
+
+    TABLE = 'lounge_chats'
+    COLUMNS = ('id', 'room_id', 'user_id', 'role', 'content', 'reasoning_content', 'sent_to_ai', 'token_count', 'created_at')
+
+    def __init__(self, room_id, content, role, user_id=None, reasoning_content=None, sent_to_ai=False, created_at=None, id=None,
+                 token_count=None):
+        self.id = id
+        self.room_id = room_id
+        self.user_id = user_id
+        self.role = role
+        self.content = content
+        self.reasoning_content = reasoning_content
+        self.sent_to_ai = sent_to_ai
+        self.token_count = token_count
+        self.created_at = created_at or datetime.now()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'room_id': self.room_id,
+            'user_id': self.user_id,
+            'role': self.role,
+            'content': self.content,
+            'reasoning_content': self.reasoning_content,
+            'sent_to_ai': self.sent_to_ai,
+            'created_at': self.created_at.isoformat() if isinstance(self.created_at, datetime) else self.created_at
+        }
+
+    @staticmethod
+    def from_row(row):
+        """从行字典创建聊天记录对象"""
+        if not row:
+            return None
+        return LoungeChat(
+            id=row.get('id'),
+            room_id=row.get('room_id'),
+            user_id=row.get('user_id'),
+            role=row.get('role'),
+            content=row.get('content'),
+            reasoning_content=row.get('reasoning_content'),
+            sent_to_ai=bool(row.get('sent_to_ai')),
+            token_count=row.get('token_count'),
+            created_at=row.get('created_at')
+        )
+
+    def _write(self):
+        self.token_count = estimate_tokens(self.content)
+        return _write_row(self, {
+            'room_id': self.room_id,
+            'user_id': self.user_id,
+            'role': self.role,
+            'content': self.content,
+            'reasoning_content': self.reasoning_content,
+            'sent_to_ai': bool(self.sent_to_ai),
+            'token_count': self.token_count,
+            'created_at': self.created_at
+        })
+
+    def save(self):
+        """保存聊天记录"""
+        return _save(self, '客厅聊天记录')
+
+    @staticmethod
+    def get(id):
+        """根据ID获取聊天记录"""
+        return _get(LoungeChat, id)
+
+    @staticmethod
+    def filter(**kwargs):
+        """根据条件过滤聊天记录（按创建时间排序）"""
+        return _filter(LoungeChat, kwargs, order_by='created_at')
+
+    @staticmethod
+    def query(*columns):
+        """创建查询构造器"""
+        return Query(LoungeChat, LoungeChat.TABLE, columns)
+
+    @staticmethod
+    def all():
+        """获取所有聊天记录"""
+        return _filter(LoungeChat, {}, order_by='created_at')
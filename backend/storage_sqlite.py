@@ -5,27 +5,402 @@ SQLite 存储层实现
 """
 import sqlite3
 import os
+import re
+import json
 from datetime import datetime
 import secrets
-from threading import Lock
+from threading import Lock, local
+from contextlib import contextmanager
+from log import get_logger
+from tokens import estimate_tokens
 
-# 数据库路径 - 使用持久化目录（生产环境）或当前目录（开发环境）
-if os.path.exists('/mnt/workspace'):
+log = get_logger('db.sqlite')
+
+# 数据库路径 - 可用 SQLITE_DB_PATH 指定（测试/基准），否则使用持久化目录（生产环境）或当前目录（开发环境）
+if os.getenv('SQLITE_DB_PATH'):
+    DB_PATH = os.getenv('SQLITE_DB_PATH')
+elif os.path.exists('/mnt/workspace'):
     DB_PATH = os.path.join('/mnt/workspace', 'emotion_helper.db')
 else:
     DB_PATH = os.path.join(os.path.dirname(__file__), 'emotion_helper.db')
 
+# 本地工作副本 - 设置 SQLITE_LOCAL_PATH（本地磁盘 / tmpfs）后读写都走本地副本，
+# 由 sqlite_checkpoint 定期写回上面的持久化路径；启动时本地副本不存在则从最新检查点恢复
+PERSISTENT_PATH = DB_PATH
+LOCAL_PATH = os.getenv('SQLITE_LOCAL_PATH') or None
+if LOCAL_PATH:
+    import sqlite_checkpoint
+    sqlite_checkpoint.restore(PERSISTENT_PATH, LOCAL_PATH)
+    DB_PATH = LOCAL_PATH
+
 # 线程锁，确保数据库操作线程安全
 db_lock = Lock()
 
 
+# ==================== 查询计划检查 ====================
+# SQLITE_QUERY_PLAN_CHECK=1：记录每种语句的 EXPLAIN QUERY PLAN；=strict：遇到带条件的全表扫描立即抛错
+# SQLITE_QUERY_PLAN_REPORT：进程退出时把计划目录写入该 JSON 文件
+QUERY_PLAN_CHECK = os.getenv('SQLITE_QUERY_PLAN_CHECK', '')
+QUERY_PLAN_REPORT = os.getenv('SQLITE_QUERY_PLAN_REPORT', '')
+PLAN_GUARDED_TABLES = ('lounge_chats', 'coach_chats', 'users', 'relationships')
+
+
+class QueryPlanError(Exception):
+    """热点表上带条件的语句没有走索引"""
+
+
+class QueryPlanCatalogue:
+    """按语句形状（参数个数、LIMIT 数值归一化）记录查询计划"""
+
+    _SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+    _SEARCH = re.compile(r'^SEARCH (?:TABLE )?(\w+)')
+
+    def __init__(self, strict=False):
+        self.strict = strict
+        self._lock = Lock()
+        self._local = local()
+        self.statements = {}
+
+    @staticmethod
+    def shape(sql):
+        sql = " ".join(sql.split())
+        sql = re.sub(r'\(\?(?:, \?)*\)', '(?...)', sql)
+        return re.sub(r'\bLIMIT \d+', 'LIMIT ?', sql)
+
+    @property
+    def exempt(self):
+        return getattr(self._local, 'exempt', 0) > 0
+
+    def observe(self, conn, sql, parameters):
+        head = sql.lstrip()[:6].upper()
+        if head not in ('SELECT', 'UPDATE', 'DELETE'):
+            return
+        shape = self.shape(sql)
+        with self._lock:
+            entry = self.statements.get(shape)
+            if entry is not None:
+                entry['count'] += 1
+                return
+        plan = [row[3] for row in sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()]
+        scanned = sorted({m.group(1) for m in map(self._SCAN.match, plan) if m} & set(PLAN_GUARDED_TABLES))
+        # 没有 WHERE 条件的语句（all()、filter() 不带参数）本来就是全量读取
+        filtered = ' WHERE ' in shape and ' WHERE 1=1' not in shape
+        if self.exempt:
+            status = 'exempt'
+        elif scanned and filtered:
+            status = 'scan'
+        elif scanned:
+            status = 'full_read'
+        else:
+            status = 'ok'
+        entry = {
+            'sql': shape,
+            'plan': plan,
+            'tables': sorted({m.group(1) for m in map(self._SEARCH.match, plan) if m} | set(scanned)),
+            'status': status,
+            'count': 1,
+        }
+        with self._lock:
+            self.statements.setdefault(shape, entry)
+        if status == 'scan':
+            log.warning("全表扫描 %s: %s -> %s", ', '.join(scanned), shape, plan)
+            if self.strict:
+                raise QueryPlanError(f"{', '.join(scanned)} 全表扫描: {shape} -> {plan}")
+
+    def violations(self):
+        with self._lock:
+            return [dict(e) for e in self.statements.values() if e['status'] == 'scan']
+
+    def report(self, path=None):
+        with self._lock:
+            statements = sorted((dict(e) for e in self.statements.values()), key=lambda e: (e['status'] != 'scan', e['sql']))
+        report = {
+            'generated_at': datetime.now().isoformat(timespec='seconds'),
+            'sqlite_version': sqlite3.sqlite_version,
+            'guarded_tables': list(PLAN_GUARDED_TABLES),
+            'statements': statements,
+            'violations': [e for e in statements if e['status'] == 'scan'],
+        }
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        return report
+
+
+class _PlanCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        if _plan_catalogue is not None:
+            _plan_catalogue.observe(self.connection, sql, parameters)
+        return super().execute(sql, parameters)
+
+
+class _PlanConnection(sqlite3.Connection):
+    def cursor(self, factory=_PlanCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        # Connection.execute 内部不走 cursor()，需要单独接管
+        return self.cursor().execute(sql, parameters)
+
+
+_plan_catalogue = None
+
+
+def enable_query_plan_capture(strict=False):
+    """开启查询计划记录，返回计划目录（测试和基准调用）"""
+    global _plan_catalogue
+    _plan_catalogue = QueryPlanCatalogue(strict=strict)
+    return _plan_catalogue
+
+
+def disable_query_plan_capture():
+    global _plan_catalogue
+    catalogue, _plan_catalogue = _plan_catalogue, None
+    return catalogue
+
+
+@contextmanager
+def query_plan_exempt():
+    """代码块内的语句只记录、不判定（建表迁移等一次性语句）"""
+    if _plan_catalogue is None:
+        yield
+        return
+    catalogue = _plan_catalogue
+    catalogue._local.exempt = getattr(catalogue._local, 'exempt', 0) + 1
+    try:
+        yield
+    finally:
+        catalogue._local.exempt -= 1
+
+
+if QUERY_PLAN_CHECK:
+    enable_query_plan_capture(strict=QUERY_PLAN_CHECK == 'strict')
+    if QUERY_PLAN_REPORT:
+        import atexit
+        atexit.register(lambda: _plan_catalogue and _plan_catalogue.report(QUERY_PLAN_REPORT))
+
+
 def get_db_connection():
-    """获取数据库连接"""
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    """获取数据库连接（开启查询计划检查时使用带记录的连接）"""
+    factory = _PlanConnection if _plan_catalogue is not None else sqlite3.Connection
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=factory)
     conn.row_factory = sqlite3.Row  # 使查询结果可以像字典一样访问
     return conn
 
 
+def _to_db_value(value):
+    """Python 值转换为 SQLite 参数"""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class Query:
+    """
+    查询构造器（与 storage_supabase.Query 接口一致）
+    支持列投影、比较/集合过滤、排序和分页，全部下推到 SQL 执行
+
+    用法：
+        LoungeChat.query('id', 'content').eq('room_id', room_id).gt('id', since_id).order('created_at').all()
+    """
+
+    _OPERATORS = {'eq': '=', 'neq': '!=', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+
+    def __init__(self, model, table, columns=()):
+        self.model = model
+        self.table = table
+        self._columns = []
+        self._conditions = []
+        self._values = []
+        self._orders = []
+        self._limit = None
+        self._empty = False
+        self.select(*columns)
+
+    def _check_column(self, column):
+        if column not in self.model.COLUMNS:
+            raise ValueError(f"{self.table} 没有字段: {column}")
+        return column
+
+    def select(self, *columns):
+        """只查询指定列（不传则查询全部列）"""
+        self._columns = [self._check_column(c) for c in columns]
+        return self
+
+    def _compare(self, op, column, value):
+        self._conditions.append(f"{self._check_column(column)} {self._OPERATORS[op]} ?")
+        self._values.append(_to_db_value(value))
+        return self
+
+    def eq(self, column, value):
+        if value is None:
+            self._conditions.append(f"{self._check_column(column)} IS NULL")
+            return self
+        return self._compare('eq', column, value)
+
+    def neq(self, column, value):
+        return self._compare('neq', column, value)
+
+    def gt(self, column, value):
+        return self._compare('gt', column, value)
+
+    def gte(self, column, value):
+        return self._compare('gte', column, value)
+
+    def lt(self, column, value):
+        return self._compare('lt', column, value)
+
+    def lte(self, column, value):
+        return self._compare('lte', column, value)
+
+    def in_(self, column, values):
+        values = list(values)
+        if not values:
+            self._empty = True
+            return self
+        placeholders = ", ".join("?" for _ in values)
+        self._conditions.append(f"{self._check_column(column)} IN ({placeholders})")
+        self._values.extend(_to_db_value(v) for v in values)
+        return self
+
+    def or_eq(self, **kwargs):
+        """任一字段相等即可，如 or_eq(user1_id=1, user2_id=1)"""
+        parts = []
+        for key, value in kwargs.items():
+            parts.append(f"{self._check_column(key)} = ?")
+            self._values.append(_to_db_value(value))
+        if parts:
+            self._conditions.append("(" + " OR ".join(parts) + ")")
+        return self
+
+    def order(self, column, desc=False):
+        self._orders.append(f"{self._check_column(column)} {'DESC' if desc else 'ASC'}")
+        return self
+
+    def limit(self, n):
+        self._limit = int(n)
+        return self
+
+    def to_sql(self):
+        """生成 SQL 语句和参数"""
+        columns = ", ".join(self._columns) if self._columns else "*"
+        sql = f"SELECT {columns} FROM {self.table}"
+        if self._conditions:
+            sql += " WHERE " + " AND ".join(self._conditions)
+        if self._orders:
+            sql += " ORDER BY " + ", ".join(self._orders)
+        if self._limit is not None:
+            sql += f" LIMIT {self._limit}"
+        return sql, list(self._values)
+
+    def all(self, raise_errors=False):
+        """执行查询，返回模型对象列表（未查询的字段为默认值）；查询失败总是抛出，raise_errors 只为与其他后端接口一致"""
+        if self._empty:
+            return []
+        sql, values = self.to_sql()
+        with db_lock:
+            conn = get_db_connection()
+            try:
+                rows = conn.execute(sql, values).fetchall()
+            finally:
+                conn.close()
+        return [self.model.from_row(row) for row in rows]
+
+    def first(self, raise_errors=False):
+        """执行查询，返回第一条结果或 None"""
+        results = self.limit(1).all(raise_errors)
+        return results[0] if results else None
+
+
+class Batch:
+    """
+    批量写入（工作单元，与 storage_supabase.Batch 接口一致）
+    收集多次写入，在同一个连接、同一个事务中提交：要么全部成功，要么全部回滚
+
+    用法：
+        with batch() as b:
+            b.save(relationship)
+            b.save(user)
+            b.update(LoungeChat, [1, 2, 3], sent_to_ai=True)
+            b.import_rows(CoachChat, chats)     # 按原 id 写入（导入 / 迁移用）
+    """
+
+    def __init__(self):
+        self._ops = []
+
+    def save(self, obj):
+        """登记一次新建或更新（按 obj.id 判断）"""
+        self._ops.append(('save', obj))
+        return obj
+
+    def update(self, model, ids, **fields):
+        """登记一次批量更新：把 ids 对应行的 fields 设为相同的值"""
+        ids = list(ids)
+        for column in fields:
+            if column not in model.COLUMNS or column == 'id':
+                raise ValueError(f"{model.TABLE} 不能批量更新字段: {column}")
+        if ids and fields:
+            self._ops.append(('update', model, ids, fields))
+
+    def import_rows(self, model, objs):
+        """登记一批按原 id 写入的记录（所有列原样写入）；id 已存在的行跳过，重复导入不会产生重复数据"""
+        rows = [[_to_db_value(getattr(obj, column)) for column in model.COLUMNS] for obj in objs]
+        if rows:
+            self._ops.append(('import', model, rows))
+
+    def commit(self):
+        """在一个事务中执行所有登记的写入"""
+        if not self._ops:
+            return
+        inserted = []
+        with db_lock:
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                for op in self._ops:
+                    if op[0] == 'save':
+                        obj = op[1]
+                        if not obj.id:
+                            inserted.append(obj)
+                        obj._write(cursor)
+                    elif op[0] == 'import':
+                        _, model, rows = op
+                        cursor.executemany(
+                            f"INSERT INTO {model.TABLE} ({', '.join(model.COLUMNS)}) "
+                            f"VALUES ({', '.join('?' for _ in model.COLUMNS)}) ON CONFLICT(id) DO NOTHING",
+                            rows
+                        )
+                    else:
+                        _, model, ids, fields = op
+                        assignments = ", ".join(f"{column}=?" for column in fields)
+                        placeholders = ", ".join("?" for _ in ids)
+                        cursor.execute(
+                            f"UPDATE {model.TABLE} SET {assignments} WHERE id IN ({placeholders})",
+                            [_to_db_value(v) for v in fields.values()] + ids
+                        )
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                # 回滚后新建对象的 ID 无效
+                for obj in inserted:
+                    obj.id = None
+                log.error("批量写入失败，已回滚: %s", e)
+                raise
+            finally:
+                conn.close()
+        self._ops = []
+
+
+@contextmanager
+def batch():
+    """批量写入上下文：退出时一次性提交（代码块内抛出异常则不提交）"""
+    unit = Batch()
+    yield unit
+    unit.commit()
+
+
 def init_db():
     """初始化数据库表"""
     with db_lock:
@@ -68,6 +443,7 @@ def init_db():
                 role TEXT NOT NULL,
                 content TEXT NOT NULL,
                 reasoning_content TEXT,
+                token_count INTEGER,
                 created_at TEXT NOT NULL
             )
         ''')
@@ -82,6 +458,7 @@ def init_db():
                 content TEXT NOT NULL,
                 reasoning_content TEXT,
                 sent_to_ai INTEGER DEFAULT 0,
+                token_count INTEGER,
                 created_at TEXT NOT NULL
             )
         ''')
@@ -91,46 +468,63 @@ def init_db():
             cursor.execute("SELECT sent_to_ai FROM lounge_chats LIMIT 1")
         except sqlite3.OperationalError:
             # 字段不存在，需要添加
-            print("[SQLite] 迁移：为 lounge_chats 表添加 sent_to_ai 字段", flush=True)
+            log.info("迁移：为 lounge_chats 表添加 sent_to_ai 字段")
             cursor.execute("ALTER TABLE lounge_chats ADD COLUMN sent_to_ai INTEGER DEFAULT 0")
-            print("[SQLite] 迁移完成", flush=True)
+            log.info("迁移完成")
         
         # 数据库迁移：为已存在的 lounge_chats 表添加 reasoning_content 字段
         try:
             cursor.execute("SELECT reasoning_content FROM lounge_chats LIMIT 1")
         except sqlite3.OperationalError:
             # 字段不存在，需要添加
-            print("[SQLite] 迁移：为 lounge_chats 表添加 reasoning_content 字段", flush=True)
+            log.info("迁移：为 lounge_chats 表添加 reasoning_content 字段")
             cursor.execute("ALTER TABLE lounge_chats ADD COLUMN reasoning_content TEXT")
-            print("[SQLite] 迁移完成", flush=True)
+            log.info("迁移完成")
         
         # 数据库迁移：为已存在的 users 表添加 nickname 字段
         try:
             cursor.execute("SELECT nickname FROM users LIMIT 1")
         except sqlite3.OperationalError:
             # 字段不存在，需要添加
-            print("[SQLite] 迁移：为 users 表添加 nickname 字段", flush=True)
+            log.info("迁移：为 users 表添加 nickname 字段")
             cursor.execute("ALTER TABLE users ADD COLUMN nickname TEXT")
-            print("[SQLite] 迁移完成", flush=True)
+            log.info("迁移完成")
         
         # 数据库迁移：为已存在的 users 表添加 coach_greeting_shown 字段
         try:
             cursor.execute("SELECT coach_greeting_shown FROM users LIMIT 1")
         except sqlite3.OperationalError:
             # 字段不存在，需要添加
-            print("[SQLite] 迁移：为 users 表添加 coach_greeting_shown 字段", flush=True)
+            log.info("迁移：为 users 表添加 coach_greeting_shown 字段")
             cursor.execute("ALTER TABLE users ADD COLUMN coach_greeting_shown INTEGER DEFAULT 0")
-            print("[SQLite] 迁移完成", flush=True)
+            log.info("迁移完成")
         
         # 数据库迁移：为已存在的 relationships 表添加 greeting_shown 字段
         try:
             cursor.execute("SELECT greeting_shown FROM relationships LIMIT 1")
         except sqlite3.OperationalError:
             # 字段不存在，需要添加
-            print("[SQLite] 迁移：为 relationships 表添加 greeting_shown 字段", flush=True)
+            log.info("迁移：为 relationships 表添加 greeting_shown 字段")
             cursor.execute("ALTER TABLE relationships ADD COLUMN greeting_shown INTEGER DEFAULT 0")
-            print("[SQLite] 迁移完成", flush=True)
-        
+            log.info("迁移完成")
+
+        # 数据库迁移：为已存在的聊天记录表添加 token_count 字段（估算的 token 数，旧记录为空，构造上下文时补齐）
+        for table in ('coach_chats', 'lounge_chats'):
+            try:
+                cursor.execute(f"SELECT token_count FROM {table} LIMIT 1")
+            except sqlite3.OperationalError:
+                log.info("迁移：为 %s 表添加 token_count 字段", table)
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN token_count INTEGER")
+                log.info("迁移完成")
+
+        # 热点查询索引（按房间/用户取消息、按用户找关系、按绑定码找用户）
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_lounge_chats_room_created ON lounge_chats(room_id, created_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_coach_chats_user_created ON coach_chats(user_id, created_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_relationships_user1 ON relationships(user1_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_relationships_user2 ON relationships(user2_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_relationships_room ON relationships(room_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_binding_code ON users(binding_code)")
+
         conn.commit()
         
         # 自动补充历史用户的开场白
@@ -138,7 +532,7 @@ def init_db():
         
         conn.commit()
         conn.close()
-        print(f"[SQLite] 数据库初始化完成: {DB_PATH}", flush=True)
+        log.info("数据库初始化完成: %s", DB_PATH)
 
 
 def _auto_migrate_greetings(cursor):
@@ -240,15 +634,19 @@ def _auto_migrate_greetings(cursor):
                 lounge_added += 1
     
     if coach_added > 0 or lounge_added > 0:
-        print(f"[SQLite] 自动补充开场白：个人教练 {coach_added} 条，情感客厅 {lounge_added} 条", flush=True)
+        log.info("自动补充开场白：个人教练 %s 条，情感客厅 %s 条", coach_added, lounge_added)
 
 
-# 启动时初始化数据库
-init_db()
+# 启动时初始化数据库（建表、迁移语句不参与查询计划判定）
+with query_plan_exempt():
+    init_db()
 
 
 class User:
     """用户模型"""
+
+    TABLE = 'users'
+    COLUMNS = ('id', 'phone', 'password', 'nickname', 'binding_code', 'partner_id', 'unbind_at', 'coach_greeting_shown', 'created_at')
     
     def __init__(self, phone, password, nickname=None, binding_code=None, partner_id=None, unbind_at=None, coach_greeting_shown=False, created_at=None, id=None):
         self.id = id
@@ -281,18 +679,19 @@ class User:
     
     @staticmethod
     def from_row(row):
-        """从数据库行创建用户对象"""
+        """从数据库行创建用户对象（兼容只查询部分列的结果）"""
         if not row:
             return None
+        data = dict(row)
         
-        created_at = row['created_at']
+        created_at = data.get('created_at')
         if created_at and isinstance(created_at, str):
             try:
                 created_at = datetime.fromisoformat(created_at)
             except ValueError:
                 created_at = None
         
-        unbind_at = row['unbind_at']
+        unbind_at = data.get('unbind_at')
         if unbind_at and isinstance(unbind_at, str):
             try:
                 unbind_at = datetime.fromisoformat(unbind_at)
@@ -300,58 +699,54 @@ class User:
                 unbind_at = None
         
         # 兼容旧数据：如果没有 nickname 字段，设为 None
-        try:
-            nickname = row['nickname']
-        except (KeyError, IndexError):
-            nickname = None
+        nickname = data.get('nickname')
         
         # 兼容旧数据：如果没有 coach_greeting_shown 字段，设为 False
-        try:
-            coach_greeting_shown = bool(row['coach_greeting_shown'])
-        except (KeyError, IndexError):
-            coach_greeting_shown = False
+        coach_greeting_shown = bool(data.get('coach_greeting_shown'))
         
         return User(
-            id=row['id'],
-            phone=row['phone'],
-            password=row['password'],
+            id=data.get('id'),
+            phone=data.get('phone'),
+            password=data.get('password'),
             nickname=nickname,
-            binding_code=row['binding_code'],
-            partner_id=row['partner_id'],
+            binding_code=data.get('binding_code'),
+            partner_id=data.get('partner_id'),
             unbind_at=unbind_at,
             coach_greeting_shown=coach_greeting_shown,
             created_at=created_at
         )
     
+    def _write(self, cursor):
+        """在给定游标上执行写入（save() 和 Batch 共用）"""
+        unbind_at_str = self.unbind_at.isoformat() if isinstance(self.unbind_at, datetime) else self.unbind_at
+        created_at_str = self.created_at.isoformat() if isinstance(self.created_at, datetime) else self.created_at
+        
+        if self.id:
+            # 更新现有用户
+            cursor.execute('''
+                UPDATE users 
+                SET phone=?, password=?, nickname=?, binding_code=?, partner_id=?, unbind_at=?, coach_greeting_shown=?
+                WHERE id=?
+            ''', (self.phone, self.password, self.nickname, self.binding_code, self.partner_id, unbind_at_str, int(self.coach_greeting_shown), self.id))
+        else:
+            # 创建新用户
+            cursor.execute('''
+                INSERT INTO users (phone, password, nickname, binding_code, partner_id, unbind_at, coach_greeting_shown, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (self.phone, self.password, self.nickname, self.binding_code, self.partner_id, unbind_at_str, int(self.coach_greeting_shown), created_at_str))
+            self.id = cursor.lastrowid
+    
     def save(self):
         """保存用户信息"""
         with db_lock:
             conn = get_db_connection()
             cursor = conn.cursor()
-            
-            unbind_at_str = self.unbind_at.isoformat() if isinstance(self.unbind_at, datetime) else self.unbind_at
-            created_at_str = self.created_at.isoformat() if isinstance(self.created_at, datetime) else self.created_at
-            
             try:
-                if self.id:
-                    # 更新现有用户
-                    cursor.execute('''
-                        UPDATE users 
-                        SET phone=?, password=?, nickname=?, binding_code=?, partner_id=?, unbind_at=?, coach_greeting_shown=?
-                        WHERE id=?
-                    ''', (self.phone, self.password, self.nickname, self.binding_code, self.partner_id, unbind_at_str, int(self.coach_greeting_shown), self.id))
-                else:
-                    # 创建新用户
-                    cursor.execute('''
-                        INSERT INTO users (phone, password, nickname, binding_code, partner_id, unbind_at, coach_greeting_shown, created_at)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (self.phone, self.password, self.nickname, self.binding_code, self.partner_id, unbind_at_str, int(self.coach_greeting_shown), created_at_str))
-                    self.id = cursor.lastrowid
-                
+                self._write(cursor)
                 conn.commit()
                 return self
             except Exception as e:
-                print(f"[SQLite Error] 保存用户失败: {e}", flush=True)
+                log.error("保存用户失败: %s", e)
                 raise
             finally:
                 conn.close()
@@ -390,6 +785,11 @@ class User:
             
             return [User.from_row(row) for row in rows]
     
+    @staticmethod
+    def query(*columns):
+        """创建查询构造器"""
+        return Query(User, User.TABLE, columns)
+    
     @staticmethod
     def all():
         """获取所有用户"""
@@ -404,6 +804,9 @@ class User:
 
 class Relationship:
     """关系绑定模型"""
+
+    TABLE = 'relationships'
+    COLUMNS = ('id', 'user1_id', 'user2_id', 'room_id', 'is_active', 'greeting_shown', 'created_at')
     
     def __init__(self, user1_id, user2_id, room_id, is_active=True, greeting_shown=False, created_at=None, id=None):
         self.id = id
@@ -427,11 +830,12 @@ class Relationship:
     
     @staticmethod
     def from_row(row):
-        """从数据库行创建关系对象"""
+        """从数据库行创建关系对象（兼容只查询部分列的结果）"""
         if not row:
             return None
+        data = dict(row)
         
-        created_at = row['created_at']
+        created_at = data.get('created_at')
         if created_at and isinstance(created_at, str):
             try:
                 created_at = datetime.fromisoformat(created_at)
@@ -439,49 +843,48 @@ class Relationship:
                 created_at = None
         
         # 兼容旧数据：如果没有 greeting_shown 字段，设为 False
-        try:
-            greeting_shown = bool(row['greeting_shown'])
-        except (KeyError, IndexError):
-            greeting_shown = False
+        greeting_shown = bool(data.get('greeting_shown'))
         
         return Relationship(
-            id=row['id'],
-            user1_id=row['user1_id'],
-            user2_id=row['user2_id'],
-            room_id=row['room_id'],
-            is_active=bool(row['is_active']),
+            id=data.get('id'),
+            user1_id=data.get('user1_id'),
+            user2_id=data.get('user2_id'),
+            room_id=data.get('room_id'),
+            is_active=bool(data.get('is_active', 1)),
             greeting_shown=greeting_shown,
             created_at=created_at
         )
     
+    def _write(self, cursor):
+        """在给定游标上执行写入（save() 和 Batch 共用）"""
+        created_at_str = self.created_at.isoformat() if isinstance(self.created_at, datetime) else self.created_at
+        
+        if self.id:
+            # 更新现有关系
+            cursor.execute('''
+                UPDATE relationships 
+                SET user1_id=?, user2_id=?, room_id=?, is_active=?, greeting_shown=?
+                WHERE id=?
+            ''', (self.user1_id, self.user2_id, self.room_id, int(self.is_active), int(self.greeting_shown), self.id))
+        else:
+            # 创建新关系
+            cursor.execute('''
+                INSERT INTO relationships (user1_id, user2_id, room_id, is_active, greeting_shown, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (self.user1_id, self.user2_id, self.room_id, int(self.is_active), int(self.greeting_shown), created_at_str))
+            self.id = cursor.lastrowid
+    
     def save(self):
         """保存关系信息"""
         with db_lock:
             conn = get_db_connection()
             cursor = conn.cursor()
-            
-            created_at_str = self.created_at.isoformat() if isinstance(self.created_at, datetime) else self.created_at
-            
             try:
-                if self.id:
-                    # 更新现有关系
-                    cursor.execute('''
-                        UPDATE relationships 
-                        SET user1_id=?, user2_id=?, room_id=?, is_active=?, greeting_shown=?
-                        WHERE id=?
-                    ''', (self.user1_id, self.user2_id, self.room_id, int(self.is_active), int(self.greeting_shown), self.id))
-                else:
-                    # 创建新关系
-                    cursor.execute('''
-                        INSERT INTO relationships (user1_id, user2_id, room_id, is_active, greeting_shown, created_at)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    ''', (self.user1_id, self.user2_id, self.room_id, int(self.is_active), int(self.greeting_shown), created_at_str))
-                    self.id = cursor.lastrowid
-                
+                self._write(cursor)
                 conn.commit()
                 return self
             except Exception as e:
-                print(f"[SQLite Error] 保存关系失败: {e}", flush=True)
+                log.error("保存关系失败: %s", e)
                 raise
             finally:
                 conn.close()
@@ -519,6 +922,11 @@ class Relationship:
             
             return [Relationship.from_row(row) for row in rows]
     
+    @staticmethod
+    def query(*columns):
+        """创建查询构造器"""
+        return Query(Relationship, Relationship.TABLE, columns)
+    
     @staticmethod
     def all():
         """获取所有关系"""
@@ -533,13 +941,17 @@ class Relationship:
 
 class CoachChat:
     """个人教练聊天记录模型"""
+
+    TABLE = 'coach_chats'
+    COLUMNS = ('id', 'user_id', 'role', 'content', 'reasoning_content', 'token_count', 'created_at')
     
-    def __init__(self, user_id, role, content, reasoning_content=None, created_at=None, id=None):
+    def __init__(self, user_id, role, content, reasoning_content=None, created_at=None, id=None, token_count=None):
         self.id = id
         self.user_id = user_id
         self.role = role
         self.content = content
         self.reasoning_content = reasoning_content
+        self.token_count = token_count
         self.created_at = created_at or datetime.now()
     
     def to_dict(self):
@@ -557,8 +969,9 @@ class CoachChat:
         """从数据库行创建聊天记录对象"""
         if not row:
             return None
+        data = dict(row)
         
-        created_at = row['created_at']
+        created_at = data.get('created_at')
         if created_at and isinstance(created_at, str):
             try:
                 created_at = datetime.fromisoformat(created_at)
@@ -566,14 +979,35 @@ class CoachChat:
                 created_at = None
         
         return CoachChat(
-            id=row['id'],
-            user_id=row['user_id'],
-            role=row['role'],
-            content=row['content'],
-            reasoning_content=row['reasoning_content'],
+            id=data.get('id'),
+            user_id=data.get('user_id'),
+            role=data.get('role'),
+            content=data.get('content'),
+            reasoning_content=data.get('reasoning_content'),
+            token_count=data.get('token_count'),
             created_at=created_at
         )
     
+    def _write(self, cursor):
+        """在给定游标上执行写入（save() 和 Batch 共用）"""
+        created_at_str = self.created_at.isoformat() if isinstance(self.created_at, datetime) else self.created_at
+        self.token_count = estimate_tokens(self.content)
+        
+        if self.id:
+            # 更新现有记录
+            cursor.execute('''
+                UPDATE coach_chats 
+                SET user_id=?, role=?, content=?, reasoning_content=?, token_count=?
+                WHERE id=?
+            ''', (self.user_id, self.role, self.content, self.reasoning_content, self.token_count, self.id))
+        else:
+            # 创建新记录
+            cursor.execute('''
+                INSERT INTO coach_chats (user_id, role, content, reasoning_content, token_count, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (self.user_id, self.role, self.content, self.reasoning_content, self.token_count, created_at_str))
+            self.id = cursor.lastrowid
+    
     def save(self):
         """保存聊天记录"""
         import time
@@ -583,35 +1017,16 @@ class CoachChat:
             conn = get_db_connection()
             cursor = conn.cursor()
             
-            created_at_str = self.created_at.isoformat() if isinstance(self.created_at, datetime) else self.created_at
-            
             try:
-                if self.id:
-                    # 更新现有记录
-                    print(f"[DB] 更新教练聊天记录 ID={self.id}, role={self.role}, content_len={len(self.content)}", flush=True)
-                    cursor.execute('''
-                        UPDATE coach_chats 
-                        SET user_id=?, role=?, content=?, reasoning_content=?
-                        WHERE id=?
-                    ''', (self.user_id, self.role, self.content, self.reasoning_content, self.id))
-                else:
-                    # 创建新记录
-                    print(f"[DB] 创建教练聊天记录 user_id={self.user_id}, role={self.role}, content_len={len(self.content)}", flush=True)
-                    cursor.execute('''
-                        INSERT INTO coach_chats (user_id, role, content, reasoning_content, created_at)
-                        VALUES (?, ?, ?, ?, ?)
-                    ''', (self.user_id, self.role, self.content, self.reasoning_content, created_at_str))
-                    self.id = cursor.lastrowid
-                    print(f"[DB] ✓ 教练聊天记录已创建，ID={self.id}", flush=True)
-                
+                created = not self.id
+                self._write(cursor)
                 conn.commit()
-                elapsed = time.time() - save_start
-                print(f"[DB] ✓ 教练聊天记录保存成功，耗时: {elapsed:.3f}s", flush=True)
+                log.debug("教练聊天记录%s ID=%s, role=%s, content_len=%d，耗时: %.3fs",
+                          '已创建' if created else '已更新', self.id, self.role, len(self.content),
+                          time.time() - save_start)
                 return self
             except Exception as e:
-                print(f"[DB] ❌ 保存教练聊天记录失败: {e}", flush=True)
-                import traceback
-                print(f"[DB] 异常堆栈:\n{traceback.format_exc()}", flush=True)
+                log.exception("保存教练聊天记录失败: %s", e)
                 raise
             finally:
                 conn.close()
@@ -646,17 +1061,20 @@ class CoachChat:
             where_clause = " AND ".join(conditions) if conditions else "1=1"
             query = f"SELECT * FROM coach_chats WHERE {where_clause} ORDER BY created_at ASC"
             
-            print(f"[DB] 查询教练聊天记录: {kwargs}", flush=True)
             cursor.execute(query, values)
             rows = cursor.fetchall()
             conn.close()
             
             result = [CoachChat.from_row(row) for row in rows]
-            elapsed = time.time() - query_start
-            print(f"[DB] ✓ 查询完成，返回 {len(result)} 条记录，耗时: {elapsed:.3f}s", flush=True)
+            log.debug("查询教练聊天记录 %s，返回 %d 条，耗时: %.3fs", kwargs, len(result), time.time() - query_start)
             
             return result
     
+    @staticmethod
+    def query(*columns):
+        """创建查询构造器"""
+        return Query(CoachChat, CoachChat.TABLE, columns)
+    
     @staticmethod
     def all():
         """获取所有聊天记录"""
@@ -671,8 +1089,12 @@ class CoachChat:
 
 class LoungeChat:
     """情感客厅聊天记录模型"""
+
+    TABLE = 'lounge_chats'
+    COLUMNS = ('id', 'room_id', 'user_id', 'role', 'content', 'reasoning_content', 'sent_to_ai', 'token_count', 'created_at')
     
-    def __init__(self, room_id, content, role, user_id=None, reasoning_content=None, sent_to_ai=False, created_at=None, id=None):
+    def __init__(self, room_id, content, role, user_id=None, reasoning_content=None, sent_to_ai=False, created_at=None, id=None,
+                 token_count=None):
         self.id = id
         self.room_id = room_id
         self.user_id = user_id
@@ -680,6 +1102,7 @@ class LoungeChat:
         self.content = content
         self.reasoning_content = reasoning_content
         self.sent_to_ai = sent_to_ai
+        self.token_count = token_count
         self.created_at = created_at or datetime.now()
     
     def to_dict(self):
@@ -699,8 +1122,9 @@ class LoungeChat:
         """从数据库行创建聊天记录对象"""
         if not row:
             return None
+        data = dict(row)
         
-        created_at = row['created_at']
+        created_at = data.get('created_at')
         if created_at and isinstance(created_at, str):
             try:
                 created_at = datetime.fromisoformat(created_at)
@@ -708,50 +1132,54 @@ class LoungeChat:
                 created_at = None
         
         # 兼容旧数据：如果没有 reasoning_content 字段，设为 None
-        try:
-            reasoning_content = row['reasoning_content']
-        except (KeyError, IndexError):
-            reasoning_content = None
+        reasoning_content = data.get('reasoning_content')
         
         return LoungeChat(
-            id=row['id'],
-            room_id=row['room_id'],
-            user_id=row['user_id'],
-            role=row['role'],
-            content=row['content'],
+            id=data.get('id'),
+            room_id=data.get('room_id'),
+            user_id=data.get('user_id'),
+            role=data.get('role'),
+            content=data.get('content'),
             reasoning_content=reasoning_content,
-            sent_to_ai=bool(row['sent_to_ai']),
+            sent_to_ai=bool(data.get('sent_to_ai')),
+            token_count=data.get('token_count'),
             created_at=created_at
         )
     
+    def _write(self, cursor):
+        """在给定游标上执行写入（save() 和 Batch 共用）"""
+        created_at_str = self.created_at.isoformat() if isinstance(self.created_at, datetime) else self.created_at
+        self.token_count = estimate_tokens(self.content)
+        
+        if self.id:
+            # 更新现有记录
+            cursor.execute('''
+                UPDATE lounge_chats 
+                SET room_id=?, user_id=?, role=?, content=?, reasoning_content=?, sent_to_ai=?, token_count=?
+                WHERE id=?
+            ''', (self.room_id, self.user_id, self.role, self.content, self.reasoning_content, int(self.sent_to_ai),
+                  self.token_count, self.id))
+        else:
+            # 创建新记录
+            cursor.execute('''
+                INSERT INTO lounge_chats (room_id, user_id, role, content, reasoning_content, sent_to_ai, token_count, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (self.room_id, self.user_id, self.role, self.content, self.reasoning_content, int(self.sent_to_ai),
+                  self.token_count, created_at_str))
+            self.id = cursor.lastrowid
+    
     def save(self):
         """保存聊天记录"""
         with db_lock:
             conn = get_db_connection()
             cursor = conn.cursor()
             
-            created_at_str = self.created_at.isoformat() if isinstance(self.created_at, datetime) else self.created_at
-            
             try:
-                if self.id:
-                    # 更新现有记录
-                    cursor.execute('''
-                        UPDATE lounge_chats 
-                        SET room_id=?, user_id=?, role=?, content=?, reasoning_content=?, sent_to_ai=?
-                        WHERE id=?
-                    ''', (self.room_id, self.user_id, self.role, self.content, self.reasoning_content, int(self.sent_to_ai), self.id))
-                else:
-                    # 创建新记录
-                    cursor.execute('''
-                        INSERT INTO lounge_chats (room_id, user_id, role, content, reasoning_content, sent_to_ai, created_at)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ''', (self.room_id, self.user_id, self.role, self.content, self.reasoning_content, int(self.sent_to_ai), created_at_str))
-                    self.id = cursor.lastrowid
-                
+                self._write(cursor)
                 conn.commit()
                 return self
             except Exception as e:
-                print(f"[SQLite Error] 保存客厅聊天记录失败: {e}", flush=True)
+                log.error("保存客厅聊天记录失败: %s", e)
                 raise
             finally:
                 conn.close()
@@ -789,6 +1217,11 @@ class LoungeChat:
             
             return [LoungeChat.from_row(row) for row in rows]
     
+    @staticmethod
+    def query(*columns):
+        """创建查询构造器"""
+        return Query(LoungeChat, LoungeChat.TABLE, columns)
+    
     @staticmethod
     def all():
         """获取所有聊天记录"""
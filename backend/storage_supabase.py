@@ -4,10 +4,23 @@ Supabase 存储层实现
 保持与原 storage.py 相同的接口，底层使用 Supabase PostgreSQL
 """
 import os
+import random
+import time
 from datetime import datetime
 import secrets
-from supabase import create_client, Client
+from contextlib import contextmanager
+from threading import Lock, local
+import httpx
+from postgrest import SyncPostgrestClient
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_HEADERS
+from postgrest.exceptions import APIError
+from postgrest.utils import SyncClient
 from dotenv import load_dotenv
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from log import get_logger
+from tokens import estimate_tokens
+
+log = get_logger('db.supabase')
 
 # 加载环境变量
 load_dotenv()
@@ -16,31 +29,434 @@ load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
 
-# 调试：打印环境变量（只打印前后几个字符，不泄露完整key）
-print(f"[Debug] SUPABASE_URL: {SUPABASE_URL}", flush=True)
-print(f"[Debug] SUPABASE_KEY 长度: {len(SUPABASE_KEY)}, 前10字符: {SUPABASE_KEY[:10]}...", flush=True)
+# 调试：只记录地址和 key 长度，不输出 key 内容
+log.debug("Supabase 配置", extra={'url': SUPABASE_URL, 'key_length': len(SUPABASE_KEY)})
+
+# HTTP 传输配置：连接池、keep-alive、HTTP/2、超时
+SUPABASE_POOL_MAX_CONNECTIONS = int(os.getenv("SUPABASE_POOL_MAX_CONNECTIONS", 20))
+SUPABASE_POOL_MAX_KEEPALIVE = int(os.getenv("SUPABASE_POOL_MAX_KEEPALIVE", 10))
+SUPABASE_KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", 30))
+SUPABASE_HTTP2 = os.getenv("SUPABASE_HTTP2", "1") == "1"
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv("SUPABASE_CONNECT_TIMEOUT", 3))
+SUPABASE_READ_TIMEOUT = float(os.getenv("SUPABASE_READ_TIMEOUT", 10))
+SUPABASE_WRITE_TIMEOUT = float(os.getenv("SUPABASE_WRITE_TIMEOUT", 10))
+SUPABASE_POOL_TIMEOUT = float(os.getenv("SUPABASE_POOL_TIMEOUT", 2))
+
+# 重试与熔断：只对幂等读重试；连续失败达到阈值后熔断，快速失败
+SUPABASE_READ_RETRIES = int(os.getenv("SUPABASE_READ_RETRIES", 2))
+SUPABASE_RETRY_BACKOFF = float(os.getenv("SUPABASE_RETRY_BACKOFF", 0.1))
+SUPABASE_BREAKER_THRESHOLD = int(os.getenv("SUPABASE_BREAKER_THRESHOLD", 5))
+SUPABASE_BREAKER_RECOVERY = float(os.getenv("SUPABASE_BREAKER_RECOVERY", 15))
+
+_breaker = CircuitBreaker(
+    'supabase',
+    failure_threshold=SUPABASE_BREAKER_THRESHOLD,
+    recovery_timeout=SUPABASE_BREAKER_RECOVERY
+)
+_stats_lock = Lock()
+_stats = {'requests': 0, 'retries': 0, 'transport_errors': 0, 'server_errors': 0, 'short_circuited': 0}
+# 当前线程最近一次响应的 HTTP 状态码（APIError 不带状态码，由响应钩子记录）
+_last_response = local()
+# 连接池所在的传输层（用于 transport_stats）
+_transport = None
+
+
+def _http2_available():
+    """HTTP/2 需要安装 h2"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _remember_status(response):
+    _last_response.status = response.status_code
+
+
+def _create_http_session(base_url, headers):
+    """创建带连接池和超时配置的 HTTP 会话（整个进程复用）"""
+    global _transport
+    _transport = httpx.HTTPTransport(
+        limits=httpx.Limits(
+            max_connections=SUPABASE_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=SUPABASE_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY
+        ),
+        http2=SUPABASE_HTTP2 and _http2_available()
+    )
+    return SyncClient(
+        base_url=base_url,
+        headers=headers,
+        timeout=httpx.Timeout(
+            connect=SUPABASE_CONNECT_TIMEOUT,
+            read=SUPABASE_READ_TIMEOUT,
+            write=SUPABASE_WRITE_TIMEOUT,
+            pool=SUPABASE_POOL_TIMEOUT
+        ),
+        transport=_transport,
+        follow_redirects=True,
+        event_hooks={'response': [_remember_status]}
+    )
+
+
+class _PooledPostgrestClient(SyncPostgrestClient):
+    """PostgREST 客户端：通过 create_session 换成上面配置的 HTTP 会话"""
+
+    def create_session(self, base_url, headers, timeout, verify=True, proxy=None):
+        return _create_http_session(base_url, headers)
+
 
 # 延迟初始化：只在真正使用时才检查和创建客户端
 def get_supabase_client():
-    """获取 Supabase 客户端（延迟初始化）"""
+    """
+    获取 Supabase 数据库客户端（延迟初始化）
+    存储层只用到 PostgREST（table / rpc），直接创建 PostgREST 客户端，用 anon key 鉴权
+    """
     if not SUPABASE_URL or not SUPABASE_KEY:
         raise ValueError("请在环境变量中配置 SUPABASE_URL 和 SUPABASE_KEY")
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
+    return _PooledPostgrestClient(
+        f"{SUPABASE_URL.rstrip('/')}/rest/v1",
+        headers={
+            **DEFAULT_POSTGREST_CLIENT_HEADERS,
+            'apiKey': SUPABASE_KEY,
+            'Authorization': f'Bearer {SUPABASE_KEY}'
+        }
+    )
 
 # 全局客户端实例（首次使用时初始化）
 _supabase_client = None
+_client_lock = Lock()
 
 def supabase():
     """获取全局 Supabase 客户端"""
     global _supabase_client
     if _supabase_client is None:
-        _supabase_client = get_supabase_client()
+        with _client_lock:
+            if _supabase_client is None:
+                _supabase_client = get_supabase_client()
     return _supabase_client
 
 
+def _count(key, n=1):
+    with _stats_lock:
+        _stats[key] += n
+
+
+def _execute(request, idempotent=True):
+    """
+    执行 PostgREST 请求
+    - 熔断打开时直接抛出 CircuitOpenError
+    - 幂等读遇到网络层错误（超时、连接失败）时有限重试，指数退避 + 随机抖动
+    - 写请求不重试，避免重复写入
+    - PostgREST 返回错误（APIError）：5xx / 429 记为熔断失败，其他 4xx 说明服务正常，记为成功；都原样抛出
+    """
+    try:
+        _breaker.check()
+    except CircuitOpenError:
+        _count('short_circuited')
+        raise
+    attempts = SUPABASE_READ_RETRIES + 1 if idempotent else 1
+    for attempt in range(attempts):
+        _count('requests')
+        _last_response.status = None
+        try:
+            response = request.execute()
+        except APIError:
+            status = getattr(_last_response, 'status', None)
+            if status is None or status >= 500 or status == 429:
+                _count('server_errors')
+                _breaker.record_failure()
+            else:
+                _breaker.record_success()
+            raise
+        except httpx.TransportError as e:
+            _count('transport_errors')
+            _breaker.record_failure()
+            if attempt + 1 >= attempts or not _breaker.allow():
+                raise
+            _count('retries')
+            delay = SUPABASE_RETRY_BACKOFF * (2 ** attempt)
+            time.sleep(delay / 2 + random.uniform(0, delay / 2))
+            log.warning("请求失败，第 %d 次重试: %s", attempt + 1, type(e).__name__)
+            continue
+        _breaker.record_success()
+        return response
+
+
+def _pool_stats():
+    """连接池使用情况；httpx / httpcore 没有公开连接池状态，取不到时只返回配置"""
+    stats = {'max_connections': SUPABASE_POOL_MAX_CONNECTIONS}
+    connections = getattr(getattr(_transport, '_pool', None), 'connections', None)
+    if connections is None:
+        return stats
+    try:
+        connections = list(connections)
+        idle = sum(1 for c in connections if c.is_idle())
+    except Exception:
+        return stats
+    stats.update(connections=len(connections), idle=idle, active=len(connections) - idle)
+    return stats
+
+
+def transport_stats():
+    """传输层指标：请求数、重试数、网络错误数、熔断状态、连接池使用情况"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['circuit'] = _breaker.stats()
+    stats['pool'] = _pool_stats()
+    return stats
+
+
+def _to_api_value(value):
+    """Python 值转换为 PostgREST 参数"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class Query:
+    """
+    查询构造器（与 storage_sqlite.Query 接口一致）
+    列投影、比较/集合过滤、排序和分页都下推到 PostgREST，只传输需要的行和列
+
+    用法：
+        LoungeChat.query('id', 'content').eq('room_id', room_id).gt('id', since_id).order('created_at').all()
+    """
+
+    def __init__(self, model, table, columns=()):
+        self.model = model
+        self.table = table
+        self._columns = []
+        self._filters = []
+        self._orders = []
+        self._limit = None
+        self._empty = False
+        self.select(*columns)
+
+    def _check_column(self, column):
+        if column not in self.model.COLUMNS:
+            raise ValueError(f"{self.table} 没有字段: {column}")
+        return column
+
+    def select(self, *columns):
+        """只查询指定列（不传则查询全部列）"""
+        self._columns = [self._check_column(c) for c in columns]
+        return self
+
+    def _add(self, op, column, value):
+        self._filters.append((op, self._check_column(column), _to_api_value(value)))
+        return self
+
+    def eq(self, column, value):
+        if value is None:
+            return self._add('is_', column, 'null')
+        return self._add('eq', column, value)
+
+    def neq(self, column, value):
+        return self._add('neq', column, value)
+
+    def gt(self, column, value):
+        return self._add('gt', column, value)
+
+    def gte(self, column, value):
+        return self._add('gte', column, value)
+
+    def lt(self, column, value):
+        return self._add('lt', column, value)
+
+    def lte(self, column, value):
+        return self._add('lte', column, value)
+
+    def in_(self, column, values):
+        values = [_to_api_value(v) for v in values]
+        if not values:
+            self._empty = True
+            return self
+        return self._add('in_', column, values)
+
+    def or_eq(self, **kwargs):
+        """任一字段相等即可，如 or_eq(user1_id=1, user2_id=1)"""
+        parts = [f"{self._check_column(k)}.eq.{_to_api_value(v)}" for k, v in kwargs.items()]
+        if parts:
+            self._filters.append(('or_', None, ",".join(parts)))
+        return self
+
+    def order(self, column, desc=False):
+        self._orders.append((self._check_column(column), desc))
+        return self
+
+    def limit(self, n):
+        self._limit = int(n)
+        return self
+
+    def build(self):
+        """构造 PostgREST 请求"""
+        query = supabase().table(self.table).select(",".join(self._columns) if self._columns else "*")
+        for op, column, value in self._filters:
+            if op == 'or_':
+                query = query.or_(value)
+            else:
+                query = getattr(query, op)(column, value)
+        for column, desc in self._orders:
+            query = query.order(column, desc=desc)
+        if self._limit is not None:
+            query = query.limit(self._limit)
+        return query
+
+    def all(self, raise_errors=False):
+        """
+        执行查询，返回模型对象列表（未查询的字段为默认值）
+        查询失败时记录日志并返回空列表；raise_errors=True 时抛出，调用方据此区分"没有记录"和"读取失败"
+        """
+        if self._empty:
+            return []
+        try:
+            response = _execute(self.build())
+            return [self.model.from_dict(data) for data in response.data]
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            log.error("查询 %s 失败: %s", self.table, e)
+            if raise_errors:
+                raise
+            return []
+
+    def first(self, raise_errors=False):
+        """执行查询，返回第一条结果或 None"""
+        results = self.limit(1).all(raise_errors)
+        return results[0] if results else None
+
+
+_sequence_warned = set()
+
+
+def setval_sql(table):
+    """把 table 的 id 序列推进到当前最大 id 的 SQL（apply_batch 的 import 会自动执行，兼容路径需要手动执行）"""
+    return (f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"(SELECT COALESCE(MAX(id), 1) FROM {table}));")
+
+
+def _warn_sequence_not_advanced(table):
+    """兼容路径按原 id 写入后序列没有推进，之后新建的行会与导入的 id 冲突；每张表每个进程提示一次"""
+    if table in _sequence_warned:
+        return
+    _sequence_warned.add(table)
+    log.warning("apply_batch 未部署，%s 按原 id 导入后 id 序列没有推进，导入完成后请在 Supabase SQL Editor 执行: %s"
+                "（或先部署 supabase_migrations.sql 中的 apply_batch 再导入）", table, setval_sql(table))
+
+
+class Batch:
+    """
+    批量写入（工作单元，与 storage_sqlite.Batch 接口一致）
+    收集多次写入，提交时通过 Postgres 函数 apply_batch 一次 RPC 完成（单次往返、单个事务）。
+    apply_batch 定义见 supabase_migrations.sql；数据库尚未部署该函数时退化为逐条写入。
+
+    用法：
+        with batch() as b:
+            b.save(relationship)
+            b.save(user)
+            b.update(LoungeChat, [1, 2, 3], sent_to_ai=True)
+            b.import_rows(CoachChat, chats)     # 按原 id 写入（导入 / 迁移用）
+    """
+
+    def __init__(self):
+        self._ops = []
+
+    def save(self, obj):
+        """登记一次新建或更新（按 obj.id 判断）"""
+        self._ops.append(('save', obj))
+        return obj
+
+    def update(self, model, ids, **fields):
+        """登记一次批量更新：把 ids 对应行的 fields 设为相同的值"""
+        ids = list(ids)
+        for column in fields:
+            if column not in model.COLUMNS or column == 'id':
+                raise ValueError(f"{model.TABLE} 不能批量更新字段: {column}")
+        if ids and fields:
+            self._ops.append(('update', model, ids, {k: _to_api_value(v) for k, v in fields.items()}))
+
+    def import_rows(self, model, objs):
+        """登记一批按原 id 写入的记录（所有列原样写入）；id 已存在的行跳过，重复导入不会产生重复数据"""
+        rows = [{column: _to_api_value(getattr(obj, column)) for column in model.COLUMNS} for obj in objs]
+        if rows:
+            self._ops.append(('import', model, rows))
+
+    def _rpc_ops(self):
+        ops = []
+        for op in self._ops:
+            if op[0] == 'save':
+                obj = op[1]
+                if obj.id:
+                    ops.append({'table': obj.TABLE, 'action': 'update', 'ids': [obj.id], 'data': obj._payload()})
+                else:
+                    ops.append({'table': obj.TABLE, 'action': 'insert', 'data': obj._payload()})
+            elif op[0] == 'import':
+                _, model, rows = op
+                ops.append({'table': model.TABLE, 'action': 'import', 'rows': rows})
+            else:
+                _, model, ids, fields = op
+                ops.append({'table': model.TABLE, 'action': 'update', 'ids': ids, 'data': fields})
+        return ops
+
+    def _apply_results(self, results):
+        """把新建行的 id / created_at 回填到对象上"""
+        for op, result in zip(self._ops, results):
+            if op[0] == 'save' and not op[1].id and isinstance(result, dict):
+                obj = op[1]
+                obj.id = result.get('id')
+                if result.get('created_at'):
+                    obj.created_at = datetime.fromisoformat(result['created_at'].replace('Z', '+00:00'))
+
+    def _commit_sequential(self):
+        """逐条写入（apply_batch 未部署时的兼容路径，非原子）"""
+        for op in self._ops:
+            if op[0] == 'save':
+                op[1].save()
+            elif op[0] == 'import':
+                _, model, rows = op
+                _execute(supabase().table(model.TABLE).upsert(rows, on_conflict='id', ignore_duplicates=True),
+                         idempotent=True)
+                _warn_sequence_not_advanced(model.TABLE)
+            else:
+                _, model, ids, fields = op
+                _execute(supabase().table(model.TABLE).update(fields).in_('id', ids), idempotent=False)
+
+    def commit(self):
+        """一次 RPC 提交所有登记的写入"""
+        if not self._ops:
+            return
+        try:
+            response = _execute(supabase().rpc('apply_batch', {'ops': self._rpc_ops()}), idempotent=False)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            # PGRST202：数据库中找不到该函数
+            if 'PGRST202' not in str(e) and 'Could not find the function' not in str(e):
+                log.error("批量写入失败: %s", e)
+                raise
+            log.warning("未找到 apply_batch 函数，退化为逐条写入（请执行 supabase_migrations.sql）")
+            self._commit_sequential()
+        else:
+            self._apply_results(response.data or [])
+        self._ops = []
+
+
+@contextmanager
+def batch():
+    """批量写入上下文：退出时一次性提交（代码块内抛出异常则不提交）"""
+    unit = Batch()
+    yield unit
+    unit.commit()
+
+
 class User:
     """用户模型"""
 
+    TABLE = 'users'
+    COLUMNS = ('id', 'phone', 'password', 'nickname', 'binding_code', 'partner_id', 'unbind_at', 'created_at')
+
     def __init__(self, phone, password, binding_code=None, partner_id=None, unbind_at=None, created_at=None, id=None, nickname=None):
         self.id = id
         self.phone = phone
@@ -49,7 +465,7 @@ class User:
         self.partner_id = partner_id
         self.unbind_at = unbind_at
         self.created_at = created_at or datetime.now()
-        self.nickname = nickname or phone[-4:]  # 默认使用手机号后4位
+        self.nickname = nickname or (phone[-4:] if phone else None)  # 默认使用手机号后4位
     
     def generate_binding_code(self):
         """生成6位绑定码"""
@@ -81,7 +497,7 @@ class User:
                 created_at = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
             except ValueError as e:
                 # 处理微秒位数不足的情况
-                print(f"[Debug] 时间格式解析失败: {created_at}, 错误: {e}")
+                log.warning("时间格式解析失败: %s, 错误: %s", created_at, e)
                 # 尝试手动补齐微秒位数
                 if '+' in created_at:
                     time_part, tz_part = created_at.rsplit('+', 1)
@@ -114,47 +530,55 @@ class User:
             nickname=data.get('nickname')
         )
     
-    def save(self):
-        """保存用户信息"""
+    def _payload(self):
+        """写入数据（save() 和 Batch 共用）"""
         user_data = {
             'phone': self.phone,
             'password': self.password,
             'binding_code': self.binding_code,
             'partner_id': self.partner_id,
-            'unbind_at': self.unbind_at.isoformat() if isinstance(self.unbind_at, datetime) else self.unbind_at,
             'nickname': self.nickname,
         }
         
         # 移除 None 值
         user_data = {k: v for k, v in user_data.items() if v is not None}
+        # unbind_at 需要能被清空（撤销解绑），始终写入
+        user_data['unbind_at'] = self.unbind_at.isoformat() if isinstance(self.unbind_at, datetime) else self.unbind_at
+        return user_data
+    
+    def save(self):
+        """保存用户信息"""
+        user_data = self._payload()
         
         try:
             if self.id:
                 # 更新现有用户
-                response = supabase().table('users').update(user_data).eq('id', self.id).execute()
+                response = _execute(supabase().table('users').update(user_data).eq('id', self.id), idempotent=False)
                 if response.data:
                     return self
             else:
                 # 创建新用户
-                response = supabase().table('users').insert(user_data).execute()
+                response = _execute(supabase().table('users').insert(user_data), idempotent=False)
                 if response.data and len(response.data) > 0:
                     self.id = response.data[0]['id']
                     self.created_at = datetime.fromisoformat(response.data[0]['created_at'].replace('Z', '+00:00'))
             return self
         except Exception as e:
-            print(f"[Supabase Error] 保存用户失败: {e}")
+            log.error("保存用户失败: %s", e)
             raise
     
     @staticmethod
     def get(id):
         """根据ID获取用户"""
         try:
-            response = supabase().table('users').select('*').eq('id', id).execute()
+            response = _execute(supabase().table('users').select('*').eq('id', id))
             if response.data and len(response.data) > 0:
                 return User.from_dict(response.data[0])
             return None
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            print(f"[Supabase Error] 获取用户失败: {e}")
+            log.error("获取用户失败: %s", e)
             return None
     
     @staticmethod
@@ -164,33 +588,39 @@ class User:
             query = supabase().table('users').select('*')
             for key, value in kwargs.items():
                 query = query.eq(key, value)
-            response = query.execute()
-            
-            # 调试日志
-            print(f"[Debug] User.filter 查询条件: {kwargs}")
-            print(f"[Debug] 查询结果数量: {len(response.data)}")
-            if response.data:
-                for user in response.data:
-                    print(f"[Debug] 找到用户: phone={user.get('phone')}, password={user.get('password')}")
+            response = _execute(query)
             
+            log.debug("User.filter 返回 %d 条", len(response.data), extra={'conditions': kwargs})
             return [User.from_dict(data) for data in response.data]
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            print(f"[Supabase Error] 过滤用户失败: {e}")
+            log.error("过滤用户失败: %s", e)
             return []
     
+    @staticmethod
+    def query(*columns):
+        """创建查询构造器"""
+        return Query(User, User.TABLE, columns)
+    
     @staticmethod
     def all():
         """获取所有用户"""
         try:
-            response = supabase().table('users').select('*').execute()
+            response = _execute(supabase().table('users').select('*'))
             return [User.from_dict(data) for data in response.data]
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            print(f"[Supabase Error] 获取所有用户失败: {e}")
+            log.error("获取所有用户失败: %s", e)
             return []
 
 
 class Relationship:
     """关系绑定模型"""
+
+    TABLE = 'relationships'
+    COLUMNS = ('id', 'user1_id', 'user2_id', 'room_id', 'is_active', 'created_at')
     
     def __init__(self, user1_id, user2_id, room_id, is_active=True, created_at=None, id=None):
         self.id = id
@@ -222,7 +652,7 @@ class Relationship:
                 created_at = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
             except ValueError as e:
                 # 处理微秒位数不足的情况
-                print(f"[Debug] Relationship 时间格式解析失败: {created_at}, 错误: {e}")
+                log.warning("Relationship 时间格式解析失败: %s, 错误: %s", created_at, e)
                 if '+' in created_at:
                     time_part, tz_part = created_at.rsplit('+', 1)
                     if '.' in time_part:
@@ -245,40 +675,46 @@ class Relationship:
             created_at=created_at
         )
     
-    def save(self):
-        """保存关系信息"""
-        relationship_data = {
+    def _payload(self):
+        """写入数据（save() 和 Batch 共用）"""
+        return {
             'user1_id': self.user1_id,
             'user2_id': self.user2_id,
             'room_id': self.room_id,
             'is_active': self.is_active
         }
+    
+    def save(self):
+        """保存关系信息"""
+        relationship_data = self._payload()
         
         try:
             if self.id:
                 # 更新现有关系
-                response = supabase().table('relationships').update(relationship_data).eq('id', self.id).execute()
+                response = _execute(supabase().table('relationships').update(relationship_data).eq('id', self.id), idempotent=False)
             else:
                 # 创建新关系
-                response = supabase().table('relationships').insert(relationship_data).execute()
+                response = _execute(supabase().table('relationships').insert(relationship_data), idempotent=False)
                 if response.data and len(response.data) > 0:
                     self.id = response.data[0]['id']
                     self.created_at = datetime.fromisoformat(response.data[0]['created_at'].replace('Z', '+00:00'))
             return self
         except Exception as e:
-            print(f"[Supabase Error] 保存关系失败: {e}")
+            log.error("保存关系失败: %s", e)
             raise
     
     @staticmethod
     def get(id):
         """根据ID获取关系"""
         try:
-            response = supabase().table('relationships').select('*').eq('id', id).execute()
+            response = _execute(supabase().table('relationships').select('*').eq('id', id))
             if response.data and len(response.data) > 0:
                 return Relationship.from_dict(response.data[0])
             return None
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            print(f"[Supabase Error] 获取关系失败: {e}")
+            log.error("获取关系失败: %s", e)
             return None
     
     @staticmethod
@@ -288,32 +724,45 @@ class Relationship:
             query = supabase().table('relationships').select('*')
             for key, value in kwargs.items():
                 query = query.eq(key, value)
-            response = query.execute()
+            response = _execute(query)
             return [Relationship.from_dict(data) for data in response.data]
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            print(f"[Supabase Error] 过滤关系失败: {e}")
+            log.error("过滤关系失败: %s", e)
             return []
     
+    @staticmethod
+    def query(*columns):
+        """创建查询构造器"""
+        return Query(Relationship, Relationship.TABLE, columns)
+    
     @staticmethod
     def all():
         """获取所有关系"""
         try:
-            response = supabase().table('relationships').select('*').execute()
+            response = _execute(supabase().table('relationships').select('*'))
             return [Relationship.from_dict(data) for data in response.data]
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            print(f"[Supabase Error] 获取所有关系失败: {e}")
+            log.error("获取所有关系失败: %s", e)
             return []
 
 
 class CoachChat:
     """个人教练聊天记录模型"""
+
+    TABLE = 'coach_chats'
+    COLUMNS = ('id', 'user_id', 'role', 'content', 'reasoning_content', 'token_count', 'created_at')
     
-    def __init__(self, user_id, role, content, reasoning_content=None, created_at=None, id=None):
+    def __init__(self, user_id, role, content, reasoning_content=None, created_at=None, id=None, token_count=None):
         self.id = id
         self.user_id = user_id
         self.role = role
         self.content = content
         self.reasoning_content = reasoning_content
+        self.token_count = token_count
         self.created_at = created_at or datetime.now()
     
     def to_dict(self):
@@ -338,7 +787,7 @@ class CoachChat:
                 created_at = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
             except ValueError as e:
                 # 处理微秒位数不足的情况
-                print(f"[Debug] CoachChat 时间格式解析失败: {created_at}, 错误: {e}")
+                log.warning("CoachChat 时间格式解析失败: %s, 错误: %s", created_at, e)
                 if '+' in created_at:
                     time_part, tz_part = created_at.rsplit('+', 1)
                     if '.' in time_part:
@@ -358,46 +807,55 @@ class CoachChat:
             role=data.get('role'),
             content=data.get('content'),
             reasoning_content=data.get('reasoning_content'),
+            token_count=data.get('token_count'),
             created_at=created_at
         )
     
-    def save(self):
-        """保存聊天记录"""
+    def _payload(self):
+        """写入数据（save() 和 Batch 共用）"""
+        self.token_count = estimate_tokens(self.content)
         chat_data = {
             'user_id': self.user_id,
             'role': self.role,
             'content': self.content,
-            'reasoning_content': self.reasoning_content
+            'reasoning_content': self.reasoning_content,
+            'token_count': self.token_count
         }
         
         # 移除 None 值
-        chat_data = {k: v for k, v in chat_data.items() if v is not None}
+        return {k: v for k, v in chat_data.items() if v is not None}
+    
+    def save(self):
+        """保存聊天记录"""
+        chat_data = self._payload()
         
         try:
             if self.id:
                 # 更新现有记录
-                response = supabase().table('coach_chats').update(chat_data).eq('id', self.id).execute()
+                response = _execute(supabase().table('coach_chats').update(chat_data).eq('id', self.id), idempotent=False)
             else:
                 # 创建新记录
-                response = supabase().table('coach_chats').insert(chat_data).execute()
+                response = _execute(supabase().table('coach_chats').insert(chat_data), idempotent=False)
                 if response.data and len(response.data) > 0:
                     self.id = response.data[0]['id']
                     self.created_at = datetime.fromisoformat(response.data[0]['created_at'].replace('Z', '+00:00'))
             return self
         except Exception as e:
-            print(f"[Supabase Error] 保存教练聊天记录失败: {e}")
+            log.error("保存教练聊天记录失败: %s", e)
             raise
     
     @staticmethod
     def get(id):
         """根据ID获取聊天记录"""
         try:
-            response = supabase().table('coach_chats').select('*').eq('id', id).execute()
+            response = _execute(supabase().table('coach_chats').select('*').eq('id', id))
             if response.data and len(response.data) > 0:
                 return CoachChat.from_dict(response.data[0])
             return None
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            print(f"[Supabase Error] 获取教练聊天记录失败: {e}")
+            log.error("获取教练聊天记录失败: %s", e)
             return None
     
     @staticmethod
@@ -408,32 +866,48 @@ class CoachChat:
             for key, value in kwargs.items():
                 query = query.eq(key, value)
             # 按创建时间排序
-            response = query.order('created_at', desc=False).execute()
+            response = _execute(query.order('created_at', desc=False))
             return [CoachChat.from_dict(data) for data in response.data]
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            print(f"[Supabase Error] 过滤教练聊天记录失败: {e}")
+            log.error("过滤教练聊天记录失败: %s", e)
             return []
     
+    @staticmethod
+    def query(*columns):
+        """创建查询构造器"""
+        return Query(CoachChat, CoachChat.TABLE, columns)
+    
     @staticmethod
     def all():
         """获取所有聊天记录"""
         try:
-            response = supabase().table('coach_chats').select('*').order('created_at', desc=False).execute()
+            response = _execute(supabase().table('coach_chats').select('*').order('created_at', desc=False))
             return [CoachChat.from_dict(data) for data in response.data]
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            print(f"[Supabase Error] 获取所有教练聊天记录失败: {e}")
+            log.error("获取所有教练聊天记录失败: %s", e)
             return []
 
 
 class LoungeChat:
     """情感客厅聊天记录模型"""
+
+    TABLE = 'lounge_chats'
+    COLUMNS = ('id', 'room_id', 'user_id', 'role', 'content', 'reasoning_content', 'sent_to_ai', 'token_count', 'created_at')
     
-    def __init__(self, room_id, content, role, user_id=None, created_at=None, id=None):
+    def __init__(self, room_id, content, role, user_id=None, reasoning_content=None, sent_to_ai=False, created_at=None, id=None,
+                 token_count=None):
         self.id = id
         self.room_id = room_id
         self.user_id = user_id
         self.role = role
         self.content = content
+        self.reasoning_content = reasoning_content
+        self.sent_to_ai = sent_to_ai
+        self.token_count = token_count
         self.created_at = created_at or datetime.now()
     
     def to_dict(self):
@@ -443,6 +917,8 @@ class LoungeChat:
             'user_id': self.user_id,
             'role': self.role,
             'content': self.content,
+            'reasoning_content': self.reasoning_content,
+            'sent_to_ai': self.sent_to_ai,
             'created_at': self.created_at.isoformat() if isinstance(self.created_at, datetime) else self.created_at
         }
     
@@ -458,7 +934,7 @@ class LoungeChat:
                 created_at = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
             except ValueError as e:
                 # 处理微秒位数不足的情况
-                print(f"[Debug] LoungeChat 时间格式解析失败: {created_at}, 错误: {e}")
+                log.warning("LoungeChat 时间格式解析失败: %s, 错误: %s", created_at, e)
                 if '+' in created_at:
                     time_part, tz_part = created_at.rsplit('+', 1)
                     if '.' in time_part:
@@ -478,43 +954,56 @@ class LoungeChat:
             user_id=data.get('user_id'),
             role=data.get('role'),
             content=data.get('content'),
+            reasoning_content=data.get('reasoning_content'),
+            sent_to_ai=bool(data.get('sent_to_ai')),
+            token_count=data.get('token_count'),
             created_at=created_at
         )
     
-    def save(self):
-        """保存聊天记录"""
-        chat_data = {
+    def _payload(self):
+        """写入数据（save() 和 Batch 共用）"""
+        self.token_count = estimate_tokens(self.content)
+        return {
             'room_id': self.room_id,
             'user_id': self.user_id,
             'role': self.role,
-            'content': self.content
+            'content': self.content,
+            'reasoning_content': self.reasoning_content,
+            'sent_to_ai': bool(self.sent_to_ai),
+            'token_count': self.token_count
         }
+    
+    def save(self):
+        """保存聊天记录"""
+        chat_data = self._payload()
         
         try:
             if self.id:
                 # 更新现有记录
-                response = supabase().table('lounge_chats').update(chat_data).eq('id', self.id).execute()
+                response = _execute(supabase().table('lounge_chats').update(chat_data).eq('id', self.id), idempotent=False)
             else:
                 # 创建新记录
-                response = supabase().table('lounge_chats').insert(chat_data).execute()
+                response = _execute(supabase().table('lounge_chats').insert(chat_data), idempotent=False)
                 if response.data and len(response.data) > 0:
                     self.id = response.data[0]['id']
                     self.created_at = datetime.fromisoformat(response.data[0]['created_at'].replace('Z', '+00:00'))
             return self
         except Exception as e:
-            print(f"[Supabase Error] 保存客厅聊天记录失败: {e}")
+            log.error("保存客厅聊天记录失败: %s", e)
             raise
     
     @staticmethod
     def get(id):
         """根据ID获取聊天记录"""
         try:
-            response = supabase().table('lounge_chats').select('*').eq('id', id).execute()
+            response = _execute(supabase().table('lounge_chats').select('*').eq('id', id))
             if response.data and len(response.data) > 0:
                 return LoungeChat.from_dict(response.data[0])
             return None
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            print(f"[Supabase Error] 获取客厅聊天记录失败: {e}")
+            log.error("获取客厅聊天记录失败: %s", e)
             return None
     
     @staticmethod
@@ -525,18 +1014,27 @@ class LoungeChat:
             for key, value in kwargs.items():
                 query = query.eq(key, value)
             # 按创建时间排序
-            response = query.order('created_at', desc=False).execute()
+            response = _execute(query.order('created_at', desc=False))
             return [LoungeChat.from_dict(data) for data in response.data]
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            print(f"[Supabase Error] 过滤客厅聊天记录失败: {e}")
+            log.error("过滤客厅聊天记录失败: %s", e)
             return []
     
+    @staticmethod
+    def query(*columns):
+        """创建查询构造器"""
+        return Query(LoungeChat, LoungeChat.TABLE, columns)
+    
     @staticmethod
     def all():
         """获取所有聊天记录"""
         try:
-            response = supabase().table('lounge_chats').select('*').order('created_at', desc=False).execute()
+            response = _execute(supabase().table('lounge_chats').select('*').order('created_at', desc=False))
             return [LoungeChat.from_dict(data) for data in response.data]
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            print(f"[Supabase Error] 获取所有客厅聊天记录失败: {e}")
+            log.error("获取所有客厅聊天记录失败: %s", e)
             return []
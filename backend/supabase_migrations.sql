@@ -0,0 +1,78 @@
+-- Supabase 增量迁移脚本
+-- 在 Supabase SQL Editor 中执行；所有语句可重复执行
+
+-- 情感客厅：思考过程和"已传给AI"标记（与 storage_sqlite 表结构保持一致）
+ALTER TABLE lounge_chats ADD COLUMN IF NOT EXISTS reasoning_content TEXT;
+ALTER TABLE lounge_chats ADD COLUMN IF NOT EXISTS sent_to_ai BOOLEAN DEFAULT FALSE;
+
+-- 聊天记录的估算 token 数（保存时写入，构造 Coze 上下文时按预算取舍；旧记录为空，首次用到时补齐）
+ALTER TABLE coach_chats ADD COLUMN IF NOT EXISTS token_count INTEGER;
+ALTER TABLE lounge_chats ADD COLUMN IF NOT EXISTS token_count INTEGER;
+
+-- 热点查询索引（Query 构造器下推的过滤和排序依赖这些索引）
+CREATE INDEX IF NOT EXISTS idx_lounge_chats_room_created ON lounge_chats(room_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_lounge_chats_room_unsent ON lounge_chats(room_id, created_at) WHERE role = 'user' AND sent_to_ai = FALSE;
+CREATE INDEX IF NOT EXISTS idx_coach_chats_user_created ON coach_chats(user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_relationships_user1 ON relationships(user1_id);
+CREATE INDEX IF NOT EXISTS idx_relationships_user2 ON relationships(user2_id);
+CREATE INDEX IF NOT EXISTS idx_relationships_room ON relationships(room_id);
+CREATE INDEX IF NOT EXISTS idx_users_binding_code ON users(binding_code);
+
+-- 批量写入函数：storage_supabase.Batch 一次 RPC 提交多条 insert/update，整体在一个事务中执行
+-- ops 格式：[{"table": "users", "action": "insert", "data": {...}},
+--            {"table": "lounge_chats", "action": "update", "ids": [1, 2], "data": {"sent_to_ai": true}},
+--            {"table": "coach_chats", "action": "import", "rows": [{"id": 7, ...}, ...]}]
+-- 返回与 ops 一一对应的结果：insert 返回新行，update 返回被更新的 id 列表，import 返回实际写入的行数
+-- import 按原 id 写入（history_transfer.py 导入 / 迁移用），id 已存在的行跳过，写入后把 id 序列推进到最大 id 之后
+CREATE OR REPLACE FUNCTION apply_batch(ops JSONB)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    op JSONB;
+    tbl TEXT;
+    cols TEXT;
+    sets TEXT;
+    seq TEXT;
+    row_out JSONB;
+    results JSONB := '[]'::JSONB;
+BEGIN
+    FOR op IN SELECT * FROM jsonb_array_elements(ops) LOOP
+        tbl := op->>'table';
+        IF tbl NOT IN ('users', 'relationships', 'coach_chats', 'lounge_chats') THEN
+            RAISE EXCEPTION 'apply_batch: 不支持的表 %', tbl;
+        END IF;
+
+        IF op->>'action' = 'insert' THEN
+            SELECT string_agg(quote_ident(k), ', ') INTO cols FROM jsonb_object_keys(op->'data') AS k;
+            EXECUTE format(
+                'INSERT INTO %I (%s) SELECT %s FROM jsonb_populate_record(NULL::%I, $1) RETURNING to_jsonb(%I.*)',
+                tbl, cols, cols, tbl, tbl
+            ) INTO row_out USING op->'data';
+        ELSIF op->>'action' = 'update' THEN
+            SELECT string_agg(format('%I = r.%I', k, k), ', ') INTO sets FROM jsonb_object_keys(op->'data') AS k;
+            EXECUTE format(
+                'WITH updated AS (UPDATE %I AS t SET %s FROM jsonb_populate_record(NULL::%I, $1) AS r '
+                'WHERE t.id = ANY($2) RETURNING t.id) SELECT COALESCE(jsonb_agg(id), ''[]''::JSONB) FROM updated',
+                tbl, sets, tbl
+            ) INTO row_out
+            USING op->'data', ARRAY(SELECT jsonb_array_elements_text(op->'ids')::BIGINT);
+        ELSIF op->>'action' = 'import' THEN
+            SELECT string_agg(quote_ident(k), ', ') INTO cols FROM jsonb_object_keys(op->'rows'->0) AS k;
+            EXECUTE format(
+                'WITH inserted AS (INSERT INTO %I (%s) SELECT %s FROM jsonb_populate_recordset(NULL::%I, $1) '
+                'ON CONFLICT (id) DO NOTHING RETURNING 1) SELECT to_jsonb(count(*)) FROM inserted',
+                tbl, cols, cols, tbl
+            ) INTO row_out USING op->'rows';
+            seq := pg_get_serial_sequence(tbl, 'id');
+            EXECUTE format('SELECT setval(%L, GREATEST((SELECT MAX(id) FROM %I), (SELECT last_value FROM %s)))',
+                           seq, tbl, seq);
+        ELSE
+            RAISE EXCEPTION 'apply_batch: 不支持的操作 %', op->>'action';
+        END IF;
+
+        results := results || jsonb_build_array(row_out);
+    END LOOP;
+    RETURN results;
+END;
+$$;
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Coze 准入控制测试：流之间轮流放行、bot 配额、排队上限、等待超时、排队中放弃
+
+用法：
+    python test_admission.py
+"""
+import threading
+
+import admission
+
+
+def drain(controller, tickets, order):
+    """按放行顺序记录名字，每放行一个就归还，直到全部完成"""
+    def worker(name, ticket):
+        ticket.wait(5)
+        order.append(name)
+        ticket.release()
+
+    threads = [threading.Thread(target=worker, args=item) for item in tickets]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def test_fair_between_flows():
+    controller = admission.AdmissionController(capacity=1, quotas={}, max_queue=10, queue_timeout=5)
+    holder = controller.enqueue('coach', 'coach:a')   # 占住唯一名额
+    assert holder.state == 'granted'
+    # 用户 a 连发 3 条，用户 b 之后发 1 条：b 不必等 a 的全部请求
+    tickets = [('a1', controller.enqueue('coach', 'coach:a')),
+               ('a2', controller.enqueue('coach', 'coach:a')),
+               ('a3', controller.enqueue('coach', 'coach:a')),
+               ('b1', controller.enqueue('coach', 'coach:b'))]
+    order = []
+    threads = drain(controller, tickets, order)
+    holder.release()
+    for thread in threads:
+        thread.join(5)
+    assert order == ['a1', 'b1', 'a2', 'a3'], order
+    assert controller.stats()['running'] == 0 and controller.stats()['flows'] == 0
+    print('  ✅ 流之间轮流放行')
+
+
+def test_bot_quota():
+    controller = admission.AdmissionController(capacity=3, quotas={'coach': 1}, max_queue=10, queue_timeout=5)
+    coach = controller.enqueue('coach', 'coach:a')
+    waiting = controller.enqueue('coach', 'coach:b')
+    assert waiting.state == 'waiting'
+    # coach 配额已满，lounge 仍可直接放行
+    lounge = controller.enqueue('lounge', 'lounge:r1')
+    assert lounge.state == 'granted'
+    coach.release()
+    assert waiting.state == 'granted'
+    waiting.release()
+    lounge.release()
+    print('  ✅ bot 配额')
+
+
+def test_queue_full_timeout_cancel():
+    controller = admission.AdmissionController(capacity=1, quotas={}, max_queue=1, queue_timeout=0.05)
+    holder = controller.enqueue('coach', 'coach:a')
+    queued = controller.enqueue('coach', 'coach:b')
+    try:
+        controller.enqueue('coach', 'coach:c')
+        assert False, '应当拒绝'
+    except admission.AdmissionRejected as e:
+        assert e.reason == 'queue_full' and e.retry_after >= 1
+    try:
+        queued.wait()
+        assert False, '应当超时'
+    except admission.AdmissionRejected as e:
+        assert e.reason == 'timeout'
+
+    # 排队中放弃（客户端断开）后不再占位
+    abandoned = controller.enqueue('coach', 'coach:d')
+    abandoned.release()
+    holder.release()
+    assert abandoned.state == 'cancelled'
+    stats = controller.stats()
+    assert stats['waiting'] == 0 and stats['running'] == 0
+    assert stats['rejected'] == {'queue_full': 1, 'timeout': 1}
+    print('  ✅ 排队上限、等待超时、放弃排队')
+
+
+def main():
+    print("=" * 50)
+    print("开始准入控制测试")
+    print("=" * 50)
+    test_fair_between_flows()
+    test_bot_quota()
+    test_queue_full_timeout_cancel()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
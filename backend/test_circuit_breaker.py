@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+熔断器测试：滑动窗口失败率、慢调用、半开探测，以及 Coze 熔断时流式接口立即返回错误事件
+
+用法：
+    python test_circuit_breaker.py
+"""
+import json
+import os
+import secrets
+import time
+
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+from circuit_breaker import CircuitBreaker, CircuitOpenError, RollingWindowBreaker
+
+
+def test_rolling_window():
+    breaker = RollingWindowBreaker('test', window=60, min_calls=4, failure_rate=0.5, slow_call_seconds=1.0,
+                                   recovery_timeout=0.05)
+    breaker.record(True, 0.2)
+    breaker.record(False)
+    breaker.record(True, 0.3)
+    assert breaker.state == CircuitBreaker.CLOSED   # 调用数不足 min_calls
+    breaker.record(True, 5.0)                       # 慢调用按失败计：2/4
+    assert breaker.state == CircuitBreaker.OPEN
+    try:
+        breaker.check()
+        assert False, '应当拒绝'
+    except CircuitOpenError as e:
+        assert e.name == 'test' and e.retry_after > 0
+
+    time.sleep(0.06)
+    assert breaker.allow()          # 半开：放行一个探测
+    assert not breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    stats = breaker.stats()
+    assert stats['slow'] == 1 and stats['opened'] == 1 and stats['window_calls'] == 0
+    print('  ✅ 滑动窗口失败率、慢调用、半开探测')
+
+
+def test_half_open_probe_expires():
+    breaker = CircuitBreaker('test', failure_threshold=1, recovery_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    # 探测没有上报结果：超过 recovery_timeout 后允许新的探测
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    print('  ✅ 探测无结果时重新探测')
+
+
+def test_coze_stream_fails_fast():
+    import storage_memory
+    import app as app_module
+    from testing import use_backend
+    saved = app_module.coze_breaker
+    # 换上一个已打开的熔断器，不改动应用原来那个的状态
+    breaker = RollingWindowBreaker('coze', recovery_timeout=30)
+    with breaker._lock:
+        breaker._open()
+    app_module.coze_breaker = breaker
+    try:
+        with use_backend(app_module, storage_memory) as client:
+            phone = '196' + str(secrets.randbelow(10 ** 8)).zfill(8)
+            client.post('/api/register', json={'phone': phone, 'password': 'pw'}).close()
+            client.post('/api/login', json={'phone': phone, 'password': 'pw'}).close()
+
+            response = client.post('/api/coach/chat/stream', json={'message': '你好'})
+            events = [json.loads(line[6:]) for line in response.get_data(as_text=True).split('\n')
+                      if line.startswith('data: ')]
+            assert response.mimetype == 'text/event-stream' and 'Retry-After' in response.headers
+            assert len(events) == 1 and events[0]['type'] == 'error' and events[0]['retry_after'] >= 1
+
+            response = client.post('/api/coach/chat', json={'message': '你好'})
+            assert response.status_code == 503 and response.get_json()['message'].startswith('AI')
+            # 没有保存用户消息（注册时的开场白除外）
+            user_id = client.get('/api/user/info').get_json()['user']['id']
+            assert not storage_memory.CoachChat.filter(user_id=user_id, role='user')
+    finally:
+        app_module.coze_breaker = saved
+    print('  ✅ Coze 熔断时立即返回错误')
+
+
+def main():
+    print("=" * 50)
+    print("开始熔断器测试")
+    print("=" * 50)
+    test_rolling_window()
+    test_half_open_probe_expires()
+    test_coze_stream_fails_fast()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+教练上下文环形缓冲测试：懒加载、写穿、异步保存前可见、多 worker 版本比对、按用户 LRU 淘汰
+
+用法：
+    python test_coach_context.py
+"""
+import os
+import secrets
+import tempfile
+
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+import storage_memory
+from coach_context import RecentTurns
+from storage_cache import VersionStore
+
+CoachChat = storage_memory.CoachChat
+
+
+def make_turns(versions=None, **kwargs):
+    turns = RecentTurns(versions=versions or VersionStore(), **kwargs)
+    turns.model = CoachChat
+    return turns
+
+
+def save(turns, user_id, role, content):
+    msg = CoachChat(user_id=user_id, role=role, content=content)
+    msg.save()
+    turns.saved(msg)
+    return msg
+
+
+def new_user():
+    return 10 ** 6 + secrets.randbelow(10 ** 6)
+
+
+def test_lazy_load_and_write_through():
+    user_id = new_user()
+    turns = make_turns(size=4)
+    for i in range(5):
+        CoachChat(user_id=user_id, role='user', content=f"旧消息{i}").save()
+
+    assert [t['content'] for t in turns.recent(user_id, 3)] == ['旧消息2', '旧消息3', '旧消息4']
+    assert turns.stats()['loads'] == 1
+    save(turns, user_id, 'user', '你好')
+    reply = save(turns, user_id, 'assistant', '你好呀')
+    # 同一条记录再次保存（边流式边保存）只更新内容
+    reply.content = '你好呀，今天怎么样？'
+    reply.save()
+    turns.saved(reply)
+    history = turns.recent(user_id, 5)
+    assert [t['content'] for t in history] == ['旧消息3', '旧消息4', '你好', '你好呀，今天怎么样？']
+    stats = turns.stats()
+    assert stats['loads'] == 1 and stats['hits'] == 1
+    print('  ✅ 懒加载、写穿不访问存储')
+
+
+def test_pending_visible_before_save():
+    user_id = new_user()
+    turns = make_turns()
+    msg = CoachChat(user_id=user_id, role='user', content='刚发送')
+    turns.pending(msg)
+    # 异步保存还没完成：上下文里已经有这条
+    assert [(t['role'], t['content'], t['id']) for t in turns.recent(user_id, 5)] == [('user', '刚发送', None)]
+    msg.save()
+    turns.saved(msg)
+    assert [(t['role'], t['content'], t['id']) for t in turns.recent(user_id, 5)] == [('user', '刚发送', msg.id)]
+
+    # 保存已拿到 id、还没写穿时重新加载：不重复
+    racing = CoachChat(user_id=user_id, role='user', content='并发保存')
+    turns.pending(racing)
+    racing.save()
+    turns.versions.bump(turns._key(user_id))    # 其他 worker 写入，触发重新加载
+    assert [t['content'] for t in turns.recent(user_id, 5)] == ['刚发送', '并发保存']
+    turns.saved(racing)
+    assert [t['content'] for t in turns.recent(user_id, 5)] == ['刚发送', '并发保存']
+
+    failed = CoachChat(user_id=user_id, role='user', content='保存失败')
+    turns.pending(failed)
+    turns.discard(failed)
+    assert len(turns.recent(user_id, 5)) == 2
+    print('  ✅ 异步保存前可见，保存失败移除')
+
+
+def test_versions_across_workers():
+    path = os.path.join(tempfile.mkdtemp(prefix='coach_context_'), 'versions.db')
+    worker_a = make_turns(versions=VersionStore(path))
+    worker_b = make_turns(versions=VersionStore(path))
+    user_id = new_user()
+    save(worker_a, user_id, 'user', '在 A 发送')
+    worker_a.recent(user_id, 5)
+    worker_b.recent(user_id, 5)
+    save(worker_b, user_id, 'assistant', '在 B 回复')
+    # B 直接跟进；A 的版本号落后，重新加载
+    assert worker_b.recent(user_id, 5)[-1]['content'] == '在 B 回复'
+    assert worker_b.stats()['loads'] == 1
+    assert worker_a.recent(user_id, 5)[-1]['content'] == '在 B 回复'
+    assert worker_a.stats()['loads'] == 2
+    print('  ✅ 多 worker 版本比对')
+
+
+def test_lru_over_users():
+    turns = make_turns(max_users=2)
+    users = [new_user() for _ in range(3)]
+    for user_id in users:
+        turns.recent(user_id, 5)
+    stats = turns.stats()
+    assert stats['users'] == 2 and stats['evictions'] == 1
+    turns.recent(users[0], 5)
+    assert turns.stats()['loads'] == 4   # 被淘汰的用户重新加载
+    print('  ✅ 按用户 LRU 淘汰')
+
+
+def main():
+    print("=" * 50)
+    print("开始教练上下文缓冲测试")
+    print("=" * 50)
+    test_lazy_load_and_write_through()
+    test_pending_visible_before_save()
+    test_versions_across_workers()
+    test_lru_over_users()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Coze 上下文 token 预算测试：中英文估算、整条保留 / 截断 / 省略、客厅省略提示、旧记录 token 数写回
+
+用法：
+    python test_coze_context.py
+"""
+import os
+import secrets
+
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+import coze_context
+import storage_memory
+from tokens import estimate_tokens, truncate_to_tokens, write_token_counts
+
+LoungeChat = storage_memory.LoungeChat
+OVERHEAD = coze_context.MESSAGE_OVERHEAD_TOKENS
+
+
+def test_estimate_tokens():
+    assert estimate_tokens('') == 0
+    assert estimate_tokens('你好，世界！') == 6
+    assert estimate_tokens('hello world') == 3
+    assert estimate_tokens('你好，世界！hello world') == 9
+    assert truncate_to_tokens('你好世界abcdefgh', 3) == '你好世'
+    assert truncate_to_tokens('短', 10) == '短'
+    print('  ✅ 中英文 token 估算')
+
+
+def test_fit_history():
+    history = [{'role': 'user', 'content': '一' * 100}, {'role': 'assistant', 'content': '二' * 100},
+               {'role': 'user', 'content': '三' * 10, 'tokens': 10}]
+    # 预算足够：整条保留
+    context = coze_context.fit_history(history, budget=1000)
+    assert [m['content'] for m in context.messages] == [h['content'] for h in history]
+    assert context.tokens == 210 + 3 * OVERHEAD and not context.elided and not context.truncated
+
+    # 第二条放不下但剩余足够：保留开头并标注截断，第一条省略
+    context = coze_context.fit_history(history, budget=100)
+    assert len(context.messages) == 2 and context.elided == 1 and context.truncated
+    assert context.messages[0]['role'] == 'assistant'
+    assert context.messages[0]['content'].startswith('二') and context.messages[0]['content'].endswith(coze_context.TRUNCATED_MARK)
+    assert context.tokens == 100
+
+    # 剩余不足以截断：直接省略
+    context = coze_context.fit_history(history, budget=30)
+    assert [m['content'] for m in context.messages] == ['三' * 10] and context.elided == 2 and not context.truncated
+    assert coze_context.fit_history([]).messages == []
+    print('  ✅ 教练历史整条保留 / 截断 / 省略')
+
+
+def test_fit_lounge_and_write_back():
+    room_id = f"room_{secrets.token_hex(4)}"
+    messages = []
+    for i in range(6):
+        msg = LoungeChat(room_id=room_id, user_id=i % 2 + 1, role='user', content=f"第{i}条" + 'x' * 200)
+        msg.save()
+        msg.token_count = None      # 模拟迁移前的旧记录
+        messages.append(msg)
+    context = coze_context.fit_lounge(messages, {1: '小明', 2: '小红'}, budget=200)
+    lines = context.text.split('\n')
+    assert lines[0] == f"（更早的 {context.elided} 条消息已省略）" and context.elided > 0
+    assert lines[-1].startswith('小红：第5条')
+    assert sum(len(ids) for ids in context.missing.values()) == 6
+
+    with storage_memory.batch() as unit:
+        write_token_counts(unit, LoungeChat, context.missing)
+    stored = LoungeChat.query('id', 'token_count').eq('room_id', room_id).all()
+    assert all(row.token_count == estimate_tokens(messages[0].content) for row in stored)
+    print('  ✅ 客厅省略提示、旧记录 token 数写回')
+
+
+def main():
+    print("=" * 50)
+    print("开始 Coze 上下文预算测试")
+    print("=" * 50)
+    test_estimate_tokens()
+    test_fit_history()
+    test_fit_lounge_and_write_back()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
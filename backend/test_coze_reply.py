@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Coze 回复清理测试：与原实现（bench_coze_reply.legacy_clean_reply）输出一致，深层嵌套时仍是线性耗时
+
+用法：
+    python test_coze_reply.py
+"""
+import random
+import time
+
+from bench_coze_reply import legacy_clean_reply, recorded_replies
+from coze_reply import clean_reply
+
+
+def test_examples():
+    assert clean_reply('') == ''
+    assert clean_reply(None) is None
+    assert clean_reply('你好 {"msg_type":"generate_answer_finish","data":""}  世界') == '你好 世界'
+    assert clean_reply('{"a":{"data":"x"}}') == '{"a":}'
+    # 内层删除后外层不含花括号，按同样规则继续判断
+    assert clean_reply('前{"data":"1",{"msg_type":"x"}}后') == '前后'
+    # 内层保留时外层也保留
+    assert clean_reply('{"data":"1",{"k":"v"}}') == '{"data":"1",{"k":"v"}}'
+    assert clean_reply('  第一行   \n   第二行  ') == '第一行\n第二行'
+    half = '我听到了你的感受，这确实很不容易，我们慢慢来。'
+    assert clean_reply(half + half) == half
+    print('  ✅ 清理规则')
+
+
+def test_same_as_legacy():
+    samples = recorded_replies()
+    assert samples, '缺少 fixtures/coze 录制数据'
+    rng = random.Random(20261019)
+    pieces = ['{', '}', '"msg_type"', '"data"', '"', ':', ',', ' ', '  ', '\n', '。', '！', '？',
+              '好的', '我明白', '我们继续']
+    for _ in range(2000):
+        samples.append(''.join(rng.choice(pieces) for _ in range(rng.randint(0, 60))))
+    sentence = '今天我们聊聊沟通的方式'
+    samples.append('。'.join([sentence, sentence, '换个话题', '换个话题', sentence]))
+    samples.append('{' * 50 + '"data":"x"' + '}' * 50 + '正文')
+    for text in samples:
+        assert clean_reply(text) == legacy_clean_reply(text), repr(text)
+    print(f'  ✅ {len(samples)} 个样本与原实现一致')
+
+
+def test_deep_nesting_linear():
+    depth = 20000
+    text = '{' * depth + '"data":"x"' + '}' * depth + '正文'
+    start = time.perf_counter()
+    # 最内层删除后外层是空的 {}，不是噪声，保留
+    assert clean_reply(text) == '{' * (depth - 1) + '}' * (depth - 1) + '正文'
+    assert time.perf_counter() - start < 1.0
+    print('  ✅ 深层嵌套线性耗时')
+
+
+def main():
+    print("=" * 50)
+    print("开始 Coze 回复清理测试")
+    print("=" * 50)
+    test_examples()
+    test_same_as_legacy()
+    test_deep_nesting_linear()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+聊天记录导出 / 导入测试：memory -> 文件 -> sqlite 往返一致、按原 id 写入且可重复导入、
+导入中断后按检查点续传、导出文件截断后 --resume 续写、后端直接迁移、读取失败时重试或中止（不写 _end 行）
+
+用法：
+    python test_history_transfer.py
+"""
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+os.environ.setdefault('SQLITE_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='test_transfer_'), 'test.db'))
+
+import coach_context
+import history_transfer
+from storage import load_backend
+
+memory = load_backend('memory')
+sqlite = load_backend('sqlite')
+
+
+def populate():
+    """memory 后端：2 个用户、1 个房间、5 条教练记录、7 条客厅记录"""
+    memory.reset()
+    u1 = memory.User(phone='19900000001', password='pw', nickname='小明')
+    u2 = memory.User(phone='19900000002', password='pw', coach_greeting_shown=True)
+    u1.save()
+    u2.save()
+    memory.Relationship(user1_id=u1.id, user2_id=u2.id, room_id='room-1').save()
+    base = datetime(2026, 1, 1, 8, 0, 0)
+    for i in range(5):
+        memory.CoachChat(user_id=u1.id, role='user' if i % 2 == 0 else 'assistant', content=f'教练{i}',
+                         reasoning_content='思考' if i % 2 else None, created_at=base + timedelta(minutes=i)).save()
+    for i in range(7):
+        memory.LoungeChat(room_id='room-1', user_id=u1.id if i % 2 == 0 else u2.id, role='user',
+                          content=f'客厅{i}', created_at=base + timedelta(minutes=i), sent_to_ai=i < 3).save()
+    return u1, u2
+
+
+@contextmanager
+def fresh_sqlite():
+    """临时换一个空的 SQLite 文件（导入按原 id 写入，不能和其他测试的数据混在一起）"""
+    saved = sqlite.DB_PATH
+    sqlite.DB_PATH = os.path.join(tempfile.mkdtemp(prefix='test_transfer_'), 'target.db')
+    try:
+        sqlite.init_db()
+        yield sqlite
+    finally:
+        sqlite.DB_PATH = saved
+
+
+def export_file(storage, chunk=3, **kwargs):
+    path = os.path.join(tempfile.mkdtemp(prefix='test_transfer_'), 'export.ndjson')
+    with open(path, 'wb') as f:
+        for block in history_transfer.export_lines(storage, history_transfer.TABLES, chunk=chunk, **kwargs):
+            f.write(block)
+    return path
+
+
+def read_lines(path):
+    with open(path, 'rb') as f:
+        return [json.loads(line) for line in f]
+
+
+def rows_of(lines):
+    return [line for line in lines if not any(key.startswith('_') for key in line)]
+
+
+def dump_rows(storage):
+    """每张表的全部记录（导出格式），用于比较两个后端的数据"""
+    lines = []
+    for block in history_transfer.export_lines(storage, history_transfer.TABLES, chunk=100):
+        lines.extend(json.loads(line) for line in block.splitlines())
+    return rows_of(lines)
+
+
+def test_round_trip():
+    u1, _ = populate()
+    path = export_file(memory)
+    lines = read_lines(path)
+    assert lines[0]['_export']['tables'] == list(history_transfer.TABLES)
+    assert lines[-1]['_end']['rows'] == 15 and 'rows_per_second' in lines[-1]['_end']
+    # 每页（chunk=3）之后一个检查点：1 + 1 + 2 + 3 页
+    assert [line['_checkpoint']['after_id'] for line in lines if '_checkpoint' in line] == [2, 1, 3, 5, 3, 6, 7]
+
+    version = coach_context.recent_turns.versions.get(f"coach_chats:{u1.id}")
+    with fresh_sqlite() as target:
+        history_transfer.import_file(target, path, batch_size=4)
+        assert dump_rows(target) == dump_rows(memory)
+        # 重复导入：已存在的 id 跳过
+        history_transfer.import_file(target, path, batch_size=4)
+        assert len(target.CoachChat.filter(user_id=u1.id)) == 5
+        # 之后新建的记录 id 接在导入的最大 id 之后
+        chat = target.CoachChat(user_id=u1.id, role='user', content='新消息')
+        chat.save()
+        assert chat.id == 6
+    assert coach_context.recent_turns.versions.get(f"coach_chats:{u1.id}") > version
+    print('  ✅ memory -> 文件 -> sqlite 往返一致，重复导入不重复写入')
+
+
+def test_import_resume():
+    populate()
+    path = export_file(memory)
+    with open(path, 'rb') as f:
+        data = f.read()
+    lines = data.splitlines(keepends=True)
+    # 模拟中断：只有前 12 行（首行、用户、关系、3 条教练记录）
+    partial = path + '.partial'
+    with open(partial, 'wb') as f:
+        f.write(b''.join(lines[:12]))
+    checkpoint = path + '.ckpt'
+
+    with fresh_sqlite() as target:
+        first = history_transfer.import_file(target, partial, batch_size=2, checkpoint=checkpoint)
+        assert not first.finished
+        state = history_transfer.read_checkpoint(checkpoint)
+        assert state['table'] == 'coach_chats' and state['offset'] == len(b''.join(lines[:12]))
+        # 续传：从已提交的位置继续，只写剩下的记录
+        second = history_transfer.import_file(target, path, batch_size=2, checkpoint=checkpoint)
+        assert second.finished and second.progress.rows == 15 - state['rows']
+        assert dump_rows(target) == dump_rows(memory)
+    print('  ✅ 导入中断后按检查点续传')
+
+
+def test_export_resume():
+    populate()
+    path = export_file(memory)
+    expected = rows_of(read_lines(path))
+    with open(path, 'rb') as f:
+        data = f.read()
+    # 截断在一条记录中间
+    cut = data.index(b'"content":"\xe5\xae\xa2\xe5\x8e\x854"')
+    with open(path, 'wb') as f:
+        f.write(data[:cut])
+    header, checkpoint, _, finished = history_transfer.scan_export(path)
+    assert header and checkpoint['table'] == 'lounge_chats' and not finished
+
+    history_transfer.main(['export', '--backend', 'memory', '-o', path, '--resume', '--chunk', '3'])
+    lines = read_lines(path)
+    assert rows_of(lines) == expected and lines[-1]['_end']['rows'] == 15
+    assert sum('_export' in line for line in lines) == 1
+    print('  ✅ 导出文件截断后 --resume 续写')
+
+
+def test_migrate_scoped():
+    u1, _ = populate()
+    checkpoint = os.path.join(tempfile.mkdtemp(prefix='test_transfer_'), 'migrate.ckpt')
+    with fresh_sqlite() as target:
+        importer = history_transfer.migrate(memory, target, ['coach_chats'], {'coach_chats': {'user_id': u1.id}},
+                                            chunk=2, batch_size=3, checkpoint=checkpoint)
+        assert importer.state['rows'] == 5 and importer.state['after_id'] == 5
+        assert [c.content for c in target.CoachChat.filter(user_id=u1.id)] == [f'教练{i}' for i in range(5)]
+        # 检查点之后没有新记录：再跑一次什么都不写
+        again = history_transfer.migrate(memory, target, ['coach_chats'], {'coach_chats': {'user_id': u1.id}},
+                                         checkpoint=checkpoint)
+        assert again.progress.rows == 0
+    print('  ✅ 后端直接迁移（按用户过滤、检查点续传）')
+
+
+class FlakyStorage:
+    """包装 memory 后端：CoachChat 的分页读取从第 fail_from 次起失败 failures 次"""
+
+    def __init__(self, fail_from, failures):
+        self.User, self.Relationship, self.LoungeChat = memory.User, memory.Relationship, memory.LoungeChat
+        self.calls = 0
+        storage = self
+
+        class CoachChat(memory.CoachChat):
+            @staticmethod
+            def query(*columns):
+                return FlakyQuery(storage, memory.CoachChat.query(*columns))
+
+        self.CoachChat = CoachChat
+        self.fail_from = fail_from
+        self.failures = failures
+
+
+class FlakyQuery:
+    def __init__(self, storage, query):
+        self._storage = storage
+        self._query = query
+
+    def __getattr__(self, name):
+        attr = getattr(self._query, name)
+
+        def builder(*args, **kwargs):
+            attr(*args, **kwargs)
+            return self
+        return builder
+
+    def all(self, raise_errors=False):
+        storage = self._storage
+        storage.calls += 1
+        if storage.calls >= storage.fail_from and storage.failures > 0:
+            storage.failures -= 1
+            if not raise_errors:
+                return []       # 与 Supabase 后端一致：不要求抛出时吞掉错误
+            raise ConnectionError('读取失败')
+        return self._query.all(raise_errors)
+
+
+@contextmanager
+def no_backoff():
+    saved = history_transfer.HISTORY_TRANSFER_RETRY_BACKOFF
+    history_transfer.HISTORY_TRANSFER_RETRY_BACKOFF = 0
+    try:
+        yield
+    finally:
+        history_transfer.HISTORY_TRANSFER_RETRY_BACKOFF = saved
+
+
+def test_export_read_failure():
+    populate()
+
+    def export(storage, lines):
+        for block in history_transfer.export_lines(storage, ['coach_chats'], chunk=2):
+            lines.extend(json.loads(line) for line in block.splitlines())
+        return lines
+
+    expected = rows_of(export(memory, []))
+    with no_backoff():
+        # 第 2 页读取失败一次：重试后完整导出
+        lines = export(FlakyStorage(fail_from=2, failures=1), [])
+        assert rows_of(lines) == expected and lines[-1]['_end']['rows'] == 5
+
+        # 一直失败：重试用完后抛出，不写 _end 行
+        flaky = FlakyStorage(fail_from=2, failures=history_transfer.HISTORY_TRANSFER_RETRIES + 1)
+        lines = []
+        try:
+            export(flaky, lines)
+            assert False, '应当抛出'
+        except ConnectionError:
+            pass
+        assert len(rows_of(lines)) == 2 and not any('_end' in line for line in lines)
+        assert flaky.calls == 1 + history_transfer.HISTORY_TRANSFER_RETRIES + 1
+    print('  ✅ 分页读取失败时重试，重试用完后中止导出')
+
+
+def main():
+    print("=" * 50)
+    print("开始聊天记录导出 / 导入测试")
+    print("=" * 50)
+    test_round_trip()
+    test_import_resume()
+    test_export_resume()
+    test_migrate_scoped()
+    test_export_read_failure()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
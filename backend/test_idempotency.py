@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Idempotency-Key 测试：普通接口保存/回放响应、冲突与处理中、流式记录与跟读、客户端断开后继续生成、
+失败后重试重新执行、过期与数量上限清理
+
+用法：
+    python test_idempotency.py
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+from flask import Flask, Response, jsonify, request, stream_with_context
+
+import idempotency
+import process_identity
+
+
+def make_app():
+    path = os.path.join(tempfile.mkdtemp(prefix='idempotency_'), 'idempotency.db')
+    manager = idempotency.IdempotencyManager(idempotency.IdempotencyStore(path), wait_seconds=5)
+    idempotency._manager = manager
+    app = Flask(__name__)
+    idempotency.init_app(app)
+    calls = {'send': 0, 'stream': 0}
+    gate = threading.Event()
+
+    @app.errorhandler(idempotency.IdempotencyError)
+    def handle_idempotency_error(e):
+        return jsonify({'success': False, 'message': e.message}), e.status
+
+    @app.route('/send', methods=['POST'])
+    def send():
+        if not request.json.get('content'):
+            return jsonify({'success': False}), 400
+        claim = idempotency.claim(1)
+        if claim is not None and claim.duplicate:
+            return claim.replay()
+        calls['send'] += 1
+        return jsonify({'success': True, 'id': calls['send']})
+
+    @app.route('/stream', methods=['POST'])
+    def stream():
+        claim = idempotency.claim(1, stream=True)
+        if claim is not None and claim.duplicate:
+            return claim.replay()
+        calls['stream'] += 1
+        fail = request.json.get('fail')
+
+        def generate():
+            for i in range(3):
+                if i == 1:
+                    gate.wait(5)
+                yield f"data: {json.dumps({'type': 'content', 'content': str(i)})}\n\n"
+            yield f"data: {json.dumps({'type': 'error' if fail else 'done'})}\n\n"
+
+        return Response(idempotency.record(claim, stream_with_context(generate())), mimetype='text/event-stream')
+
+    return app, manager, calls, gate
+
+
+def read(response, stop_after=None):
+    chunks = []
+    for chunk in response.response:
+        chunks.append(chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk)
+        if stop_after is not None and len(chunks) >= stop_after:
+            break
+    response.close()
+    return ''.join(chunks)
+
+
+def test_json_replay_and_conflict():
+    app, manager, calls, _ = make_app()
+    client = app.test_client()
+    first = client.post('/send', json={'content': 'hi'}, headers={'Idempotency-Key': 'a'})
+    again = client.post('/send', json={'content': 'hi'}, headers={'Idempotency-Key': 'a'})
+    assert first.json == again.json == {'success': True, 'id': 1} and calls['send'] == 1
+    assert again.headers['Idempotent-Replayed'] == 'true'
+    assert client.post('/send', json={'content': 'other'}, headers={'Idempotency-Key': 'a'}).status_code == 422
+    assert client.post('/send', json={'content': 'hi'}, headers={'Idempotency-Key': ' '}).status_code == 400
+    # 没有请求头：每次都执行
+    client.post('/send', json={'content': 'hi'})
+    assert calls['send'] == 2
+
+    # 原请求还在处理：409
+    with app.test_request_context('/send', method='POST', json={'content': 'hi'}):
+        manager.store.claim('/send:1:busy', idempotency.fingerprint(), 'json', process_identity.current(), 60)
+    assert client.post('/send', json={'content': 'hi'}, headers={'Idempotency-Key': 'busy'}).status_code == 409
+    # 记录的 pid 与本进程相同但启动时间不同：pid 被复用，原进程已退出，重试重新执行
+    with app.test_request_context('/send', method='POST', json={'content': 'hi'}):
+        reused = f"{os.getpid()}:0:{process_identity.current().split(':', 2)[2]}"
+        manager.store.claim('/send:1:reused', idempotency.fingerprint(), 'json', reused, 60)
+    assert not process_identity.alive(reused)
+    assert client.post('/send', json={'content': 'hi'}, headers={'Idempotency-Key': 'reused'}).status_code == 200
+    print('  ✅ 普通接口：回放、冲突 422、处理中 409、原进程 pid 被复用时重新执行')
+
+
+def test_json_error_not_saved():
+    app, manager, calls, _ = make_app()
+    client = app.test_client()
+
+    @app.route('/boom', methods=['POST'])
+    def boom():
+        idempotency.claim(1)
+        raise RuntimeError('boom')
+
+    app.testing = False
+    assert client.post('/boom', json={}, headers={'Idempotency-Key': 'x'}).status_code == 500
+    assert manager.store.get('/boom:1:x') is None
+    assert manager.stats()['requests']['released'] == 1
+    print('  ✅ 普通接口：出错时释放幂等键')
+
+
+def test_stream_attach_and_disconnect():
+    app, manager, calls, gate = make_app()
+    client = app.test_client()
+    results = {}
+
+    def original():
+        results['first'] = read(client.post('/stream', json={}, headers={'Idempotency-Key': 's'}, buffered=False))
+
+    thread = threading.Thread(target=original)
+    thread.start()
+    time.sleep(0.2)
+    # 原请求还在生成：重试接上，不再执行
+    retry = client.post('/stream', json={}, headers={'Idempotency-Key': 's'}, buffered=False)
+    threading.Timer(0.2, gate.set).start()
+    results['retry'] = read(retry)
+    thread.join()
+    assert results['first'] == results['retry'] and results['first'].endswith('"done"}\n\n')
+    assert calls['stream'] == 1
+
+    # 读到第一帧就断开：继续生成到结束，重试拿到完整的流
+    partial = read(client.post('/stream', json={}, headers={'Idempotency-Key': 't'}, buffered=False), stop_after=1)
+    full = read(client.post('/stream', json={}, headers={'Idempotency-Key': 't'}, buffered=False))
+    assert full.startswith(partial) and full.endswith('"done"}\n\n') and calls['stream'] == 2
+    print('  ✅ 流式接口：跟读原请求、断开后继续生成')
+
+
+def test_stream_failure_retried():
+    app, manager, calls, gate = make_app()
+    gate.set()
+    client = app.test_client()
+    read(client.post('/stream', json={'fail': True}, headers={'Idempotency-Key': 'f'}, buffered=False))
+    assert manager.store.get('/stream:1:f')['status'] == 'failed'
+    body = read(client.post('/stream', json={'fail': True}, headers={'Idempotency-Key': 'f'}, buffered=False))
+    assert calls['stream'] == 2 and body.endswith('"error"}\n\n')
+    print('  ✅ 流式接口：以 error 结束的记录重试时重新执行')
+
+
+def test_purge():
+    path = os.path.join(tempfile.mkdtemp(prefix='idempotency_'), 'idempotency.db')
+    store = idempotency.IdempotencyStore(path)
+    for i in range(5):
+        store.claim(f"k{i}", 'fp', 'stream', process_identity.current(), 60)
+        store.append(f"k{i}", 1, 'data: {}\n\n')
+        store.finish(f"k{i}", 'done')
+    store.claim('old', 'fp', 'json', process_identity.current(), -1)
+    assert store.purge(time.time(), max_keys=3) == 3
+    assert store.get('old') is None and store.get('k0') is None and store.get('k4') is not None
+    assert store.frames('k0') == [] and len(store.frames('k4')) == 1
+    print('  ✅ 过期和数量上限清理')
+
+
+def main():
+    print("=" * 50)
+    print("开始 Idempotency-Key 测试")
+    print("=" * 50)
+    test_json_replay_and_conflict()
+    test_json_error_not_saved()
+    test_stream_attach_and_disconnect()
+    test_stream_failure_retried()
+    test_purge()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+后台任务测试：提交 / 等待、失败、排队上限、接管已退出进程的任务（上次已写入结果时不重复执行）、
+教练聊天接口返回 job_id
+
+用法：
+    python test_jobs.py
+"""
+import os
+import secrets
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+os.environ.setdefault('JOBS_DB_PATH', os.path.join(tempfile.mkdtemp(), 'jobs.db'))
+
+import jobs
+import process_identity
+from testing import use_backend
+
+
+def make_manager(max_queue=4):
+    return jobs.JobManager(jobs.JobStore(os.path.join(tempfile.mkdtemp(), 'jobs.db')), max_queue=max_queue)
+
+
+def test_submit_and_wait():
+    manager = make_manager()
+
+    @manager.handler('echo', lane='test')
+    def echo(params):
+        return {'value': params['value'] * 2}
+
+    @manager.handler('boom', lane='test')
+    def boom(params):
+        raise ValueError('bad input')
+
+    job = manager.submit('echo', {'value': 21}, user_id=7)
+    done = manager.wait(job['id'], 5)
+    assert done['status'] == 'done' and done['result'] == {'value': 42} and done['user_id'] == 7
+    assert done['attempts'] == 1
+
+    failed = manager.wait(manager.submit('boom', {})['id'], 5)
+    assert failed['status'] == 'failed' and 'bad input' in failed['error']
+    assert manager.stats()['lanes']['test']['pending'] == 0
+    print('  ✅ 提交、等待、失败')
+
+
+def test_queue_limit():
+    manager = make_manager(max_queue=2)
+    release = threading.Event()
+
+    @manager.handler('block', lane='slow')
+    def block(params):
+        release.wait(5)
+        return {}
+
+    first = manager.submit('block', {})
+    manager.submit('block', {})
+    try:
+        manager.submit('block', {})
+        assert False, '应当拒绝'
+    except jobs.JobQueueFull as e:
+        assert e.lane == 'slow'
+    # 超时时返回当前状态
+    assert manager.wait(first['id'], 0.05)['status'] in ('queued', 'running')
+    release.set()
+    assert manager.wait(first['id'], 5)['status'] == 'done'
+    print('  ✅ 排队上限')
+
+
+def test_recover_orphans():
+    manager = make_manager()
+    ran = []
+
+    @manager.handler('echo', lane='test')
+    def echo(params):
+        ran.append(params['n'])
+        return {'n': params['n']}
+
+    dead_pid = 2 ** 22 + 12345  # 超过 pid_max 默认值，不会是存活进程
+    base = {'kind': 'echo', 'lane': 'test', 'user_id': 1, 'result': None, 'error': None,
+            'owner_pid': dead_pid, 'owner': None, 'created_at': time.time(), 'started_at': None, 'finished_at': None}
+    manager.store.insert(dict(base, id='orphan-queued', status='queued', params={'n': 1}, attempts=0))
+    manager.store.insert(dict(base, id='orphan-running', status='running', params={'n': 2}, attempts=1))
+    manager.store.insert(dict(base, id='orphan-exhausted', status='running', params={'n': 3},
+                              attempts=jobs.JOBS_MAX_ATTEMPTS))
+
+    assert manager.recover() == 2
+    assert manager.wait('orphan-queued', 5)['status'] == 'done'
+    assert manager.wait('orphan-running', 5)['attempts'] == 2
+    assert manager.get('orphan-exhausted')['status'] == 'failed'
+    assert sorted(ran) == [1, 2]
+    # 已接管的任务不会被再次接管
+    assert manager.recover() == 0
+
+    # 所属进程的 pid 被复用（这里正是本进程的 pid，启动时间不同）：仍按已退出处理
+    reused = f"{os.getpid()}:0:{process_identity.current().split(':', 2)[2]}"
+    manager.store.insert(dict(base, id='orphan-reused', status='queued', params={'n': 4}, attempts=0,
+                              owner_pid=os.getpid(), owner=reused))
+    assert manager.recover() == 1 and manager.wait('orphan-reused', 5)['status'] == 'done'
+    print('  ✅ 接管已退出进程的任务')
+
+
+def test_recover_skips_finished_work():
+    manager = make_manager()
+    ran, checked = [], []
+    saved = {2: {'message_id': 20}}     # 任务 2 上次执行已写入结果，退出前没来得及标记完成
+
+    def find_saved(params):
+        checked.append(params['n'])
+        return saved.get(params['n'])
+
+    @manager.handler('reply', lane='test', resume=find_saved)
+    def reply(params):
+        ran.append(params['n'])
+        return {'message_id': params['n'] * 100}
+
+    dead_pid = 2 ** 22 + 23456
+    base = {'kind': 'reply', 'lane': 'test', 'user_id': 1, 'result': None, 'error': None,
+            'owner_pid': dead_pid, 'owner': None, 'created_at': time.time(), 'started_at': None, 'finished_at': None}
+    manager.store.insert(dict(base, id='never-started', status='queued', params={'n': 1}, attempts=0))
+    manager.store.insert(dict(base, id='saved', status='running', params={'n': 2}, attempts=1))
+    manager.store.insert(dict(base, id='not-saved', status='running', params={'n': 3}, attempts=1))
+
+    assert manager.recover() == 3
+    assert manager.wait('saved', 5)['result'] == {'message_id': 20}
+    assert manager.wait('not-saved', 5)['result'] == {'message_id': 300}
+    assert manager.wait('never-started', 5)['status'] == 'done'
+    # 从未执行过的任务不检查；上次已写入结果的任务不再执行
+    assert sorted(checked) == [2, 3] and sorted(ran) == [1, 3]
+    print('  ✅ 接管的任务上次已写入结果时不重复执行')
+
+
+def test_coach_chat_returns_job():
+    import app as app_module
+    import storage_memory
+    with use_backend(app_module, storage_memory) as client:
+        phone = '197' + str(secrets.randbelow(10 ** 8)).zfill(8)
+        client.post('/api/register', json={'phone': phone, 'password': 'pw'}).close()
+        token = client.post('/api/login', json={'phone': phone, 'password': 'pw'}).get_json()['token']
+        headers = {'Authorization': f'Bearer {token}'}
+
+        response = client.post('/api/coach/chat', json={'message': '你好'}, headers=headers)
+        assert response.status_code == 202
+        job_id = response.get_json()['job_id']
+        assert response.headers['Location'] == f'/api/jobs/{job_id}'
+
+        job = client.get(f'/api/jobs/{job_id}/wait?timeout=5', headers=headers).get_json()['job']
+        assert job['status'] == 'done' and job['result']['message']
+        # 接管重跑时能找到已保存的回复
+        assert app_module.find_coach_reply(jobs.get_job(job_id)['params']) == job['result']
+        # 其他人（这里是未登录的新客户端）看不到任务
+        assert app_module.app.test_client().get(f'/api/jobs/{job_id}').status_code == 401
+        assert client.get('/api/jobs/unknown', headers=headers).status_code == 404
+    print('  ✅ 教练聊天返回 job_id')
+
+
+def main():
+    print("=" * 50)
+    print("开始后台任务测试")
+    print("=" * 50)
+    test_submit_and_wait()
+    test_queue_limit()
+    test_recover_orphans()
+    test_recover_skips_finished_work()
+    test_coach_chat_returns_job()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
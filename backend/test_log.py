@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+结构化日志测试：脱敏、抽样、队列满时不阻塞、日志调用不用 f-string（参数在确定输出后才格式化）
+
+用法：
+    python test_log.py
+"""
+import ast
+import glob
+import logging
+import os
+import queue
+
+import log
+
+
+def test_redact():
+    text = log.redact('phone=13812345678 password=abc123 {"token": "xyz"} Authorization: Bearer eyJ.abc-1')
+    assert '13812345678' not in text and '138****5678' in text
+    assert 'abc123' not in text and 'xyz' not in text and 'eyJ' not in text
+    # 非手机号的长数字不处理
+    assert log.redact('id=202612345678901') == 'id=202612345678901'
+    fields = log._redact_value('payload', {'user_id': '13912345678', 'password': 'pw', 'items': ['15912345678']})
+    assert fields == {'user_id': '139****5678', 'password': '***', 'items': ['159****5678']}
+    print('  ✅ 脱敏')
+
+
+def test_sampling():
+    original = dict(log.LOG_SAMPLE)
+    log.LOG_SAMPLE.clear()
+    log.LOG_SAMPLE.update({'coze.stream': 0.0})
+    try:
+        sampler = log.SamplingFilter()
+        record = logging.LogRecord('between_us.coze.stream', logging.DEBUG, '', 0, 'x', (), None)
+        assert not sampler.filter(record)
+        # 子类别继承父类别的抽样率，WARNING 及以上不抽样
+        record.name = 'between_us.coze.stream.raw'
+        assert not sampler.filter(record)
+        record.levelno = logging.WARNING
+        assert sampler.filter(record)
+        record = logging.LogRecord('between_us.coach', logging.INFO, '', 0, 'x', (), None)
+        assert sampler.filter(record)
+    finally:
+        log.LOG_SAMPLE.clear()
+        log.LOG_SAMPLE.update(original)
+    print('  ✅ 抽样')
+
+
+def test_queue_full_drops():
+    handler = log.DroppingQueueHandler(queue.Queue(maxsize=1))
+    for i in range(3):
+        handler.handle(logging.LogRecord('between_us.test', logging.INFO, '', 0, 'msg %d', (i,), None))
+    assert handler.queue.qsize() == 1 and handler.dropped == 2
+    assert handler.queue.get_nowait().msg == 'msg 0'
+    print('  ✅ 队列满时丢弃')
+
+
+def test_no_fstring_messages():
+    """日志消息用 %s 参数或 extra 传值：f-string 在记录被抽样丢弃时也会格式化"""
+    levels = ('debug', 'info', 'warning', 'error', 'exception', 'critical')
+    offenders = []
+    for path in glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py')):
+        with open(path, encoding='utf-8') as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr in levels \
+                    and isinstance(node.func.value, ast.Name) and node.func.value.id.endswith('log') \
+                    and node.args and isinstance(node.args[0], ast.JoinedStr):
+                offenders.append(f"{os.path.basename(path)}:{node.lineno}")
+    assert not offenders, offenders
+    print('  ✅ 日志调用不用 f-string')
+
+
+def main():
+    print("=" * 50)
+    print("开始日志测试")
+    print("=" * 50)
+    test_redact()
+    test_sampling()
+    test_queue_full_drops()
+    test_no_fstring_messages()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
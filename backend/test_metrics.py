@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Prometheus 指标测试
+内存后端 + Flask 测试客户端，检查 /metrics 中的路由、存储和 Coze 流指标
+
+用法：
+    python test_metrics.py
+"""
+import os
+import secrets
+
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+import storage_memory
+import request_timing
+import metrics
+import app as app_module
+from testing import use_backend
+
+
+class FakeStream:
+    """模拟 requests 的流式响应"""
+
+    def __init__(self, lines):
+        from datetime import timedelta
+        self.lines = lines
+        self.elapsed = timedelta(milliseconds=100)
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+
+def scrape(client):
+    return client.get('/metrics').get_data(as_text=True)
+
+
+def test_route_and_storage_metrics():
+    if not metrics.METRICS_ENABLED:
+        print('  跳过：未安装 prometheus_client')
+        return
+    phone = '199' + str(secrets.randbelow(10 ** 8)).zfill(8)
+    with use_backend(app_module, storage_memory) as client:
+        client.post('/api/register', json={'phone': phone, 'password': 'pw'}).close()
+        client.get('/api/user/404404').close()
+
+    text = scrape(client)
+    assert 'http_requests_total{method="POST",route="/api/register",status="200"}' in text
+    assert 'route="/api/user/<int:user_id>"' in text
+    assert 'storage_calls_total{backend="memory",method="save",model="User",result="ok"}' in text
+    print('  ✅ 路由、存储指标')
+
+
+def test_coze_stream_metrics():
+    if not metrics.METRICS_ENABLED:
+        print('  跳过：未安装 prometheus_client')
+        return
+    bot = next(iter(metrics.COZE_BOTS), None)
+    label = metrics.bot_label(bot)
+    lines = [b'event:conversation.message.delta', b'data:{}'] * 3 + [b'event:conversation.chat.completed', b'data:{}']
+    list(request_timing.timed_lines('coze', FakeStream(lines), bot=bot))
+
+    cancelled = request_timing.timed_lines('coze', FakeStream(lines), bot=bot)
+    next(cancelled)
+    cancelled.close()
+
+    text = scrape(app_module.app.test_client())
+    assert f'coze_streams_total{{bot="{label}",outcome="done"}}' in text
+    assert f'coze_stream_cancellations_total{{bot="{label}"}}' in text
+    assert f'coze_time_to_first_token_seconds_count{{bot="{label}"}}' in text
+    assert f'coze_streams_in_flight{{bot="{label}"}} 0.0' in text
+    print('  ✅ Coze 流指标')
+
+
+def main():
+    print("=" * 50)
+    print("开始指标测试")
+    print("=" * 50)
+    test_route_and_storage_metrics()
+    test_coze_stream_metrics()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
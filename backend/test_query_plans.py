@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+查询计划回归测试
+开启 storage_sqlite 的查询计划记录，用 SQLite 后端把主要接口跑一遍，
+lounge_chats / coach_chats / users / relationships 上带条件的语句出现全表扫描即失败，
+计划目录写入 SQLITE_QUERY_PLAN_REPORT（默认 临时目录/query_plans.json）
+
+用法：
+    python test_query_plans.py
+"""
+import os
+import secrets
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix='test_query_plans_')
+os.environ.setdefault('SQLITE_DB_PATH', os.path.join(_tmp, 'test.db'))
+# AI 接口指向不可达地址，只检查存储查询
+os.environ.setdefault('COZE_API_URL', 'http://127.0.0.1:9/v3/chat')
+REPORT_PATH = os.getenv('SQLITE_QUERY_PLAN_REPORT') or os.path.join(_tmp, 'query_plans.json')
+
+import storage_sqlite
+import app as app_module
+from testing import use_backend
+
+
+def unique_phone():
+    return '199' + str(secrets.randbelow(10 ** 8)).zfill(8)
+
+
+def drive_routes(client):
+    """按真实使用顺序调用热点接口"""
+    phones = [unique_phone(), unique_phone()]
+    ids = []
+    for phone in phones:
+        client.post('/api/logout')
+        assert client.post('/api/register', json={'phone': phone, 'password': 'pw123456'}).get_json()['success']
+        assert client.post('/api/login', json={'phone': phone, 'password': 'pw123456'}).get_json()['success']
+        ids.append(client.get('/api/user/info').get_json()['user']['id'])
+    binding_code = client.get('/api/binding/code').get_json()['binding_code']
+
+    client.post('/api/login', json={'phone': phones[0], 'password': 'pw123456'})
+    assert client.post('/api/binding/bind', json={'binding_code': binding_code}).get_json()['success']
+    client.post('/api/user/update_nickname', json={'nickname': '小明'})
+    client.get(f'/api/user/{ids[1]}')
+
+    room_id = client.get('/api/lounge/room').get_json()['room_id']
+    for i in range(3):
+        client.post('/api/lounge/send', json={'room_id': room_id, 'content': f'消息{i}'})
+    boot = client.get('/api/lounge/bootstrap?limit=2').get_json()
+    client.get(f"/api/lounge/messages/new?since_id={boot['since_id']}")
+    older = client.get(f"/api/lounge/history?before_id={boot['messages'][0]['id']}").get_json()
+    assert boot['has_more'] and older['messages'] and not older['has_more']
+    client.get('/api/lounge/history')
+    client.post('/api/lounge/call_ai', json={'room_id': room_id})
+    client.post('/api/lounge/call_ai/stream', json={'room_id': room_id}).get_data()
+
+    client.post('/api/coach/chat', json={'message': '你好'})
+    client.post('/api/coach/chat/stream', json={'message': '你好'}).get_data()
+    client.get('/api/coach/history')
+
+    client.post('/api/binding/unbind')
+    client.post('/api/binding/cancel_unbind')
+
+
+def test_hot_queries_use_indexes():
+    catalogue = storage_sqlite.enable_query_plan_capture()
+    try:
+        # 不装缓存等包装：每条语句都真正执行
+        with use_backend(app_module, storage_sqlite, wrap=False) as client:
+            drive_routes(client)
+        report = catalogue.report(REPORT_PATH)
+    finally:
+        storage_sqlite.disable_query_plan_capture()
+
+    print(f"  记录 {len(report['statements'])} 种语句，报告: {REPORT_PATH}")
+    for entry in report['violations']:
+        print(f"  ❌ {entry['sql']}\n     {entry['plan']}")
+    assert report['statements'], '没有记录到任何语句'
+    assert not report['violations'], f"{len(report['violations'])} 条语句在热点表上全表扫描"
+    print('  ✅ 热点查询全部走索引')
+
+
+def main():
+    print("=" * 50)
+    print("开始查询计划回归测试")
+    print("=" * 50)
+    test_hot_queries_use_indexes()
+    print("=" * 50)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
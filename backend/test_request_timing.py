@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求耗时分解测试
+内存后端 + Flask 测试客户端，检查 Server-Timing 响应头、慢请求环形缓冲，以及存储观察者出错不影响请求
+
+用法：
+    python test_request_timing.py
+"""
+import os
+import secrets
+
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+import storage_memory
+import request_timing
+import app as app_module
+from testing import use_backend
+
+
+def server_timing_names(response):
+    return [part.split(';')[0].strip() for part in response.headers.get('Server-Timing', '').split(',') if part]
+
+
+def test_server_timing_header():
+    with use_backend(app_module, storage_memory) as client:
+        phone = '199' + str(secrets.randbelow(10 ** 8)).zfill(8)
+        response = client.post('/api/register', json={'phone': phone, 'password': 'pw'})
+        response.close()
+        names = server_timing_names(response)
+        assert 'db' in names and 'serialize' in names and names[-1] == 'total', names
+
+        client.post('/api/login', json={'phone': phone, 'password': 'pw'}).close()
+        response = client.get('/api/user/info')
+        response.close()
+        names = server_timing_names(response)
+        assert 'auth' in names and 'db' in names, names
+        print('  ✅ Server-Timing 响应头')
+
+
+def test_slow_request_buffer():
+    with use_backend(app_module, storage_memory) as client:
+        request_timing.buffer.clear()
+        original = request_timing.REQUEST_TIMING_SLOW_MS
+        request_timing.REQUEST_TIMING_SLOW_MS = 0
+        try:
+            client.get('/api/user/info').close()
+        finally:
+            request_timing.REQUEST_TIMING_SLOW_MS = original
+
+        data = client.get('/api/debug/timings?path=/api/user').get_json()
+        assert data['success'] and data['timing']['pid'] == os.getpid()
+        entry = data['requests'][0]
+        assert entry['path'] == '/api/user/info' and entry['slow'] and entry['status'] == 401
+        assert entry['spans'] and entry['spans'][0]['name'] in ('db', 'auth')
+        print('  ✅ 慢请求记录')
+
+
+def test_storage_observer_error():
+    def broken(backend, model, method, seconds, error):
+        raise RuntimeError('observer failed')
+
+    request_timing.storage_observers.append(broken)
+    try:
+        with use_backend(app_module, storage_memory) as client:
+            phone = '199' + str(secrets.randbelow(10 ** 8)).zfill(8)
+            assert client.post('/api/register', json={'phone': phone, 'password': 'pw'}).get_json()['success']
+            # 存储调用本身的异常照常抛出，不被观察者的异常替换
+            try:
+                with request_timing._storage_call('memory', 'User', 'get'):
+                    raise KeyError('original')
+            except KeyError as e:
+                assert e.args == ('original',)
+    finally:
+        request_timing.storage_observers.remove(broken)
+    print('  ✅ 存储观察者出错不影响请求')
+
+
+def main():
+    print("=" * 50)
+    print("开始请求耗时分解测试")
+    print("=" * 50)
+    test_server_timing_header()
+    test_slow_request_buffer()
+    test_storage_observer_error()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+JSON 序列化层测试：orjson 与标准库输出同样的 JSON 值、jsonify 走 provider、
+流式数组 / NDJSON 与一次性序列化结果一致、SSE 帧编码
+
+用法：
+    python test_serializer.py
+"""
+import json
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+from flask import Flask, jsonify
+
+import serializer
+import sse
+
+SAMPLE = {
+    'success': True,
+    'text': '你好，"世界"\n ',
+    'numbers': [0, -1, 2 ** 40, 1.5],
+    'none': None,
+    'nested': {'b': [{'x': 1}], 'a': {}},
+    'when': datetime(2024, 5, 1, 12, 30),
+    'amount': Decimal('1.10'),
+    'uid': uuid.UUID(int=1),
+}
+
+
+def backends():
+    return ['json'] + (['orjson'] if serializer.orjson is not None else [])
+
+
+def test_backends_agree():
+    expected = json.loads(serializer.dumps(SAMPLE, backend='json'))
+    for backend in backends():
+        text = serializer.dumps(SAMPLE, sort_keys=True, backend=backend)
+        assert json.loads(text) == expected, backend
+        assert '你好' in text      # 不转义中文
+        assert serializer.dumpb(SAMPLE, backend=backend).decode('utf-8') == serializer.dumps(SAMPLE, backend=backend)
+    # datetime 与 Flask 默认转换一致（HTTP 日期）
+    assert expected['when'] == 'Wed, 01 May 2024 12:30:00 GMT' and expected['amount'] == '1.10'
+    print(f"  ✅ {' / '.join(backends())} 输出一致")
+
+
+def test_jsonify_provider():
+    app = Flask(__name__)
+    serializer.init_app(app)
+    with app.app_context():
+        response = jsonify(SAMPLE)
+        assert response.mimetype == 'application/json'
+        assert response.get_json() == json.loads(serializer.dumps(SAMPLE, backend='json'))
+        assert app.json.loads(app.json.dumps({'a': [1, '二']})) == {'a': [1, '二']}
+        # 键排序与 Flask 默认行为一致
+        assert list(json.loads(app.json.dumps({'b': 1, 'a': 2}))) == ['a', 'b']
+    print('  ✅ jsonify 使用序列化层')
+
+
+def test_streaming_writers():
+    rows = [{'id': i, 'content': f'消息{i}'} for i in range(10)]
+    pages = [rows[:4], [], rows[4:8], rows[8:]]
+    body = b''.join(serializer.json_array(iter(pages), {'success': True}))
+    assert json.loads(body) == {'success': True, 'messages': rows}
+    assert json.loads(b''.join(serializer.json_array(iter([[]]), {'success': True}))) == {'success': True, 'messages': []}
+    lines = b''.join(serializer.ndjson(iter(pages))).splitlines()
+    assert [json.loads(line) for line in lines] == rows
+    print('  ✅ 流式 JSON 数组 / NDJSON')
+
+
+def test_sse_event():
+    frame = sse.event({'type': 'content', 'content': '你好'})
+    assert frame.startswith('data: ') and frame.endswith('\n\n')
+    assert json.loads(frame[len('data: '):]) == {'type': 'content', 'content': '你好'}
+    print('  ✅ SSE 帧编码')
+
+
+def main():
+    print("=" * 50)
+    print(f"开始 JSON 序列化层测试（当前实现: {serializer.BACKEND}）")
+    print("=" * 50)
+    test_backends_agree()
+    test_jsonify_provider()
+    test_streaming_writers()
+    test_sse_event()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SQLite 检查点测试：本地副本写回持久化路径后恢复一致、最新检查点损坏时用上一代恢复、
+本地副本已存在时不覆盖、没有修改时不写回、有修改时按 RPO 写回并更新状态
+
+用法：
+    python test_sqlite_checkpoint.py
+"""
+import os
+import sqlite3
+import tempfile
+import time
+
+import sqlite_checkpoint
+
+
+def workdir():
+    """持久化目录和本地目录"""
+    root = tempfile.mkdtemp(prefix='test_checkpoint_')
+    os.makedirs(os.path.join(root, 'persistent'))
+    return os.path.join(root, 'persistent', 'app.db'), os.path.join(root, 'local', 'app.db')
+
+
+def write(path, *contents):
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS notes (id INTEGER PRIMARY KEY, content TEXT)')
+        conn.executemany('INSERT INTO notes (content) VALUES (?)', [(c,) for c in contents])
+    conn.close()
+
+
+def read(path):
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute('SELECT content FROM notes ORDER BY id')]
+    finally:
+        conn.close()
+
+
+def test_checkpoint_and_restore():
+    persistent, local = workdir()
+    assert sqlite_checkpoint.restore(persistent, local) is None       # 还没有检查点：新建
+    write(local, '第一条')
+    checkpointer = sqlite_checkpoint.Checkpointer(local, persistent, rpo=0)
+    checkpointer.tick()
+    assert read(persistent) == ['第一条'] and not os.path.exists(persistent + '.1')
+
+    write(local, '第二条')
+    checkpointer.tick()
+    assert read(persistent) == ['第一条', '第二条'] and read(persistent + '.1') == ['第一条']
+
+    # 本地副本丢失（tmpfs 清空）：从最新检查点恢复
+    os.remove(local)
+    assert sqlite_checkpoint.restore(persistent, local) == persistent
+    assert read(local) == ['第一条', '第二条']
+
+    # 本地副本已存在：不覆盖
+    write(local, '第三条')
+    assert sqlite_checkpoint.restore(persistent, local) == local
+    assert read(local) == ['第一条', '第二条', '第三条']
+    print('  ✅ 写回持久化路径并轮换上一代，本地副本丢失时从检查点恢复')
+
+
+def test_restore_falls_back():
+    persistent, local = workdir()
+    os.makedirs(os.path.dirname(local))
+    write(local, '第一条')
+    checkpointer = sqlite_checkpoint.Checkpointer(local, persistent, rpo=0)
+    checkpointer.tick()
+    write(local, '第二条')
+    checkpointer.tick()
+    # 最新检查点损坏：用上一代
+    with open(persistent, 'r+b') as f:
+        f.write(b'\x00' * 4096)
+    os.remove(local)
+    assert sqlite_checkpoint.restore(persistent, local) == persistent + '.1'
+    assert read(local) == ['第一条']
+    print('  ✅ 最新检查点损坏时从上一代恢复')
+
+
+def test_dirty_detection():
+    persistent, local = workdir()
+    os.makedirs(os.path.dirname(local))
+    write(local, '第一条')
+    events = []
+    sqlite_checkpoint.observers.append(lambda event, **fields: events.append((event, fields)))
+    try:
+        checkpointer = sqlite_checkpoint.Checkpointer(local, persistent, rpo=3600)
+        checkpointer.tick()          # 启动时有未写回的内容：立即写回一次
+        assert checkpointer._status['checkpoints'] == 1 and checkpointer.dirty_since is None
+        checkpointer.tick()          # 没有修改：不写回
+        assert checkpointer._status['checkpoints'] == 1
+
+        write(local, '第二条')
+        checkpointer.tick()          # 有修改，但距上次写回不到 RPO / 2：只记录滞后
+        assert checkpointer._status['checkpoints'] == 1 and checkpointer.dirty_since is not None
+        assert sqlite_checkpoint.stats() == {'enabled': False}
+
+        checkpointer.tick(force=True)
+        assert checkpointer._status['checkpoints'] == 2 and read(persistent) == ['第一条', '第二条']
+        checkpoints = [fields for event, fields in events if event == 'checkpoint']
+        assert len(checkpoints) == 2 and all(fields['ok'] and fields['bytes'] > 0 for fields in checkpoints)
+        assert [fields['seconds'] for event, fields in events if event == 'lag'][-1] == 0.0
+    finally:
+        sqlite_checkpoint.observers.pop()
+    print('  ✅ 按文件头修改计数器判断是否需要写回，记录耗时和滞后')
+
+
+def test_leader_thread():
+    persistent, local = workdir()
+    os.makedirs(os.path.dirname(local))
+    write(local, '第一条')
+    checkpointer = sqlite_checkpoint.Checkpointer(local, persistent, rpo=3600, poll=0.01).start()
+    while not checkpointer.leader:
+        time.sleep(0.01)
+    write(local, '第二条')
+    checkpointer.stop()              # 退出前写回最后的修改
+    assert read(persistent) == ['第一条', '第二条']
+    print('  ✅ 后台线程负责写回，退出前再写回一次')
+
+
+def main():
+    print("=" * 50)
+    print("开始 SQLite 检查点测试")
+    print("=" * 50)
+    test_checkpoint_and_restore()
+    test_restore_falls_back()
+    test_dirty_detection()
+    test_leader_thread()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
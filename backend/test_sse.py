@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SSE 增量合并测试：首字立即发送、按时间/字节合并、上游停顿时按时发出、类型切换和其他事件前先发出缓冲、流式档位
+
+用法：
+    python test_sse.py
+"""
+import json
+
+import sse
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def parse(frames):
+    return [json.loads(line[6:]) for line in frames.split('\n') if line.startswith('data: ')]
+
+
+def test_coalesce():
+    clock = FakeClock()
+    coalescer = sse.Coalescer(interval_ms=50, max_bytes=1024, clock=clock)
+    # 首字快速通道
+    assert parse(coalescer.add('content', '你')) == [{'type': 'content', 'content': '你'}]
+    clock.now = 0.01
+    assert coalescer.add('content', '好') == ''
+    clock.now = 0.02
+    assert coalescer.add('content', '，') == ''
+    clock.now = 0.06
+    assert parse(coalescer.add('content', '我')) == [{'type': 'content', 'content': '好，我'}]
+    # 间隔本来就超过 50ms 的增量立即发送
+    clock.now = 0.2
+    assert parse(coalescer.add('content', '在')) == [{'type': 'content', 'content': '在'}]
+    clock.now = 0.21
+    assert coalescer.add('content', '。') == ''
+    events = parse(coalescer.event({'type': 'done'}))
+    assert events == [{'type': 'content', 'content': '。'}, {'type': 'done'}]
+    stats = coalescer.stats()
+    assert stats['deltas'] == 6 and stats['frames'] == 5
+    print('  ✅ 首字立即发送、按时间合并')
+
+
+def test_tick_flushes_on_pause():
+    clock = FakeClock()
+    coalescer = sse.Coalescer(interval_ms=50, max_bytes=1024, clock=clock)
+    coalescer.add('content', '你')
+    clock.now = 0.01
+    assert coalescer.add('content', '好') == ''
+    # 上游停顿，期间只有空行 / 心跳：未到时间不发出，到时间就发出缓冲
+    clock.now = 0.03
+    assert coalescer.tick() == ''
+    clock.now = 0.06
+    assert parse(coalescer.tick()) == [{'type': 'content', 'content': '好'}]
+    assert coalescer.tick() == ''
+    print('  ✅ 上游停顿时缓冲按时发出')
+
+
+def test_bytes_and_kind_switch():
+    clock = FakeClock()
+    coalescer = sse.Coalescer(interval_ms=1000, max_bytes=6, clock=clock)
+    coalescer.add('reasoning', '想')
+    assert coalescer.add('reasoning', '一') == ''
+    assert parse(coalescer.add('reasoning', '下')) == [{'type': 'reasoning', 'content': '一下'}]  # 6 字节
+    assert coalescer.add('reasoning', '嗯') == ''
+    # 切换到正文：先发出缓冲的思考内容，正文第一个增量立即发送
+    assert parse(coalescer.add('content', '好')) == [{'type': 'reasoning', 'content': '嗯'},
+                                                     {'type': 'content', 'content': '好'}]
+    assert coalescer.flush() == ''
+    print('  ✅ 按字节合并、类型切换保持顺序')
+
+
+def test_disabled():
+    coalescer = sse.Coalescer(interval_ms=0)
+    deltas = ['一', '二', '三', '四']
+    frames = ''.join(coalescer.add('content', d) for d in deltas)
+    assert [e['content'] for e in parse(frames)] == deltas
+    print('  ✅ SSE_COALESCE_MS=0 时每个增量一帧')
+
+
+def test_profiles():
+    reasoning = ['用户', '提到', '和伴侣吵架。', '需要先共情。']
+    for profile, expected in (('content', []),
+                              ('summary', [{'type': 'reasoning_summary', 'content': '用户提到和伴侣吵架。需要先共情。'}])):
+        coalescer = sse.Coalescer(profile, interval_ms=0)
+        assert ''.join(coalescer.add('reasoning', r) for r in reasoning) == ''
+        events = parse(coalescer.add('content', '好'))
+        assert events == expected + [{'type': 'content', 'content': '好'}], events
+        assert coalescer.stats()['skipped'] == len(reasoning)
+        # 摘要每个流只发送一次
+        assert parse(coalescer.event({'type': 'done'})) == [{'type': 'done'}]
+
+    long_reasoning = '先理解对方的处境。' * 40
+    summary = sse.summarize_reasoning(long_reasoning, limit=50)
+    assert len(summary) <= 50 and summary.endswith('。')
+    assert sse.visible_reasoning('content', long_reasoning) is None
+    assert sse.visible_reasoning('full', long_reasoning) == long_reasoning
+    print('  ✅ 流式档位：只要正文、思考摘要')
+
+
+def main():
+    print("=" * 50)
+    print("开始 SSE 合并测试")
+    print("=" * 50)
+    test_coalesce()
+    test_tick_flushes_on_pause()
+    test_bytes_and_kind_switch()
+    test_disabled()
+    test_profiles()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+存储缓存测试脚本
+验证命中、负缓存、写入失效、跨进程版本号和 LRU 淘汰
+"""
+import os
+import tempfile
+
+_tmp_dir = tempfile.mkdtemp(prefix='test_storage_cache_')
+os.environ.setdefault('SQLITE_DB_PATH', os.path.join(_tmp_dir, 'test.db'))
+
+import storage_sqlite
+from storage_sqlite import User, Relationship, batch
+from storage_cache import StorageCache, VersionStore, install_cache, uninstall_cache
+
+
+def make_cache(**kwargs):
+    versions = VersionStore(os.path.join(_tmp_dir, 'versions.db'))
+    return StorageCache(versions=versions, **kwargs)
+
+
+def test_hit_and_invalidate_on_save():
+    """测试命中与 save() 后失效"""
+    cache = install_cache(storage_sqlite, cache=make_cache(), enabled=True)
+    try:
+        user = User(phone="13700000001", password="x", nickname="旧昵称")
+        user.save()
+        assert User.get(user.id).nickname == "旧昵称"
+        assert User.get(user.id).nickname == "旧昵称"
+        stats = cache.stats()['models']['User']
+        assert stats['hits'] >= 1
+        print(f"✅ 命中: {stats}")
+
+        # 修改返回的对象不影响缓存
+        User.get(user.id).nickname = "被篡改"
+        assert User.get(user.id).nickname == "旧昵称"
+
+        user.nickname = "新昵称"
+        user.save()
+        assert User.get(user.id).nickname == "新昵称"
+        print("✅ save() 后读到新值")
+    finally:
+        uninstall_cache(storage_sqlite)
+
+
+def test_negative_cache_and_batch():
+    """测试负缓存和批量写入后失效"""
+    cache = install_cache(storage_sqlite, cache=make_cache(), enabled=True)
+    try:
+        u1 = User(phone="13700000002", password="x")
+        u2 = User(phone="13700000003", password="x")
+        u1.save()
+        u2.save()
+        query = lambda: Relationship.query('room_id').or_eq(user1_id=u1.id, user2_id=u1.id).first()
+        assert query() is None
+        assert query() is None
+        assert cache.stats()['models']['Relationship']['negative_hits'] == 1
+        print("✅ 负缓存命中")
+
+        with batch() as unit:
+            unit.save(Relationship(user1_id=u1.id, user2_id=u2.id, room_id=f"room_{u1.id}_{u2.id}"))
+        assert query().room_id == f"room_{u1.id}_{u2.id}"
+        print("✅ 批量写入后负缓存失效")
+    finally:
+        uninstall_cache(storage_sqlite)
+
+
+def test_cross_process_version():
+    """测试版本号跨进程可见（两个 VersionStore 共用同一文件，模拟两个 worker）"""
+    path = os.path.join(_tmp_dir, 'shared_versions.db')
+    worker_a = StorageCache(versions=VersionStore(path))
+    worker_b = StorageCache(versions=VersionStore(path))
+    loads = []
+    loader = lambda: loads.append(1) or ['row']
+    worker_a.fetch(User, ('get', 1), loader)
+    worker_a.fetch(User, ('get', 1), loader)
+    assert len(loads) == 1
+    worker_b.invalidate(User.TABLE)
+    worker_a.fetch(User, ('get', 1), loader)
+    assert len(loads) == 2
+    assert worker_a.stats()['models']['User']['stale'] == 1
+    print("✅ 另一进程写入后本进程缓存失效")
+
+
+def test_lru_eviction():
+    """测试 LRU 淘汰"""
+    cache = StorageCache(max_entries=2, versions=VersionStore())
+    for i in range(3):
+        cache.fetch(User, ('get', i), lambda: ['row'])
+    cache.fetch(User, ('get', 0), lambda: ['row'])
+    stats = cache.stats()
+    assert stats['size'] == 2
+    assert stats['models']['User']['evictions'] == 2
+    print(f"✅ LRU 淘汰: {stats}")
+
+
+def main():
+    print("=" * 50)
+    print("开始测试存储缓存")
+    print("=" * 50)
+    test_hit_and_invalidate_on_save()
+    test_negative_cache_and_batch()
+    test_cross_process_version()
+    test_lru_eviction()
+    print("\n" + "=" * 50)
+    print("✅ 所有测试通过！")
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
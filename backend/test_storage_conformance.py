@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+存储后端一致性测试
+同一套用例跑在每个后端上（memory、sqlite，设置 STORAGE_CONFORMANCE_SUPABASE=1 时也跑 supabase），
+保证切换 STORAGE_BACKEND 不改变应用行为
+
+用法：
+    python test_storage_conformance.py [memory sqlite supabase]
+"""
+import os
+import secrets
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+os.environ.setdefault('SQLITE_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='test_conformance_'), 'test.db'))
+
+from storage import load_backend
+
+
+def unique_phone():
+    return '199' + str(secrets.randbelow(10 ** 8)).zfill(8)
+
+
+def check_user(s):
+    """用户：增、查、改、部分列查询、手机号唯一"""
+    user = s.User(phone=unique_phone(), password='pw', nickname='小明')
+    user.generate_binding_code()
+    user.save()
+    assert user.id
+    assert s.User.get(user.id).nickname == '小明'
+    assert [u.id for u in s.User.filter(phone=user.phone)] == [user.id]
+    assert [u.id for u in s.User.filter(binding_code=user.binding_code)] == [user.id]
+    assert s.User.get(-1) is None
+
+    user.nickname = '小红'
+    user.coach_greeting_shown = True
+    user.save()
+    found = s.User.get(user.id)
+    assert found.nickname == '小红' and found.coach_greeting_shown is True
+
+    partial = s.User.query('id', 'nickname').eq('id', user.id).first()
+    assert partial.nickname == '小红' and partial.phone is None
+
+    try:
+        s.User(phone=user.phone, password='pw').save()
+    except Exception:
+        pass
+    else:
+        raise AssertionError('重复手机号应当写入失败')
+    print('  ✅ 用户')
+    return user
+
+
+def check_relationship(s):
+    """关系：OR 条件、布尔字段"""
+    u1 = s.User(phone=unique_phone(), password='pw')
+    u2 = s.User(phone=unique_phone(), password='pw')
+    u1.save()
+    u2.save()
+    room_id = f"room_{u1.id}_{u2.id}"
+    rel = s.Relationship(user1_id=u1.id, user2_id=u2.id, room_id=room_id)
+    rel.save()
+
+    for uid in (u1.id, u2.id):
+        found = s.Relationship.query().or_eq(user1_id=uid, user2_id=uid).eq('is_active', True).first()
+        assert found.id == rel.id and found.room_id == room_id
+
+    rel.is_active = False
+    rel.save()
+    assert s.Relationship.query().or_eq(user1_id=u1.id, user2_id=u1.id).eq('is_active', True).first() is None
+    assert s.Relationship.get(rel.id).is_active is False
+    print('  ✅ 关系')
+    return u1, u2, room_id
+
+
+def check_lounge_queries(s, u1, u2, room_id):
+    """客厅消息：比较、集合、NULL、排序、分页"""
+    base = datetime(2026, 1, 1, 12, 0, 0)
+    messages = []
+    for i in range(6):
+        is_ai = i == 5
+        msg = s.LoungeChat(room_id=room_id, content=f'消息{i}', role='assistant' if is_ai else 'user',
+                           user_id=None if is_ai else (u1.id if i % 2 == 0 else u2.id),
+                           created_at=base + timedelta(seconds=i))
+        msg.save()
+        messages.append(msg)
+    ids = [m.id for m in messages]
+
+    assert [m.content for m in s.LoungeChat.filter(room_id=room_id)] == [f'消息{i}' for i in range(6)]
+
+    newer = s.LoungeChat.query('id', 'content').eq('room_id', room_id).gt('id', ids[2]).order('created_at').all()
+    assert [m.id for m in newer] == ids[3:]
+
+    latest = s.LoungeChat.query().eq('room_id', room_id).order('created_at', desc=True).limit(2).all()
+    assert [m.id for m in latest] == [ids[5], ids[4]]
+
+    in_range = s.LoungeChat.query('id').eq('room_id', room_id).gte('id', ids[1]).lte('id', ids[3]).order('id').all()
+    assert [m.id for m in in_range] == ids[1:4]
+
+    picked = s.LoungeChat.query('id').in_('id', [ids[0], ids[4]]).order('id').all()
+    assert [m.id for m in picked] == [ids[0], ids[4]]
+    assert s.LoungeChat.query().in_('id', []).all() == []
+
+    ai = s.LoungeChat.query('id', 'role').eq('room_id', room_id).eq('user_id', None).all()
+    assert [m.id for m in ai] == [ids[5]]
+    users_only = s.LoungeChat.query('id').eq('room_id', room_id).neq('role', 'assistant').lt('id', ids[5]).all()
+    assert sorted(m.id for m in users_only) == ids[:5]
+
+    unsent = s.LoungeChat.query('id').eq('room_id', room_id).eq('role', 'user').eq('sent_to_ai', False).all()
+    assert sorted(m.id for m in unsent) == ids[:5]
+    print('  ✅ 查询构造器')
+    return ids
+
+
+def check_batch(s, room_id, ids):
+    """批量写入：提交、批量更新、失败回滚"""
+    with s.batch() as unit:
+        unit.update(s.LoungeChat, ids[:3], sent_to_ai=True)
+        greeting = unit.save(s.LoungeChat(room_id=room_id, content='欢迎', role='assistant'))
+    assert greeting.id
+    unsent = s.LoungeChat.query('id').eq('room_id', room_id).eq('role', 'user').eq('sent_to_ai', False).all()
+    assert sorted(m.id for m in unsent) == ids[3:5]
+
+    existing = s.User(phone=unique_phone(), password='pw')
+    existing.save()
+    fresh = s.User(phone=unique_phone(), password='pw')
+    try:
+        with s.batch() as unit:
+            unit.save(fresh)
+            unit.save(s.User(phone=existing.phone, password='pw'))
+    except Exception:
+        pass
+    else:
+        raise AssertionError('批量写入中的重复手机号应当失败')
+    assert fresh.id is None
+    assert s.User.filter(phone=fresh.phone) == []
+    print('  ✅ 批量写入')
+
+
+def check_coach(s, user):
+    """教练对话：按时间排序、最近 N 条"""
+    base = datetime(2026, 1, 1, 8, 0, 0)
+    for i in range(4):
+        s.CoachChat(user_id=user.id, role='user' if i % 2 == 0 else 'assistant',
+                    content=f'对话{i}', created_at=base + timedelta(minutes=i)).save()
+    assert [c.content for c in s.CoachChat.filter(user_id=user.id)] == ['对话0', '对话1', '对话2', '对话3']
+    recent = s.CoachChat.query('role', 'content', 'created_at').eq('user_id', user.id) \
+        .order('created_at', desc=True).limit(2).all()
+    assert [c.content for c in recent] == ['对话3', '对话2']
+    print('  ✅ 教练对话')
+
+
+def run_conformance(name):
+    print(f"\n=== 后端: {name} ===")
+    s = load_backend(name)
+    if hasattr(s, 'reset'):
+        s.reset()
+    user = check_user(s)
+    u1, u2, room_id = check_relationship(s)
+    ids = check_lounge_queries(s, u1, u2, room_id)
+    check_batch(s, room_id, ids)
+    check_coach(s, user)
+
+
+def test_memory():
+    run_conformance('memory')
+
+
+def test_sqlite():
+    run_conformance('sqlite')
+
+
+def test_supabase():
+    # 会写入真实数据库，需要显式开启
+    if os.getenv('STORAGE_CONFORMANCE_SUPABASE') != '1':
+        print("\n=== 后端: supabase（跳过，设置 STORAGE_CONFORMANCE_SUPABASE=1 开启）===")
+        return
+    run_conformance('supabase')
+
+
+def main():
+    names = sys.argv[1:] or ['memory', 'sqlite', 'supabase']
+    print("=" * 50)
+    print("开始存储后端一致性测试")
+    print("=" * 50)
+    for name in names:
+        if name == 'supabase':
+            test_supabase()
+        else:
+            run_conformance(name)
+    print("\n" + "=" * 50)
+    print("✅ 所有后端通过一致性测试！")
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
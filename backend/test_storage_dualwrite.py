@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+双写 / 影子读测试：主库写入（save、批量更新、导入）按原 id 复制到副库、副库缺行时补齐、
+影子读排在之前的写入之后执行且结果一致、副库数据不一致时记录样本、副库写入失败不影响主库
+
+用法：
+    python test_storage_dualwrite.py
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+
+os.environ.setdefault('SQLITE_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='test_dualwrite_'), 'test.db'))
+
+import storage_dualwrite
+from storage import load_backend
+
+memory = load_backend('memory')
+sqlite = load_backend('sqlite')
+
+
+@contextmanager
+def dualwrite(shadow_read_rate=1.0):
+    """memory 为主库、空的 SQLite 文件为副库"""
+    memory.reset()
+    saved = sqlite.DB_PATH
+    sqlite.DB_PATH = os.path.join(tempfile.mkdtemp(prefix='test_dualwrite_'), 'secondary.db')
+    sqlite.init_db()
+    writer = storage_dualwrite.DualWriter(sqlite, shadow_read_rate=shadow_read_rate, flush_ms=5)
+    storage_dualwrite.install(memory, sqlite, writer)
+    try:
+        yield writer
+    finally:
+        writer.flush(5)
+        storage_dualwrite.uninstall(memory)
+        sqlite.DB_PATH = saved
+
+
+def test_writes_replicated():
+    with dualwrite(shadow_read_rate=0) as writer:
+        u1 = memory.User(phone='19900000001', password='pw', nickname='小明')
+        u2 = memory.User(phone='19900000002', password='pw')
+        u1.save()
+        u2.save()
+        with memory.batch() as unit:
+            unit.save(memory.Relationship(user1_id=u1.id, user2_id=u2.id, room_id='room-1'))
+            for i in range(3):
+                unit.save(memory.LoungeChat(room_id='room-1', user_id=u1.id, role='user', content=f'客厅{i}'))
+        ids = [c.id for c in memory.LoungeChat.filter(room_id='room-1')]
+        with memory.batch() as unit:
+            unit.update(memory.LoungeChat, ids[:2], sent_to_ai=True)
+        u1.nickname = '小红'
+        u1.save()
+        assert writer.flush(5)
+
+        assert sqlite.User.get(u1.id).nickname == '小红' and sqlite.User.get(u2.id).phone == '19900000002'
+        chats = sqlite.LoungeChat.filter(room_id='room-1')
+        assert [c.id for c in chats] == ids and [c.sent_to_ai for c in chats] == [True, True, False]
+        stats = writer.stats()
+        assert stats['writes_failed'] == 0 and stats['writes_applied'] == stats['writes_queued'] == 8
+        assert stats['batches'] < stats['writes_applied']       # 攒批提交
+        assert 'Batch.commit' in stats['latency']['secondary'] and 'User.save' in stats['latency']['primary']
+    print('  ✅ 写入按原 id 异步攒批复制到副库')
+
+
+def test_shadow_reads():
+    with dualwrite() as writer:
+        user = memory.User(phone='19900000003', password='pw')
+        user.save()
+        for i in range(3):
+            memory.CoachChat(user_id=user.id, role='user', content=f'教练{i}').save()
+        # 紧接着读：影子读排在复制之后，结果一致
+        memory.User.get(user.id)
+        memory.CoachChat.filter(user_id=user.id)
+        memory.CoachChat.query('id', 'content').eq('user_id', user.id).order('created_at', desc=True).limit(2).all()
+        memory.Relationship.query('room_id').or_eq(user1_id=user.id, user2_id=user.id).first()
+        assert writer.flush(5)
+        stats = writer.stats()
+        assert stats['reads_shadowed'] == 4 and stats['reads_matched'] == 4, stats
+        assert stats['latency']['secondary']['CoachChat.query']['count'] == 1
+
+        # 副库被改动：记录不一致的样本
+        with sqlite.batch() as unit:
+            unit.update(sqlite.CoachChat, [1], content='被改过')
+        memory.CoachChat.get(1)
+        assert writer.flush(5)
+        stats = writer.stats()
+        assert stats['reads_mismatched'] == 1 and '被改过' in stats['mismatches'][0]['secondary']
+    print('  ✅ 影子读：结果比较和两边延迟')
+
+
+def test_secondary_failure_isolated():
+    with dualwrite(shadow_read_rate=0) as writer:
+        # 副库里已有同手机号的另一个用户：复制这一行会违反唯一约束
+        sqlite.User(phone='19900000009', password='pw').save()
+        taken = memory.User(phone='19900000009', password='pw')
+        other = memory.User(phone='19900000010', password='pw')
+        with memory.batch() as unit:
+            unit.save(memory.User(phone='19900000008', password='pw'))
+        with memory.batch() as unit:
+            unit.save(taken)
+            unit.save(other)
+        assert writer.flush(5)
+        assert memory.User.get(taken.id).phone == '19900000009'      # 主库不受影响
+        assert sqlite.User.get(other.id) is not None                 # 整批失败后逐条重试
+        assert writer.stats()['writes_failed'] == 1
+    print('  ✅ 副库写入失败只计数，不影响主库和同批其他写入')
+
+
+def main():
+    print("=" * 50)
+    print("开始双写 / 影子读测试")
+    print("=" * 50)
+    test_writes_replicated()
+    test_shadow_reads()
+    test_secondary_failure_isolated()
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+测试共用的辅助函数
+
+应用模块导入时按 STORAGE_BACKEND 绑定模型；多个测试文件在同一进程里运行（pytest）时，
+先导入 app 的测试决定了它的后端，其他测试用 use_backend() 临时换成需要的后端，结束后恢复
+
+用法：
+    with use_backend(app_module, storage_memory) as client:
+        client.post('/api/register', json={...})
+"""
+from contextlib import contextmanager
+
+import coach_context
+
+MODEL_NAMES = ('User', 'Relationship', 'CoachChat', 'LoungeChat', 'batch')
+
+
+@contextmanager
+def use_backend(app_module, backend, wrap=True):
+    """
+    应用临时改用 backend 的模型，产出测试客户端；结束后恢复原来的模型和教练上下文缓冲
+    wrap=True 时先用 app.install_storage() 装上与生产相同的包装（双写、缓存、教练上下文写穿、计时），
+    包装装上后留在后端模块上（与应用进程内的状态一致，重复调用无效）；
+    wrap=False 时直接使用后端模型（查询计划检查用：缓存命中会让语句不执行，漏掉需要检查的查询）
+    """
+    turns = coach_context.recent_turns
+    saved = {name: getattr(app_module, name) for name in MODEL_NAMES}
+    saved_turns = (turns.model, turns.batch)
+    if wrap:
+        app_module.install_storage(backend)
+    for name in MODEL_NAMES:
+        setattr(app_module, name, getattr(backend, name))
+    # 环形缓冲按用户 id 缓存，不同后端的 id 会重叠
+    turns.model, turns.batch = backend.CoachChat, getattr(backend, 'batch', None)
+    turns.clear()
+    try:
+        yield app_module.app.test_client()
+    finally:
+        for name, value in saved.items():
+            setattr(app_module, name, value)
+        turns.model, turns.batch = saved_turns
+        turns.clear()
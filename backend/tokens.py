@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+token 数估算（不依赖具体分词器，用于 Coze 上下文预算）
+
+中日韩文字和全角标点按每字 1 个 token 计，其余字符（英文、数字、半角标点、空白）按每 4 个字符 1 个 token 计。
+对中文略微高估，预算宁紧勿松。聊天记录保存时把估算值写入 token_count 列，每条消息只算一次；
+迁移前的旧记录为空，第一次用到时补上并批量写回（missing_token_counts / write_token_counts）。
+"""
+import math
+import re
+
+# CJK 标点、假名、扩展 A、统一表意文字、谚文、全角字符
+_CJK = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    cjk = len(text) - len(_CJK.sub('', text))
+    return cjk + math.ceil((len(text) - cjk) / CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text, budget):
+    """保留开头不超过 budget 个 token 的部分"""
+    if estimate_tokens(text) <= budget:
+        return text
+    cost = 0.0
+    for i, ch in enumerate(text):
+        cost += 1 if _CJK.match(ch) else 1 / CHARS_PER_TOKEN
+        if cost > budget:
+            return text[:i]
+    return text
+
+
+def missing_token_counts(rows):
+    """旧记录（token_count 为空）补上估算值，返回 {token 数: [id, ...]}，用于批量写回存储"""
+    groups = {}
+    for row in rows:
+        if row.token_count is None:
+            row.token_count = estimate_tokens(row.content)
+            if row.id is not None:
+                groups.setdefault(row.token_count, []).append(row.id)
+    return groups
+
+
+def write_token_counts(unit, model, groups):
+    """把 missing_token_counts 的结果登记到批量写入（token 数相同的记录合并成一次更新）"""
+    for count, ids in groups.items():
+        unit.update(model, ids, token_count=count)